@@ -0,0 +1,46 @@
+from .harness import (
+    Timer,
+    CudaEventTimer,
+    PerfCounterTimer,
+    BenchResult,
+    get_timer,
+    get_backend,
+    get_device,
+    get_device_name,
+    get_device_capability,
+    synchronize,
+    do_bench,
+    format_out,
+    get_func_name,
+    run_benchmark,
+)
+from .check import (
+    CheckResult,
+    check_close,
+    get_tolerance,
+    sum_tolerance,
+)
+from .results import (
+    ResultsStore,
+    get_store,
+    make_record,
+    record_result,
+)
+from .roofline import (
+    Cost,
+    gemm_cost,
+    get_cost_func,
+    get_peak,
+    get_roofline_info,
+)
+from .build import (
+    ArtifactMissingError,
+    load,
+)
+from .registry import (
+    REGISTRY,
+    LazyLib,
+    lazy_load,
+    find_binding,
+    parse_defines,
+)
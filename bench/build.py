@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import shutil
+import fcntl
+import hashlib
+import importlib.util
+import subprocess
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+# Persistent, content-addressed JIT build cache on top of
+# torch.utils.cpp_extension.load. The cache key is a hash of the source
+# contents, compile flags, toolchain version and target arch, so that an
+# unchanged kernel is never rebuilt, and a shared cache dir can be used by
+# several users and CI runners at the same time.
+#
+# <cache_dir>/
+#   <key>/<name>.so       built artifact, present only when complete
+#   <key>/meta.json       what was built and how
+#   <key>/.last_used      mtime used for LRU eviction
+#   <key>.lock            per-key build lock
+#   .evict.lock           global eviction lock
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "cuda-learn-notes", "build")
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3 # 10 GB
+DEFAULT_LOCK_TIMEOUT = 3600 # seconds, a cold hgemm build takes minutes
+
+
+class ArtifactMissingError(RuntimeError):
+    pass
+
+
+class LockTimeoutError(TimeoutError):
+    pass
+
+
+def get_cache_dir() -> str:
+    return os.environ.get("BENCH_BUILD_CACHE", DEFAULT_CACHE_DIR)
+
+
+def get_cache_size() -> int:
+    return int(os.environ.get("BENCH_BUILD_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+
+
+def find_nvcc() -> Optional[str]:
+    from torch.utils.cpp_extension import CUDA_HOME
+    if CUDA_HOME is not None:
+        nvcc = os.path.join(CUDA_HOME, "bin", "nvcc")
+        if os.path.exists(nvcc):
+            return nvcc
+    return shutil.which("nvcc")
+
+
+@lru_cache(maxsize=None)
+def get_toolchain_version() -> str:
+    # nvcc release if available, otherwise the CUDA version torch was built
+    # with (they normally match), so that machines without nvcc can still
+    # compute the key and hit the artifacts built elsewhere.
+    import torch
+    cuda_version = torch.version.cuda
+    nvcc = find_nvcc()
+    if nvcc is not None:
+        try:
+            output = subprocess.check_output(
+                [nvcc, "--version"], timeout=30).decode()
+            for token in output.replace(",", " ").split():
+                if token.startswith("V") and token[1:2].isdigit():
+                    cuda_version = ".".join(token[1:].split(".")[:2])
+        except (subprocess.SubprocessError, OSError):
+            pass
+    return (f"torch-{torch.__version__}-cuda-{cuda_version}-"
+            f"py{sys.version_info.major}{sys.version_info.minor}")
+
+
+def get_target_arch() -> str:
+    # same priority as torch: TORCH_CUDA_ARCH_LIST, else the current device.
+    import torch
+    arch_list = os.environ.get("TORCH_CUDA_ARCH_LIST")
+    if arch_list:
+        return arch_list
+    if torch.cuda.is_available():
+        major, minor = torch.cuda.get_device_capability(torch.cuda.current_device())
+        return f"{major}.{minor}"
+    return "all"
+
+
+def make_build_key(name: str, sources: List[str],
+                   extra_cflags: List[str], extra_cuda_cflags: List[str],
+                   extra_ldflags: List[str], toolchain: str, arch: str) -> str:
+    h = hashlib.sha256()
+    h.update(f"name={name}\0".encode())
+    for source in sources:
+        h.update(f"source={os.path.basename(source)}\0".encode())
+        with open(source, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    for tag, flags in (("cflags", extra_cflags), ("cuda_cflags", extra_cuda_cflags),
+                       ("ldflags", extra_ldflags)):
+        h.update(f"{tag}={json.dumps(list(flags))}\0".encode())
+    h.update(f"toolchain={toolchain}\0arch={arch}\0".encode())
+    return h.hexdigest()
+
+
+@contextmanager
+def file_lock(path: str, timeout: float = DEFAULT_LOCK_TIMEOUT):
+    # advisory flock, polled so that we never block forever on a dead peer.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+") as f:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise LockTimeoutError(f"timeout waiting for lock {path}")
+                time.sleep(0.5)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def import_extension(name: str, path: str):
+    import torch # make sure libtorch symbols are loaded first
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def _touch(entry_dir: str):
+    stamp = os.path.join(entry_dir, ".last_used")
+    with open(stamp, "a"):
+        pass
+    os.utime(stamp, None)
+
+
+def list_entries(cache_dir: Optional[str] = None) -> List[Dict]:
+    cache_dir = cache_dir or get_cache_dir()
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        if key.startswith(".") or not os.path.isdir(entry_dir):
+            continue
+        stamp = os.path.join(entry_dir, ".last_used")
+        last_used = os.path.getmtime(stamp) if os.path.exists(stamp) else 0.0
+        entries.append({"key": key, "dir": entry_dir, "last_used": last_used,
+                        "size": _dir_size(entry_dir)})
+    return entries
+
+
+def evict(cache_dir: Optional[str] = None, max_size: Optional[int] = None,
+          keep: Optional[str] = None) -> List[str]:
+    # drop least recently used entries until the cache fits in max_size.
+    cache_dir = cache_dir or get_cache_dir()
+    max_size = get_cache_size() if max_size is None else max_size
+    evicted = []
+    with file_lock(os.path.join(cache_dir, ".evict.lock")):
+        entries = sorted(list_entries(cache_dir), key=lambda e: e["last_used"])
+        total = sum(e["size"] for e in entries)
+        for entry in entries:
+            if total <= max_size:
+                break
+            if entry["key"] == keep:
+                continue
+            # never evict an entry while someone is building it
+            try:
+                with file_lock(entry["dir"] + ".lock", timeout=0):
+                    shutil.rmtree(entry["dir"], ignore_errors=True)
+            except LockTimeoutError:
+                continue
+            total -= entry["size"]
+            evicted.append(entry["key"])
+    return evicted
+
+
+def load(name: str, sources: List[str],
+         extra_cflags: Optional[List[str]] = None,
+         extra_cuda_cflags: Optional[List[str]] = None,
+         extra_ldflags: Optional[List[str]] = None,
+         verbose: bool = False,
+         cache_dir: Optional[str] = None,
+         lock_timeout: float = DEFAULT_LOCK_TIMEOUT):
+    # drop-in replacement of torch.utils.cpp_extension.load
+    extra_cflags = list(extra_cflags or [])
+    extra_cuda_cflags = list(extra_cuda_cflags or [])
+    extra_ldflags = list(extra_ldflags or [])
+    sources = [os.path.abspath(s) for s in sources]
+    cache_dir = cache_dir or get_cache_dir()
+
+    key = make_build_key(name, sources, extra_cflags, extra_cuda_cflags,
+                         extra_ldflags, get_toolchain_version(), get_target_arch())
+    entry_dir = os.path.join(cache_dir, key)
+    artifact = os.path.join(entry_dir, f"{name}.so")
+
+    if os.path.exists(artifact):
+        _touch(entry_dir)
+        if verbose: print(f"[bench.build] cache hit {name}: {artifact}")
+        return import_extension(name, artifact)
+
+    if find_nvcc() is None:
+        raise ArtifactMissingError(
+            f"artifact missing for {name} (key={key[:16]}) in {cache_dir}, "
+            f"and no nvcc found to build it. Build it on a machine with the "
+            f"CUDA toolkit and share BENCH_BUILD_CACHE, or install nvcc.")
+
+    module = None
+    with file_lock(entry_dir + ".lock", timeout=lock_timeout):
+        # somebody else may have finished the build while we were waiting
+        if not os.path.exists(artifact):
+            from torch.utils.cpp_extension import load as torch_load
+            build_dir = os.path.join(cache_dir, f".tmp-{key[:16]}-{os.getpid()}")
+            shutil.rmtree(build_dir, ignore_errors=True)
+            os.makedirs(build_dir)
+            try:
+                if verbose: print(f"[bench.build] cache miss {name}, building in {build_dir}")
+                module = torch_load(name=name, sources=sources, extra_cflags=extra_cflags,
+                                    extra_cuda_cflags=extra_cuda_cflags,
+                                    extra_ldflags=extra_ldflags,
+                                    build_directory=build_dir,
+                                    verbose=verbose)
+                os.makedirs(entry_dir, exist_ok=True)
+                with open(os.path.join(entry_dir, "meta.json"), "w") as f:
+                    json.dump({"name": name, "sources": sources,
+                               "extra_cflags": extra_cflags,
+                               "extra_cuda_cflags": extra_cuda_cflags,
+                               "extra_ldflags": extra_ldflags,
+                               "toolchain": get_toolchain_version(),
+                               "arch": get_target_arch(),
+                               "created": time.time()}, f, indent=2)
+                # rename is atomic, readers never see a partial artifact
+                os.replace(os.path.join(build_dir, f"{name}.so"), artifact)
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+        _touch(entry_dir)
+
+    evict(cache_dir, keep=key)
+    if module is None:
+        module = import_extension(name, artifact)
+    return module
@@ -0,0 +1,129 @@
+import math
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+# Correctness check of a kernel output against a reference (torch op, naive
+# implementation, cuBLAS ...). Run once per variant, outside the timed region
+# (see harness.run_benchmark). An element mismatches if
+#   |out - ref| > atol + rtol * |ref|   (or is nan/inf where ref is not)
+# and errors are also reported in ULPs of the output dtype, which says more
+# than a max-abs for the f16/bf16 kernels.
+
+# dtype name -> (atol, rtol), used when the caller does not pass tolerances
+TOLERANCES = {
+    "float64":       (1e-8, 1e-7),
+    "float32":       (1e-5, 1e-4),
+    "float16":       (1e-3, 1e-2),
+    "bfloat16":      (1e-2, 5e-2),
+    "float8_e4m3fn": (1.25e-1, 2.5e-1),
+    "float8_e5m2":   (2.5e-1, 5e-1),
+}
+
+
+def _dtype_name(dtype) -> str:
+    return str(dtype).replace("torch.", "")
+
+
+def get_tolerance(dtype) -> Tuple[float, float]:
+    # integer (and bool) outputs are compared exactly
+    return TOLERANCES.get(_dtype_name(dtype), (0.0, 0.0))
+
+
+def get_eps(dtype) -> float:
+    import torch
+    if dtype.is_floating_point:
+        return torch.finfo(dtype).eps
+    return 0.0
+
+
+def sum_tolerance(n: int, dtype, rtol: Optional[float] = None) -> Tuple[float, float]:
+    # for outputs that are sums of n O(1) terms accumulated in `dtype` (dot,
+    # reduce, gemm K loop): a tree of rounded partial sums, error grows about
+    # eps * sqrt(n) * log2(n), times 4 as the max over many outputs.
+    eps = get_eps(dtype)
+    atol = 4.0 * eps * math.sqrt(n) * max(math.log2(n), 1.0)
+    return atol, (get_tolerance(dtype)[1] if rtol is None else rtol)
+
+
+def ulp(x: Any, dtype) -> Any:
+    # spacing of the `dtype` numbers around x (float64 tensor), subnormals
+    # included, 1 for the integer dtypes.
+    import torch
+    if not dtype.is_floating_point:
+        return torch.ones_like(x)
+    finfo = torch.finfo(dtype)
+    _, exponent = torch.frexp(x.abs().clamp_min(finfo.tiny))
+    return torch.ldexp(torch.full_like(x, finfo.eps),
+                       exponent - 1).clamp_min(finfo.tiny * finfo.eps)
+
+
+@dataclass
+class CheckResult:
+    ok: bool
+    max_abs: float
+    max_rel: float
+    max_ulp: float
+    mean_ulp: float
+    num_mismatch: int
+    numel: int
+    atol: float
+    rtol: float
+    error: str = "" # set when shapes mismatch etc.
+
+    def summary(self) -> str:
+        if self.error:
+            return f"WRONG({self.error})"
+        if self.ok:
+            return f"ok(ulp:{self.max_ulp:.0f})"
+        return (f"WRONG(mismatch:{self.num_mismatch}/{self.numel}, "
+                f"max_abs:{self.max_abs:.3g}, max_rel:{self.max_rel:.3g}, "
+                f"max_ulp:{self.max_ulp:.0f})")
+
+
+def check_close(out: Any, ref: Any, atol: Optional[float] = None,
+                rtol: Optional[float] = None,
+                chunk_size: int = 1 << 24) -> CheckResult:
+    # out: kernel output, ref: reference, may be computed in a higher
+    # precision. Compared in float64 on out's device, chunk by chunk so
+    # that a 16384x16384 hgemm output does not need GBs of temporaries.
+    import torch
+    default_atol, default_rtol = get_tolerance(out.dtype)
+    atol = default_atol if atol is None else atol
+    rtol = default_rtol if rtol is None else rtol
+    inf = float("inf")
+    numel = out.numel()
+    if numel != ref.numel():
+        return CheckResult(False, inf, inf, inf, inf, numel, numel, atol, rtol,
+                           error=f"shape {tuple(out.shape)} vs {tuple(ref.shape)}")
+    out_flat = out.detach().reshape(-1)
+    ref_flat = ref.detach().reshape(-1)
+    max_abs = max_rel = max_ulp = sum_ulp = 0.0
+    num_mismatch = 0
+    for i in range(0, numel, chunk_size):
+        o = out_flat[i:i + chunk_size].to(torch.float64)
+        r = ref_flat[i:i + chunk_size].to(device=o.device, dtype=torch.float64)
+        diff = (o - r).abs()
+        same = (o == r) | (torch.isnan(o) & torch.isnan(r))
+        diff = torch.where(same, torch.zeros_like(diff), diff)
+        diff = torch.where(torch.isnan(diff), torch.full_like(diff, inf), diff)
+        # a nan/inf ref has to be matched exactly, its bound would be nan/inf
+        close = same | (torch.isfinite(r) & (diff <= atol + rtol * r.abs()))
+        num_mismatch += int((~close).sum().item())
+        rel = diff / r.abs().clamp_min(torch.finfo(torch.float64).tiny)
+        rel = torch.where(diff == 0, torch.zeros_like(rel), rel)
+        ulps = diff / ulp(r, out.dtype)
+        max_abs = max(max_abs, diff.max().item())
+        max_rel = max(max_rel, rel.max().item())
+        max_ulp = max(max_ulp, ulps.max().item())
+        sum_ulp += ulps.sum().item()
+    return CheckResult(
+        ok=num_mismatch == 0,
+        max_abs=max_abs,
+        max_rel=max_rel,
+        max_ulp=max_ulp,
+        mean_ulp=sum_ulp / numel if numel else 0.0,
+        num_mismatch=num_mismatch,
+        numel=numel,
+        atol=atol,
+        rtol=rtol,
+    )
@@ -0,0 +1,220 @@
+import sys
+import math
+import random
+import argparse
+import statistics
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .harness import percentile
+from .results import ResultsStore, get_results_path
+
+# Offline performance regression detector over the results store. Compares
+# the per iteration samples of a new run against a base run (or the pooled
+# samples of the last N runs, a rolling baseline) for every
+# (script, tag, shape, dtype, device) and flags the statistically
+# significant slowdowns, with either a one-sided Mann-Whitney U test or a
+# bootstrap CI of the median ratio. No GPU needed, only stored records.
+#
+#   python3 -m bench.compare --new <run_id> --base <run_id>
+#   python3 -m bench.compare --rolling 5          # latest run vs last 5 runs
+#
+# exit code 1 if any regression is found, 0 otherwise.
+
+KEY_FIELDS = ("script", "tag", "shape", "dtype", "device_name")
+METHODS = ("mannwhitney", "bootstrap")
+
+
+def mann_whitney_u(x: Sequence[float], y: Sequence[float]) -> Tuple[float, float]:
+    # one-sided test of "x is stochastically greater than y", e.g x = new
+    # times, y = base times. Normal approximation with tie and continuity
+    # correction, good enough from ~8 samples per side. returns (U_x, p).
+    n1, n2 = len(x), len(y)
+    if n1 == 0 or n2 == 0:
+        return float("nan"), 1.0
+    values = sorted([(v, 0) for v in x] + [(v, 1) for v in y])
+    n = n1 + n2
+    ranks = [0.0] * n
+    tie_term = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1.0 # average rank, 1 based
+        t = j - i + 1
+        tie_term += t ** 3 - t
+        i = j + 1
+    r1 = sum(r for r, (_, g) in zip(ranks, values) if g == 0)
+    u1 = r1 - n1 * (n1 + 1) / 2.0
+    mu = n1 * n2 / 2.0
+    var = n1 * n2 / 12.0 * ((n + 1) - tie_term / (n * (n - 1)))
+    if var <= 0:
+        return u1, 1.0 # all samples equal
+    z = (u1 - mu - 0.5) / math.sqrt(var)
+    return u1, 0.5 * math.erfc(z / math.sqrt(2.0))
+
+
+def bootstrap_ratio_ci(base: Sequence[float], new: Sequence[float],
+                       alpha: float = 0.05, iters: int = 2000,
+                       seed: int = 0) -> Tuple[float, float]:
+    # percentile bootstrap CI of median(new) / median(base)
+    rng = random.Random(seed)
+    ratios = []
+    for _ in range(iters):
+        b = statistics.median(rng.choices(base, k=len(base)))
+        n = statistics.median(rng.choices(new, k=len(new)))
+        ratios.append(n / b if b > 0 else float("inf"))
+    ratios.sort()
+    return percentile(ratios, 100 * alpha / 2), percentile(ratios, 100 * (1 - alpha / 2))
+
+
+@dataclass
+class Comparison:
+    key: Tuple[str, ...] # KEY_FIELDS values
+    base_median: float # ms
+    new_median: float # ms
+    change: float # new / base - 1, > 0 is slower
+    p_value: float
+    ci_low: float # of new / base
+    ci_high: float
+    regressed: bool
+    improved: bool
+
+    @property
+    def tag(self) -> str:
+        return self.key[KEY_FIELDS.index("tag")]
+
+    @property
+    def shape(self) -> str:
+        return self.key[KEY_FIELDS.index("shape")]
+
+
+def compare_samples(key: Tuple[str, ...], base: Sequence[float], new: Sequence[float],
+                    method: str = "mannwhitney", alpha: float = 0.05,
+                    threshold: float = 0.05, seed: int = 0) -> Comparison:
+    # a regression must be both significant and larger than `threshold`
+    # (relative), so that tiny but consistent shifts are not reported.
+    if method not in METHODS:
+        raise ValueError(f"unknown method: {method}, available: {list(METHODS)}")
+    base_median, new_median = statistics.median(base), statistics.median(new)
+    change = new_median / base_median - 1.0 if base_median > 0 else float("inf")
+    _, p_slower = mann_whitney_u(new, base)
+    _, p_faster = mann_whitney_u(base, new)
+    ci_low, ci_high = bootstrap_ratio_ci(base, new, alpha=alpha, seed=seed)
+    if method == "mannwhitney":
+        regressed = p_slower < alpha and change > threshold
+        improved = p_faster < alpha and change < -threshold
+    else:
+        regressed = ci_low > 1.0 + threshold
+        improved = ci_high < 1.0 - threshold
+    return Comparison(key, base_median, new_median, change,
+                      p_slower, ci_low, ci_high, regressed, improved)
+
+
+def _key(record: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(str(record.get(f, "")) for f in KEY_FIELDS)
+
+
+def _samples(record: Dict[str, Any]) -> List[float]:
+    # older or hand written records may only have the median
+    return list(record.get("samples_ms") or [record["median_ms"]])
+
+
+def get_run_ids(records: Sequence[Dict[str, Any]]) -> List[str]:
+    # run ids ordered by their first record timestamp, oldest first
+    first_seen: Dict[str, float] = {}
+    for r in records:
+        first_seen[r["run_id"]] = min(first_seen.get(r["run_id"], math.inf), r["timestamp"])
+    return sorted(first_seen, key=first_seen.get)
+
+
+def group_samples(records: Sequence[Dict[str, Any]],
+                  run_ids: Sequence[str]) -> Dict[Tuple[str, ...], List[float]]:
+    run_ids = set(run_ids)
+    groups: Dict[Tuple[str, ...], List[float]] = {}
+    for r in records:
+        if r["run_id"] in run_ids and r.get("check_ok") is not False:
+            groups.setdefault(_key(r), []).extend(_samples(r))
+    return groups
+
+
+def compare_runs(records: Sequence[Dict[str, Any]], new_run: str,
+                 base_runs: Sequence[str], method: str = "mannwhitney",
+                 alpha: float = 0.05, threshold: float = 0.05,
+                 seed: int = 0) -> List[Comparison]:
+    # compares every key present in both the new run and the base runs,
+    # most regressed first. wrong (failed check) records are ignored.
+    new = group_samples(records, [new_run])
+    base = group_samples(records, base_runs)
+    comparisons = [compare_samples(key, base[key], samples, method=method,
+                                   alpha=alpha, threshold=threshold, seed=seed)
+                   for key, samples in new.items() if key in base]
+    return sorted(comparisons, key=lambda c: c.change, reverse=True)
+
+
+def select_runs(records: Sequence[Dict[str, Any]], new_run: Optional[str] = None,
+                base_run: Optional[str] = None,
+                rolling: int = 1) -> Tuple[str, List[str]]:
+    # new run: given or the latest one, base runs: given, else the `rolling`
+    # runs right before the new one.
+    run_ids = get_run_ids(records)
+    if not run_ids:
+        raise ValueError("no results to compare")
+    new_run = new_run or run_ids[-1]
+    if new_run not in run_ids:
+        raise ValueError(f"unknown run: {new_run}")
+    if base_run is not None:
+        if base_run not in run_ids:
+            raise ValueError(f"unknown run: {base_run}")
+        return new_run, [base_run]
+    before = run_ids[:run_ids.index(new_run)]
+    if not before:
+        raise ValueError(f"no run before {new_run} to compare with")
+    return new_run, before[-rolling:]
+
+
+def format_report(comparisons: Sequence[Comparison], method: str) -> str:
+    lines = ["-" * 130]
+    regressions = [c for c in comparisons if c.regressed]
+    improvements = [c for c in comparisons if c.improved]
+    lines.append(f"{len(comparisons)} compared, {len(regressions)} regressed, "
+                 f"{len(improvements)} improved, method: {method}")
+    lines.append("-" * 130)
+    for title, items in (("REGRESSED", regressions), ("IMPROVED", improvements)):
+        for c in items:
+            lines.append(f"{title:>9} {c.tag:>42} {c.shape:>18}: "
+                         f"{c.base_median:.6f}ms -> {c.new_median:.6f}ms "
+                         f"({c.change:+.2%}), p:{c.p_value:.2g}, "
+                         f"ci:[{c.ci_low:.3f}, {c.ci_high:.3f}]")
+    lines.append("-" * 130)
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="bench regression detector")
+    parser.add_argument("--path", type=str, default=None, help="results.jsonl path")
+    parser.add_argument("--new", type=str, default=None, help="New run id, default the latest")
+    parser.add_argument("--base", type=str, default=None, help="Base run id")
+    parser.add_argument("--rolling", type=int, default=1, help="Base on the last N runs before --new")
+    parser.add_argument("--method", type=str, default="mannwhitney", choices=METHODS)
+    parser.add_argument("--alpha", type=float, default=0.05, help="Significance level")
+    parser.add_argument("--threshold", type=float, default=0.05, help="Min relative slowdown")
+    parser.add_argument("--script", type=str, default=None, help="Only this script, e.g hgemm.py")
+    parser.add_argument("--seed", type=int, default=0, help="Bootstrap seed")
+    args = parser.parse_args(argv)
+
+    store = ResultsStore(args.path or get_results_path())
+    filters = {"script": args.script} if args.script else {}
+    records = store.load(**filters)
+    new_run, base_runs = select_runs(records, args.new, args.base, args.rolling)
+    print(f"new run: {new_run}, base runs: {', '.join(base_runs)}")
+    comparisons = compare_runs(records, new_run, base_runs, method=args.method,
+                               alpha=args.alpha, threshold=args.threshold, seed=args.seed)
+    print(format_report(comparisons, args.method))
+    return 1 if any(c.regressed for c in comparisons) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
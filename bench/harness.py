@@ -0,0 +1,288 @@
+import os
+import math
+import time
+import statistics
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from .check import CheckResult, check_close
+from .results import record_result
+from .roofline import (Cost, get_cost_func, get_roofline_info,
+                       format_roofline_info)
+
+
+# ------------------------------- timers -----------------------------------------
+# A timer runs `fn` for `iters` iterations and returns one sample (ms) per
+# iteration, so that we can look at the distribution instead of one mean.
+class Timer:
+    name = "base"
+
+    def time(self, fn: Callable[[], Any], iters: int) -> List[float]:
+        raise NotImplementedError
+
+
+class CudaEventTimer(Timer):
+    # device side timestamps, the python launch overhead is not counted
+    # as long as the GPU queue is kept busy.
+    name = "cuda_event"
+
+    def time(self, fn: Callable[[], Any], iters: int) -> List[float]:
+        import torch
+        starts = [torch.cuda.Event(enable_timing=True) for _ in range(iters)]
+        ends = [torch.cuda.Event(enable_timing=True) for _ in range(iters)]
+        torch.cuda.synchronize()
+        for i in range(iters):
+            starts[i].record()
+            fn()
+            ends[i].record()
+        torch.cuda.synchronize()
+        return [s.elapsed_time(e) for s, e in zip(starts, ends)]
+
+
+class PerfCounterTimer(Timer):
+    # host side wall clock, used for the CPU backend. pass `synchronize`
+    # (e.g torch.cuda.synchronize) if fn launches asynchronous work.
+    name = "perf_counter"
+
+    def __init__(self, synchronize: Optional[Callable[[], Any]] = None):
+        self.synchronize = synchronize
+
+    def time(self, fn: Callable[[], Any], iters: int) -> List[float]:
+        samples = []
+        for _ in range(iters):
+            start = time.perf_counter_ns()
+            fn()
+            if self.synchronize is not None:
+                self.synchronize()
+            end = time.perf_counter_ns()
+            samples.append((end - start) * 1e-6) # ns -> ms
+        return samples
+
+
+TIMERS = {
+    CudaEventTimer.name: CudaEventTimer,
+    PerfCounterTimer.name: PerfCounterTimer,
+}
+
+
+def cuda_is_available() -> bool:
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+# ------------------------------- backends ---------------------------------------
+# "cuda" runs the compiled kernels, "cpu" runs the pure PyTorch references
+# of bench/reference.py under the same binding names, so that the scripts
+# can be checked (and the references timed) on a machine without GPU.
+BACKENDS = ("cuda", "cpu")
+
+
+def get_backend() -> str:
+    # BENCH_BACKEND env > cuda if a GPU is present
+    backend = os.environ.get("BENCH_BACKEND")
+    if backend is None:
+        backend = "cuda" if cuda_is_available() else "cpu"
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend: {backend}, available: {list(BACKENDS)}")
+    return backend
+
+
+def get_device():
+    import torch
+    return torch.device(get_backend())
+
+
+def synchronize():
+    # torch.cuda.synchronize, a no-op for the CPU backend
+    if get_backend() == "cuda":
+        import torch
+        torch.cuda.synchronize()
+
+
+def get_device_name() -> str:
+    if get_backend() == "cpu":
+        import platform
+        return (platform.processor() or platform.machine()).upper()
+    import torch
+    return torch.cuda.get_device_name(torch.cuda.current_device())
+
+
+def get_device_capability() -> Tuple[int, int]:
+    if get_backend() == "cpu":
+        return (0, 0)
+    import torch
+    return torch.cuda.get_device_capability(torch.cuda.current_device())
+
+
+def get_timer(name: Optional[str] = None) -> Timer:
+    # explicit name > BENCH_TIMER env > cuda events for the cuda backend
+    name = name or os.environ.get("BENCH_TIMER")
+    if name is None:
+        name = "cuda_event" if get_backend() == "cuda" else "perf_counter"
+    if name not in TIMERS:
+        raise ValueError(f"unknown timer: {name}, available: {list(TIMERS)}")
+    return TIMERS[name]()
+
+
+# ------------------------------- statistics -------------------------------------
+def percentile(sorted_samples: Sequence[float], q: float) -> float:
+    # linear interpolation between closest ranks, q in [0, 100]
+    if not sorted_samples:
+        return float("nan")
+    pos = (len(sorted_samples) - 1) * q / 100.0
+    lo = math.floor(pos)
+    hi = math.ceil(pos)
+    return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (pos - lo)
+
+
+def reject_outliers(samples: Sequence[float], k: float = 1.5) -> List[float]:
+    # Tukey fences: keep samples inside [q1 - k*iqr, q3 + k*iqr]
+    s = sorted(samples)
+    q1, q3 = percentile(s, 25), percentile(s, 75)
+    iqr = q3 - q1
+    lo, hi = q1 - k * iqr, q3 + k * iqr
+    return [v for v in s if lo <= v <= hi]
+
+
+@dataclass
+class BenchResult:
+    tag: str
+    timer: str
+    samples: List[float] = field(repr=False) # ms, one per iteration
+    median: float
+    p10: float
+    p90: float
+    stddev: float
+    mean: float
+    trimmed_mean: float # outlier-rejected mean
+    num_outliers: int
+    check: Optional[CheckResult] = None # None if no reference was given
+    roofline: Optional[Dict[str, Any]] = None # None if the cost is unknown
+
+    @classmethod
+    def from_samples(cls, tag: str, samples: Sequence[float],
+                     timer: str = "") -> "BenchResult":
+        if not samples:
+            raise ValueError(f"{tag}: no timing samples")
+        s = sorted(samples)
+        kept = reject_outliers(s)
+        return cls(
+            tag=tag,
+            timer=timer,
+            samples=list(samples),
+            median=statistics.median(s),
+            p10=percentile(s, 10),
+            p90=percentile(s, 90),
+            stddev=statistics.stdev(s) if len(s) > 1 else 0.0,
+            mean=statistics.fmean(s),
+            trimmed_mean=statistics.fmean(kept),
+            num_outliers=len(s) - len(kept),
+        )
+
+    @property
+    def valid(self) -> bool:
+        # a wrong variant must never be ranked as the best one
+        return self.check is None or self.check.ok
+
+    def summary(self) -> str:
+        info = (f"time:{self.median:.8f}ms, p10:{self.p10:.8f}ms, "
+                f"p90:{self.p90:.8f}ms, std:{self.stddev:.8f}ms")
+        if self.roofline is not None:
+            info += f", {format_roofline_info(self.roofline)}"
+        if self.check is not None:
+            info += f", {self.check.summary()}"
+        return info
+
+
+# ------------------------------- runners ----------------------------------------
+def do_bench(fn: Callable[[], Any], tag: str = "",
+             warmup: int = 10, iters: int = 100,
+             timer: Optional[Timer] = None) -> BenchResult:
+    timer = timer or get_timer()
+    for _ in range(warmup):
+        fn()
+    samples = timer.time(fn, iters)
+    return BenchResult.from_samples(tag, samples, timer.name)
+
+
+def get_func_name(func: Callable) -> str:
+    # lib bindings, torch ops and functools.partial of them
+    while hasattr(func, "func"):
+        func = func.func
+    return getattr(func, "__name__", type(func).__name__)
+
+
+def format_out(out: Any, num: int = 3) -> str:
+    # default pretty print: scalar value or the first `num` values.
+    if out.numel() == 1:
+        out_val = out.item()
+        if isinstance(out_val, int):
+            return f"{out_val:<15}"
+        return f"{out_val:<15.8f}"
+    out_val = out.flatten()[:num].detach().cpu().float().numpy().tolist()
+    out_val = [round(v, 8) for v in out_val]
+    out_val = [f"{v:<12}" for v in out_val]
+    return f"{out_val}"
+
+
+def run_benchmark(perf_func: Callable, inputs: Sequence[Any],
+                  tag: str, out: Optional[Any] = None,
+                  args: Sequence[Any] = (),
+                  warmup: int = 10, iters: int = 1000,
+                  show_all: bool = False,
+                  timer: Optional[Timer] = None,
+                  width: int = 24,
+                  format_func: Callable[[Any], str] = format_out,
+                  ref: Optional[Any] = None,
+                  atol: Optional[float] = None,
+                  rtol: Optional[float] = None,
+                  record: bool = True,
+                  meta: Optional[Dict[str, Any]] = None,
+                  cost: Optional[Any] = None,
+                  ) -> Tuple[Any, BenchResult]:
+    # calling convention shared by all the kernel bindings:
+    #   perf_func(*inputs, out, *args) if out is given, else
+    #   out = perf_func(*inputs, *args)
+    # ref: expected output, or a callable returning it, checked once against
+    # the output of the timed run (see check.check_close).
+    # record: append the result to the results store, meta: extra record
+    # fields (e.g shape, tflops), see results.make_record.
+    # cost: bytes/FLOPs of the run, a roofline.Cost, a cost function of the
+    # inputs or a binding/family name. The binding's own cost is used if
+    # perf_func is a known binding, `cost` is for the torch baselines.
+    if out is not None:
+        out.fill_(0)
+        fn = lambda: perf_func(*inputs, out, *args)
+    else:
+        fn = lambda: perf_func(*inputs, *args)
+    result = do_bench(fn, tag, warmup=warmup, iters=iters, timer=timer)
+    if out is None:
+        out = fn() # keep the output out of the timed region
+    if ref is not None:
+        ref = ref() if callable(ref) else ref
+        result.check = check_close(out, ref, atol=atol, rtol=rtol)
+    cost_func = get_cost_func(get_func_name(perf_func))
+    if cost_func is None and isinstance(cost, str):
+        cost_func = get_cost_func(cost)
+    elif cost_func is None and callable(cost):
+        cost_func = cost
+    cost = cost_func(*inputs) if cost_func is not None else cost
+    if isinstance(cost, Cost):
+        dtype = inputs[0].dtype if hasattr(inputs[0], "dtype") else ""
+        result.roofline = get_roofline_info(cost, result.median, get_device_name(),
+                                            str(dtype).replace("torch.", ""))
+    if record:
+        tensors = [t for t in inputs if hasattr(t, "shape")]
+        fields = {"kernel": get_func_name(perf_func),
+                  "shape": [tuple(t.shape) for t in tensors],
+                  "dtype": tensors[0].dtype if tensors else ""}
+        fields.update(result.roofline or {})
+        fields.update(meta or {})
+        record_result(result, **fields)
+    out_info = f"out_{tag}"
+    print(f"{out_info:>{width}}: {format_func(out)}, {result.summary()}")
+    if show_all: print(out)
+    return out, result
@@ -0,0 +1,949 @@
+import math
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+# Pure PyTorch CPU references of the kernel bindings, with the same names,
+# signatures and output conventions as the lib.* functions, so that a script
+# runs unchanged with BENCH_BACKEND=cpu (see registry.LazyLib). Each reference
+# computes what the binding is meant to compute, in the dtypes the kernel
+# computes and accumulates in, stage by stage (e.g f16 products, f16 sum
+# within a warp, f32 across warps). The summation order inside a stage is
+# not reproduced, so compare against CUDA with a tolerance, not bitwise.
+
+WARP_SIZE = 32
+
+# binding name -> CPU reference
+REFERENCES: Dict[str, Callable] = {}
+
+
+def register(name: str, func: Callable) -> Callable:
+    func.__name__ = name
+    func.__qualname__ = name
+    REFERENCES[name] = func
+    return func
+
+
+def get_reference(name: str) -> Callable:
+    if name not in REFERENCES:
+        raise KeyError(f"no CPU reference for binding {name}")
+    return REFERENCES[name]
+
+
+def _dtype(name: str) -> Optional[torch.dtype]:
+    # fp8 dtypes only exist since torch 2.1
+    return getattr(torch, name, None)
+
+
+F32 = torch.float32
+F16 = torch.float16
+BF16 = torch.bfloat16
+I32 = torch.int32
+I8 = torch.int8
+FP8_E4M3 = _dtype("float8_e4m3fn")
+FP8_E5M2 = _dtype("float8_e5m2")
+
+
+# ------------------------------- helpers ----------------------------------------
+def _check_dtype(t: torch.Tensor, dtype: torch.dtype):
+    # same as CHECK_TORCH_TENSOR_DTYPE, pybind11 maps runtime_error to RuntimeError
+    if t.dtype != dtype:
+        raise RuntimeError(f"values must be {dtype}")
+
+
+def _check_shape(t: torch.Tensor, *sizes: int):
+    if tuple(t.shape[:len(sizes)]) != sizes:
+        raise RuntimeError("Tensor size mismatch!")
+
+
+def _store(out: torch.Tensor, value: torch.Tensor):
+    out.copy_(value.reshape(out.shape))
+
+
+def _const(value: float, dtype: torch.dtype) -> torch.Tensor:
+    # a 0-dim tensor keeps the constant in the kernel dtype, e.g __float2half(c),
+    # while a python scalar would be applied in f32 by the CPU half ops.
+    return torch.tensor(value, dtype=dtype)
+
+
+def _pad_last(v: torch.Tensor, size: int) -> torch.Tensor:
+    if v.shape[-1] >= size:
+        return v
+    pad = v.new_zeros(*v.shape[:-1], size - v.shape[-1])
+    return torch.cat([v, pad], dim=-1)
+
+
+def _next_pow2(n: int) -> int:
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def _warp_reduce_sum(v: torch.Tensor) -> torch.Tensor:
+    # __shfl_xor_sync butterfly over the last dim (power of 2), in v.dtype.
+    # lane i adds lane i^mask, we keep lane 0's value.
+    width = v.shape[-1]
+    while width > 1:
+        width //= 2
+        v = v[..., :width] + v[..., width:2 * width]
+    return v[..., 0]
+
+
+def _block_reduce_sum(x: torch.Tensor, pack: int = 1,
+                      pack_acc: torch.dtype = F32,
+                      warp_acc: torch.dtype = F32,
+                      block_acc: torch.dtype = F32) -> torch.Tensor:
+    # x: [..., NUM_THREADS * pack] -> [...], the block all reduce used by the
+    # kernels: each thread sums its pack, then warp_reduce_sum<WARP_SIZE>
+    # and warp_reduce_sum<NUM_WARPS> over the warp leaders.
+    *lead, n = x.shape
+    threads = n // pack
+    v = x.reshape(*lead, threads, pack).to(pack_acc)
+    s = v[..., 0]
+    for i in range(1, pack):
+        s = s + v[..., i]
+    num_warps = (threads + WARP_SIZE - 1) // WARP_SIZE
+    s = _pad_last(s.to(warp_acc), num_warps * WARP_SIZE)
+    s = _warp_reduce_sum(s.reshape(*lead, num_warps, WARP_SIZE))
+    s = _pad_last(s.to(block_acc), _next_pow2(num_warps))
+    return _warp_reduce_sum(s)
+
+
+def _matmul_f16_acc(a: torch.Tensor, b: torch.Tensor, k_tile: int = 16) -> torch.Tensor:
+    # f16 x f16 with an f16 accumulator (mma.m16n8k16.f16.f16.f16.f16, wmma
+    # accumulator<half>, CUBLAS_COMPUTE_16F): each k tile is summed exactly
+    # then rounded into the f16 accumulator. The CUDA Cores kernels do one k
+    # per __hfma, we keep the 16 wide tiles for all of them to stay usable on
+    # large shapes, the accumulator dtype is the same.
+    K = a.shape[-1]
+    acc = torch.zeros(*a.shape[:-1], b.shape[-1], dtype=F16)
+    for k in range(0, K, k_tile):
+        tile = a[..., k:k + k_tile].float() @ b[..., k:k + k_tile, :].float()
+        acc = (acc.float() + tile).half()
+    return acc
+
+
+def _round_tf32(x: torch.Tensor) -> torch.Tensor:
+    # wmma::__float_to_tf32 / cublas tf32 math: keep 10 mantissa bits,
+    # round to nearest with ties away from zero.
+    bits = x.contiguous().view(torch.int32)
+    bits = (bits + 0x1000) & ~0x1FFF
+    return bits.view(torch.float32)
+
+
+# ------------------------------- elementwise ------------------------------------
+# elementwise_add_*, relu_*, gelu_*, swish_*, sigmoid_*: f32 kernels compute in
+# f32, f16 kernels in half with half constants. The packed variants only
+# change the memory access, so they share one reference per dtype.
+PACKED_ELEM_TYPES = {
+    "f32": F32, "f32x4": F32,
+    "f16": F16, "f16x2": F16, "f16x8": F16, "f16x8_pack": F16,
+}
+
+MAX_EXP_F32 = 88.3762626647949
+MIN_EXP_F32 = -88.3762626647949
+MAX_EXP_F16 = 11.089866488461016
+MIN_EXP_F16 = -9.704060527839234
+
+
+def _clamp_exp(x: torch.Tensor) -> torch.Tensor:
+    if x.dtype == F16:
+        return torch.minimum(torch.maximum(x, _const(MIN_EXP_F16, F16)),
+                             _const(MAX_EXP_F16, F16))
+    return x.clamp(MIN_EXP_F32, MAX_EXP_F32)
+
+
+def _relu(x: torch.Tensor) -> torch.Tensor:
+    return torch.maximum(x, torch.zeros((), dtype=x.dtype))
+
+
+def _gelu(x: torch.Tensor) -> torch.Tensor:
+    # tanh approximate, the f16 one builds tanh from hexp as in gelu.cu
+    x = _clamp_exp(x)
+    if x.dtype == F16:
+        one, two, half_ = _const(1.0, F16), _const(2.0, F16), _const(0.5, F16)
+        sqrt_2_pi = _const(math.sqrt(2.0), F16) * _const(2.0 / math.sqrt(math.pi), F16) * half_
+        inner = sqrt_2_pi * (x + _const(0.044715, F16) * (x * x * x))
+        e = torch.exp(inner * two)
+        return half_ * x * (one + (e - one) / (e + one))
+    sqrt_2_pi = math.sqrt(2.0) * (2.0 / math.sqrt(math.pi)) * 0.5
+    return 0.5 * x * (1.0 + torch.tanh(sqrt_2_pi * (x + 0.044715 * x * x * x)))
+
+
+def _swish(x: torch.Tensor) -> torch.Tensor:
+    if x.dtype == F16:
+        one = _const(1.0, F16)
+        return x * (one / (one + torch.exp(-x)))
+    return x / (1.0 + torch.exp(-x))
+
+
+def _sigmoid(x: torch.Tensor) -> torch.Tensor:
+    x = _clamp_exp(x)
+    one = _const(1.0, x.dtype)
+    return one / (one + torch.exp(-x))
+
+
+def _make_unary(name: str, dtype: torch.dtype, op: Callable):
+    def unary(x: torch.Tensor, y: torch.Tensor):
+        _check_dtype(x, dtype)
+        _check_dtype(y, dtype)
+        _store(y, op(x))
+    return register(name, unary)
+
+
+def _make_elementwise_add(name: str, dtype: torch.dtype):
+    def elementwise_add(a: torch.Tensor, b: torch.Tensor, c: torch.Tensor):
+        _check_dtype(a, dtype)
+        _check_dtype(b, dtype)
+        _check_dtype(c, dtype)
+        _store(c, a + b)
+    return register(name, elementwise_add)
+
+
+for _packed_type, _dt in PACKED_ELEM_TYPES.items():
+    _make_elementwise_add(f"elementwise_add_{_packed_type}", _dt)
+    _make_unary(f"relu_{_packed_type}", _dt, _relu)
+    _make_unary(f"gelu_{_packed_type}", _dt, _gelu)
+    _make_unary(f"swish_{_packed_type}", _dt, _swish)
+    _make_unary(f"sigmoid_{_packed_type}", _dt, _sigmoid)
+
+
+# ------------------------------- embedding --------------------------------------
+def _make_embedding(name: str, dtype: torch.dtype):
+    def embedding(a: torch.Tensor, weight: torch.Tensor, o: torch.Tensor):
+        _check_dtype(a, I32)
+        _check_dtype(weight, dtype)
+        _check_dtype(o, dtype)
+        _store(o, weight.index_select(0, a.long()))
+    return register(name, embedding)
+
+
+for _packed_type, _dt in (("f32", F32), ("f32x4", F32), ("f32x4_pack", F32),
+                          ("f16", F16), ("f16x8", F16), ("f16x8_pack", F16)):
+    _make_embedding(f"embedding_{_packed_type}", _dt)
+
+
+# ------------------------------- reduce -----------------------------------------
+# (packed_type, acc_type) -> (th_type, n_elements, pack_acc, warp_acc, block_acc)
+# as in the TORCH_BINDING_REDUCE table of block_all_reduce.cu. The per block
+# sums are always atomicAdd-ed into an f32 (i32 for i8) output.
+BLOCK_ALL_REDUCE_SUM = {
+    ("f32", "f32"):              (F32,      1,  F32,  F32,  F32),
+    ("f32x4", "f32"):            (F32,      4,  F32,  F32,  F32),
+    ("f16", "f16"):              (F16,      1,  F16,  F16,  F32),
+    ("f16", "f32"):              (F16,      1,  F16,  F32,  F32),
+    ("f16x2", "f16"):            (F16,      2,  F16,  F16,  F32),
+    ("f16x2", "f32"):            (F16,      2,  F16,  F32,  F32),
+    ("f16x8_pack", "f16"):       (F16,      8,  F16,  F16,  F32),
+    ("f16x8_pack", "f32"):       (F16,      8,  F32,  F32,  F32),
+    ("bf16", "bf16"):            (BF16,     1,  BF16, BF16, BF16),
+    ("bf16", "f32"):             (BF16,     1,  BF16, F32,  F32),
+    ("bf16x2", "bf16"):          (BF16,     2,  BF16, BF16, BF16),
+    ("bf16x2", "f32"):           (BF16,     2,  BF16, F32,  F32),
+    ("bf16x8_pack", "bf16"):     (BF16,     8,  BF16, BF16, BF16),
+    ("bf16x8_pack", "f32"):      (BF16,     8,  BF16, F32,  F32),
+    ("fp8_e4m3", "f16"):         (FP8_E4M3, 1,  F16,  F16,  F16),
+    ("fp8_e4m3x16_pack", "f16"): (FP8_E4M3, 16, F16,  F16,  F16),
+    ("fp8_e5m2", "f16"):         (FP8_E5M2, 1,  F16,  F16,  F16),
+    ("fp8_e5m2x16_pack", "f16"): (FP8_E5M2, 16, F16,  F16,  F16),
+    ("i8", "i32"):               (I8,       1,  I32,  I32,  I32),
+    ("i8x16_pack", "i32"):       (I8,       16, I32,  I32,  I32),
+}
+
+SUPPORTED_NUM_THREADS = (32, 64, 128, 256, 512, 1024)
+
+
+def _block_size(x: torch.Tensor, n_elements: int, max_threads: int) -> int:
+    # elements per thread block, following the 1D/2D dispatch of the bindings
+    if x.dim() == 2 and x.size(1) // n_elements <= 1024:
+        if x.size(1) // n_elements not in SUPPORTED_NUM_THREADS:
+            raise RuntimeError(
+                "only support (K)/(n_elements): 32/64/128/256/512/1024")
+        return x.size(1)
+    return max_threads * n_elements
+
+
+def _blocks(x: torch.Tensor, block_size: int) -> torch.Tensor:
+    # [num_blocks, block_size], zero filled tail like the idx < N guards
+    x = x.flatten()
+    num_blocks = (x.numel() + block_size - 1) // block_size
+    return _pad_last(x, num_blocks * block_size).reshape(num_blocks, block_size)
+
+
+def _make_block_all_reduce_sum(name: str, th_type, n_elements: int,
+                               pack_acc, warp_acc, block_acc):
+    out_type = I32 if th_type == I8 else F32
+
+    def block_all_reduce_sum(x: torch.Tensor) -> torch.Tensor:
+        _check_dtype(x, th_type)
+        block_size = _block_size(x, n_elements, 1024 // n_elements)
+        if x.dtype in (FP8_E4M3, FP8_E5M2):
+            x = x.to(F16) # __nv_cvt_fp8_to_halfraw is exact
+        sums = _block_reduce_sum(_blocks(x, block_size), n_elements,
+                                 pack_acc, warp_acc, block_acc)
+        return sums.to(out_type).sum(dtype=out_type).reshape(1)
+    return register(name, block_all_reduce_sum)
+
+
+for (_packed_type, _acc_type), _cfg in BLOCK_ALL_REDUCE_SUM.items():
+    if _cfg[0] is not None: # no fp8 in this torch
+        _make_block_all_reduce_sum(
+            f"block_all_reduce_sum_{_packed_type}_{_acc_type}", *_cfg)
+
+
+# ------------------------------- dot product ------------------------------------
+# packed_type -> (th_type, n_elements, pack_acc), f16 products are __hmul-ed
+# in half, the warps and blocks always reduce in f32.
+DOT_PROD = {
+    "f32":        (F32, 1, F32),
+    "f32x4":      (F32, 4, F32),
+    "f16":        (F16, 1, F16),
+    "f16x2":      (F16, 2, F16),
+    "f16x8_pack": (F16, 8, F16),
+}
+
+
+def _make_dot_prod(name: str, th_type, n_elements: int, pack_acc):
+    def dot_prod(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+        _check_dtype(a, th_type)
+        _check_dtype(b, th_type)
+        block_size = _block_size(a, n_elements, 256)
+        sums = _block_reduce_sum(_blocks(a * b, block_size), n_elements, pack_acc)
+        return sums.sum(dtype=F32).reshape(1)
+    return register(name, dot_prod)
+
+
+for _packed_type, _cfg in DOT_PROD.items():
+    _make_dot_prod(f"dot_prod_{_packed_type}_f32", *_cfg)
+
+
+# ------------------------------- gemv -------------------------------------------
+def _gemv(a: torch.Tensor, x: torch.Tensor, n_elements: int) -> torch.Tensor:
+    # one warp per row: each lane accumulates a*x over the k it owns, in the
+    # input dtype, then warp_reduce_sum over the lanes (16 lanes for K=16).
+    M, K = a.shape
+    prod = a * x.reshape(1, K)
+    if K == 16:
+        return _warp_reduce_sum(prod)
+    lanes = prod.reshape(M, -1, WARP_SIZE, n_elements)
+    lane_sum = lanes[..., 0]
+    for i in range(1, n_elements):
+        lane_sum = lane_sum + lanes[..., i]
+    acc = lane_sum[:, 0]
+    for w in range(1, lane_sum.shape[1]):
+        acc = acc + lane_sum[:, w]
+    return _warp_reduce_sum(acc)
+
+
+def _make_gemv(name: str, dtype: torch.dtype, n_elements: int, k_check: Callable[[int], None]):
+    def gemv(a: torch.Tensor, x: torch.Tensor, y: torch.Tensor):
+        _check_dtype(a, dtype)
+        _check_dtype(x, dtype)
+        _check_dtype(y, dtype)
+        M, K = a.shape
+        _check_shape(x, K, 1)
+        _check_shape(y, M, 1)
+        k_check(K)
+        _store(y, _gemv(a, x, n_elements))
+    return register(name, gemv)
+
+
+def _k_multiple_of(v: int) -> Callable[[int], None]:
+    def check(K: int):
+        if K % v != 0:
+            raise RuntimeError(f"K must be multiple of {v}")
+    return check
+
+
+def _k_equal_to(v: int) -> Callable[[int], None]:
+    def check(K: int):
+        if K != v:
+            raise RuntimeError(f"K must be {v}")
+    return check
+
+
+_make_gemv("sgemv_k32_f32",    F32, 1, _k_multiple_of(32))
+_make_gemv("sgemv_k128_f32x4", F32, 4, _k_multiple_of(128))
+_make_gemv("sgemv_k16_f32",    F32, 1, _k_equal_to(16))
+_make_gemv("hgemv_k32_f16",    F16, 1, _k_multiple_of(32))
+_make_gemv("hgemv_k128_f16x4", F16, 4, _k_multiple_of(128))
+_make_gemv("hgemv_k16_f16",    F16, 1, _k_equal_to(16))
+
+
+# ------------------------------- histogram --------------------------------------
+def _make_histogram(name: str):
+    def histogram(a: torch.Tensor) -> torch.Tensor:
+        _check_dtype(a, I32)
+        M = int(a.max().item())
+        return torch.bincount(a.long(), minlength=M + 1).to(I32)
+    return register(name, histogram)
+
+
+for _packed_type in ("i32", "i32x4"):
+    _make_histogram(f"histogram_{_packed_type}")
+
+
+# ------------------------------- mat transpose ----------------------------------
+def _make_mat_transpose(name: str):
+    def mat_transpose(x: torch.Tensor, y: torch.Tensor):
+        _check_dtype(x, F32)
+        _check_dtype(y, F32)
+        y.copy_(x.t())
+    return register(name, mat_transpose)
+
+
+for _tag in ("f32_col2row", "f32_row2col", "f32x4_col2row", "f32x4_row2col",
+             "f32_col2row2d", "f32_row2col2d", "f32x4_col2row2d", "f32x4_row2col2d",
+             "f32_diagonal2d",
+             "f32x4_shared_col2row2d", "f32x4_shared_row2col2d",
+             "f32x4_shared_bcf_col2row2d", "f32x4_shared_bcf_row2col2d"):
+    _make_mat_transpose(f"mat_transpose_{_tag}")
+
+
+# ------------------------------- rope -------------------------------------------
+def _rope(x: torch.Tensor, theta: float = 10000.0) -> torch.Tensor:
+    # x: [seq_len, hidden_size], rotate the (x[2i], x[2i+1]) pairs of token
+    # `pos` by pos * theta^(-2i/hidden_size), in f32.
+    seq_len, hidden_size = x.shape
+    inv_freq = 1.0 / (theta ** (torch.arange(0, hidden_size, 2, dtype=F32) / hidden_size))
+    angle = torch.outer(torch.arange(seq_len, dtype=F32), inv_freq)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    x1, x2 = x[:, 0::2], x[:, 1::2]
+    out = torch.empty_like(x)
+    out[:, 0::2] = x1 * cos - x2 * sin
+    out[:, 1::2] = x1 * sin + x2 * cos
+    return out
+
+
+def _make_rope(name: str):
+    def rope(x: torch.Tensor, out: torch.Tensor):
+        _check_dtype(x, F32)
+        _check_dtype(out, F32)
+        _store(out, _rope(x))
+    return register(name, rope)
+
+
+for _name in ("rope_f32", "rope_f32_v2", "rope_f32x4_pack"):
+    _make_rope(_name)
+
+
+def _make_rope_cached(name: str, n_pack: int):
+    # cos/sin tables: [max_pos, hidden_size/2], token s of sequence b at
+    # position offsets[b] + s
+    def rope_cached(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor,
+                    offsets: torch.Tensor, out: torch.Tensor):
+        for t in (x, cos, sin, out):
+            _check_dtype(t, F32)
+        _check_dtype(offsets, I32)
+        seq_len, hidden_size = x.shape[-2:]
+        xb = x.reshape(-1, seq_len, hidden_size)
+        N = hidden_size // 2
+        if (hidden_size % n_pack or cos.size(1) != N or sin.size(1) != N
+                or offsets.numel() != xb.shape[0]):
+            raise RuntimeError("Tensor size mismatch!")
+        pos = offsets.long()[:, None] + torch.arange(seq_len)
+        c, s = cos[pos], sin[pos]
+        x1, x2 = xb[..., 0::2], xb[..., 1::2]
+        _store(out, torch.stack([x1 * c - x2 * s, x1 * s + x2 * c], dim=-1))
+    return register(name, rope_cached)
+
+
+_make_rope_cached("rope_cached_f32", 2)
+_make_rope_cached("rope_cached_f32x4_pack", 4)
+
+
+def _make_rope_qk_cached(name: str, th_type: torch.dtype):
+    # q: [num_tokens, num_heads, head_dim], k: [num_tokens, num_kv_heads,
+    # head_dim] rotated in place at positions: [num_tokens], the first
+    # 2 * cos.size(1) dims of a head, in f32. GPT-J: pairs (x[2i], x[2i+1]),
+    # NeoX: (x[i], x[i+N]).
+    def rope_qk_cached(q: torch.Tensor, k: torch.Tensor, positions: torch.Tensor,
+                       cos: torch.Tensor, sin: torch.Tensor, is_neox: bool):
+        _check_dtype(q, th_type)
+        _check_dtype(k, th_type)
+        _check_dtype(positions, I32)
+        _check_dtype(cos, F32)
+        _check_dtype(sin, F32)
+        if q.dim() != 3 or k.dim() != 3:
+            raise RuntimeError("q, k must be [num_tokens, num_heads, head_dim]")
+        N = cos.size(1)
+        if (k.size(0) != q.size(0) or k.size(2) != q.size(2) or sin.size(1) != N
+                or positions.numel() != q.size(0) or 2 * N > q.size(2)):
+            raise RuntimeError("Tensor size mismatch!")
+        c = cos[positions.long()][:, None, :]
+        s = sin[positions.long()][:, None, :]
+        for x in (q, k):
+            if is_neox:
+                i1, i2 = slice(0, N), slice(N, 2 * N)
+            else:
+                i1, i2 = slice(0, 2 * N, 2), slice(1, 2 * N, 2)
+            x1, x2 = x[..., i1].float(), x[..., i2].float()
+            x[..., i1], x[..., i2] = (x1 * c - x2 * s).to(th_type), (x1 * s + x2 * c).to(th_type)
+    return register(name, rope_qk_cached)
+
+
+_make_rope_qk_cached("rope_qk_cached_f32", F32)
+_make_rope_qk_cached("rope_qk_cached_f16", F16)
+
+
+# ------------------------------- layer norm / rms norm --------------------------
+# One thread block per row, K/n_elements threads. The *_f16 variants do
+# everything in half (half K, half epsilon, hrsqrt, __hfma), the *_f32 ones
+# load half and compute in f32. NOTE: the kernels apply epsilon as
+# rsqrt(var / (K + eps)), except rms_norm_f32/f32x4 which use var / K + eps.
+EPSILON = 1e-5
+
+# variant -> (th_type, n_elements, acc_type)
+LAYER_NORM = {
+    "f32":            (F32, 1, F32),
+    "f32x4":          (F32, 4, F32),
+    "f16_f16":        (F16, 1, F16),
+    "f16x2_f16":      (F16, 2, F16),
+    "f16x8_f16":      (F16, 8, F16),
+    "f16x8_pack_f16": (F16, 8, F16),
+    "f16x8_pack_f32": (F16, 8, F32),
+    "f16_f32":        (F16, 1, F32),
+}
+
+RMS_NORM = {
+    "f32":            (F32, 1, F32),
+    "f32x4":          (F32, 4, F32),
+    "f16_f16":        (F16, 1, F16),
+    "f16x2_f16":      (F16, 2, F16),
+    "f16x8_f16":      (F16, 8, F16),
+    "f16x8_pack_f16": (F16, 8, F16),
+    "f16x8_f32":      (F16, 8, F32),
+    "f16x8_pack_f32": (F16, 8, F32),
+    "f16_f32":        (F16, 1, F32),
+}
+
+
+def _row_sum(x: torch.Tensor, n_elements: int, acc: torch.dtype) -> torch.Tensor:
+    # block_reduce_sum_f32 or block_reduce_sum_f16_f16 over each row
+    return _block_reduce_sum(x, n_elements, acc, acc, acc).unsqueeze(-1)
+
+
+def _layer_norm(x: torch.Tensor, g: float, b: float, n_elements: int,
+                acc: torch.dtype) -> torch.Tensor:
+    K = x.shape[-1]
+    v = x.to(acc)
+    K_ = _const(K, acc)
+    eps = _const(EPSILON, acc)
+    mean = _row_sum(v, n_elements, acc) / K_
+    x_hat = v - mean
+    variance = _row_sum(x_hat * x_hat, n_elements, acc)
+    rstd = torch.rsqrt(variance / (K_ + eps))
+    if acc == F16:
+        # __hfma((x - mean) * rstd, g, b): one rounding for the fma
+        y = (x_hat * rstd).float() * _const(g, F16).float() + _const(b, F16).float()
+    else:
+        y = (x_hat * rstd) * g + b
+    return y.to(x.dtype)
+
+
+def _rms_norm(x: torch.Tensor, g: float, n_elements: int, acc: torch.dtype,
+              eps_inside: bool) -> torch.Tensor:
+    K = x.shape[-1]
+    v = x.to(acc)
+    K_ = _const(K, acc)
+    eps = _const(EPSILON, acc)
+    variance = _row_sum(v * v, n_elements, acc)
+    if eps_inside:
+        rstd = torch.rsqrt(variance / (K_ + eps))
+    else:
+        rstd = torch.rsqrt(variance / K_ + eps)
+    y = (v * rstd) * _const(g, acc)
+    return y.to(x.dtype)
+
+
+def _make_layer_norm(name: str, th_type, n_elements: int, acc):
+    def layer_norm(x: torch.Tensor, y: torch.Tensor, g: float, b: float):
+        _check_dtype(x, th_type)
+        _check_dtype(y, th_type)
+        _store(y, _layer_norm(x, g, b, n_elements, acc))
+    return register(name, layer_norm)
+
+
+def _make_rms_norm(name: str, th_type, n_elements: int, acc):
+    eps_inside = th_type != F32
+
+    def rms_norm(x: torch.Tensor, y: torch.Tensor, g: float):
+        _check_dtype(x, th_type)
+        _check_dtype(y, th_type)
+        _store(y, _rms_norm(x, g, n_elements, acc, eps_inside))
+    return register(name, rms_norm)
+
+
+for _variant, _cfg in LAYER_NORM.items():
+    _make_layer_norm(f"layer_norm_{_variant}", *_cfg)
+for _variant, _cfg in RMS_NORM.items():
+    _make_rms_norm(f"rms_norm_{_variant}", *_cfg)
+
+
+# *_auto: any K, the strategy (-1 auto, 0 warp, 1 block, 2 split) only
+# changes the launch. f32 math, var / K + eps, two pass layer norm.
+NORM_STRATEGIES = (-1, 0, 1, 2)
+
+
+def _check_norm_auto(x: torch.Tensor, y: torch.Tensor, th_type, strategy: int):
+    _check_dtype(x, th_type)
+    _check_dtype(y, th_type)
+    if x.shape != y.shape or x.dim() != 2:
+        raise RuntimeError("x, y must be contiguous NxK")
+    if strategy not in NORM_STRATEGIES:
+        raise RuntimeError("strategy: -1 (auto), 0 (warp), 1 (block), 2 (split)")
+
+
+def _make_layer_norm_auto(name: str, th_type):
+    def layer_norm(x: torch.Tensor, y: torch.Tensor, g: float, b: float, strategy: int):
+        _check_norm_auto(x, y, th_type, strategy)
+        v = x.float()
+        x_hat = v - v.mean(-1, keepdim=True)
+        rstd = torch.rsqrt((x_hat * x_hat).mean(-1, keepdim=True) + EPSILON)
+        _store(y, (x_hat * rstd * g + b).to(x.dtype))
+    return register(name, layer_norm)
+
+
+def _make_rms_norm_auto(name: str, th_type):
+    def rms_norm(x: torch.Tensor, y: torch.Tensor, g: float, strategy: int):
+        _check_norm_auto(x, y, th_type, strategy)
+        v = x.float()
+        rstd = torch.rsqrt((v * v).mean(-1, keepdim=True) + EPSILON)
+        _store(y, (v * rstd * g).to(x.dtype))
+    return register(name, rms_norm)
+
+
+for _variant, _th_type in (("f32", F32), ("f16_f32", F16)):
+    _make_layer_norm_auto(f"layer_norm_{_variant}_auto", _th_type)
+    _make_rms_norm_auto(f"rms_norm_{_variant}_auto", _th_type)
+
+
+
+# ------------------------------- fused add + norm -------------------------------
+# residual += x in place (rounded to half), y = norm(residual) * weight (+ bias)
+# in f32, epsilon as var / K + eps. y: half, or int8/fp8(e4m3) with a per
+# token (row) scale = max|y| / QUANT_MAX, y_q = y / scale.
+QUANT_MAX = {I8: 127.0, FP8_E4M3: 448.0}
+
+
+def _quant_per_token(y: torch.Tensor, out_type: torch.dtype):
+    qmax = QUANT_MAX[out_type]
+    absmax = y.abs().amax(dim=-1, keepdim=True)
+    inv_scale = torch.where(absmax > 0, qmax / absmax, torch.zeros_like(absmax))
+    v = y * inv_scale
+    if out_type == I8:
+        q = v.round().clamp(-128, 127).to(I8)
+    else:
+        q = v.clamp(-qmax, qmax).to(out_type)
+    return q, (absmax / qmax).squeeze(-1)
+
+
+def _fused_add_norm_store(y_f32: torch.Tensor, y: torch.Tensor,
+                          scale: Optional[torch.Tensor]):
+    if scale is None:
+        _store(y, y_f32.to(y.dtype))
+        return
+    q, s = _quant_per_token(y_f32, y.dtype)
+    _store(y, q)
+    _store(scale, s)
+
+
+def _check_fused_add_norm(x, residual, params, y, out_type, scale):
+    for t in (x, residual, *params):
+        _check_dtype(t, F16)
+    _check_dtype(y, out_type)
+    _check_shape(residual, *x.shape)
+    _check_shape(y, *x.shape)
+    K = x.shape[-1]
+    if K % 8 or any(p.numel() != K for p in params):
+        raise RuntimeError("K must be a multiple of 8, weight, bias: K")
+    if scale is not None:
+        _check_dtype(scale, F32)
+        if scale.numel() != x.shape[0]:
+            raise RuntimeError("scale: N")
+
+
+def _make_fused_add_rms_norm(name: str, out_type: torch.dtype):
+    quant = out_type != F16
+
+    def fused_add_rms_norm(x, residual, weight, y, *args):
+        scale, eps = args if quant else (None, *args)
+        _check_fused_add_norm(x, residual, (weight,), y, out_type, scale)
+        residual.copy_((residual.float() + x.float()).to(F16))
+        r = residual.float()
+        rstd = torch.rsqrt((r * r).sum(-1, keepdim=True) / r.shape[-1] + eps)
+        _fused_add_norm_store(r * rstd * weight.float(), y, scale)
+    return register(name, fused_add_rms_norm)
+
+
+def _make_fused_add_layer_norm(name: str, out_type: torch.dtype):
+    quant = out_type != F16
+
+    def fused_add_layer_norm(x, residual, weight, bias, y, *args):
+        scale, eps = args if quant else (None, *args)
+        _check_fused_add_norm(x, residual, (weight, bias), y, out_type, scale)
+        residual.copy_((residual.float() + x.float()).to(F16))
+        r = residual.float()
+        x_hat = r - r.mean(-1, keepdim=True)
+        rstd = torch.rsqrt((x_hat * x_hat).sum(-1, keepdim=True) / r.shape[-1] + eps)
+        _fused_add_norm_store(x_hat * rstd * weight.float() + bias.float(), y, scale)
+    return register(name, fused_add_layer_norm)
+
+
+for _suffix, _out_type in (("", F16), ("_int8", I8), ("_fp8", FP8_E4M3)):
+    if _out_type is not None: # no fp8 in this torch
+        _make_fused_add_rms_norm(f"fused_add_rms_norm_f16x8_f32{_suffix}", _out_type)
+        _make_fused_add_layer_norm(f"fused_add_layer_norm_f16x8_f32{_suffix}", _out_type)
+
+# ------------------------------- softmax ----------------------------------------
+# name -> (th_type, n_elements, safe). softmax_f32/f32x4 normalize over the
+# whole tensor (grid level total), the *_per_token ones over each row. All of
+# them compute exp and the sums in f32.
+SOFTMAX_PER_TOKEN = {
+    "softmax_f32_per_token":                 (F32, 1, False),
+    "softmax_f32x4_per_token":               (F32, 4, False),
+    "safe_softmax_f32_per_token":            (F32, 1, True),
+    "safe_softmax_f32x4_per_token":          (F32, 4, True),
+    "safe_softmax_f16_f32_per_token":        (F16, 1, True),
+    "safe_softmax_f16x2_f32_per_token":      (F16, 2, True),
+    "safe_softmax_f16x8_pack_f32_per_token": (F16, 8, True),
+    "online_safe_softmax_f32_per_token":     (F32, 1, True),
+    "online_safe_softmax_f32x4_pack_per_token": (F32, 4, True),
+}
+
+
+def _make_softmax(name: str, n_elements: int):
+    def softmax(x: torch.Tensor, y: torch.Tensor):
+        _check_dtype(x, F32)
+        _check_dtype(y, F32)
+        _check_shape(y, *x.shape)
+        exp_val = torch.exp(x.flatten())
+        block_size = 256 * n_elements
+        total = _block_reduce_sum(_blocks(exp_val, block_size), n_elements).sum()
+        _store(y, exp_val / total)
+    return register(name, softmax)
+
+
+def _make_softmax_per_token(name: str, th_type, n_elements: int, safe: bool):
+    def softmax_per_token(x: torch.Tensor, y: torch.Tensor):
+        _check_dtype(x, th_type)
+        _check_dtype(y, th_type)
+        _check_shape(y, *x.shape)
+        v = x.float()
+        if safe:
+            v = v - v.amax(dim=-1, keepdim=True)
+        exp_val = torch.exp(v)
+        exp_sum = _block_reduce_sum(exp_val, n_elements).unsqueeze(-1)
+        _store(y, (exp_val / exp_sum).to(th_type))
+    return register(name, softmax_per_token)
+
+
+_make_softmax("softmax_f32", 1)
+_make_softmax("softmax_f32x4", 4)
+for _name, _cfg in SOFTMAX_PER_TOKEN.items():
+    _make_softmax_per_token(_name, *_cfg)
+
+
+# ------------------------------- nms --------------------------------------------
+def nms(boxes: torch.Tensor, scores: torch.Tensor, iou_threshold: float) -> torch.Tensor:
+    # greedy NMS on the boxes sorted by score, returns the kept positions in
+    # the sorted order as int32, like the binding.
+    _check_dtype(boxes, F32)
+    _check_dtype(scores, F32)
+    order = scores.sort(stable=True, dim=0, descending=True)[1]
+    b = boxes.index_select(0, order)
+    x1, y1, x2, y2 = b.unbind(1)
+    area = (x2 - x1) * (y2 - y1)
+    keep = torch.ones(b.shape[0], dtype=torch.bool)
+    for i in range(b.shape[0]):
+        if not keep[i]:
+            continue
+        inter_w = (torch.minimum(x2[i], x2[i + 1:]) - torch.maximum(x1[i], x1[i + 1:])).clamp_min(0.0)
+        inter_h = (torch.minimum(y2[i], y2[i + 1:]) - torch.maximum(y1[i], y1[i + 1:])).clamp_min(0.0)
+        inter_area = inter_w * inter_h
+        iou = inter_area / (area[i] + area[i + 1:] - inter_area)
+        keep[i + 1:] &= ~(iou > iou_threshold)
+    return keep.nonzero().flatten().to(I32)
+
+
+register("nms", nms)
+
+
+# ------------------------------- flash attn -------------------------------------
+def flash_attn_1_fwd_f32(Q: torch.Tensor, K: torch.Tensor, V: torch.Tensor, O: torch.Tensor):
+    # Q, K, V, O: [B, H, N, d], f32 all the way
+    for t in (Q, K, V, O):
+        _check_dtype(t, F32)
+    scale = 1.0 / math.sqrt(Q.size(-1))
+    S = (Q @ K.transpose(-2, -1)) * scale
+    _store(O, torch.softmax(S, dim=-1) @ V)
+
+
+def flash_attn_2_fwd_f16_mma_m16n8k16(Q: torch.Tensor, K: torch.Tensor, V: torch.Tensor,
+                                      O: torch.Tensor):
+    # QK^T and PV on f16 mma with f16 accumulators, P = exp(S*scale - max)
+    # rounded to half, the running max/sum and O rescaling in f32.
+    for t in (Q, K, V, O):
+        _check_dtype(t, F16)
+    if Q.size(-1) <= 0 or Q.size(-1) % 8 != 0 or Q.size(-1) > 256:
+        raise RuntimeError("head_dim must be a multiple of 8 from 8 to 256")
+    scale = 1.0 / math.sqrt(Q.size(-1))
+    S = _matmul_f16_acc(Q, K.transpose(-2, -1)).float() * scale
+    P = torch.exp(S - S.amax(dim=-1, keepdim=True))
+    l = P.sum(dim=-1, keepdim=True)
+    PV = _matmul_f16_acc(P.half(), V)
+    _store(O, (PV.float() / l).half())
+
+
+def flash_attn_1_fwd_f32_lse(Q: torch.Tensor, K: torch.Tensor, V: torch.Tensor,
+                             O: torch.Tensor, L: torch.Tensor):
+    # flash_attn_1_fwd_f32 and L: [B, H, N], logsumexp of the scaled scores
+    _check_dtype(L, F32)
+    flash_attn_1_fwd_f32(Q, K, V, O)
+    S = (Q @ K.transpose(-2, -1)) * (1.0 / math.sqrt(Q.size(-1)))
+    _store(L, torch.logsumexp(S, dim=-1))
+
+
+def flash_attn_1_bwd_f32(Q: torch.Tensor, K: torch.Tensor, V: torch.Tensor,
+                         O: torch.Tensor, dO: torch.Tensor, L: torch.Tensor,
+                         dQ: torch.Tensor, dK: torch.Tensor, dV: torch.Tensor):
+    # P recomputed from L, dS = P * (dO V^T - rowsum(dO * O)), f32 all the way
+    for t in (Q, K, V, O, dO, L, dQ, dK, dV):
+        _check_dtype(t, F32)
+    for t in (K, V, O, dO, dQ, dK, dV):
+        _check_shape(t, *Q.shape)
+    scale = 1.0 / math.sqrt(Q.size(-1))
+    P = torch.exp((Q @ K.transpose(-2, -1)) * scale - L.unsqueeze(-1))
+    D = (dO * O).sum(dim=-1, keepdim=True)
+    dS = P * (dO @ V.transpose(-2, -1) - D)
+    _store(dV, P.transpose(-2, -1) @ dO)
+    _store(dQ, (dS @ K) * scale)
+    _store(dK, (dS.transpose(-2, -1) @ Q) * scale)
+
+
+def _make_flash_attn_varlen(name: str, dense: Callable):
+    # Q, K, V, O: [total_tokens, H, d] packed, cu_seqlens: [B+1] int32, the
+    # dense kernel on every sequence alone, no padding
+    def flash_attn_varlen(Q: torch.Tensor, K: torch.Tensor, V: torch.Tensor,
+                          cu_seqlens: torch.Tensor, O: torch.Tensor):
+        _check_dtype(cu_seqlens, I32)
+        if Q.dim() != 3:
+            raise RuntimeError("Tensor size mismatch!")
+        for t in (K, V, O):
+            _check_shape(t, *Q.shape)
+        bounds = cu_seqlens.tolist()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            seq = lambda t: t[start:end].transpose(0, 1).unsqueeze(0) # [1, H, n, d]
+            dense(seq(Q), seq(K), seq(V), seq(O))
+    return register(name, flash_attn_varlen)
+
+
+register("flash_attn_1_fwd_f32", flash_attn_1_fwd_f32)
+register("flash_attn_2_fwd_f16_mma_m16n8k16", flash_attn_2_fwd_f16_mma_m16n8k16)
+register("flash_attn_1_fwd_f32_lse", flash_attn_1_fwd_f32_lse)
+register("flash_attn_1_bwd_f32", flash_attn_1_bwd_f32)
+_make_flash_attn_varlen("flash_attn_1_fwd_f32_varlen", flash_attn_1_fwd_f32)
+_make_flash_attn_varlen("flash_attn_2_fwd_f16_mma_m16n8k16_varlen",
+                        flash_attn_2_fwd_f16_mma_m16n8k16)
+
+
+# ------------------------------- hgemm / sgemm ----------------------------------
+# All the HGEMM kernels (CUDA Cores, WMMA, MMA and cuBLAS with
+# CUBLAS_COMPUTE_16F) accumulate in f16. SGEMM accumulates in f32, with tf32
+# inputs for the WMMA and cublas_tf32 ones. *_tn take b as [N, K].
+HGEMM = [
+    "hgemm_naive_f16",
+    "hgemm_sliced_k_f16",
+    "hgemm_t_8x8_sliced_k_f16x4",
+    "hgemm_t_8x8_sliced_k_f16x4_pack",
+    "hgemm_t_8x8_sliced_k_f16x4_bcf",
+    "hgemm_t_8x8_sliced_k_f16x4_pack_bcf",
+    "hgemm_t_8x8_sliced_k_f16x8_pack_bcf",
+    "hgemm_t_8x8_sliced_k_f16x8_pack_bcf_dbuf",
+    "hgemm_t_8x8_sliced_k16_f16x8_pack_dbuf",
+    "hgemm_t_8x8_sliced_k16_f16x8_pack_dbuf_async",
+    "hgemm_t_8x8_sliced_k32_f16x8_pack_dbuf",
+    "hgemm_t_8x8_sliced_k32_f16x8_pack_dbuf_async",
+    "hgemm_t_16x8_sliced_k32_f16x8_pack_dbuf",
+    "hgemm_t_16x8_sliced_k32_f16x8_pack_dbuf_async",
+    "hgemm_cublas_tensor_op_nn",
+    "hgemm_cublas_tensor_op_tn",
+    "hgemm_wmma_m16n16k16_naive",
+    "hgemm_wmma_m16n16k16_mma4x2",
+    "hgemm_wmma_m16n16k16_mma4x2_warp2x4",
+    "hgemm_wmma_m16n16k16_mma4x2_warp2x4_dbuf_async",
+    "hgemm_wmma_m32n8k16_mma2x4_warp2x4_dbuf_async",
+    "hgemm_wmma_m16n16k16_mma4x2_warp2x4_stages",
+    "hgemm_wmma_m16n16k16_mma4x2_warp2x4_stages_dsmem",
+    "hgemm_wmma_m16n16k16_mma4x2_warp4x4_stages_dsmem",
+    "hgemm_wmma_m16n16k16_mma4x4_warp4x4_stages_dsmem",
+    "hgemm_mma_m16n8k16_naive",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4_stages",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4x2_stages_dsmem",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4x2_stages_dsmem_x4",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4x2_stages_dsmem_rr",
+    "hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn",
+]
+
+SGEMM = [
+    "sgemm_naive_f32",
+    "sgemm_sliced_k_f32",
+    "sgemm_t_8x8_sliced_k_f32x4",
+    "sgemm_t_8x8_sliced_k_f32x4_bcf",
+    "sgemm_t_8x8_sliced_k_f32x4_bcf_offset",
+    "sgemm_t_8x8_sliced_k_f32x4_bcf_dbuf",
+    "sgemm_t_8x8_sliced_k_f32x4_bcf_dbuf_offset",
+    "sgemm_t_8x4_sliced_k16_f32x4_bcf_dbuf",
+    "sgemm_t_8x4_sliced_k16_f32x4_bcf_dbuf_async",
+    "sgemm_t_8x8_sliced_k16_f32x4_bcf_dbuf",
+    "sgemm_t_8x8_sliced_k16_f32x4_bcf_dbuf_async",
+    "sgemm_t_8x16_sliced_k16_f32x4_bcf_dbuf",
+    "sgemm_t_8x16_sliced_k16_f32x4_bcf_dbuf_async",
+    "sgemm_cublas",
+    "sgemm_cublas_tf32",
+    "sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages",
+    "sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages_dsmem",
+]
+
+
+def _gemm_operands(a: torch.Tensor, b: torch.Tensor, c: torch.Tensor,
+                   dtype: torch.dtype, tn: bool):
+    _check_dtype(a, dtype)
+    _check_dtype(b, dtype)
+    _check_dtype(c, dtype)
+    M, K = a.shape
+    N = b.size(0) if tn else b.size(1)
+    _check_shape(b, *((N, K) if tn else (K, N)))
+    _check_shape(c, M, N)
+    return a, (b.t() if tn else b)
+
+
+def _make_gemm(name: str):
+    dtype = F16 if name.startswith("hgemm") else F32
+    tn = name.endswith("_tn")
+    tf32 = "tf32" in name or "wmma" in name
+
+    def gemm(a, b, c):
+        a, b = _gemm_operands(a, b, c, dtype, tn)
+        if dtype == F16:
+            _store(c, _matmul_f16_acc(a, b))
+        elif tf32:
+            _store(c, _round_tf32(a) @ _round_tf32(b))
+        else:
+            _store(c, a @ b)
+
+    if "stages" not in name:
+        return register(name, gemm)
+
+    def gemm_stages(a, b, c, stages: int, swizzle: bool, swizzle_stride: int):
+        # stages and block swizzle only change the schedule, not the result
+        gemm(a, b, c)
+    return register(name, gemm_stages)
+
+
+for _name in HGEMM + SGEMM:
+    _make_gemm(_name)
+
+
+def names() -> List[str]:
+    return sorted(REFERENCES)
@@ -0,0 +1,196 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .build import get_cache_dir, load
+from .harness import get_backend
+
+# Lazy, on-demand kernel library loading. Each exposed binding is mapped to
+# the translation unit (TU) that defines it, and only the TUs a run actually
+# touches are compiled (or fetched from the build cache), on first attribute
+# access. e.g `lib.hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn` only
+# builds hgemm_mma_stage_tn.cu instead of all eight hgemm TUs. With the
+# "cpu" backend (BENCH_BACKEND=cpu) nothing is built, the bindings resolve
+# to the pure PyTorch references of bench/reference.py instead.
+
+_BINDING_RE = re.compile(r"TORCH_BINDING_COMMON_EXTENSION\((\w+)\)")
+_DEFINITION_RE = re.compile(
+    r"^(void|torch::Tensor)\s+(\w+)\s*\(([^;{)]*)\)\s*\{", re.M)
+_LINE_COMMENT_RE = re.compile(r"//[^\n]*")
+_BLOCK_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_DEFINE_RE = re.compile(r"^\s*#define\s+(\w+)\s+(-?\d+)\s*$", re.M)
+
+# multi TU libs guard their all-in-one PYBIND11_MODULE with this macro, since
+# the per TU builds use generated bindings instead (see make_bindings_stub).
+SKIP_BINDINGS_FLAG = "-DSKIP_TORCH_BINDINGS"
+
+
+@dataclass
+class Binding:
+    name: str
+    lib: str
+    source: Optional[str] # TU that defines it, None if not parsable
+    declaration: Optional[str] # e.g "void f(torch::Tensor a, torch::Tensor b)"
+
+
+# binding name -> Binding, for all the libs created so far.
+REGISTRY: Dict[str, Binding] = {}
+
+
+def _strip_comments(src: str) -> str:
+    return _LINE_COMMENT_RE.sub("", _BLOCK_COMMENT_RE.sub("", src))
+
+
+def parse_bindings(lib: str, sources: List[str]) -> Dict[str, Binding]:
+    exposed = []
+    definitions = {}
+    for source in sources:
+        with open(source) as f:
+            src = _strip_comments(f.read())
+        for line in src.splitlines():
+            if line.lstrip().startswith("#"):
+                continue # the TORCH_BINDING_COMMON_EXTENSION(func) macro itself
+            exposed.extend(_BINDING_RE.findall(line))
+        for ret, name, params in _DEFINITION_RE.findall(src):
+            params = " ".join(params.split())
+            definitions[name] = (source, f"{ret} {name}({params})")
+    bindings = {}
+    for name in exposed:
+        source, declaration = definitions.get(name, (None, None))
+        bindings[name] = Binding(name, lib, source, declaration)
+    return bindings
+
+
+def parse_defines(source: str) -> Dict[str, int]:
+    # the integer `#define NAME 123` constants of a .cu, e.g the thresholds a
+    # kernel dispatch uses, so the python side reads them instead of a copy.
+    with open(source) as f:
+        src = _strip_comments(f.read())
+    return {name: int(value) for name, value in _DEFINE_RE.findall(src)}
+
+
+def make_bindings_stub(bindings: List[Binding]) -> str:
+    # same layout as flash-attn/flash_attn.cc
+    lines = [
+        "#include <torch/types.h>",
+        "#include <torch/extension.h>",
+        "",
+        "#define STRINGFY(str) #str",
+        "#define TORCH_BINDING_COMMON_EXTENSION(func) \\",
+        "  m.def(STRINGFY(func), &func, STRINGFY(func));",
+        "",
+    ]
+    lines += [f"{b.declaration};" for b in bindings]
+    lines += ["", "PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {"]
+    lines += [f"  TORCH_BINDING_COMMON_EXTENSION({b.name})" for b in bindings]
+    lines += ["}", ""]
+    return "\n".join(lines)
+
+
+def _write_if_changed(path: str, content: str):
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class LazyLib:
+    # drop-in for the module returned by load(), resolves bindings lazily.
+
+    def __init__(self, name: str, sources: List[str],
+                 extra_cflags: Optional[List[str]] = None,
+                 extra_cuda_cflags: Optional[List[str]] = None,
+                 verbose: bool = False,
+                 backend: Optional[str] = None):
+        self._name = name
+        self._sources = [os.path.abspath(s) for s in sources]
+        self._extra_cflags = list(extra_cflags or [])
+        self._extra_cuda_cflags = list(extra_cuda_cflags or [])
+        self._verbose = verbose
+        self._backend = backend or get_backend()
+        self._bindings = parse_bindings(name, self._sources)
+        self._modules = {} # TU (or None for the full lib) -> module
+        REGISTRY.update(self._bindings)
+
+    def _build_full(self):
+        if None not in self._modules:
+            self._modules[None] = load(
+                name=self._name, sources=self._sources,
+                extra_cflags=self._extra_cflags,
+                extra_cuda_cflags=self._extra_cuda_cflags,
+                verbose=self._verbose)
+        return self._modules[None]
+
+    def _build_unit(self, source: str):
+        if source in self._modules:
+            return self._modules[source]
+        stem = os.path.splitext(os.path.basename(source))[0]
+        name = f"{self._name}_{stem}"
+        bindings = [b for b in self._bindings.values() if b.source == source]
+        stub = os.path.join(get_cache_dir(), "stubs", f"{name}_bindings.cc")
+        _write_if_changed(stub, make_bindings_stub(bindings))
+        if self._verbose:
+            print(f"[bench.registry] building {name} for {[b.name for b in bindings]}")
+        module = load(name=name, sources=[stub, source],
+                      extra_cflags=self._extra_cflags,
+                      extra_cuda_cflags=self._extra_cuda_cflags + [SKIP_BINDINGS_FLAG],
+                      verbose=self._verbose)
+        self._modules[source] = module
+        return module
+
+    def _resolve(self, attr: str):
+        if self._backend == "cpu":
+            from .reference import get_reference
+            return get_reference(attr)
+        binding = self._bindings[attr]
+        if len(self._sources) == 1 or binding.declaration is None:
+            # single TU libs carry their own PYBIND11_MODULE, and bindings
+            # we can not parse (e.g macro generated) need the full lib.
+            module = self._build_full()
+        else:
+            module = self._build_unit(binding.source)
+        return getattr(module, attr)
+
+    def __getattr__(self, attr: str):
+        if attr.startswith("_") or attr not in self._bindings:
+            raise AttributeError(f"{self._name} has no binding {attr}")
+        func = self._resolve(attr)
+        setattr(self, attr, func) # resolve only once
+        return func
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self._bindings))
+
+    def bindings(self) -> List[str]:
+        return list(self._bindings)
+
+    def preload(self, *names: str):
+        for name in (names or self._bindings):
+            getattr(self, name)
+
+    def __repr__(self):
+        return (f"LazyLib({self._name}, backend={self._backend}, "
+                f"bindings={len(self._bindings)}, built={len(self._modules)})")
+
+
+def lazy_load(name: str, sources: List[str],
+              extra_cflags: Optional[List[str]] = None,
+              extra_cuda_cflags: Optional[List[str]] = None,
+              verbose: bool = False,
+              backend: Optional[str] = None) -> LazyLib:
+    # same signature as load(), but nothing is compiled until first use.
+    return LazyLib(name, sources, extra_cflags=extra_cflags,
+                   extra_cuda_cflags=extra_cuda_cflags, verbose=verbose,
+                   backend=backend)
+
+
+def find_binding(name: str) -> Binding:
+    if name not in REGISTRY:
+        raise KeyError(f"unknown binding {name}, is its lib created?")
+    return REGISTRY[name]
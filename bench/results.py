@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import platform
+import subprocess
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+from .build import file_lock
+
+# Machine readable, append-only store of the benchmark results, so that
+# throughput can be tracked across machines and releases instead of being
+# lost when a script exits. One record (a flat dict, one JSON line) per timed
+# variant, with the timing distribution and an environment fingerprint.
+#
+# <results_dir>/
+#   results.jsonl      append only, one record per line
+#   results.parquet    optional, compacted JSONL (see compact)
+#   .results.lock      serializes appends and compaction
+#
+# BENCH_RESULTS=<path to results.jsonl> selects the store, BENCH_RESULTS=""
+# disables writing (records are still kept in memory for the current run).
+
+DEFAULT_RESULTS_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "cuda-learn-notes", "results", "results.jsonl")
+
+# one id per process, groups the records of one script run
+RUN_ID = uuid.uuid4().hex[:16]
+
+
+def get_results_path() -> Optional[str]:
+    path = os.environ.get("BENCH_RESULTS", DEFAULT_RESULTS_PATH)
+    return path or None
+
+
+def _run(cmd: List[str], cwd: Optional[str] = None) -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            cmd, cwd=cwd, stderr=subprocess.DEVNULL, timeout=30).decode().strip()
+    except (subprocess.SubprocessError, OSError):
+        return None
+
+
+def get_git_sha() -> Optional[str]:
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sha = _run(["git", "rev-parse", "HEAD"], cwd=repo_dir)
+    if sha and _run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir):
+        sha += "-dirty"
+    return sha
+
+
+def get_driver_version() -> Optional[str]:
+    output = _run(["nvidia-smi", "--query-gpu=driver_version", "--format=csv,noheader"])
+    return output.splitlines()[0] if output else None
+
+
+@lru_cache(maxsize=None)
+def get_environment() -> Dict[str, Any]:
+    # fingerprint of where the numbers come from, the same for a whole run
+    import torch
+    from .build import get_toolchain_version
+    from .harness import get_backend, get_device_name, get_device_capability
+    backend = get_backend()
+    capability = get_device_capability()
+    return {
+        "backend": backend,
+        "device_name": get_device_name(),
+        "capability": f"{capability[0]}.{capability[1]}",
+        "driver": get_driver_version() if backend == "cuda" else None,
+        "toolkit": torch.version.cuda,
+        "toolchain": get_toolchain_version(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "hostname": socket.gethostname(),
+        "git_sha": get_git_sha(),
+    }
+
+
+def format_shape(shape: Any) -> str:
+    # (4096, 4096, 1024) -> "4096x4096x1024", several tensors -> "4096x512,4096x512"
+    if isinstance(shape, str):
+        return shape
+    if shape and isinstance(shape[0], (list, tuple)):
+        return ",".join(format_shape(s) for s in shape)
+    return "x".join(str(int(s)) for s in shape)
+
+
+def format_dtype(dtype: Any) -> str:
+    return str(dtype).replace("torch.", "")
+
+
+def make_record(result: Any, kernel: str = "", shape: Any = "",
+                dtype: Any = "", stages: Optional[int] = None,
+                swizzle_stride: Optional[int] = None,
+                tflops: Optional[float] = None, gbps: Optional[float] = None,
+                **extra: Any) -> Dict[str, Any]:
+    # result: harness.BenchResult, extra: any additional flat fields
+    check = result.check
+    record = {
+        "run_id": RUN_ID,
+        "timestamp": time.time(),
+        "script": os.path.basename(sys.argv[0]) if sys.argv else "",
+        "kernel": kernel,
+        "tag": result.tag,
+        "shape": format_shape(shape),
+        "dtype": format_dtype(dtype),
+        "stages": stages,
+        "swizzle_stride": swizzle_stride,
+        "timer": result.timer,
+        "iters": len(result.samples),
+        "median_ms": result.median,
+        "p10_ms": result.p10,
+        "p90_ms": result.p90,
+        "mean_ms": result.mean,
+        "stddev_ms": result.stddev,
+        "trimmed_mean_ms": result.trimmed_mean,
+        "num_outliers": result.num_outliers,
+        "samples_ms": list(result.samples),
+        "tflops": tflops,
+        "gbps": gbps,
+        "check_ok": None if check is None else check.ok,
+        "max_abs": None if check is None else check.max_abs,
+        "max_ulp": None if check is None else check.max_ulp,
+    }
+    record.update(get_environment())
+    record.update(extra)
+    return record
+
+
+class ResultsStore:
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path # None: in memory only
+        self.records: List[Dict[str, Any]] = [] # appended by this process
+
+    @property
+    def parquet_path(self) -> Optional[str]:
+        return None if self.path is None else os.path.splitext(self.path)[0] + ".parquet"
+
+    def _lock(self):
+        return file_lock(os.path.join(os.path.dirname(os.path.abspath(self.path)),
+                                      ".results.lock"))
+
+    def append(self, *records: Dict[str, Any]):
+        self.records.extend(records)
+        if self.path is None or not records:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lines = "".join(json.dumps(r, default=str) + "\n" for r in records)
+        with self._lock():
+            with open(self.path, "a") as f:
+                f.write(lines)
+
+    def load(self, **filters: Any) -> List[Dict[str, Any]]:
+        # all the stored records (parquet first, then JSONL), optionally
+        # filtered on field equality, e.g load(tag="(cublas)", shape="4096x4096x4096")
+        records = []
+        if self.path is not None:
+            if os.path.exists(self.parquet_path):
+                records.extend(read_parquet(self.parquet_path))
+            if os.path.exists(self.path):
+                records.extend(read_jsonl(self.path))
+        return [r for r in records
+                if all(r.get(k) == v for k, v in filters.items())]
+
+    def compact(self) -> str:
+        # move the JSONL records into the parquet file, needs pandas + pyarrow
+        import pandas as pd
+        with self._lock():
+            new = read_jsonl(self.path) if os.path.exists(self.path) else []
+            frames = [pd.DataFrame(new)]
+            if os.path.exists(self.parquet_path):
+                frames.insert(0, pd.read_parquet(self.parquet_path))
+            df = pd.concat(frames, ignore_index=True)
+            tmp = f"{self.parquet_path}.{os.getpid()}.tmp"
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, self.parquet_path)
+            if os.path.exists(self.path):
+                os.truncate(self.path, 0)
+        return self.parquet_path
+
+
+def read_jsonl(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass # a partial line from a killed writer
+    return records
+
+
+def read_parquet(path: str) -> List[Dict[str, Any]]:
+    import pandas as pd
+    df = pd.read_parquet(path)
+    records = df.to_dict(orient="records")
+    for r in records: # numpy arrays/scalars -> plain python
+        for k, v in r.items():
+            if hasattr(v, "tolist"):
+                r[k] = v.tolist()
+    return records
+
+
+_STORE: Optional[ResultsStore] = None
+
+
+def get_store() -> ResultsStore:
+    global _STORE
+    if _STORE is None:
+        _STORE = ResultsStore(get_results_path())
+    return _STORE
+
+
+def set_store(store: ResultsStore) -> ResultsStore:
+    # e.g a per worker shard store, see sweep.py
+    global _STORE
+    _STORE = store
+    return store
+
+
+def record_result(result: Any, **fields: Any) -> Dict[str, Any]:
+    # make_record + append to the default store
+    record = make_record(result, **fields)
+    get_store().append(record)
+    return record
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="bench results store")
+    parser.add_argument("command", choices=["compact", "show"])
+    parser.add_argument("--path", type=str, default=None, help="results.jsonl path")
+    parser.add_argument("--tag", type=str, default=None, help="Only show this tag")
+    parser.add_argument("--kernel", type=str, default=None, help="Only show this kernel")
+    args = parser.parse_args(argv)
+    store = ResultsStore(args.path or get_results_path())
+    if store.path is None:
+        parser.error("no results path, set BENCH_RESULTS or pass --path")
+    if args.command == "compact":
+        print(f"compacted into {store.compact()}")
+        return
+    filters = {k: v for k, v in (("tag", args.tag), ("kernel", args.kernel)) if v}
+    for r in store.load(**filters):
+        tflops = f", TFLOPS: {r['tflops']:.2f}" if r.get("tflops") else ""
+        print(f"{r['run_id']} {r['device_name']:>24} {r['tag']:>42} {r['shape']:>16}: "
+              f"{r['median_ms']:.6f}ms{tflops}")
+
+
+if __name__ == "__main__":
+    main()
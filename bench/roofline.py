@@ -0,0 +1,308 @@
+import os
+import sys
+import argparse
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Bytes moved and FLOPs of every binding as a function of its input shapes
+# and dtypes, to report achieved GB/s, arithmetic intensity and % of the
+# device peak, and to draw a roofline of all the kernels from the results
+# store. Bytes are the compulsory DRAM traffic (each input read once, each
+# output written once), FLOPs count exp/tanh/rsqrt as 1, as in the kernels.
+#
+# A cost function takes the binding inputs (no out, no scalar args), e.g
+# cost(x) for relu_f32, cost(a, b) for hgemm_*, and returns a Cost.
+
+
+@dataclass
+class Cost:
+    bytes: int
+    flops: int
+
+    @property
+    def intensity(self) -> float:
+        # FLOPs per byte
+        return self.flops / self.bytes if self.bytes else 0.0
+
+
+def elementwise_cost(num_inputs: int, flops_per_elem: int) -> Callable[..., Cost]:
+    # num_inputs tensors read, one of the same shape and dtype written
+    def cost(*inputs) -> Cost:
+        x = inputs[0]
+        n = x.numel()
+        return Cost((num_inputs + 1) * n * x.element_size(), flops_per_elem * n)
+    return cost
+
+
+def reduce_cost(num_inputs: int, flops_per_elem: int) -> Callable[..., Cost]:
+    # num_inputs tensors read, reduced into one f32/i32 scalar
+    def cost(*inputs) -> Cost:
+        x = inputs[0]
+        n = x.numel()
+        return Cost(num_inputs * n * x.element_size() + 4, flops_per_elem * n)
+    return cost
+
+
+def embedding_cost(idx, weight) -> Cost:
+    # idx read, one weight row read and written per index
+    n = idx.numel() * weight.size(1)
+    return Cost(idx.numel() * idx.element_size() + 2 * n * weight.element_size(), 0)
+
+
+def gemm_cost(a, b) -> Cost:
+    # a: [M, K], b: [K, N] or [N, K] (tn), c: [M, N]
+    M, K = a.shape
+    N = b.numel() // K
+    return Cost((M * K + K * N + M * N) * a.element_size(), 2 * M * N * K)
+
+
+def gemv_cost(a, x) -> Cost:
+    # a: [M, K], x: [K, 1], y: [M, 1]
+    M, K = a.shape
+    return Cost((M * K + K + M) * a.element_size(), 2 * M * K)
+
+
+def rope_cached_cost(x, cos=None, sin=None, offsets=None) -> Cost:
+    # x read, out written, one cos and one sin per pair read instead of
+    # computed: 2 mul + 1 add per element
+    n = x.numel()
+    offsets_bytes = offsets.numel() * offsets.element_size() if offsets is not None else 0
+    return Cost(3 * n * x.element_size() + offsets_bytes, 3 * n)
+
+
+def rope_qk_cost(q, k, positions, cos, sin, is_neox=False) -> Cost:
+    # q and k read and written in place, the rotated dims only, one cos/sin
+    # row per token (the heads share it, from L1)
+    num_tokens, rot_dim = q.shape[0], 2 * cos.size(1)
+    n = (q.numel() + k.numel()) // q.shape[-1] * rot_dim
+    return Cost(2 * n * q.element_size() + num_tokens * rot_dim * cos.element_size()
+                + positions.numel() * positions.element_size(), 3 * n)
+
+
+def fused_add_norm_cost(num_params: int, out_size: int,
+                        flops_per_elem: int) -> Callable[..., Cost]:
+    # x read, residual read and written, num_params K vectors (weight, bias)
+    # read, y written with out_size bytes per element (+ an f32 scale per
+    # row when quantized)
+    def cost(x, residual, *params) -> Cost:
+        N, K = x.shape
+        n = x.numel()
+        scale_bytes = 4 * N if out_size == 1 else 0
+        return Cost(3 * n * x.element_size() + num_params * K * x.element_size()
+                    + n * out_size + scale_bytes, flops_per_elem * n)
+    return cost
+
+
+def attn_cost(q, k, v, cu_seqlens=None) -> Cost:
+    # q, k, v, o: [B, H, N, d], QK^T and PV, softmax not counted. varlen:
+    # [total_tokens, H, d] packed, sequence b is cu_seqlens[b]:cu_seqlens[b+1]
+    if cu_seqlens is None:
+        B, H, N, d = q.shape
+        return Cost(4 * q.numel() * q.element_size(), 4 * B * H * N * N * d)
+    _, H, d = q.shape
+    lens = (cu_seqlens[1:] - cu_seqlens[:-1]).tolist()
+    return Cost(4 * q.numel() * q.element_size() + cu_seqlens.numel() * cu_seqlens.element_size(),
+                4 * H * d * sum(n * n for n in lens))
+
+
+def attn_bwd_cost(q, k, v, o, do, lse) -> Cost:
+    # q, k, v, o, do read, dq, dk, dv written: [B, H, N, d], lse: [B, H, N].
+    # P = QK^T recomputed, dV = P^T dO, dP = dO V^T, dQ = dS K, dK = dS^T Q
+    B, H, N, d = q.shape
+    return Cost(8 * q.numel() * q.element_size() + lse.numel() * lse.element_size(),
+                10 * B * H * N * N * d)
+
+
+def attn_train_cost(q, k, v) -> Cost:
+    # forward (saving the lse) + backward of a training step
+    fwd = attn_cost(q, k, v)
+    B, H, N, _ = q.shape
+    bwd = attn_bwd_cost(q, k, v, q, q, q.new_empty(B, H, N))
+    return Cost(fwd.bytes + bwd.bytes, fwd.flops + bwd.flops)
+
+
+# family -> cost, the torch baselines of the scripts use these directly
+FAMILY_COSTS: Dict[str, Callable[..., Cost]] = {
+    "elementwise_add": elementwise_cost(2, 1),
+    "relu": elementwise_cost(1, 1),
+    "sigmoid": elementwise_cost(1, 4), # neg, exp, add, div
+    "swish": elementwise_cost(1, 5),
+    "gelu": elementwise_cost(1, 9), # tanh approximate
+    "mat_transpose": elementwise_cost(1, 0),
+    "rope": elementwise_cost(1, 4), # sin, cos, 2 mul, 1 add per element
+    "rope_cached": rope_cached_cost,
+    "fused_add_rms_norm": fused_add_norm_cost(1, 2, 5), # add, sq, sum, 2 mul
+    "fused_add_rms_norm_f16x8_f32_int8": fused_add_norm_cost(1, 1, 7), # + max, mul
+    "fused_add_rms_norm_f16x8_f32_fp8": fused_add_norm_cost(1, 1, 7),
+    "fused_add_layer_norm": fused_add_norm_cost(2, 2, 8), # add, sum, sub, sq, sum, fma
+    "fused_add_layer_norm_f16x8_f32_int8": fused_add_norm_cost(2, 1, 10),
+    "fused_add_layer_norm_f16x8_f32_fp8": fused_add_norm_cost(2, 1, 10),
+    "rope_qk_cached": rope_qk_cost,
+    "layer_norm": elementwise_cost(1, 7), # sum, sub, sq, sum, mul, fma
+    "rms_norm": elementwise_cost(1, 4), # sq, sum, 2 mul
+    "softmax": elementwise_cost(1, 3), # exp, sum, div
+    "safe_softmax": elementwise_cost(1, 5), # + max, sub
+    "block_all_reduce_sum": reduce_cost(1, 1),
+    "dot_prod": reduce_cost(2, 2),
+    "embedding": embedding_cost,
+    "sgemv": gemv_cost,
+    "hgemv": gemv_cost,
+    "sgemm": gemm_cost,
+    "hgemm": gemm_cost,
+    "flash_attn": attn_cost,
+    "flash_attn_bwd": attn_bwd_cost,
+    "flash_attn_train": attn_train_cost,
+}
+
+# binding name prefix -> family, longest prefix wins
+_FAMILY_PREFIXES = {
+    "online_safe_softmax": "safe_softmax",
+    "flash_attn_": "flash_attn",
+    "flash_attn_1_bwd": "flash_attn_bwd",
+}
+
+
+def get_family(name: str) -> Optional[str]:
+    if name in FAMILY_COSTS:
+        return name
+    prefixes = [p for p in _FAMILY_PREFIXES if name.startswith(p)]
+    if prefixes:
+        return _FAMILY_PREFIXES[max(prefixes, key=len)]
+    families = [f for f in FAMILY_COSTS if name == f or name.startswith(f + "_")]
+    return max(families, key=len) if families else None
+
+
+def get_cost_func(name: str) -> Optional[Callable[..., Cost]]:
+    # binding name (e.g relu_f16x8_pack) or family name (e.g relu)
+    family = get_family(name)
+    return FAMILY_COSTS[family] if family is not None else None
+
+
+# ------------------------------- device peaks -----------------------------------
+# device name substring -> dense peaks: DRAM GB/s, f32 CUDA Cores TFLOPS,
+# f16 Tensor Cores TFLOPS (f32 accumulate). BENCH_PEAK_GBPS and
+# BENCH_PEAK_TFLOPS override them, e.g for an unlisted device or clocks.
+DEVICE_PEAKS = {
+    "H100 SXM": {"gbps": 3350.0, "tflops_f32": 67.0, "tflops_f16": 989.0},
+    "H100 PCIe": {"gbps": 2000.0, "tflops_f32": 51.0, "tflops_f16": 756.0},
+    "A100-SXM4-80GB": {"gbps": 2039.0, "tflops_f32": 19.5, "tflops_f16": 312.0},
+    "A100-SXM4-40GB": {"gbps": 1555.0, "tflops_f32": 19.5, "tflops_f16": 312.0},
+    "L20": {"gbps": 864.0, "tflops_f32": 59.8, "tflops_f16": 119.5},
+    "RTX 4090": {"gbps": 1008.0, "tflops_f32": 82.6, "tflops_f16": 165.2},
+}
+
+
+def get_peak(device_name: str, dtype: str = "float32") -> Dict[str, Optional[float]]:
+    peak: Dict[str, Optional[float]] = {"gbps": None, "tflops": None}
+    for name, peaks in DEVICE_PEAKS.items():
+        if name in device_name:
+            half = dtype in ("float16", "bfloat16")
+            peak = {"gbps": peaks["gbps"],
+                    "tflops": peaks["tflops_f16" if half else "tflops_f32"]}
+            break
+    if os.environ.get("BENCH_PEAK_GBPS"):
+        peak["gbps"] = float(os.environ["BENCH_PEAK_GBPS"])
+    if os.environ.get("BENCH_PEAK_TFLOPS"):
+        peak["tflops"] = float(os.environ["BENCH_PEAK_TFLOPS"])
+    return peak
+
+
+def get_roofline_info(cost: Cost, time_ms: float, device_name: str = "",
+                      dtype: str = "float32") -> Dict[str, Optional[float]]:
+    # achieved GB/s and TFLOPS, and % of the roofline bound at this
+    # intensity: bandwidth bound below the ridge point, compute bound above.
+    seconds = time_ms * 1e-3
+    gbps = cost.bytes / seconds * 1e-9
+    tflops = cost.flops / seconds * 1e-12
+    peak = get_peak(device_name, dtype)
+    peak_pct = None
+    if peak["gbps"]:
+        bound_tflops = cost.intensity * peak["gbps"] * 1e-3
+        if cost.flops == 0 or not peak["tflops"] or bound_tflops < peak["tflops"]:
+            peak_pct = 100.0 * gbps / peak["gbps"]
+        else:
+            peak_pct = 100.0 * tflops / peak["tflops"]
+    return {"bytes": cost.bytes, "flops": cost.flops, "intensity": cost.intensity,
+            "gbps": gbps, "tflops": tflops, "peak_pct": peak_pct}
+
+
+def format_roofline_info(info: Dict[str, Optional[float]]) -> str:
+    peak = f"({info['peak_pct']:.1f}%)" if info["peak_pct"] is not None else ""
+    return f"{info['gbps']:.1f}GB/s{peak}, AI:{info['intensity']:.2f}"
+
+
+# ------------------------------- plot -------------------------------------------
+def plot_roofline(records: Sequence[Dict[str, Any]], save_path: str,
+                  title: str = "", top: int = 40):
+    # left: roofline (TFLOPS vs FLOPs/byte, log-log) of the kernels that do
+    # FLOPs, right: % of peak DRAM bandwidth of each kernel. median over the
+    # records of the same (tag, dtype, shape) when several runs are given.
+    import matplotlib.pyplot as plt
+    import numpy as np
+    records = [r for r in records if r.get("bytes") and r.get("check_ok") is not False]
+    if not records:
+        raise ValueError("no records with bytes/flops to plot")
+    device_name = records[0].get("device_name", "")
+    fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(20, 9))
+    fig.suptitle(title or f"Roofline, {device_name}")
+
+    peak = get_peak(device_name, "float16")
+    peak_f32 = get_peak(device_name, "float32")
+    intensities = [r["intensity"] for r in records if r.get("flops")]
+    if peak["gbps"] and intensities:
+        x = np.logspace(np.log10(max(min(intensities) / 2, 1e-3)),
+                        np.log10(max(intensities) * 2), 256)
+        for p, label in ((peak_f32, "f32"), (peak, "f16 tensor")):
+            if p["tflops"]:
+                ax0.plot(x, np.minimum(x * p["gbps"] * 1e-3, p["tflops"]),
+                         label=f"roofline({label})", linewidth=2)
+    for r in records:
+        if r.get("flops"):
+            ax0.scatter(r["intensity"], r["tflops"], s=12)
+            ax0.annotate(r["tag"], (r["intensity"], r["tflops"]), fontsize=6)
+    ax0.set_xscale("log")
+    ax0.set_yscale("log")
+    ax0.set_xlabel("Arithmetic Intensity (FLOPs/Byte)")
+    ax0.set_ylabel("TFLOPS")
+    ax0.grid(True, which="both", alpha=0.3)
+    ax0.legend()
+
+    gbps: Dict[str, List[float]] = {}
+    for r in records:
+        label = f"{r.get('script', '')}:{r['tag']}({r['dtype']}, {r['shape']})"
+        gbps.setdefault(label, []).append(r["gbps"])
+    bars = sorted(((k, float(np.median(v))) for k, v in gbps.items()),
+                  key=lambda kv: kv[1])[-top:]
+    ax1.barh([k for k, _ in bars], [v for _, v in bars])
+    if peak["gbps"]:
+        ax1.axvline(peak["gbps"], color="r", linestyle="--", label="peak DRAM")
+        ax1.legend()
+    ax1.set_xlabel("Achieved GB/s")
+    ax1.tick_params(axis="y", labelsize=6)
+    plt.tight_layout()
+    plt.savefig(save_path, dpi=300)
+    return save_path
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    from .compare import get_run_ids
+    from .results import ResultsStore, get_results_path
+    parser = argparse.ArgumentParser(description="roofline of the stored results")
+    parser.add_argument("--path", type=str, default=None, help="results.jsonl path")
+    parser.add_argument("--run", type=str, default=None, help="Run id, default all the runs")
+    parser.add_argument("--latest", action="store_true", help="Only the latest run")
+    parser.add_argument("--device", type=str, default=None, help="Only this device name")
+    parser.add_argument("--top", type=int, default=40, help="Max bars to draw")
+    parser.add_argument("--save", type=str, default="./roofline.png", help="Save path")
+    args = parser.parse_args(argv)
+    records = ResultsStore(args.path or get_results_path()).load()
+    if args.device:
+        records = [r for r in records if r.get("device_name") == args.device]
+    run_id = args.run or (get_run_ids(records)[-1] if args.latest and records else None)
+    if run_id:
+        records = [r for r in records if r["run_id"] == run_id]
+    print(f"roofline saved as {plot_roofline(records, args.save, top=args.top)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import multiprocessing
+from collections import Counter
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+
+from . import results
+from .build import file_lock
+from .results import ResultsStore, read_jsonl
+
+# Parallel, sharded and resumable benchmark sweeps. A sweep is a list of
+# tasks (e.g one per MNK) made of independent jobs (e.g one per kernel,
+# stages, swizzle variant). Tasks are dispatched to a pool of worker
+# processes, one per GPU (pinned with CUDA_VISIBLE_DEVICES) or N workers for
+# the CPU backend, and every job is checkpointed, so that a crashed or
+# interrupted sweep resumes where it stopped. Tasks can also be sharded
+# across machines (shard_tasks). See hgemm/sweep.py.
+#
+# <sweep_dir>/<sweep_id>/         sweep_id: hash of the sweep config
+#   sweep.json                    config and run id, shared by all resumes
+#   shard-<worker>.jsonl          results records of the jobs, with "job"
+#   jobs-<worker>.jsonl           job events: started, done, failed
+#
+# The shard records are merged into the results store when the sweep ends
+# (or is interrupted), under the sweep run id, each job only once.
+
+DEFAULT_SWEEP_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "cuda-learn-notes", "sweeps")
+# a job that took its worker down this many times is not retried
+MAX_ATTEMPTS = 2
+
+
+def get_sweep_dir() -> str:
+    return os.environ.get("BENCH_SWEEP_DIR", DEFAULT_SWEEP_DIR)
+
+
+def get_sweep_id(config: Dict[str, Any]) -> str:
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+@dataclass
+class Task:
+    key: str # e.g "4096x4096x4096", the jobs of a task run on one worker
+    jobs: List[Dict[str, Any]] # picklable, each with a unique "job" key
+
+
+def shard_tasks(tasks: Sequence[Task], num_shards: int = 1, shard_id: int = 0) -> List[Task]:
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"shard id {shard_id} not in [0, {num_shards})")
+    return list(tasks[shard_id::num_shards])
+
+
+def get_workers(backend: str, num_workers: Optional[int] = None) -> List[str]:
+    # cuda: one worker per visible device, cpu: num_workers (default 1)
+    if backend == "cpu":
+        return [str(i) for i in range(num_workers or 1)]
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible:
+        devices = [d.strip() for d in visible.split(",") if d.strip()]
+    else:
+        import torch
+        devices = [str(i) for i in range(torch.cuda.device_count())]
+    if not devices:
+        raise RuntimeError("no CUDA device found, use the cpu backend")
+    return devices[:num_workers or len(devices)]
+
+
+class SweepCheckpoint:
+
+    def __init__(self, config: Dict[str, Any], root: Optional[str] = None):
+        self.config = config
+        self.sweep_id = get_sweep_id(config)
+        self.dir = os.path.join(root or get_sweep_dir(), self.sweep_id)
+        self.run_id: Optional[str] = None # set by open
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.dir, "sweep.json")
+
+    def open(self) -> "SweepCheckpoint":
+        # create the sweep, or reuse the run id of the interrupted one
+        os.makedirs(self.dir, exist_ok=True)
+        with file_lock(os.path.join(self.dir, ".sweep.lock")):
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path) as f:
+                    meta = json.load(f)
+            else:
+                meta = {"sweep_id": self.sweep_id, "run_id": uuid.uuid4().hex[:16],
+                        "created": time.time(), "config": self.config}
+                tmp = f"{self.meta_path}.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump(meta, f, indent=2, default=str)
+                os.replace(tmp, self.meta_path)
+        self.run_id = meta["run_id"]
+        return self
+
+    def shard_path(self, worker: str) -> str:
+        return os.path.join(self.dir, f"shard-{worker}.jsonl")
+
+    def events_path(self, worker: str) -> str:
+        return os.path.join(self.dir, f"jobs-{worker}.jsonl")
+
+    def _read(self, prefix: str) -> List[Dict[str, Any]]:
+        records = []
+        if os.path.isdir(self.dir):
+            for name in sorted(os.listdir(self.dir)):
+                if name.startswith(prefix) and name.endswith(".jsonl"):
+                    records.extend(read_jsonl(os.path.join(self.dir, name)))
+        return records
+
+    def records(self) -> List[Dict[str, Any]]:
+        return self._read("shard-")
+
+    def log_event(self, worker: str, job: str, status: str, error: str = ""):
+        # one writer per file (its worker), an append of a short line
+        event = {"job": job, "status": status, "timestamp": time.time()}
+        if error:
+            event["error"] = error
+        with open(self.events_path(worker), "a") as f:
+            f.write(json.dumps(event) + "\n")
+
+    def get_job_status(self) -> Dict[str, str]:
+        # job -> done, failed (raised, or crashed MAX_ATTEMPTS times) or
+        # started (crashed or interrupted, will be retried)
+        status: Dict[str, str] = {}
+        attempts: Counter = Counter()
+        for e in self._read("jobs-"):
+            job = e["job"]
+            if status.get(job) == "done":
+                continue
+            if e["status"] == "started":
+                attempts[job] += 1
+            status[job] = e["status"]
+        for job, n in attempts.items():
+            if status[job] == "started" and n >= MAX_ATTEMPTS:
+                status[job] = "failed"
+        return status
+
+    def merge(self, store: ResultsStore) -> int:
+        # append the records not merged yet to the store, returns how many
+        if store.path is None:
+            return 0
+        merged = {r.get("job") for r in store.load(run_id=self.run_id)}
+        new: Dict[str, Dict[str, Any]] = {} # the last record of a rerun job
+        for r in self.records():
+            if r.get("job") not in merged:
+                new[f"{r.get('job')}:{r['tag']}"] = r
+        store.append(*new.values())
+        return len(new)
+
+
+# ------------------------------- workers ----------------------------------------
+class ShardStore(ResultsStore):
+    # results store of a worker, tags the records with the running job
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.job: Optional[str] = None
+
+    def append(self, *records: Dict[str, Any]):
+        for record in records:
+            record["job"] = self.job
+        super().append(*records)
+
+
+_WORKER: Dict[str, Any] = {}
+
+
+def _init_worker(devices: Any, backend: str, checkpoint: SweepCheckpoint,
+                 num_threads: Optional[int]):
+    device = devices.get()
+    os.environ["BENCH_BACKEND"] = backend
+    if backend == "cuda":
+        # before anything initializes CUDA in this process
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    if num_threads:
+        os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    name = f"{socket.gethostname()}-{backend}{device}-{os.getpid()}"
+    results.RUN_ID = checkpoint.run_id
+    _WORKER.update(name=name, checkpoint=checkpoint,
+                   store=results.set_store(ShardStore(checkpoint.shard_path(name))))
+
+
+def _run_task(job_func: Callable[[Dict[str, Any]], Any], task: Task) -> Dict[str, int]:
+    name, checkpoint, store = _WORKER["name"], _WORKER["checkpoint"], _WORKER["store"]
+    stats = {"done": 0, "failed": 0}
+    for job in task.jobs:
+        checkpoint.log_event(name, job["job"], "started")
+        store.job = job["job"]
+        try:
+            job_func(job)
+        except Exception as e: # e.g a kernel launch error, keep going
+            checkpoint.log_event(name, job["job"], "failed", f"{type(e).__name__}: {e}")
+            stats["failed"] += 1
+        else:
+            checkpoint.log_event(name, job["job"], "done")
+            stats["done"] += 1
+        finally:
+            store.job = None
+    return stats
+
+
+def run_sweep(tasks: Sequence[Task], job_func: Callable[[Dict[str, Any]], Any],
+              checkpoint: SweepCheckpoint, backend: str, workers: Sequence[str],
+              retry_failed: bool = False, store: Optional[ResultsStore] = None,
+              num_threads: Optional[int] = None) -> Dict[str, int]:
+    # job_func(job) runs one job in a worker and records its results with
+    # bench.record_result, it must be picklable (a module level function).
+    # done jobs are skipped, failed ones too unless retry_failed.
+    checkpoint.open()
+    status = checkpoint.get_job_status()
+    skip: Set[str] = {j for j, s in status.items()
+                      if s == "done" or (s == "failed" and not retry_failed)}
+    pending = [Task(t.key, [j for j in t.jobs if j["job"] not in skip]) for t in tasks]
+    pending = [t for t in pending if t.jobs]
+    num_jobs = sum(len(t.jobs) for t in tasks)
+    num_pending = sum(len(t.jobs) for t in pending)
+    print(f"sweep {checkpoint.sweep_id} (run {checkpoint.run_id}): {num_jobs} jobs, "
+          f"{num_jobs - num_pending} done or skipped, {num_pending} to run on "
+          f"{len(workers)} {backend} worker(s), checkpoint: {checkpoint.dir}")
+    stats = {"done": 0, "failed": 0, "crashed": 0}
+    ctx = multiprocessing.get_context("spawn") # no CUDA state inherited
+    devices = ctx.Queue()
+    for device in workers:
+        devices.put(device)
+    pool = ProcessPoolExecutor(max_workers=len(workers), mp_context=ctx,
+                               initializer=_init_worker,
+                               initargs=(devices, backend, checkpoint, num_threads))
+    try:
+        futures = {pool.submit(_run_task, job_func, task): task for task in pending}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                task_stats = future.result()
+            except BrokenProcessPool:
+                # the running jobs are retried on resume, up to MAX_ATTEMPTS
+                stats["crashed"] += 1
+                print("a worker crashed, run the same sweep again to resume")
+                break
+            stats["done"] += task_stats["done"]
+            stats["failed"] += task_stats["failed"]
+            print(f"[{i + 1}/{len(pending)}] {futures[future].key}: {task_stats['done']} done, "
+                  f"{task_stats['failed']} failed")
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if store is not None:
+            print(f"merged {checkpoint.merge(store)} records into {store.path}")
+    return stats
@@ -0,0 +1,118 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from bench import build
+from bench.build import (ArtifactMissingError, LockTimeoutError, evict, file_lock,
+                         list_entries, make_build_key)
+
+# build cache key, locking and eviction, without nvcc.
+FLAGS = (["-O3"], ["-O3", "--use_fast_math"], [])
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+
+def build_key(sources, flags=FLAGS, toolchain="torch-2.4-cuda-12.4-py310", arch="8.9"):
+    return make_build_key("hgemm_lib", sources, *flags, toolchain, arch)
+
+
+def test_build_key(tmp_path):
+    source = write(tmp_path / "a" / "hgemm.cu", "__global__ void f() {}")
+    key = build_key([source])
+    assert key == build_key([source]) and len(key) == 64
+    # the same source somewhere else: same key, artifacts are shared
+    assert build_key([write(tmp_path / "b" / "hgemm.cu", "__global__ void f() {}")]) == key
+    # anything that changes the binary changes the key
+    changed = [
+        build_key([write(tmp_path / "c" / "hgemm.cu", "__global__ void g() {}")]),
+        build_key([write(tmp_path / "d" / "hgemm_v2.cu", "__global__ void f() {}")]),
+        build_key([source], flags=(["-O3"], ["-O3"], [])),
+        build_key([source], flags=(["-O3"], ["--use_fast_math", "-O3"], [])),
+        build_key([source], flags=([], ["-O3", "--use_fast_math"], ["-O3"])),
+        build_key([source], toolchain="torch-2.4-cuda-12.1-py310"),
+        build_key([source], arch="9.0"),
+        make_build_key("sgemm_lib", [source], *FLAGS, "torch-2.4-cuda-12.4-py310", "8.9"),
+    ]
+    assert len(set(changed + [key])) == len(changed) + 1
+
+
+def test_target_arch(monkeypatch):
+    monkeypatch.setenv("TORCH_CUDA_ARCH_LIST", "8.0;9.0")
+    assert build.get_target_arch() == "8.0;9.0"
+
+
+def test_file_lock(tmp_path):
+    path = str(tmp_path / "entry.lock")
+    with file_lock(path):
+        # flock is per open file, a second open conflicts in the same process
+        start = time.monotonic()
+        with pytest.raises(LockTimeoutError):
+            with file_lock(path, timeout=0):
+                pass
+        with pytest.raises(TimeoutError):
+            with file_lock(path, timeout=1):
+                pass
+        assert time.monotonic() - start >= 1.0
+        # and in another process
+        proc = subprocess.run(
+            [sys.executable, "-c", "import sys; from bench.build import file_lock\n"
+             "with file_lock(sys.argv[1], timeout=0): pass", path],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True)
+        assert proc.returncode != 0 and "LockTimeoutError" in proc.stderr
+    # released on exit, also on an exception
+    with pytest.raises(ValueError):
+        with file_lock(path, timeout=0):
+            raise ValueError
+    with file_lock(path, timeout=0):
+        pass
+
+
+def make_entry(cache_dir, key, size, last_used):
+    entry_dir = os.path.join(cache_dir, key)
+    write(os.path.join(entry_dir, "lib.so"), "x" * size)
+    build._touch(entry_dir)
+    os.utime(os.path.join(entry_dir, ".last_used"), (last_used, last_used))
+
+
+def test_evict(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for i, key in enumerate(["k0", "k1", "k2", "k3"]):
+        make_entry(cache_dir, key, 100, 1000.0 + i)
+    assert sorted(e["key"] for e in list_entries(cache_dir)) == ["k0", "k1", "k2", "k3"]
+    assert evict(cache_dir, max_size=1000) == []
+    # least recently used first, `keep` and the locked entries are never evicted
+    with file_lock(os.path.join(cache_dir, "k1.lock")):
+        assert evict(cache_dir, max_size=300, keep="k0") == ["k2"]
+    assert sorted(e["key"] for e in list_entries(cache_dir)) == ["k0", "k1", "k3"]
+    assert evict(cache_dir, max_size=200) == ["k0"]
+    assert evict(cache_dir, max_size=0) == ["k1", "k3"]
+    assert list_entries(cache_dir) == []
+
+
+def test_load_missing_artifact(tmp_path, monkeypatch):
+    monkeypatch.setattr(build, "find_nvcc", lambda: None)
+    monkeypatch.setattr(build, "get_toolchain_version", lambda: "torch-2.4-cuda-12.4-py310")
+    monkeypatch.setenv("TORCH_CUDA_ARCH_LIST", "8.9")
+    source = write(tmp_path / "hgemm.cu", "__global__ void f() {}")
+    cache_dir = str(tmp_path / "cache")
+    with pytest.raises(ArtifactMissingError, match="no nvcc found"):
+        build.load("hgemm_lib", [source], cache_dir=cache_dir)
+    # an artifact under the right key is imported, not rebuilt
+    key = make_build_key("hgemm_lib", [source], [], [], [],
+                         "torch-2.4-cuda-12.4-py310", "8.9")
+    write(os.path.join(cache_dir, key, "hgemm_lib.so"), "")
+    imported = []
+    monkeypatch.setattr(build, "import_extension",
+                        lambda name, path: imported.append((name, path)) or name)
+    assert build.load("hgemm_lib", [source], cache_dir=cache_dir) == "hgemm_lib"
+    assert imported == [("hgemm_lib", os.path.join(cache_dir, key, "hgemm_lib.so"))]
+    assert os.path.exists(os.path.join(cache_dir, key, ".last_used"))
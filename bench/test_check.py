@@ -0,0 +1,91 @@
+import math
+
+import pytest
+
+from bench.check import TOLERANCES, check_close, get_tolerance, sum_tolerance, ulp
+
+# check_close: default and given tolerances, nan/inf, ULP errors.
+torch = pytest.importorskip("torch")
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_default_tolerance(dtype):
+    atol, rtol = TOLERANCES[str(dtype).replace("torch.", "")]
+    assert get_tolerance(dtype) == (atol, rtol)
+    ref = torch.tensor([0.0, 1.0, -2.0, 4.0], dtype=torch.float64)
+    # within atol + rtol * |ref|, then over it in one element
+    inside = ref + 0.5 * (atol + rtol * ref.abs())
+    result = check_close(inside.to(dtype), inside)
+    assert result.ok and (result.atol, result.rtol) == (atol, rtol)
+    outside = inside.clone()
+    outside[3] = ref[3] + 2.0 * (atol + rtol * ref[3].abs())
+    result = check_close(outside.to(dtype), ref)
+    assert not result.ok and result.num_mismatch == 1 and result.numel == 4
+    assert result.max_abs == pytest.approx(2.0 * (atol + rtol * 4.0), rel=0.05)
+
+
+def test_given_tolerance():
+    ref = torch.tensor([1.0, 2.0, 3.0], dtype=torch.float64)
+    out = ref + torch.tensor([0.0, 0.0, 0.25], dtype=torch.float64)
+    # 0.25 <= atol + rtol * 3 is inclusive
+    assert check_close(out, ref, atol=0.1, rtol=0.05).ok
+    assert not check_close(out, ref, atol=0.1, rtol=0.04).ok
+    assert check_close(out, ref, atol=0.25, rtol=0.0).ok
+    assert not check_close(out, ref, atol=0.0, rtol=0.0).ok
+    # chunked the same as in one go
+    big_ref = torch.randn(1000, dtype=torch.float64)
+    big_out = big_ref + 1e-3 * torch.randn(1000, dtype=torch.float64)
+    one = check_close(big_out, big_ref, atol=1e-3, rtol=0.0)
+    chunked = check_close(big_out, big_ref, atol=1e-3, rtol=0.0, chunk_size=7)
+    assert (one.num_mismatch, one.max_abs, one.max_ulp) == \
+        (chunked.num_mismatch, chunked.max_abs, chunked.max_ulp)
+    assert one.mean_ulp == pytest.approx(chunked.mean_ulp)
+
+
+def test_integer_exact():
+    ref = torch.tensor([1, 2, 3], dtype=torch.int32)
+    assert get_tolerance(torch.int32) == (0.0, 0.0)
+    assert check_close(ref.clone(), ref).ok
+    result = check_close(torch.tensor([1, 2, 4], dtype=torch.int32), ref)
+    assert not result.ok and result.max_abs == 1.0 and result.max_ulp == 1.0
+
+
+def test_nan_inf():
+    nan, inf = float("nan"), float("inf")
+    ref = torch.tensor([1.0, nan, inf, -inf])
+    assert check_close(ref.clone(), ref).ok # nan == nan, inf == inf
+    result = check_close(torch.tensor([nan, nan, inf, -inf]), ref)
+    assert not result.ok and result.num_mismatch == 1 and math.isinf(result.max_abs)
+    result = check_close(torch.tensor([1.0, 0.0, inf, inf]), ref)
+    assert result.num_mismatch == 2
+    assert "WRONG(mismatch:2/4" in result.summary()
+
+
+def test_shape_mismatch():
+    result = check_close(torch.zeros(2, 3), torch.zeros(4, 3))
+    assert not result.ok and result.error == "shape (2, 3) vs (4, 3)"
+    assert result.summary() == "WRONG(shape (2, 3) vs (4, 3))"
+    # same numel, compared flat
+    assert check_close(torch.zeros(2, 3), torch.zeros(3, 2)).ok
+
+
+def test_ulp():
+    # f16 around 1.0: 2^-10 above, 2^-11 below, subnormal spacing near 0
+    x = torch.tensor([1.0, 1.5, 0.75, 1024.0, 0.0], dtype=torch.float64)
+    assert ulp(x, torch.float16).tolist() == [2 ** -10, 2 ** -10, 2 ** -11, 1.0, 2 ** -24]
+    assert ulp(torch.tensor([1.0], dtype=torch.float64), torch.float32).item() == 2 ** -23
+    ref = torch.ones(4, dtype=torch.float64)
+    out = torch.tensor([1.0, 1.0 + 2 ** -10, 1.0 + 3 * 2 ** -10, 1.0]).half()
+    result = check_close(out, ref)
+    assert result.max_ulp == 3.0 and result.mean_ulp == 1.0
+    assert result.ok and result.summary() == "ok(ulp:3)"
+
+
+def test_sum_tolerance():
+    eps = torch.finfo(torch.float16).eps
+    assert sum_tolerance(1, torch.float16) == (4.0 * eps, 1e-2)
+    atol, rtol = sum_tolerance(4096, torch.float16, rtol=0.0)
+    assert atol == pytest.approx(4.0 * eps * 64 * 12) and rtol == 0.0
+    # grows with n
+    assert sum_tolerance(1 << 20, torch.float32)[0] > sum_tolerance(1 << 10, torch.float32)[0]
+    assert sum_tolerance(4096, torch.int32) == (0.0, 0.0)
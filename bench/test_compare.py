@@ -0,0 +1,132 @@
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+from bench.compare import (bootstrap_ratio_ci, compare_runs, main, mann_whitney_u,
+                           select_runs)
+
+# bench.compare on synthetic results files: two runs of the same kernels,
+# with an injected 30% slowdown of one of them, or noise only.
+TAGS = ["(mma2x4+warp4x4)", "(cublas)", "(wmma4x2)"]
+REGRESSED = "(mma2x4+warp4x4)"
+
+
+def make_record(run_id, tag, samples, timestamp, **extra):
+    record = {"run_id": run_id, "timestamp": timestamp, "script": "hgemm.py",
+              "tag": tag, "shape": "4096x4096x4096", "dtype": "float16",
+              "device_name": "NVIDIA L20", "median_ms": sorted(samples)[len(samples) // 2],
+              "samples_ms": samples, "check_ok": True}
+    record.update(extra)
+    return record
+
+
+def write_runs(path, slowdown=1.0, num_samples=30, seed=0):
+    # base run then new run, each tag ~1ms +- 2% noise, the REGRESSED tag
+    # slowdown times slower in the new run
+    rng = random.Random(seed)
+    records = []
+    for i, run_id in enumerate(["base", "new"]):
+        for tag in TAGS:
+            scale = slowdown if run_id == "new" and tag == REGRESSED else 1.0
+            samples = [scale * rng.gauss(1.0, 0.02) for _ in range(num_samples)]
+            records.append(make_record(run_id, tag, samples, 1000.0 + i))
+    with open(path, "w") as f:
+        f.writelines(json.dumps(r) + "\n" for r in records)
+    return records
+
+
+@pytest.mark.parametrize("method", ["mannwhitney", "bootstrap"])
+def test_regression_flagged(tmp_path, method):
+    records = write_runs(tmp_path / "results.jsonl", slowdown=1.3)
+    comparisons = compare_runs(records, "new", ["base"], method=method)
+    assert [c.tag for c in comparisons if c.regressed] == [REGRESSED]
+    assert not any(c.improved for c in comparisons)
+    c = comparisons[0] # most regressed first
+    assert c.tag == REGRESSED and c.change == pytest.approx(0.3, abs=0.03)
+    # all 30 new samples above all 30 base ones
+    assert c.p_value < 1e-9
+    assert 1.25 < c.ci_low <= c.new_median / c.base_median <= c.ci_high < 1.35
+    assert main(["--path", str(tmp_path / "results.jsonl"), "--method", method]) == 1
+
+
+@pytest.mark.parametrize("method", ["mannwhitney", "bootstrap"])
+def test_noise_only(tmp_path, method):
+    records = write_runs(tmp_path / "results.jsonl", slowdown=1.0)
+    comparisons = compare_runs(records, "new", ["base"], method=method)
+    assert len(comparisons) == len(TAGS)
+    assert not any(c.regressed or c.improved for c in comparisons)
+    for c in comparisons:
+        assert c.p_value > 0.05 or abs(c.change) < 0.05
+        assert c.ci_low < 1.05 and c.ci_high > 0.95
+    assert main(["--path", str(tmp_path / "results.jsonl"), "--method", method]) == 0
+
+
+def test_exit_code(tmp_path):
+    # python3 -m bench.compare fails a CI job on a regression only
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for slowdown, code in ((1.3, 1), (1.0, 0)):
+        write_runs(tmp_path / "results.jsonl", slowdown=slowdown)
+        proc = subprocess.run([sys.executable, "-m", "bench.compare", "--path",
+                               str(tmp_path / "results.jsonl")],
+                              cwd=root, capture_output=True, text=True)
+        assert proc.returncode == code, proc.stdout + proc.stderr
+        assert ("REGRESSED" in proc.stdout) == (code == 1)
+
+
+def test_significant_but_small(tmp_path):
+    # a consistent 2% shift is significant, but under the 5% threshold
+    records = write_runs(tmp_path / "results.jsonl", slowdown=1.02, num_samples=200)
+    c = next(c for c in compare_runs(records, "new", ["base"]) if c.tag == REGRESSED)
+    assert c.p_value < 0.05 and not c.regressed
+    assert next(c for c in compare_runs(records, "new", ["base"], threshold=0.01)
+                if c.tag == REGRESSED).regressed
+
+
+def test_mann_whitney_u():
+    # U = 9, mu = 4.5, var = 3 * 3 / 12 * 7, z = (9 - 4.5 - 0.5) / sqrt(var)
+    u, p = mann_whitney_u([4.0, 5.0, 6.0], [1.0, 2.0, 3.0])
+    assert u == 9.0
+    assert p == pytest.approx(0.5 * math.erfc(4.0 / math.sqrt(5.25) / math.sqrt(2.0)))
+    assert p == pytest.approx(0.0404, abs=1e-4)
+    # the other side, and all equal samples (no variance)
+    assert mann_whitney_u([1.0, 2.0, 3.0], [4.0, 5.0, 6.0])[1] > 0.95
+    assert mann_whitney_u([1.0] * 5, [1.0] * 5) == (12.5, 1.0)
+    assert mann_whitney_u([], [1.0])[1] == 1.0
+
+
+def test_mann_whitney_u_scipy():
+    stats = pytest.importorskip("scipy.stats")
+    rng = random.Random(1)
+    x = [round(rng.gauss(1.1, 0.1), 2) for _ in range(40)] # with ties
+    y = [round(rng.gauss(1.0, 0.1), 2) for _ in range(25)]
+    u, p = mann_whitney_u(x, y)
+    ref = stats.mannwhitneyu(x, y, alternative="greater", method="asymptotic",
+                             use_continuity=True)
+    assert u == pytest.approx(ref.statistic) and p == pytest.approx(ref.pvalue)
+
+
+def test_bootstrap_ratio_ci():
+    base = [1.0, 1.1, 0.9, 1.05, 0.95]
+    # new = 2 * base: the CI holds 2, the same seed gives the same CI
+    ci = bootstrap_ratio_ci(base, [2 * b for b in base], seed=3)
+    assert ci[0] <= 2.0 <= ci[1]
+    assert ci == bootstrap_ratio_ci(base, [2 * b for b in base], seed=3)
+    # constant samples: a zero width CI
+    assert bootstrap_ratio_ci([1.0] * 10, [1.5] * 10) == (1.5, 1.5)
+
+
+def test_select_runs_and_wrong_records():
+    records = [make_record(f"run{i}", "(cublas)", [1.0 + i], 1000.0 + i) for i in range(4)]
+    assert select_runs(records) == ("run3", ["run2"])
+    assert select_runs(records, rolling=2) == ("run3", ["run1", "run2"])
+    assert select_runs(records, "run2", "run0") == ("run2", ["run0"])
+    with pytest.raises(ValueError):
+        select_runs(records, "run0")
+    # records that failed their check are not compared
+    records.append(make_record("run4", "(cublas)", [9.0] * 10, 1004.0, check_ok=False))
+    assert compare_runs(records, "run4", ["run3"]) == []
@@ -0,0 +1,176 @@
+import os
+
+import pytest
+
+from bench import registry
+from bench.registry import (SKIP_BINDINGS_FLAG, find_binding, lazy_load,
+                            make_bindings_stub, parse_bindings, parse_defines)
+
+# binding registry of the multi TU libs, nothing is compiled here.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HGEMM_SOURCES = ["hgemm.cu", "hgemm_async.cu", "hgemm_wmma.cu", "hgemm_wmma_stage.cu",
+                 "hgemm_cublas.cu", "hgemm_mma.cu", "hgemm_mma_stage.cu",
+                 "hgemm_mma_stage_tn.cu"]
+SGEMM_SOURCES = ["sgemm.cu", "sgemm_async.cu", "sgemm_wmma_tf32_stage.cu", "sgemm_cublas.cu"]
+GEMM = "(torch::Tensor a, torch::Tensor b, torch::Tensor c)"
+GEMM_STAGES = ("(torch::Tensor a, torch::Tensor b, torch::Tensor c, "
+               "int stages, bool swizzle, int swizzle_stride)")
+
+
+def sources(lib, names):
+    return [os.path.join(ROOT, lib, s) for s in names]
+
+
+def test_parse_bindings():
+    hgemm = parse_bindings("hgemm_lib", sources("hgemm", HGEMM_SOURCES))
+    sgemm = parse_bindings("sgemm_lib", sources("sgemm", SGEMM_SOURCES))
+    # exposed in hgemm.cu/sgemm.cu, defined in the TU of each kernel family
+    expected = {
+        "hgemm_naive_f16": ("hgemm.cu", GEMM),
+        "hgemm_t_8x8_sliced_k16_f16x8_pack_dbuf_async": ("hgemm_async.cu", GEMM),
+        "hgemm_wmma_m16n16k16_mma4x2": ("hgemm_wmma.cu", GEMM),
+        "hgemm_wmma_m16n16k16_mma4x2_warp2x4_stages": ("hgemm_wmma_stage.cu", GEMM_STAGES),
+        "hgemm_mma_m16n8k16_mma2x4_warp4x4": ("hgemm_mma.cu", GEMM),
+        "hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem": ("hgemm_mma_stage.cu", GEMM_STAGES),
+        "hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn": ("hgemm_mma_stage_tn.cu",
+                                                             GEMM_STAGES),
+        "hgemm_cublas_tensor_op_nn": ("hgemm_cublas.cu", GEMM),
+        "hgemm_cublas_tensor_op_tn": ("hgemm_cublas.cu", GEMM),
+        "sgemm_naive_f32": ("sgemm.cu", GEMM),
+        "sgemm_t_8x8_sliced_k16_f32x4_bcf_dbuf_async": ("sgemm_async.cu", GEMM),
+        "sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages": ("sgemm_wmma_tf32_stage.cu", GEMM_STAGES),
+        "sgemm_cublas_tf32": ("sgemm_cublas.cu", GEMM),
+    }
+    for name, (source, params) in expected.items():
+        binding = (hgemm if name.startswith("h") else sgemm)[name]
+        assert binding.lib == ("hgemm_lib" if name.startswith("h") else "sgemm_lib")
+        assert os.path.basename(binding.source) == source
+        assert binding.declaration == f"void {name}{params}"
+    # every exposed binding has a parsed definition
+    assert all(b.declaration for b in [*hgemm.values(), *sgemm.values()])
+
+
+def test_parse_comments_and_macros(tmp_path):
+    src = tmp_path / "ops.cu"
+    src.write_text(
+        "#define TORCH_BINDING_COMMON_EXTENSION(func) m.def(#func, &func);\n"
+        "void f16_add(torch::Tensor a,\n"
+        "             torch::Tensor b) {\n}\n"
+        "/* void old_add(torch::Tensor a) {} */\n"
+        "PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {\n"
+        "  TORCH_BINDING_COMMON_EXTENSION(f16_add)\n"
+        "  // TORCH_BINDING_COMMON_EXTENSION(old_add)\n"
+        "  TORCH_BINDING_COMMON_EXTENSION(macro_made)\n"
+        "}\n")
+    bindings = parse_bindings("ops_lib", [str(src)])
+    assert list(bindings) == ["f16_add", "macro_made"]
+    assert bindings["f16_add"].declaration == "void f16_add(torch::Tensor a, torch::Tensor b)"
+    # not parsable: needs the full lib
+    assert bindings["macro_made"].source is None and bindings["macro_made"].declaration is None
+
+
+def test_parse_defines(tmp_path):
+    src = tmp_path / "norm.cu"
+    src.write_text("#define NORM_WARP_MAX_K 1024\n"
+                   "  #define NEG -1\n"
+                   "// #define OLD 7\n"
+                   "#define WARP_SIZE 32 // lanes\n"
+                   "#define FLOAT4(value) (reinterpret_cast<float4*>(&(value))[0])\n")
+    assert parse_defines(str(src)) == {"NORM_WARP_MAX_K": 1024, "NEG": -1, "WARP_SIZE": 32}
+    # the norm *_auto strategy thresholds, the same in both libs
+    rms = parse_defines(os.path.join(ROOT, "rms-norm", "rms_norm.cu"))
+    layer = parse_defines(os.path.join(ROOT, "layer-norm", "layer_norm.cu"))
+    for name in ("NORM_WARP_MAX_K", "NORM_BLOCK_MAX_K"):
+        assert rms[name] == layer[name]
+    assert 0 < rms["NORM_WARP_MAX_K"] < rms["NORM_BLOCK_MAX_K"]
+
+
+def test_bindings_stub():
+    tn = os.path.join(ROOT, "hgemm", "hgemm_mma_stage_tn.cu")
+    bindings = [b for b in parse_bindings("hgemm_lib", sources("hgemm", HGEMM_SOURCES)).values()
+                if b.source == tn]
+    assert [b.name for b in bindings] == ["hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn"]
+    stub = make_bindings_stub(bindings)
+    assert f"void hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn{GEMM_STAGES};" in stub
+    assert ("PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {\n"
+            "  TORCH_BINDING_COMMON_EXTENSION(hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn)\n"
+            "}") in stub
+    # the all-in-one module is skipped in the per TU builds
+    assert SKIP_BINDINGS_FLAG == "-DSKIP_TORCH_BINDINGS"
+    for path in (os.path.join(ROOT, "hgemm", "hgemm.cu"), os.path.join(ROOT, "sgemm", "sgemm.cu")):
+        with open(path) as f:
+            src = f.read()
+        guard = src.index("#ifndef SKIP_TORCH_BINDINGS")
+        assert guard < src.index("PYBIND11_MODULE") < src.index("#endif", guard)
+
+
+class FakeModule:
+
+    def __getattr__(self, attr):
+        return f"built:{attr}"
+
+
+@pytest.fixture
+def builds(tmp_path, monkeypatch):
+    # load() calls, instead of building
+    monkeypatch.setenv("BENCH_BUILD_CACHE", str(tmp_path / "cache"))
+    calls = []
+    monkeypatch.setattr(registry, "load", lambda **kwargs: calls.append(kwargs) or FakeModule())
+    return calls
+
+
+def test_lazy_build_unit(tmp_path, builds):
+    lib = lazy_load("hgemm_lib", sources("hgemm", HGEMM_SOURCES),
+                    extra_cuda_cflags=["-O3"], backend="cuda")
+    assert builds == [] # nothing at creation
+    name = "hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn"
+    assert getattr(lib, name) == f"built:{name}"
+    assert getattr(lib, name) == f"built:{name}" # resolved once
+    call, = builds
+    stub = os.path.join(str(tmp_path / "cache"), "stubs",
+                        "hgemm_lib_hgemm_mma_stage_tn_bindings.cc")
+    assert call["name"] == "hgemm_lib_hgemm_mma_stage_tn"
+    assert call["sources"] == [stub, os.path.join(ROOT, "hgemm", "hgemm_mma_stage_tn.cu")]
+    assert call["extra_cuda_cflags"] == ["-O3", SKIP_BINDINGS_FLAG]
+    with open(stub) as f:
+        assert f.read() == make_bindings_stub([find_binding(name)])
+    # an other binding of the same TU reuses its build
+    lib.hgemm_cublas_tensor_op_nn
+    lib.hgemm_cublas_tensor_op_tn
+    assert [c["name"] for c in builds] == ["hgemm_lib_hgemm_mma_stage_tn",
+                                          "hgemm_lib_hgemm_cublas"]
+    with pytest.raises(AttributeError):
+        lib.hgemm_unknown
+    assert find_binding(name).lib == "hgemm_lib"
+    with pytest.raises(KeyError):
+        find_binding("hgemm_unknown")
+
+
+def test_lazy_build_full(tmp_path, builds):
+    # single TU libs and bindings we can not parse build the full lib
+    src = tmp_path / "ops.cu"
+    src.write_text("PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {\n"
+                   "  TORCH_BINDING_COMMON_EXTENSION(macro_made)\n}\n")
+    lib = lazy_load("ops_lib", [str(src)], backend="cuda")
+    assert lib.macro_made == "built:macro_made"
+    assert [(c["name"], c["sources"]) for c in builds] == [("ops_lib", [str(src)])]
+
+
+@pytest.mark.parametrize("backend", ["cpu", None])
+def test_cpu_backend(monkeypatch, builds, backend):
+    # BENCH_BACKEND=cpu: the bindings are the references, nothing is built
+    import torch
+    from bench import reference
+    monkeypatch.setenv("BENCH_BACKEND", "cpu")
+    for lib_name, dir_name, names in (("hgemm_lib", "hgemm", HGEMM_SOURCES),
+                                      ("sgemm_lib", "sgemm", SGEMM_SOURCES)):
+        lib = lazy_load(lib_name, sources(dir_name, names), backend=backend)
+        assert lib.bindings()
+        for name in lib.bindings():
+            assert getattr(lib, name) is reference.REFERENCES[name]
+    assert builds == []
+    a, b = torch.randn(64, 32).half(), torch.randn(32, 128).half()
+    c = torch.zeros(64, 128).half()
+    hgemm = lazy_load("hgemm_lib", sources("hgemm", HGEMM_SOURCES), backend=backend)
+    hgemm.hgemm_mma_m16n8k16_mma2x4_warp4x4(a, b, c)
+    assert torch.allclose(c.float(), a.float() @ b.float(), atol=1e-1, rtol=1e-2)
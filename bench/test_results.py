@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from bench import results
+from bench.harness import BenchResult, run_benchmark
+from bench.results import ResultsStore, read_jsonl, record_result
+from bench.roofline import Cost, gemm_cost, get_roofline_info
+
+# the results store and the roofline fields of the records, on CPU tensors.
+SAMPLES = [1.0, 1.2, 0.8, 1.1, 0.9] # ms, median 1.0
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setenv("BENCH_BACKEND", "cpu")
+    store = ResultsStore(str(tmp_path / "results.jsonl"))
+    monkeypatch.setattr(results, "_STORE", store)
+    return store
+
+
+def test_record_result_roofline(store):
+    import torch
+    M, N, K = 64, 128, 32
+    a, b = torch.randn(M, K).half(), torch.randn(K, N).half()
+    result = BenchResult.from_samples("(mma)", SAMPLES)
+    info = get_roofline_info(gemm_cost(a, b), result.median, "NVIDIA L20", "float16")
+    record = record_result(result, kernel="hgemm_mma", shape=(M, N, K),
+                           dtype=a.dtype, stages=2, **info)
+    assert record["shape"] == "64x128x32" and record["dtype"] == "float16"
+    assert record["median_ms"] == 1.0 and record["samples_ms"] == SAMPLES
+    assert record["bytes"] == (M * K + K * N + M * N) * 2
+    assert record["flops"] == 2 * M * N * K
+    assert record["intensity"] == pytest.approx(record["flops"] / record["bytes"])
+    # 1ms: bytes * 1e-6 GB/s, flops * 1e-9 TFLOPS, bandwidth bound on L20
+    assert record["tflops"] == pytest.approx(2 * M * N * K * 1e-9)
+    assert record["gbps"] == pytest.approx(record["bytes"] * 1e-6)
+    assert record["peak_pct"] == pytest.approx(100.0 * record["gbps"] / 864.0)
+    # what is stored is what is returned
+    assert json.loads(json.dumps(store.load()[0])) == json.loads(json.dumps(record))
+    assert len(store.load()) == 1
+
+
+def test_roofline_peak():
+    # 100 FLOPs/byte * 3350 GB/s is under the 989 TFLOPS peak: bandwidth bound
+    cost = Cost(bytes=1000, flops=100000)
+    info = get_roofline_info(cost, 1e-3, "NVIDIA H100 SXM", "float16")
+    assert info["gbps"] == pytest.approx(1.0) and info["tflops"] == pytest.approx(0.1)
+    assert info["peak_pct"] == pytest.approx(100.0 * 1.0 / 3350.0)
+    # 1000 FLOPs/byte is above the ridge point: compute bound
+    info = get_roofline_info(Cost(1000, 1000000), 1e-3, "NVIDIA H100 SXM", "float16")
+    assert info["tflops"] == pytest.approx(1.0)
+    assert info["peak_pct"] == pytest.approx(100.0 * 1.0 / 989.0)
+    assert get_roofline_info(Cost(1000, 0), 1e-3, "NVIDIA H100 SXM")["peak_pct"] == \
+        pytest.approx(100.0 * 1.0 / 3350.0)
+    # unknown device: no peak
+    assert get_roofline_info(cost, 1e-3, "cpu")["peak_pct"] is None
+
+
+def test_run_benchmark_record(store):
+    import torch
+    a, b = torch.randn(32, 16), torch.randn(16, 8)
+    _, result = run_benchmark(torch.matmul, [a, b], "(torch)", warmup=1, iters=3,
+                              ref=lambda: a @ b, cost=gemm_cost,
+                              meta={"shape": (32, 8, 16)})
+    record, = store.load(tag="(torch)")
+    assert record["check_ok"] is True and record["iters"] == 3
+    assert record["shape"] == "32x8x16" and record["dtype"] == "float32"
+    for k in ("bytes", "flops", "intensity", "gbps", "tflops"):
+        assert record[k] == pytest.approx(result.roofline[k])
+    assert record["tflops"] == pytest.approx(2 * 32 * 8 * 16 * 1e-9 / result.median)
+
+
+def test_store_load(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    store = ResultsStore(path)
+    result = BenchResult.from_samples("(a)", SAMPLES)
+    store.append(results.make_record(result, shape=(8, 8), dtype="float32"),
+                 results.make_record(result, shape=(16, 16), dtype="float32"))
+    # a partial line from a killed writer is skipped
+    with open(path, "a") as f:
+        f.write('{"tag": "(a)", "shape": "32')
+    assert len(read_jsonl(path)) == 2
+    assert [r["shape"] for r in ResultsStore(path).load(tag="(a)", shape="16x16")] == ["16x16"]
+    assert ResultsStore(path).load(tag="(b)") == []
+    # in memory only
+    memory = ResultsStore()
+    memory.append({"tag": "(a)"})
+    assert memory.records == [{"tag": "(a)"}] and memory.load() == []
@@ -1,6 +1,9 @@
 import torch
-import time
-from torch.utils.cpp_extension import load
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import lazy_load
 from functools import partial
 from typing import Optional
 from torch.nn.functional import embedding
@@ -8,7 +11,7 @@ from torch.nn.functional import embedding
 torch.set_grad_enabled(False)
 
 # Load the CUDA kernel as a python module
-lib = load(
+lib = lazy_load(
     name="embedding",
     sources=["embedding.cu"],
     extra_cuda_cflags=[
@@ -23,48 +26,20 @@ lib = load(
     ],
     extra_cflags=["-std=c++17"],
 )
+device = bench.get_device()
 
 
-def run_benchmark(
-    perf_func: callable,
-    a: torch.Tensor,
-    b: torch.Tensor,
-    tag: str,
-    out: Optional[torch.Tensor] = None,
-    warmup: int = 2,
-    iters: int = 20,
-    show_all: bool = False,
-):
-    if out is not None:
-        out.fill_(0)
-    if out is not None:
-        for i in range(warmup):
-            perf_func(a, b, out)
-    else:
-        for i in range(warmup):
-            _ = perf_func(a, b)
-
-    torch.cuda.synchronize()
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            perf_func(a, b, out)
-    else:
-        for i in range(iters):
-            out = perf_func(a, b)
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000  # ms
-    mean_time = total_time / iters
-    out_info = f"out_{tag}"
-    out_val = out.flatten().detach().cpu().numpy().tolist()[:3]
-    out_val = [round(v, 8) for v in out_val]
-    out_val = [f"{v:<12}" for v in out_val]
-    print(f"{out_info:>23}: {out_val}, time:{mean_time:.6f}ms")
-    if show_all:
-        print(out)
-    return out.clone(), mean_time
+def run_benchmark(perf_func: callable, 
+                  a: torch.Tensor, b: torch.Tensor,
+                  tag: str, out: Optional[torch.Tensor] = None, 
+                  warmup: int = 2, iters: int = 20,
+                  show_all: bool = False):
+    out, result = bench.run_benchmark(perf_func, (a, b), tag, out,
+                                      warmup=warmup, iters=iters,
+                                      show_all=show_all, width=23,
+                                      ref=lambda: b[a.long()],
+                                      cost="embedding")
+    return out.clone(), result
 
 
 Ms = [1024, 4096]  # max value of token_ids
@@ -74,9 +49,9 @@ MNKs = [(M, N, K) for M in Ms for N in Ns for K in Ks]
 for M, N, K in MNKs:
     print("-" * 110)
     print(" " * 45 + f"MaxV={M}, SeqLen={N}, EmbSize={K}")
-    i = torch.randint(0, M, size=(N,)).cuda().int().contiguous()
-    weight = torch.randn((M, K)).float().cuda().contiguous()
-    o = torch.zeros((N, K)).float().cuda().contiguous()
+    i = torch.randint(0, M, size=(N,)).to(device).int().contiguous()
+    weight = torch.randn((M, K)).float().to(device).contiguous()
+    o = torch.zeros((N, K)).float().to(device).contiguous()
 
     run_benchmark(lib.embedding_f32, i, weight, "f32", o)
     run_benchmark(lib.embedding_f32x4, i, weight, "f32x4", o)
@@ -84,8 +59,8 @@ for M, N, K in MNKs:
     run_benchmark(partial(embedding), i, weight, "f32_th")
 
     print("-" * 110)
-    weight_f16 = torch.randn((M, K)).half().cuda().contiguous()
-    o_f16 = torch.zeros((N, K)).half().cuda().contiguous()
+    weight_f16 = torch.randn((M, K)).half().to(device).contiguous()
+    o_f16 = torch.zeros((N, K)).half().to(device).contiguous()
     run_benchmark(lib.embedding_f16, i, weight_f16, "f16", o_f16)
     run_benchmark(lib.embedding_f16x8, i, weight_f16, "f16x8", o_f16)
     run_benchmark(lib.embedding_f16x8_pack, i, weight_f16, "f16x8_pack", o_f16)
@@ -7,8 +7,16 @@
 
 void flash_attn_1_fwd_f32(torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor O);
 void flash_attn_2_fwd_f16_mma_m16n8k16(torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor O);
+void flash_attn_1_fwd_f32_varlen(torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor cu_seqlens, torch::Tensor O);
+void flash_attn_2_fwd_f16_mma_m16n8k16_varlen(torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor cu_seqlens, torch::Tensor O);
+void flash_attn_1_fwd_f32_lse(torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor O, torch::Tensor L);
+void flash_attn_1_bwd_f32(torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor O, torch::Tensor dO, torch::Tensor L, torch::Tensor dQ, torch::Tensor dK, torch::Tensor dV);
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   TORCH_BINDING_COMMON_EXTENSION(flash_attn_1_fwd_f32)
   TORCH_BINDING_COMMON_EXTENSION(flash_attn_2_fwd_f16_mma_m16n8k16)
+  TORCH_BINDING_COMMON_EXTENSION(flash_attn_1_fwd_f32_varlen)
+  TORCH_BINDING_COMMON_EXTENSION(flash_attn_2_fwd_f16_mma_m16n8k16_varlen)
+  TORCH_BINDING_COMMON_EXTENSION(flash_attn_1_fwd_f32_lse)
+  TORCH_BINDING_COMMON_EXTENSION(flash_attn_1_bwd_f32)
 }
@@ -16,14 +16,19 @@
 #define BFLOAT2(value) (reinterpret_cast<__nv_bfloat162*>(&(value))[0])
 
 
+// kVarlen: Q,K,V,O are packed [total_tokens, nh, d], the tokens of sequence
+// b are [cu_seqlens[b], cu_seqlens[b+1]), l and m are [total_tokens, nh].
+// Otherwise they are [B, nh, N, d] and N must be a multiple of Bc.
+template<const bool kVarlen>
 __global__ void flash_attn_1_fwd_f32_kernel(
   const float* Q, 
   const float* K, 
   const float* V, 
-  const int N, 
+  const int* cu_seqlens,
+  int N, 
   const int d,
-  const int Tc,
-  const int Tr, 
+  int Tc,
+  int Tr, 
   const int Bc, 
   const int Br, 
   const float scale,
@@ -37,6 +42,18 @@ __global__ void flash_attn_1_fwd_f32_kernel(
   // Offset into Q,K,V,O,l,m - different for each batch and head
   int qkv_offset = (bx * gridDim.y * N * d) + (by * N * d);  // gridDim.y = nh
   int lm_offset  = (bx * gridDim.y * N) + (by * N);  // offset for l and m
+  int qkv_stride = d;  // between 2 tokens
+  int lm_stride  = 1;
+  if (kVarlen) {
+    const int seq_start = cu_seqlens[bx];
+    N = cu_seqlens[bx + 1] - seq_start;
+    Tc = (N + Bc - 1) / Bc;
+    Tr = (N + Br - 1) / Br;
+    qkv_stride = gridDim.y * d;
+    lm_stride  = gridDim.y;
+    qkv_offset = seq_start * qkv_stride + by * d;
+    lm_offset  = seq_start * lm_stride + by;
+  }
 
   // Define SRAM for Q,K,V,S
   extern __shared__ float sram[];
@@ -48,24 +65,29 @@ __global__ void flash_attn_1_fwd_f32_kernel(
 
   for (int j = 0; j < Tc; j++) {
 
-    // Load Kj, Vj to SRAM
+    // Load Kj, Vj to SRAM, zeros past the end of the sequence
+    const bool kv_valid = !kVarlen || (Bc * j + tx) < N;
     #pragma unroll
     for (int x = 0; x < d; x++) {
-      Kj[(tx * d) + x] = K[qkv_offset + (tile_size * j) + (tx * d) + x];
-      Vj[(tx * d) + x] = V[qkv_offset + (tile_size * j) + (tx * d) + x];
+      Kj[(tx * d) + x] = kv_valid ? K[qkv_offset + (Bc * j + tx) * qkv_stride + x] : 0.0f;
+      Vj[(tx * d) + x] = kv_valid ? V[qkv_offset + (Bc * j + tx) * qkv_stride + x] : 0.0f;
     }
     __syncthreads();  // such that the inner loop can use the correct Kj, Vj
 
     #pragma unroll
     for (int i = 0; i < Tr; i++)  {
 
+      // rows past the end of the sequence, no sync in this loop
+      const bool q_valid = !kVarlen || (Br * i + tx) < N;
+      if (!q_valid) continue;
+
       // Load Qi to SRAM, l and m to registers
       #pragma unroll
       for (int x = 0; x < d; x++) {
-        Qi[(tx * d) + x] = Q[qkv_offset + (tile_size * i) + (tx * d) + x];
+        Qi[(tx * d) + x] = Q[qkv_offset + (Br * i + tx) * qkv_stride + x];
       }
-      float row_m_prev = m[lm_offset + (Br * i) + tx];
-      float row_l_prev = l[lm_offset + (Br * i) + tx];
+      float row_m_prev = m[lm_offset + (Br * i + tx) * lm_stride];
+      float row_l_prev = l[lm_offset + (Br * i + tx) * lm_stride];
 
       // S = QK^T, row_m = rowmax(S)
       float row_m = -INFINITY;
@@ -77,6 +99,7 @@ __global__ void flash_attn_1_fwd_f32_kernel(
           sum += Qi[(tx * d) + x] * Kj[(y * d) + x];
         }
         sum *= scale;
+        if (kVarlen && (Bc * j + y) >= N) sum = -INFINITY;
         S[(Bc * tx) + y] = sum;
 
         if (sum > row_m)
@@ -104,13 +127,13 @@ __global__ void flash_attn_1_fwd_f32_kernel(
         for (int y = 0; y < Bc; y++) {
           pv += S[(Bc * tx) + y] * Vj[(y * d) + x];
         }
-        O[qkv_offset + (tile_size * i) + (tx * d) + x] = \
+        O[qkv_offset + (Br * i + tx) * qkv_stride + x] = \
           (1 / row_l_new) * ((row_l_prev * __expf(row_m_prev - row_m_new) \
-          * O[qkv_offset + (tile_size * i) + (tx * d) + x]) \
+          * O[qkv_offset + (Br * i + tx) * qkv_stride + x]) \
           + (__expf(row_m - row_m_new) * pv));
       }
-      m[lm_offset + (Br * i) + tx] = row_m_new;
-      l[lm_offset + (Br * i) + tx] = row_l_new;
+      m[lm_offset + (Br * i + tx) * lm_stride] = row_m_new;
+      l[lm_offset + (Br * i + tx) * lm_stride] = row_l_new;
     }
     __syncthreads();
   }
@@ -135,6 +158,14 @@ if (((T2).size(0) != (T1).size(0)) ||                \
   throw std::runtime_error("Tensor size mismatch!"); \
 }
 
+#define CHECK_TORCH_TENSOR_SHAPE_3D(T1, T2)          \
+if (((T2).size(0) != (T1).size(0)) ||                \
+    ((T2).size(1) != (T1).size(1)) ||                \
+    ((T2).size(2) != (T1).size(2)) ||                \
+    ((T2).dim() != 3) || ((T1).dim() != 3)) {        \
+  throw std::runtime_error("Tensor size mismatch!"); \
+}
+
 void flash_attn_1_fwd_f32(
   torch::Tensor Q, 
   torch::Tensor K, 
@@ -174,10 +205,11 @@ void flash_attn_1_fwd_f32(
   dim3 grid(B, nh);  // batch_size x num_heads
   dim3 block(Bc);  // Bc threads per block
   
-  flash_attn_1_fwd_f32_kernel<<<grid, block, sram_size>>>(
+  flash_attn_1_fwd_f32_kernel<false><<<grid, block, sram_size>>>(
     reinterpret_cast<float*>(Q.data_ptr()), 
     reinterpret_cast<float*>(K.data_ptr()), 
     reinterpret_cast<float*>(V.data_ptr()), 
+    nullptr,
     N, 
     d, 
     Tc, 
@@ -192,3 +224,108 @@ void flash_attn_1_fwd_f32(
 }
   
 
+// Q, K, V, O: [total_tokens, nh, d] packed, no padding, cu_seqlens: [B+1]
+// int32, the start of every sequence in the packed tokens and the total.
+void flash_attn_1_fwd_f32_varlen(
+  torch::Tensor Q, 
+  torch::Tensor K, 
+  torch::Tensor V,
+  torch::Tensor cu_seqlens,
+  torch::Tensor O) {
+  CHECK_TORCH_TENSOR_DTYPE(Q, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(K, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(V, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(O, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(cu_seqlens, torch::kInt32)
+  const int Bc = 32; 
+  const int Br = 32;
+  // total_tokens, n_head, head_dim (T,nh,d)
+  const int B = cu_seqlens.size(0) - 1;
+  const int T = Q.size(0); 
+  const int nh = Q.size(1);
+  const int d = Q.size(2);
+  CHECK_TORCH_TENSOR_SHAPE_3D(K, Q)
+  CHECK_TORCH_TENSOR_SHAPE_3D(V, Q)
+  CHECK_TORCH_TENSOR_SHAPE_3D(O, Q)
+  const float scale = 1.0 / sqrt(d);
+
+  auto options = torch::TensorOptions().dtype(torch::kFloat32).device(torch::kCUDA, 0);
+  auto l = torch::zeros({T, nh}, options); 
+  auto m = torch::full({T, nh}, -INFINITY, options);
+
+  const int sram_size = (3 * Bc * d * sizeof(float)) + (Bc * Br * sizeof(float));
+  dim3 grid(B, nh);  // batch_size x num_heads
+  dim3 block(Bc);  // Bc threads per block
+
+  // N, Tc and Tr are per sequence
+  flash_attn_1_fwd_f32_kernel<true><<<grid, block, sram_size>>>(
+    reinterpret_cast<float*>(Q.data_ptr()), 
+    reinterpret_cast<float*>(K.data_ptr()), 
+    reinterpret_cast<float*>(V.data_ptr()), 
+    reinterpret_cast<int*>(cu_seqlens.data_ptr()),
+    0, 
+    d, 
+    0, 
+    0, 
+    Bc, 
+    Br, 
+    scale,
+    reinterpret_cast<float*>(l.data_ptr()), 
+    reinterpret_cast<float*>(m.data_ptr()), 
+    reinterpret_cast<float*>(O.data_ptr())
+  );
+}
+
+// same as flash_attn_1_fwd_f32, and the log-sum-exp of the scaled scores of
+// every row for the backward pass, L: [B, nh, N] f32.
+void flash_attn_1_fwd_f32_lse(
+  torch::Tensor Q, 
+  torch::Tensor K, 
+  torch::Tensor V,
+  torch::Tensor O,
+  torch::Tensor L) {
+  CHECK_TORCH_TENSOR_DTYPE(Q, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(K, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(V, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(O, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(L, torch::kFloat32)
+  const int Bc = 32; 
+  const int Br = 32;
+  const int B = Q.size(0); 
+  const int nh = Q.size(1);
+  const int N = Q.size(2); 
+  const int d = Q.size(3);
+  CHECK_TORCH_TENSOR_SHAPE(K, Q)
+  CHECK_TORCH_TENSOR_SHAPE(V, Q)
+  CHECK_TORCH_TENSOR_SHAPE(O, Q)
+  const int Tc = ceil((float) N / Bc); 
+  const int Tr = ceil((float) N / Br);
+  const float scale = 1.0 / sqrt(d);
+
+  auto options = torch::TensorOptions().dtype(torch::kFloat32).device(torch::kCUDA, 0);
+  auto l = torch::zeros({B, nh, N}, options); 
+  auto m = torch::full({B, nh, N}, -INFINITY, options);
+
+  const int sram_size = (3 * Bc * d * sizeof(float)) + (Bc * Br * sizeof(float));
+  dim3 grid(B, nh);  // batch_size x num_heads
+  dim3 block(Bc);  // Bc threads per block
+
+  flash_attn_1_fwd_f32_kernel<false><<<grid, block, sram_size>>>(
+    reinterpret_cast<float*>(Q.data_ptr()), 
+    reinterpret_cast<float*>(K.data_ptr()), 
+    reinterpret_cast<float*>(V.data_ptr()), 
+    nullptr,
+    N, 
+    d, 
+    Tc, 
+    Tr, 
+    Bc, 
+    Br, 
+    scale,
+    reinterpret_cast<float*>(l.data_ptr()), 
+    reinterpret_cast<float*>(m.data_ptr()), 
+    reinterpret_cast<float*>(O.data_ptr())
+  );
+  // l is the sum of exp(S - m) of the final m
+  L.copy_((m + l.log()).view_as(L));
+}
@@ -1,26 +1,31 @@
 import math
-import time
+import os
+import random
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
 import torch
 from torch.nn import functional as F
-from torch.utils.cpp_extension import load
+from bench.registry import lazy_load
 from functools import partial
-from typing import Optional
+from typing import List, Optional
 
 torch.set_grad_enabled(False)
 # Load the CUDA kernel as a python module
-lib = load(name='flash_attn_lib', 
-           sources=['flash_attn.cu', 'flash_attn_mma.cu', 'flash_attn.cc'], 
-           extra_cuda_cflags=[
-               "-O3",
-                "-U__CUDA_NO_HALF_OPERATORS__",
-                "-U__CUDA_NO_HALF_CONVERSIONS__",
-                "-U__CUDA_NO_HALF2_OPERATORS__",
-                "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
-                "--expt-relaxed-constexpr",
-                "--expt-extended-lambda",
-                "--use_fast_math"
-            ], 
-           extra_cflags=['-std=c++17'])
+lib = lazy_load(name='flash_attn_lib', 
+                sources=['flash_attn.cu', 'flash_attn_mma.cu', 'flash_attn_bwd.cu', 'flash_attn.cc'], 
+                extra_cuda_cflags=[
+                    "-O3",
+                     "-U__CUDA_NO_HALF_OPERATORS__",
+                     "-U__CUDA_NO_HALF_CONVERSIONS__",
+                     "-U__CUDA_NO_HALF2_OPERATORS__",
+                     "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
+                     "--expt-relaxed-constexpr",
+                     "--expt-extended-lambda",
+                     "--use_fast_math"
+                 ], 
+                extra_cflags=['-std=c++17'])
+device = bench.get_device()
 
 # un-fused naive attn
 def naive_attn(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
@@ -35,40 +40,61 @@ def run_benchmark(perf_func: callable,
                   tag: str, out: Optional[torch.Tensor] = None, 
                   warmup: int = 10, iters: int = 100,
                   show_all: bool = False):
-    if out is not None: 
-        out.fill_(0)      
-    if out is not None:
-        for i in range(warmup):
-            perf_func(q, k, v, out)
-    else:
-        for i in range(warmup):
-            _ = perf_func(q, k, v)
-    
-    torch.cuda.synchronize()
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            perf_func(q, k, v, out)
-    else:
-        for i in range(iters):
-            out = perf_func(q, k, v)
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000 # ms
-    mean_time = total_time / iters
-    out_info = f"out_{tag}"
-    out_val = out.flatten().detach().cpu().numpy().tolist()[:3]
-    out_val = [round(v, 8) for v in out_val]
-    out_val = [f"{v:<12}" for v in out_val]
-    print(f"{out_info:>20}: {out_val}, time:{mean_time:.6f}ms")
+    # f16 mma accumulates QK^T and PV in f16, hence the looser atol
+    atol = 1e-2 if q.dtype == torch.half else None
+    out, result = bench.run_benchmark(perf_func, (q, k, v), tag, out,
+                                      warmup=warmup, iters=iters, width=20,
+                                      ref=lambda: naive_attn(q.float(), k.float(), v.float()),
+                                      atol=atol, cost="flash_attn")
     if show_all: print(out[0, 0, 0, :])
-    return out.clone(), mean_time
+    return out.clone(), result
+
+# packed (varlen) attn, q, k, v: [total_tokens, H, d], cu_seqlens: [B+1]
+def naive_attn_varlen(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                      cu_seqlens: torch.Tensor):
+    bounds = cu_seqlens.tolist()
+    seq = lambda t, s, e: t[s:e].transpose(0, 1) # [H, n, d]
+    return torch.cat([naive_attn(seq(q, s, e), seq(k, s, e), seq(v, s, e)).transpose(0, 1)
+                      for s, e in zip(bounds[:-1], bounds[1:])])
+
+
+def run_benchmark_varlen(perf_func: callable,
+                         q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                         cu_seqlens: torch.Tensor,
+                         tag: str, out: Optional[torch.Tensor] = None,
+                         warmup: int = 10, iters: int = 100):
+    atol = 1e-2 if q.dtype == torch.half else None
+    ref = lambda: naive_attn_varlen(q.float(), k.float(), v.float(), cu_seqlens)
+    out, result = bench.run_benchmark(perf_func, (q, k, v, cu_seqlens), tag, out,
+                                      warmup=warmup, iters=iters, width=20, ref=ref,
+                                      atol=atol, cost="flash_attn")
+    return out.clone(), result
+
+
+def sample_seqlens(dist: str, batch: int, mean_len: int, max_len: int,
+                   seed: int = 0) -> List[int]:
+    # lognormal: long tail of long prompts around mean_len. bimodal: 3/4
+    # short chat turns (mean_len/4), 1/4 long documents (2.5 x mean_len),
+    # both with the same mean.
+    rng = random.Random(seed)
+    if dist == "lognormal":
+        sigma = 0.8
+        mu = math.log(mean_len) - sigma * sigma / 2
+        lens = [rng.lognormvariate(mu, sigma) for _ in range(batch)]
+    elif dist == "bimodal":
+        lens = [rng.gauss(mean_len * 2.5, mean_len * 0.25) if rng.random() < 0.25
+                else rng.gauss(mean_len / 4, mean_len / 16) for _ in range(batch)]
+    else:
+        raise ValueError(f"unknown length distribution {dist}")
+    return [min(max(int(n), 1), max_len) for n in lens]
+
 
 Bs = [8, 16]
 Hs = [8, 16]
 Ns = [256, 512, 1024]
-Ds = [64, 128] # only support [64, 128] now
+# FA2MMAf16: any multiple of 8 up to 256, 8, 72 and 88 are padded to the
+# mma k (16) inside the kernel, the others are multiples of 16 already.
+Ds = [8, 64, 72, 80, 88, 96, 112, 128, 256]
 # batch_size, n_head, seq_len, head_dim (B,nh,N,d)
 BHNDs = [(B, H, N, D) for B in Bs for H in Hs for N in Ns for D in Ds]
 
@@ -77,17 +103,17 @@ print(" "* 25 + "B: batch_size, H: n_head, N: seq_len, D: head_dim")
 for (B, H, N, D) in BHNDs:
     print("-" * 100)
     print(" " * 40 + f"B={B}, H={H}, N={N}, D={D}")
-    q = torch.randn(B, H, N, D).float().cuda().contiguous()
-    k = torch.randn(B, H, N, D).float().cuda().contiguous()
-    v = torch.randn(B, H, N, D).float().cuda().contiguous()
-    o = torch.randn(B, H, N, D).float().cuda().contiguous()
+    q = torch.randn(B, H, N, D).float().to(device).contiguous()
+    k = torch.randn(B, H, N, D).float().to(device).contiguous()
+    v = torch.randn(B, H, N, D).float().to(device).contiguous()
+    o = torch.randn(B, H, N, D).float().to(device).contiguous()
     if D <= 64:
         run_benchmark(lib.flash_attn_1_fwd_f32, 
                       q, k, v, "FA1f32", o)
         run_benchmark(naive_attn,                  
                       q, k, v, "f32_th(naive)")
     
-    if D in (64, 128):
+    if D % 8 == 0 and D <= 256:
         print("-" * 100)
         # using fp16 Tesor Core MMA instruction
         q_f16 = q.half().contiguous()
@@ -99,3 +125,47 @@ for (B, H, N, D) in BHNDs:
         run_benchmark(naive_attn, 
                       q_f16, k_f16, v_f16, "f16_th(naive)")
     print("-" * 100)
+
+# varlen: mixed lengths packed without padding vs the dense kernel on the
+# batch padded to the longest sequence (a multiple of 64, Br), which also
+# attends to the padding, so only its time is comparable.
+VARLEN_B = 16
+VARLEN_H = 8
+VARLEN_MEAN_LEN = 512
+VARLEN_MAX_LEN = 2048
+print("-" * 100)
+print(" " * 20 + "varlen, T: total tokens, pad: padded/packed tokens, flops: padded/packed FLOPs")
+for dist in ("lognormal", "bimodal"):
+    seqlens = sample_seqlens(dist, VARLEN_B, VARLEN_MEAN_LEN, VARLEN_MAX_LEN)
+    T = sum(seqlens)
+    N = (max(seqlens) + 63) // 64 * 64
+    cu_seqlens = torch.tensor([0] + seqlens, dtype=torch.int32).cumsum(0).int().to(device)
+    for D in Ds:
+        print("-" * 100)
+        print(" " * 10 + f"{dist}: B={VARLEN_B}, H={VARLEN_H}, D={D}, T={T}, "
+              f"pad={VARLEN_B * N / T:.2f}x, "
+              f"flops={VARLEN_B * N * N / sum(n * n for n in seqlens):.2f}x")
+        print(" " * 10 + f"seqlens: {seqlens}")
+        q = torch.randn(T, VARLEN_H, D).float().to(device).contiguous()
+        k = torch.randn(T, VARLEN_H, D).float().to(device).contiguous()
+        v = torch.randn(T, VARLEN_H, D).float().to(device).contiguous()
+        o = torch.randn(T, VARLEN_H, D).float().to(device).contiguous()
+        if D <= 64:
+            run_benchmark_varlen(lib.flash_attn_1_fwd_f32_varlen,
+                                 q, k, v, cu_seqlens, "FA1f32(varlen)", o)
+        print("-" * 100)
+        q_f16, k_f16, v_f16, o_f16 = [t.half().contiguous() for t in (q, k, v, o)]
+        run_benchmark_varlen(lib.flash_attn_2_fwd_f16_mma_m16n8k16_varlen,
+                             q_f16, k_f16, v_f16, cu_seqlens, "FA2MMAf16(varlen)", o_f16)
+        run_benchmark_varlen(naive_attn_varlen,
+                             q_f16, k_f16, v_f16, cu_seqlens, "f16_th(varlen)")
+        # same tokens, padded to [B, H, N, D]
+        padded = [torch.zeros(VARLEN_B, VARLEN_H, N, D, dtype=torch.half, device=device)
+                  for _ in range(4)]
+        for t, p in zip((q_f16, k_f16, v_f16), padded):
+            for b, (s, e) in enumerate(zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist())):
+                p[b, :, :e - s] = t[s:e].transpose(0, 1)
+        bench.run_benchmark(lib.flash_attn_2_fwd_f16_mma_m16n8k16, padded[:3],
+                            "FA2MMAf16(padded)", padded[3], warmup=10, iters=100,
+                            width=20, meta={"seqlens": dist})
+    print("-" * 100)
@@ -0,0 +1,277 @@
+// FlashAttention-2 backward on CUDA Cores, f32. P is recomputed tile by tile
+// from Q, K and the log-sum-exp L of the forward (flash_attn_1_fwd_f32_lse),
+// the N x N attention matrix is never stored:
+//   P = exp(Q K^T * scale - L), dV = P^T dO, dP = dO V^T
+//   dS = P * (dP - D), D = rowsum(dO * O), dQ = dS K * scale, dK = dS^T Q * scale
+// dK, dV: one block per Bc rows of K, V, looping over all the Q tiles. dQ:
+// one block per Br rows of Q, looping over all the K, V tiles. No atomics,
+// so the gradients are deterministic. Same layout as the forward, Q, K, V,
+// O, dO: [B, nh, N, d], N a multiple of Bc.
+#include <cuda.h>
+#include <cuda_runtime.h>
+#include <torch/types.h>
+#include <torch/extension.h>
+
+
+// D = rowsum(dO * O), one thread per row
+__global__ void flash_attn_1_bwd_preprocess_f32_kernel(
+  const float* O, const float* dO, const int rows, const int d, float* D) {
+  int row = blockIdx.x * blockDim.x + threadIdx.x;
+  if (row >= rows) return;
+  float sum = 0.0f;
+  for (int x = 0; x < d; x++) {
+    sum += O[row * d + x] * dO[row * d + x];
+  }
+  D[row] = sum;
+}
+
+
+// thread tx owns row tx of the Kj, Vj tile and accumulates its dK, dV rows
+__global__ void flash_attn_1_bwd_dkdv_f32_kernel(
+  const float* Q,
+  const float* K,
+  const float* V,
+  const float* dO,
+  const float* L,
+  const float* D,
+  const int N,
+  const int d,
+  const int Tr,
+  const int Bc,
+  const int Br,
+  const float scale,
+  float* dK,
+  float* dV) {
+  int tx = threadIdx.x;
+  int bx = blockIdx.x;
+  int by = blockIdx.y;  // batch and head index
+  int j = blockIdx.z;  // K, V tile
+
+  int qkv_offset = (bx * gridDim.y * N * d) + (by * N * d);  // gridDim.y = nh
+  int lm_offset  = (bx * gridDim.y * N) + (by * N);  // offset for L and D
+
+  extern __shared__ float sram[];
+  int tile_size = Bc * d;  // size of Qi, Kj, Vj, dOi (Br == Bc)
+  float* Kj = sram;
+  float* Vj = &sram[tile_size];
+  float* Qi = &sram[tile_size * 2];
+  float* dOi = &sram[tile_size * 3];
+  float* dKj = &sram[tile_size * 4];
+  float* dVj = &sram[tile_size * 5];
+  float* Li = &sram[tile_size * 6];
+  float* Di = &sram[tile_size * 6 + Br];
+
+  #pragma unroll
+  for (int x = 0; x < d; x++) {
+    Kj[(tx * d) + x] = K[qkv_offset + (tile_size * j) + (tx * d) + x];
+    Vj[(tx * d) + x] = V[qkv_offset + (tile_size * j) + (tx * d) + x];
+    dKj[(tx * d) + x] = 0.0f;
+    dVj[(tx * d) + x] = 0.0f;
+  }
+
+  for (int i = 0; i < Tr; i++) {
+    __syncthreads();  // done with the previous Qi, dOi
+    #pragma unroll
+    for (int x = 0; x < d; x++) {
+      Qi[(tx * d) + x] = Q[qkv_offset + (tile_size * i) + (tx * d) + x];
+      dOi[(tx * d) + x] = dO[qkv_offset + (tile_size * i) + (tx * d) + x];
+    }
+    Li[tx] = L[lm_offset + (Br * i) + tx];
+    Di[tx] = D[lm_offset + (Br * i) + tx];
+    __syncthreads();
+
+    for (int y = 0; y < Br; y++) {
+      // P_yx = exp(S_yx - L_y), dP_yx = dO_y . V_x
+      float s = 0.0f;
+      float dp = 0.0f;
+      #pragma unroll
+      for (int x = 0; x < d; x++) {
+        s += Qi[(y * d) + x] * Kj[(tx * d) + x];
+        dp += dOi[(y * d) + x] * Vj[(tx * d) + x];
+      }
+      float p = __expf(s * scale - Li[y]);
+      float ds = p * (dp - Di[y]);
+      #pragma unroll
+      for (int x = 0; x < d; x++) {
+        dVj[(tx * d) + x] += p * dOi[(y * d) + x];
+        dKj[(tx * d) + x] += ds * Qi[(y * d) + x];
+      }
+    }
+  }
+
+  #pragma unroll
+  for (int x = 0; x < d; x++) {
+    dK[qkv_offset + (tile_size * j) + (tx * d) + x] = dKj[(tx * d) + x] * scale;
+    dV[qkv_offset + (tile_size * j) + (tx * d) + x] = dVj[(tx * d) + x];
+  }
+}
+
+
+// thread tx owns row tx of the Qi tile and accumulates its dQ row
+__global__ void flash_attn_1_bwd_dq_f32_kernel(
+  const float* Q,
+  const float* K,
+  const float* V,
+  const float* dO,
+  const float* L,
+  const float* D,
+  const int N,
+  const int d,
+  const int Tc,
+  const int Bc,
+  const int Br,
+  const float scale,
+  float* dQ) {
+  int tx = threadIdx.x;
+  int bx = blockIdx.x;
+  int by = blockIdx.y;  // batch and head index
+  int i = blockIdx.z;  // Q tile
+
+  int qkv_offset = (bx * gridDim.y * N * d) + (by * N * d);  // gridDim.y = nh
+  int lm_offset  = (bx * gridDim.y * N) + (by * N);  // offset for L and D
+
+  extern __shared__ float sram[];
+  int tile_size = Br * d;  // size of Qi, Kj, Vj, dOi (Br == Bc)
+  float* Qi = sram;
+  float* dOi = &sram[tile_size];
+  float* dQi = &sram[tile_size * 2];
+  float* Kj = &sram[tile_size * 3];
+  float* Vj = &sram[tile_size * 4];
+
+  #pragma unroll
+  for (int x = 0; x < d; x++) {
+    Qi[(tx * d) + x] = Q[qkv_offset + (tile_size * i) + (tx * d) + x];
+    dOi[(tx * d) + x] = dO[qkv_offset + (tile_size * i) + (tx * d) + x];
+    dQi[(tx * d) + x] = 0.0f;
+  }
+  const float row_l = L[lm_offset + (Br * i) + tx];
+  const float row_d = D[lm_offset + (Br * i) + tx];
+
+  for (int j = 0; j < Tc; j++) {
+    __syncthreads();  // done with the previous Kj, Vj
+    #pragma unroll
+    for (int x = 0; x < d; x++) {
+      Kj[(tx * d) + x] = K[qkv_offset + (tile_size * j) + (tx * d) + x];
+      Vj[(tx * d) + x] = V[qkv_offset + (tile_size * j) + (tx * d) + x];
+    }
+    __syncthreads();
+
+    for (int y = 0; y < Bc; y++) {
+      float s = 0.0f;
+      float dp = 0.0f;
+      #pragma unroll
+      for (int x = 0; x < d; x++) {
+        s += Qi[(tx * d) + x] * Kj[(y * d) + x];
+        dp += dOi[(tx * d) + x] * Vj[(y * d) + x];
+      }
+      float ds = __expf(s * scale - row_l) * (dp - row_d);
+      #pragma unroll
+      for (int x = 0; x < d; x++) {
+        dQi[(tx * d) + x] += ds * Kj[(y * d) + x];
+      }
+    }
+  }
+
+  #pragma unroll
+  for (int x = 0; x < d; x++) {
+    dQ[qkv_offset + (tile_size * i) + (tx * d) + x] = dQi[(tx * d) + x] * scale;
+  }
+}
+
+// --------------------- PyTorch bindings for custom kernel -----------------------
+#define STRINGFY(str) #str
+#define TORCH_BINDING_COMMON_EXTENSION(func) \
+  m.def(STRINGFY(func), &func, STRINGFY(func));
+
+#define CHECK_TORCH_TENSOR_DTYPE(T, th_type)                 \
+if(((T).options().dtype() != (th_type))) {                   \
+  std::cout << "Tensor Info:" << (T).options() << std::endl; \
+  throw std::runtime_error("values must be "#th_type);       \
+}
+
+#define CHECK_TORCH_TENSOR_SHAPE(T1, T2)             \
+if (((T2).size(0) != (T1).size(0)) ||                \
+    ((T2).size(1) != (T1).size(1)) ||                \
+    ((T2).size(2) != (T1).size(2)) ||                \
+    ((T2).size(3) != (T1).size(3))) {                \
+  throw std::runtime_error("Tensor size mismatch!"); \
+}
+
+// Q, K, V, O, dO: [B, nh, N, d], L: [B, nh, N] from flash_attn_1_fwd_f32_lse,
+// writes dQ, dK, dV: [B, nh, N, d].
+void flash_attn_1_bwd_f32(
+  torch::Tensor Q,
+  torch::Tensor K,
+  torch::Tensor V,
+  torch::Tensor O,
+  torch::Tensor dO,
+  torch::Tensor L,
+  torch::Tensor dQ,
+  torch::Tensor dK,
+  torch::Tensor dV) {
+  CHECK_TORCH_TENSOR_DTYPE(Q, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(K, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(V, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(O, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(dO, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(L, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(dQ, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(dK, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(dV, torch::kFloat32)
+  const int Bc = 32;
+  const int Br = 32;
+  // batch_size, n_head, seq_len, head_dim (B,nh,N,d)
+  const int B = Q.size(0);
+  const int nh = Q.size(1);
+  const int N = Q.size(2);
+  const int d = Q.size(3);
+  CHECK_TORCH_TENSOR_SHAPE(K, Q)
+  CHECK_TORCH_TENSOR_SHAPE(V, Q)
+  CHECK_TORCH_TENSOR_SHAPE(O, Q)
+  CHECK_TORCH_TENSOR_SHAPE(dO, Q)
+  CHECK_TORCH_TENSOR_SHAPE(dQ, Q)
+  CHECK_TORCH_TENSOR_SHAPE(dK, Q)
+  CHECK_TORCH_TENSOR_SHAPE(dV, Q)
+  const int Tc = ceil((float) N / Bc);
+  const int Tr = ceil((float) N / Br);
+  const float scale = 1.0 / sqrt(d);
+
+  auto options = torch::TensorOptions().dtype(torch::kFloat32).device(torch::kCUDA, 0);
+  auto D = torch::empty({B, nh, N}, options);
+  const int rows = B * nh * N;
+  flash_attn_1_bwd_preprocess_f32_kernel<<<(rows + 255) / 256, 256>>>(
+    reinterpret_cast<float*>(O.data_ptr()),
+    reinterpret_cast<float*>(dO.data_ptr()),
+    rows, d,
+    reinterpret_cast<float*>(D.data_ptr()));
+
+  // 6 tiles + L, D for dK, dV, 5 tiles for dQ, above the default 48KB for
+  // d >= 64: opt in to the larger dynamic shared memory.
+  const int dkdv_sram_size = (6 * Bc * d + 2 * Br) * sizeof(float);
+  const int dq_sram_size = (5 * Br * d) * sizeof(float);
+  cudaFuncSetAttribute(flash_attn_1_bwd_dkdv_f32_kernel,
+                       cudaFuncAttributeMaxDynamicSharedMemorySize, dkdv_sram_size);
+  cudaFuncSetAttribute(flash_attn_1_bwd_dq_f32_kernel,
+                       cudaFuncAttributeMaxDynamicSharedMemorySize, dq_sram_size);
+
+  dim3 block(Bc);  // Bc threads per block, one row each
+  flash_attn_1_bwd_dkdv_f32_kernel<<<dim3(B, nh, Tc), block, dkdv_sram_size>>>(
+    reinterpret_cast<float*>(Q.data_ptr()),
+    reinterpret_cast<float*>(K.data_ptr()),
+    reinterpret_cast<float*>(V.data_ptr()),
+    reinterpret_cast<float*>(dO.data_ptr()),
+    reinterpret_cast<float*>(L.data_ptr()),
+    reinterpret_cast<float*>(D.data_ptr()),
+    N, d, Tr, Bc, Br, scale,
+    reinterpret_cast<float*>(dK.data_ptr()),
+    reinterpret_cast<float*>(dV.data_ptr()));
+  flash_attn_1_bwd_dq_f32_kernel<<<dim3(B, nh, Tr), block, dq_sram_size>>>(
+    reinterpret_cast<float*>(Q.data_ptr()),
+    reinterpret_cast<float*>(K.data_ptr()),
+    reinterpret_cast<float*>(V.data_ptr()),
+    reinterpret_cast<float*>(dO.data_ptr()),
+    reinterpret_cast<float*>(L.data_ptr()),
+    reinterpret_cast<float*>(D.data_ptr()),
+    N, d, Tc, Bc, Br, scale,
+    reinterpret_cast<float*>(dQ.data_ptr()));
+}
@@ -28,10 +28,17 @@
                  : "=r"(RD0), "=r"(RD1)                                                                                \
                  : "r"(RA0), "r"(RA1), "r"(RA2), "r"(RA3), "r"(RB0), "r"(RB1), "r"(RC0), "r"(RC1))
 
-template<const int Bc, const int Br, const int d>
+// kVarlen: Q, K, V, O are packed [total_tokens, nh, head_dim], the tokens of
+// sequence b are [cu_seqlens[b], cu_seqlens[b+1]), the rows past its end are
+// loaded as zeros, their scores masked and not stored. Otherwise they are
+// [B, nh, N, head_dim] and N must be a multiple of Br.
+// d: head_dim (a multiple of 8) padded to a multiple of 16, the k of the mma,
+// the tiles in shared memory and the O registers are d wide, the padding
+// columns are loaded as zeros and not stored.
+template<const int Bc, const int Br, const int d, const bool kVarlen>
 __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
-  half* Q, half* K, half* V, const int N,
-  const int Tc, const int Tr, const float scale,
+  half* Q, half* K, half* V, const int* cu_seqlens, int N,
+  const int head_dim, int Tc, int Tr, const float scale,
   half* O) {
   // batch and head index
   int bx = blockIdx.x; int by = blockIdx.y;
@@ -41,7 +48,16 @@ __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
   int laneId = threadIdx.x % 32;
 
   // Offset into Q, K, V, O - different for each batch and head
-  int qkv_offset = (bx * gridDim.y * N * d) + (by * N * d);  // gridDim.y = nh
+  int qkv_offset = (bx * gridDim.y * N * head_dim) + (by * N * head_dim);  // gridDim.y = nh
+  int qkv_stride = head_dim;  // between 2 tokens
+  if (kVarlen) {
+    const int seq_start = cu_seqlens[bx];
+    N = cu_seqlens[bx + 1] - seq_start;
+    Tc = (N + Bc - 1) / Bc;
+    Tr = (N + Br - 1) / Br;
+    qkv_stride = gridDim.y * head_dim;
+    qkv_offset = seq_start * qkv_stride + by * head_dim;
+  }
 
   // Define SRAM for Q,K,V,O
   extern __shared__ half sram[];
@@ -63,7 +79,11 @@ __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
       int new_dim_x = dim_x % 16;
       int new_dim_y = (dim_y / 16 * (d / 16) * 16) + (dim_x / 16 * 16) + (dim_y % 16);
 
-      LDST128BITS(Qi[new_dim_y * 16 + new_dim_x]) = LDST128BITS(Q[qkv_offset + (i * tile_size) + x]);
+      if ((!kVarlen || (i * Br + dim_y) < N) && dim_x < head_dim) {
+        LDST128BITS(Qi[new_dim_y * 16 + new_dim_x]) = LDST128BITS(Q[qkv_offset + (i * Br + dim_y) * qkv_stride + dim_x]);
+      } else {
+        LDST128BITS(Qi[new_dim_y * 16 + new_dim_x]) = make_float4(0.0f, 0.0f, 0.0f, 0.0f);
+      }
     }
     __syncthreads();
 
@@ -93,7 +113,11 @@ __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
         int new_dim_x = dim_x % 16;
         int new_dim_y = (dim_y / 16 * (d / 16) * 16) + (dim_x / 16 * 16) + (dim_y % 16);
 
-        LDST128BITS(Kj[new_dim_y * 16 + new_dim_x]) = LDST128BITS(K[qkv_offset + (j * tile_size) + x]);
+        if ((!kVarlen || (j * Bc + dim_y) < N) && dim_x < head_dim) {
+          LDST128BITS(Kj[new_dim_y * 16 + new_dim_x]) = LDST128BITS(K[qkv_offset + (j * Bc + dim_y) * qkv_stride + dim_x]);
+        } else {
+          LDST128BITS(Kj[new_dim_y * 16 + new_dim_x]) = make_float4(0.0f, 0.0f, 0.0f, 0.0f);
+        }
       }
       __syncthreads();
 
@@ -125,11 +149,15 @@ __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
 
       // Read V from global memory to shared memory
       for (int x = threadIdx.x * 8; x < tile_size; x += 1024) {
-        LDST128BITS(reg[0]) = LDST128BITS(V[qkv_offset + (j * tile_size) + x]);
-
         int dim_x = x % d;
         int dim_y = x / d;
 
+        if ((!kVarlen || (j * Bc + dim_y) < N) && dim_x < head_dim) {
+          LDST128BITS(reg[0]) = LDST128BITS(V[qkv_offset + (j * Bc + dim_y) * qkv_stride + dim_x]);
+        } else {
+          LDST128BITS(reg[0]) = make_float4(0.0f, 0.0f, 0.0f, 0.0f);
+        }
+
         #pragma unroll
         for (int iter = 0; iter < 8; iter++) {
           int new_dim_y = ((dim_x + iter) / 16 * (Bc / 16) * 16) + (dim_y / 16 * 16) + ((dim_x + iter) % 16);
@@ -148,6 +176,24 @@ __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
       LDST128BITS(reg[16]) = LDST128BITS(RC[4][0]);
       LDST128BITS(reg[24]) = LDST128BITS(RC[6][0]);
 
+      // mask the keys past the end of the sequence, reg[xi * 8 + tc_xi * 4 +
+      // tc_yi * 2 + e] is the score of key (xi * 2 + tc_xi) * 8 + laneId % 4 * 2 + e
+      if (kVarlen && (j + 1) * Bc > N) {
+        #pragma unroll
+        for (int xi = 0; xi < Bc / 16; xi++) {
+          #pragma unroll
+          for (int tc_xi = 0; tc_xi < 2; tc_xi++) {
+            #pragma unroll
+            for (int e = 0; e < 2; e++) {
+              if (j * Bc + (xi * 2 + tc_xi) * 8 + laneId % 4 * 2 + e >= N) {
+                reg[xi * 8 + tc_xi * 4 + 0 + e] = __float2half(-INFINITY);
+                reg[xi * 8 + tc_xi * 4 + 2 + e] = __float2half(-INFINITY);
+              }
+            }
+          }
+        }
+      }
+
       // thread level reduce max
       #pragma unroll
       for (int xi = 0; xi < Bc / 16; xi++) {
@@ -263,7 +309,11 @@ __global__  void flash_attn_2_fwd_f16_mma_m16n8k16_kernel(
       for(int tc_yi = 0; tc_yi < 2; tc_yi++) {
         #pragma unroll
         for(int tc_xi=0; tc_xi < 2; tc_xi++) {
-          int lane_pos = qkv_offset + i * Br * d + (warpId * 16 * d) + (laneId / 4 + tc_yi * 8) * d + tc_xi * 8 + laneId % 4 * 2 + (k * 16);
+          int row = i * Br + (warpId * 16) + (laneId / 4 + tc_yi * 8);
+          if (kVarlen && row >= N) continue;
+          int col = tc_xi * 8 + laneId % 4 * 2 + (k * 16);
+          if (col >= head_dim) continue;
+          int lane_pos = qkv_offset + row * qkv_stride + col;
           O[lane_pos + 0] = __float2half(RO[k][tc_yi][tc_xi][0]);
           O[lane_pos + 1] = __float2half(RO[k][tc_yi][tc_xi][1]);
         }
@@ -292,16 +342,79 @@ if (((T2).size(0) != (T1).size(0)) ||                \
   throw std::runtime_error("Tensor size mismatch!"); \
 }
 
+#define CHECK_TORCH_TENSOR_SHAPE_3D(T1, T2)          \
+if (((T2).size(0) != (T1).size(0)) ||                \
+    ((T2).size(1) != (T1).size(1)) ||                \
+    ((T2).size(2) != (T1).size(2)) ||                \
+    ((T2).dim() != 3) || ((T1).dim() != 3)) {        \
+  throw std::runtime_error("Tensor size mismatch!"); \
+}
+
+// head_dim padded to a multiple of 16 -> kernel instance
+#define LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(D)                                           \
+  case D:                                                                            \
+    cudaFuncSetAttribute(flash_attn_2_fwd_f16_mma_m16n8k16_kernel<Bc, Br, D, kVarlen>, \
+                         cudaFuncAttributeMaxDynamicSharedMemorySize, sram_size);   \
+    flash_attn_2_fwd_f16_mma_m16n8k16_kernel<Bc, Br, D, kVarlen><<<                  \
+    grid, block, sram_size>>>(                                                       \
+      reinterpret_cast<half*>(Q.data_ptr()),                                         \
+      reinterpret_cast<half*>(K.data_ptr()),                                         \
+      reinterpret_cast<half*>(V.data_ptr()),                                         \
+      cu_seqlens, N, d, Tc, Tr, scale,                                               \
+      reinterpret_cast<half*>(O.data_ptr())                                          \
+    );                                                                               \
+    break;
+
+// any head_dim d that is a multiple of 8 from 8 to 256. kVarlen: N, Tc and Tr
+// are per sequence, from cu_seqlens.
+template<const bool kVarlen>
+void launch_flash_attn_2_fwd_f16_mma_m16n8k16(
+  torch::Tensor Q, torch::Tensor K, torch::Tensor V, const int* cu_seqlens,
+  torch::Tensor O, const int B, const int nh, const int N, const int d) {
+  if (d <= 0 || d % 8 != 0 || d > 256) {
+    throw std::runtime_error("head_dim must be a multiple of 8 from 8 to 256");
+  }
+  const int Bc = 64; 
+  const int Br = 64;
+  const int d_pad = (d + 15) / 16 * 16;
+  const int Tc = ceil((float) N / Bc); 
+  const int Tr = ceil((float) N / Br);
+  const float scale = 1.0 / sqrt(d);
+
+  // Calculate SRAM size needed per block, above 48KB for d > 192
+  const int sram_size = (2 * Br * d_pad * sizeof(half));
+
+  dim3 grid(B, nh);  // batch_size x num_heads
+  dim3 block(128);   // 4 Warps per block
+
+  switch (d_pad) {
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(16)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(32)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(48)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(64)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(80)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(96)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(112)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(128)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(144)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(160)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(176)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(192)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(208)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(224)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(240)
+    LAUNCH_FLASH_ATTN_2_FWD_F16_MMA(256)
+    default:
+      throw std::runtime_error("no kernel instance for head_dim " + std::to_string(d));
+  }
+}
+
 void flash_attn_2_fwd_f16_mma_m16n8k16(
   torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor O) {
-  // TODO: determine Bc, Br dynamically
   CHECK_TORCH_TENSOR_DTYPE(Q, torch::kHalf)
   CHECK_TORCH_TENSOR_DTYPE(K, torch::kHalf)
   CHECK_TORCH_TENSOR_DTYPE(V, torch::kHalf)
   CHECK_TORCH_TENSOR_DTYPE(O, torch::kHalf)
-  const int Bc = 64; 
-  const int Br = 64;
-
   const int B = Q.size(0); 
   const int nh = Q.size(1);
   const int N = Q.size(2); 
@@ -309,39 +422,25 @@ void flash_attn_2_fwd_f16_mma_m16n8k16(
   CHECK_TORCH_TENSOR_SHAPE(K, Q)
   CHECK_TORCH_TENSOR_SHAPE(V, Q)
   CHECK_TORCH_TENSOR_SHAPE(O, Q)
+  launch_flash_attn_2_fwd_f16_mma_m16n8k16<false>(Q, K, V, nullptr, O, B, nh, N, d);
+}
 
-  const int Tc = ceil((float) N / Bc); 
-  const int Tr = ceil((float) N / Br);
-  const float scale = 1.0 / sqrt(d);
-
-  // Calculate SRAM size needed per block
-  const int sram_size = (2 * Br * d * sizeof(half));
-  int max_sram_size;
-  cudaDeviceGetAttribute(&max_sram_size, cudaDevAttrMaxSharedMemoryPerBlock, 0);
-
-  dim3 grid(B, nh);  // batch_size x num_heads
-  dim3 block(128);   // 4 Warps per block
-
-  // cudaStream_t stream = at::cuda::getCurrentCUDAStream();
-
-  if (d == 64) {
-    flash_attn_2_fwd_f16_mma_m16n8k16_kernel<Bc, Br, 64><<<
-    grid, block, sram_size>>>(
-      reinterpret_cast<half*>(Q.data_ptr()),
-      reinterpret_cast<half*>(K.data_ptr()),
-      reinterpret_cast<half*>(V.data_ptr()),
-      N, Tc, Tr, scale,
-      reinterpret_cast<half*>(O.data_ptr())
-    );
-  }
-  if (d == 128) {
-    flash_attn_2_fwd_f16_mma_m16n8k16_kernel<Bc, Br, 128><<<
-    grid, block, sram_size>>>(
-      reinterpret_cast<half*>(Q.data_ptr()),
-      reinterpret_cast<half*>(K.data_ptr()),
-      reinterpret_cast<half*>(V.data_ptr()),
-      N, Tc, Tr, scale,
-      reinterpret_cast<half*>(O.data_ptr())
-    );
-  }
+// Q, K, V, O: [total_tokens, nh, d] packed, no padding, cu_seqlens: [B+1]
+// int32, the start of every sequence in the packed tokens and the total.
+void flash_attn_2_fwd_f16_mma_m16n8k16_varlen(
+  torch::Tensor Q, torch::Tensor K, torch::Tensor V, torch::Tensor cu_seqlens,
+  torch::Tensor O) {
+  CHECK_TORCH_TENSOR_DTYPE(Q, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(K, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(V, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(O, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(cu_seqlens, torch::kInt32)
+  const int B = cu_seqlens.size(0) - 1;
+  const int nh = Q.size(1);
+  const int d = Q.size(2);
+  CHECK_TORCH_TENSOR_SHAPE_3D(K, Q)
+  CHECK_TORCH_TENSOR_SHAPE_3D(V, Q)
+  CHECK_TORCH_TENSOR_SHAPE_3D(O, Q)
+  launch_flash_attn_2_fwd_f16_mma_m16n8k16<true>(
+    Q, K, V, reinterpret_cast<int*>(cu_seqlens.data_ptr()), O, B, nh, 0, d);
 }
@@ -0,0 +1,126 @@
+import math
+import os
+import sys
+import warnings
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+import torch
+from torch.nn import functional as F
+from bench.registry import lazy_load
+from functools import partial
+
+# Load the CUDA kernel as a python module, same lib as flash_attn.py
+lib = lazy_load(name='flash_attn_lib',
+                sources=['flash_attn.cu', 'flash_attn_mma.cu', 'flash_attn_bwd.cu', 'flash_attn.cc'],
+                extra_cuda_cflags=[
+                    "-O3",
+                     "-U__CUDA_NO_HALF_OPERATORS__",
+                     "-U__CUDA_NO_HALF_CONVERSIONS__",
+                     "-U__CUDA_NO_HALF2_OPERATORS__",
+                     "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
+                     "--expt-relaxed-constexpr",
+                     "--expt-extended-lambda",
+                     "--use_fast_math"
+                 ],
+                extra_cflags=['-std=c++17'])
+device = bench.get_device()
+
+
+class FlashAttnFunc(torch.autograd.Function):
+    # q, k, v: [B, H, N, d] f32, N a multiple of 32. The forward saves the
+    # log-sum-exp of every row (B*H*N floats) instead of the attention
+    # matrix, the backward recomputes P from it tile by tile.
+
+    @staticmethod
+    def forward(ctx, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+        q, k, v = q.contiguous(), k.contiguous(), v.contiguous()
+        o = torch.zeros_like(q) # the f32 kernel rescales O in place
+        lse = torch.empty(q.shape[:-1], dtype=torch.float32, device=q.device)
+        lib.flash_attn_1_fwd_f32_lse(q, k, v, o, lse)
+        ctx.save_for_backward(q, k, v, o, lse)
+        return o
+
+    @staticmethod
+    def backward(ctx, do: torch.Tensor):
+        q, k, v, o, lse = ctx.saved_tensors
+        dq, dk, dv = torch.empty_like(q), torch.empty_like(k), torch.empty_like(v)
+        lib.flash_attn_1_bwd_f32(q, k, v, o, do.contiguous(), lse, dq, dk, dv)
+        return dq, dk, dv
+
+
+def flash_attn(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+    return FlashAttnFunc.apply(q, k, v)
+
+
+# un-fused naive attn, autograd keeps the N x N attention matrix
+def naive_attn(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+    att = (q @ k.transpose(-2, -1) * (1.0 / math.sqrt(k.size(-1))))
+    att = F.softmax(att, dim=-1)
+    y = att @ v
+    return y
+
+
+def sdpa(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+    return F.scaled_dot_product_attention(q, k, v)
+
+
+def train_step(attn: callable, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+               do: torch.Tensor):
+    # forward + backward, returns dq, dk, dv stacked
+    for t in (q, k, v):
+        t.grad = None
+    attn(q, k, v).backward(do)
+    return torch.stack([q.grad, k.grad, v.grad])
+
+
+def check_gradients():
+    # gradcheck of the bindings (the CPU references with BENCH_BACKEND=cpu):
+    # backward vs finite differences of the forward, in f32 as the kernels
+    # only take f32, hence eps and tolerances above the f64 defaults.
+    for (B, H, N, D) in [(1, 2, 32, 16), (2, 1, 64, 32)]:
+        q, k, v = [torch.randn(B, H, N, D, device=device, requires_grad=True)
+                   for _ in range(3)]
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=".*not a double precision")
+            ok = torch.autograd.gradcheck(flash_attn, (q, k, v), eps=1e-3, atol=1e-3,
+                                          rtol=1e-2, nondet_tol=1e-5)
+        print(f"gradcheck B={B}, H={H}, N={N}, D={D}: {'ok' if ok else 'WRONG'}")
+
+
+def run_benchmark(attn: callable, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                  do: torch.Tensor, tag: str, ref: torch.Tensor,
+                  warmup: int = 5, iters: int = 20):
+    out, result = bench.run_benchmark(partial(train_step, attn), (q, k, v), tag,
+                                      args=(do,), warmup=warmup, iters=iters,
+                                      width=20, ref=ref, atol=1e-3, rtol=1e-3,
+                                      cost="flash_attn_train",
+                                      meta={"kernel": f"{attn.__name__}_train"})
+    if device.type == "cuda":
+        # peak memory of a step, the saved activations included
+        torch.cuda.reset_peak_memory_stats()
+        train_step(attn, q, k, v, do)
+        print(f"{'':>20}  peak mem: {torch.cuda.max_memory_allocated() / 2**20:.1f}MB")
+    return out, result
+
+
+check_gradients()
+
+Bs = [4]
+Hs = [8]
+Ns = [256, 512, 1024]
+Ds = [64]
+# batch_size, n_head, seq_len, head_dim (B,nh,N,d)
+BHNDs = [(B, H, N, D) for B in Bs for H in Hs for N in Ns for D in Ds]
+
+print("-" * 100)
+print(" " * 10 + "forward + backward, out: dQ, dK, dV stacked, B: batch_size, H: n_head, N: seq_len, D: head_dim")
+for (B, H, N, D) in BHNDs:
+    print("-" * 100)
+    print(" " * 40 + f"B={B}, H={H}, N={N}, D={D}")
+    q, k, v = [torch.randn(B, H, N, D, device=device, requires_grad=True) for _ in range(3)]
+    do = torch.randn(B, H, N, D, device=device)
+    ref = train_step(naive_attn, q, k, v, do).clone()
+    run_benchmark(flash_attn, q, k, v, do, "FAf32(train)", ref)
+    run_benchmark(naive_attn, q, k, v, do, "f32_th(naive)", ref)
+    run_benchmark(sdpa, q, k, v, do, "f32_th(sdpa)", ref)
+print("-" * 100)
@@ -1025,6 +1025,9 @@ void hgemm_mma_m16n8k16_mma2x4_warp4x4x2_stages_dsmem_rr(torch::Tensor a, torch:
 void hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn(torch::Tensor a, torch::Tensor b, torch::Tensor c, int stages, bool swizzle, int swizzle_stride);
 
 
+// bench/registry.py builds each .cu alone with generated bindings and
+// -DSKIP_TORCH_BINDINGS, see bench/README.md
+#ifndef SKIP_TORCH_BINDINGS
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   // CUDA Cores FP16
   TORCH_BINDING_COMMON_EXTENSION(hgemm_naive_f16)
@@ -1068,4 +1071,6 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   // TN: A row major MxK, B col major NxK, C row major MxN
   TORCH_BINDING_COMMON_EXTENSION(hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn)
 }
+#endif
+
 
@@ -1,13 +1,17 @@
 import torch
-import time 
-from torch.utils.cpp_extension import load
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import lazy_load
 from functools import partial
 from typing import Optional
 
 torch.set_grad_enabled(False)
+device = bench.get_device()
 
 # # Load the CUDA kernel as a python module
-# lib = load(name='hgemm_lib', 
+# lib = lazy_load(name='hgemm_lib', 
 #            sources=['hgemm.cu'], 
 #            extra_cuda_cflags=[
 #                "-O3",
@@ -27,35 +31,11 @@ def run_benchmark(perf_func: callable,
                   tag: str, out: Optional[torch.Tensor] = None, 
                   warmup: int = 1, iters: int = 10,
                   show_all: bool = False):
-    if out is not None: 
-        out.fill_(0)      
-    if out is not None:
-        for i in range(warmup):
-            perf_func(a, b, out)
-    else:
-        for i in range(warmup):
-            _ = perf_func(a, b) 
-    
-    torch.cuda.synchronize()
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            perf_func(a, b, out)
-    else:
-        for i in range(iters):
-            out = perf_func(a, b) 
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000 # ms
-    mean_time = total_time / iters
-    out_info = f"out_{tag}"
-    out_val = out.flatten().detach().cpu().numpy().tolist()[:3]
-    out_val = [round(v, 8) for v in out_val]
-    out_val = [f"{v:<12}" for v in out_val]
-    print(f"{out_info:>32}: {out_val}, time:{mean_time:.6f}ms")
-    if show_all: print(out)
-    return out.clone(), mean_time
+    out, result = bench.run_benchmark(perf_func, (a, b), tag, out,
+                                      warmup=warmup, iters=iters,
+                                      show_all=show_all, width=32,
+                                      cost="hgemm")
+    return out.clone(), result
 
 
 # Ms = [1024, 2048, 4096]
@@ -68,9 +48,9 @@ MNKs = [(M, N, K) for M in Ms for N in Ns for K in Ks]
 for (M, N, K) in MNKs:
     print("-" * 110)
     print(" " * 45 + f"M={M}, N={N}, K={K}")
-    a = torch.randn((M, K)).cuda().half().contiguous() 
-    b = torch.randn((K, N)).cuda().half().contiguous() 
-    c = torch.randn((M, N)).cuda().half().contiguous() 
+    a = torch.randn((M, K)).to(device).half().contiguous() 
+    b = torch.randn((K, N)).to(device).half().contiguous() 
+    c = torch.randn((M, N)).to(device).half().contiguous() 
     # run_benchmark(lib.hgemm_naive_f16,                                     a, b, "f16",                   c)
     # run_benchmark(lib.hgemm_sliced_k_f16,                                  a, b, "f16(sk)",               c)
     # run_benchmark(lib.hgemm_t_4x4_sliced_k_f16x4_pack_bcf,                 a, b, "f16x4pack(t4x4bcf)",    c)
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.sweep import (Task, SweepCheckpoint, get_workers,
+                         run_sweep, shard_tasks)
+import variants
+
+# Parallel, resumable sweep of the HGEMM M=N=K grid of hgemm.py: every
+# (MNK, kernel, stages, swizzle) is one job, the jobs of one MNK run on one
+# worker (one per GPU, or --workers CPU backend workers), largest MNK first.
+# Rerun the same command to resume an interrupted or crashed sweep. The
+# results are merged into the results store (BENCH_RESULTS), as hgemm.py
+# records, so hgemm.py --plot, bench.compare etc. work on them.
+#
+#   python3 sweep.py --mma-all --wmma-all                # all GPUs
+#   python3 sweep.py --mma --num-shards 2 --shard-id 0   # half of the MNKs
+#   BENCH_BACKEND=cpu python3 sweep.py --mma --MMNK 1024 --workers 4
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="hgemm parallel sweep")
+    parser.add_argument("--MNK", type=int, nargs="+", default=None, help="Matrix M=N=K sizes")
+    parser.add_argument("--MMNK", type=int, default=12800, help="Matrix MAX M=M=N=K size")
+    parser.add_argument("--SEP", '--sep', type=int, default=256, help="Matrix SEP M=M=N=K size")
+    parser.add_argument("--warmup", "--w", type=int, default=2, help="Warmup iters")
+    parser.add_argument("--iters", "--i", type=int, default=10, help="Benchmark iters")
+    parser.add_argument("--enable-mma", "--mma", action="store_true", help="Enable MMA kernel tests")
+    parser.add_argument("--enable-mma-tn", "--mma-tn", action="store_true", help="Enable TN MMA kernel tests")
+    parser.add_argument("--enable-wmma", "--wmma", action="store_true", help="Enable WMMA kernel tests")
+    parser.add_argument("--enable-cuda", "--cuda", action="store_true", help="Enable CUDA kernel tests")
+    parser.add_argument("--enable-mma-all", "--mma-all", action="store_true", help="Enable all MMA kernel tests")
+    parser.add_argument("--enable-wmma-all", "--wmma-all", action="store_true", help="Enable all WMMA kernel tests")
+    parser.add_argument("--enable-cuda-all", "--cuda-all", action="store_true", help="Enable all CUDA kernel tests")
+    parser.add_argument("--disable-cublas", "--no-cublas", action="store_true", help="Disable cublas hgemm")
+    parser.add_argument("--tags", type=str, default=None, help="Only these tags, sperated by comma")
+    parser.add_argument("--sleep-duration", "--sleep", type=float, default=0.1, help="Sleep duration")
+    parser.add_argument("--swizzle-factor", "--swizzle", type=float, default=None, help="Swizzle factor")
+    parser.add_argument("--workers", type=int, default=None, help="Max workers, default one per GPU")
+    parser.add_argument("--threads", type=int, default=None, help="Threads per CPU backend worker")
+    parser.add_argument("--num-shards", type=int, default=1, help="Split the MNKs into N shards")
+    parser.add_argument("--shard-id", type=int, default=0, help="Run this shard only")
+    parser.add_argument("--retry-failed", action="store_true", help="Rerun the failed jobs")
+    parser.add_argument("--sweep-dir", type=str, default=None, help="Checkpoint dir, default BENCH_SWEEP_DIR")
+    parser.add_argument("--no-merge", action="store_true", help="Do not merge into the results store")
+    return parser.parse_args()
+
+
+def get_groups(args) -> list[str]:
+    flags = {"cuda": args.enable_cuda, "cuda_all": args.enable_cuda_all,
+             "wmma": args.enable_wmma, "wmma_all": args.enable_wmma_all,
+             "mma": args.enable_mma, "mma_all": args.enable_mma_all,
+             "mma_tn": args.enable_mma_tn}
+    groups = [group for group, enabled in flags.items() if enabled]
+    if groups and not args.disable_cublas:
+        groups.append("cublas")
+    return groups
+
+
+def get_mnks(args) -> list[int]:
+    if args.MNK:
+        return args.MNK
+    return list(range(args.SEP, args.MMNK + args.SEP, args.SEP))
+
+
+def make_tasks(args) -> list[Task]:
+    tags = args.tags.split(",") if args.tags else None
+    hgemm_variants = variants.get_variants(get_groups(args), tags)
+    if not hgemm_variants:
+        raise SystemExit("no variants selected, use --mma/--wmma/--cuda(-all), --mma-tn or --tags")
+    tasks = []
+    # largest first, so that the long tasks do not end up last on one worker
+    for MNK in sorted(get_mnks(args), reverse=True):
+        jobs = [{"job": f"{MNK}x{MNK}x{MNK}:{v.tag}", "M": MNK, "N": MNK, "K": MNK,
+                 "tag": v.tag, "warmup": args.warmup, "iters": args.iters,
+                 "swizzle_factor": args.swizzle_factor, "sleep": args.sleep_duration}
+                for v in hgemm_variants]
+        tasks.append(Task(f"{MNK}x{MNK}x{MNK}", jobs))
+    return tasks
+
+
+# per worker state: lib, and the inputs/reference of the current MNK
+STATE = {}
+VARIANTS = {v.tag: v for v in variants.HGEMM_VARIANTS}
+
+
+def get_inputs(M: int, N: int, K: int):
+    import torch
+    if STATE.get("mnk") != (M, N, K):
+        STATE.pop("inputs", None) # free the previous MNK first
+        device = bench.get_device()
+        a = torch.randn((M, K), dtype=torch.half).to(device)
+        b = torch.randn((K, N), dtype=torch.half).to(device)
+        c = torch.zeros((M, N), dtype=torch.half).to(device)
+        STATE["inputs"] = {"a": a, "b": b, "b_tn": b.t().contiguous(), "c": c,
+                           "ref": torch.matmul(a, b)}
+        STATE["mnk"] = (M, N, K)
+    return STATE["inputs"]
+
+
+def run_job(job: dict):
+    # runs in a worker, see bench.sweep
+    import torch
+    torch.set_grad_enabled(False)
+    if "lib" not in STATE:
+        STATE["lib"] = variants.load_hgemm_lib()
+    variant = VARIANTS[job["tag"]]
+    inputs = get_inputs(job["M"], job["N"], job["K"])
+    a, b = inputs["a"], inputs["b_tn" if variant.tn else "b"]
+    result, tflops, swizzle_stride = variants.bench_variant(
+        STATE["lib"], variant, a, b, inputs["c"], ref=inputs["ref"],
+        warmup=job["warmup"], iters=job["iters"], swizzle_factor=job["swizzle_factor"])
+    # recorded as hgemm.py results, comparable with the sequential runs
+    variants.record_variant(variant, result, a, b, tflops, swizzle_stride, script="hgemm.py")
+    bench.synchronize()
+    time.sleep(job["sleep"])
+
+
+def print_best(checkpoint: SweepCheckpoint):
+    # best valid variant per MNK vs cuBLAS, from the sweep records
+    best, cublas = {}, {}
+    for r in checkpoint.records():
+        if r["check_ok"] is False:
+            continue
+        if "cublas" in r["tag"]:
+            cublas[r["shape"]] = max(cublas.get(r["shape"], 0.0), r["tflops"])
+        elif r["tflops"] > best.get(r["shape"], ("", 0.0))[1]:
+            best[r["shape"]] = (r["tag"], r["tflops"])
+    print("-" * 130)
+    for shape in sorted(best, key=lambda s: int(s.split("x")[0])):
+        tag, tflops = best[shape]
+        info = f", cublas: {cublas[shape]:<6.2f}" if shape in cublas else ""
+        print(f"{shape:>18}: {tag:>45}, TFLOPS: {tflops:<6.2f}{info}")
+    print("-" * 130)
+
+
+def main():
+    args = get_args()
+    print(args)
+    backend = bench.get_backend()
+    tasks = shard_tasks(make_tasks(args), args.num_shards, args.shard_id)
+    # everything that changes the jobs or the numbers, not the parallelism
+    config = {"script": "hgemm/sweep.py", "backend": backend,
+              "tasks": [t.key for t in tasks], "jobs": [j["job"] for t in tasks for j in t.jobs],
+              "warmup": args.warmup, "iters": args.iters,
+              "swizzle_factor": args.swizzle_factor,
+              "num_shards": args.num_shards, "shard_id": args.shard_id}
+    checkpoint = SweepCheckpoint(config, args.sweep_dir)
+    workers = get_workers(backend, args.workers)
+    store = None if args.no_merge else bench.get_store()
+    stats = run_sweep(tasks, run_job, checkpoint, backend, workers,
+                      retry_failed=args.retry_failed, store=store,
+                      num_threads=args.threads)
+    print(f"done: {stats['done']}, failed: {stats['failed']}, crashed: {stats['crashed']}")
+    print_best(checkpoint)
+    return 1 if stats["crashed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
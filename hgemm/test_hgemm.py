@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+from bench.results import ResultsStore
+
+import variants
+
+# CPU backend run of hgemm.py: it runs the variants.py table of the enabled
+# groups, TN variants included, with the same records as sweep.py.
+HGEMM_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_hgemm_cpu(tmp_path):
+    M, N, K = 64, 128, 32
+    env = dict(os.environ, BENCH_BACKEND="cpu", BENCH_RESULTS=str(tmp_path / "results.jsonl"))
+    proc = subprocess.run(
+        [sys.executable, os.path.join(HGEMM_DIR, "hgemm.py"), "--M", str(M), "--N", str(N),
+         "--K", str(K), "--mma", "--mma-tn", "--no-cublas-tn", "--torch",
+         "--w", "1", "--i", "2", "--sleep", "0"],
+        cwd=HGEMM_DIR, env=env, capture_output=True, text=True, timeout=600)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    records = ResultsStore(str(tmp_path / "results.jsonl")).load()
+    expected = [v for v in variants.get_variants(["mma", "mma_tn", "cublas"])
+                if v.group != "cublas_tn"]
+    by_tag = {r["tag"]: r for r in records}
+    assert set(by_tag) == {v.tag for v in expected} | {"(torch)"}
+    for v in expected:
+        r = by_tag[v.tag]
+        assert r["kernel"] == v.binding and r["layout"] == v.layout
+        assert r["stages"] == (v.stages if v.stages > 1 else None)
+    for r in records:
+        assert r["shape"] == f"{M}x{N}x{K}" and r["check_ok"] is True
+        assert r["tflops"] == pytest.approx(2 * M * N * K * 1e-9 / r["median_ms"])
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.results import ResultsStore
+
+# CPU backend smoke run of sweep.py: every job is done and its record, with
+# the roofline fields, is merged into the results store.
+HGEMM_DIR = os.path.dirname(os.path.abspath(__file__))
+TAGS = ["(mma2x4+warp4x4+stage2+dsmem)", "(mma2x4+warp4x4+stage2+dsmem+swizzle)",
+        "tn(mma2x4+warp4x4+stage2+dsmem)", "(cublas)"]
+
+
+def run_sweep(tmp_path, *args):
+    env = dict(os.environ, BENCH_BACKEND="cpu",
+               BENCH_RESULTS=str(tmp_path / "results.jsonl"),
+               BENCH_SWEEP_DIR=str(tmp_path / "sweeps"))
+    return subprocess.run(
+        [sys.executable, os.path.join(HGEMM_DIR, "sweep.py"), "--MNK", "64", "128",
+         "--tags", ",".join(TAGS), "--w", "1", "--i", "2", "--sleep", "0", *args],
+        cwd=HGEMM_DIR, env=env, capture_output=True, text=True, timeout=600)
+
+
+def test_sweep_cpu(tmp_path):
+    proc = run_sweep(tmp_path)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    assert "done: 8, failed: 0, crashed: 0" in proc.stdout, proc.stdout
+    records = ResultsStore(str(tmp_path / "results.jsonl")).load()
+    assert len(records) == 8
+    assert {(r["shape"], r["tag"]) for r in records} == {
+        (f"{n}x{n}x{n}", tag) for n in (64, 128) for tag in TAGS}
+    for r in records:
+        assert r["script"] == "hgemm.py" and r["check_ok"] is True
+        assert r["tflops"] > 0 and r["gbps"] > 0 and r["intensity"] > 0
+        assert r["layout"] == ("TN" if r["tag"].startswith("tn") else "NN")
+    # resumed: nothing to run, nothing merged twice
+    proc = run_sweep(tmp_path)
+    assert "done: 0, failed: 0, crashed: 0" in proc.stdout, proc.stdout
+    assert len(ResultsStore(str(tmp_path / "results.jsonl")).load()) == 8
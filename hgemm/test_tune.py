@@ -0,0 +1,81 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+import bench
+from bench import results
+
+import tune
+
+# CPU backend runs of the tuner: the tuning cache is written, the candidates
+# are recorded, and the dispatcher launches the tuned config.
+GROUPS = ["mma"]
+
+
+class BrokenStore(results.ResultsStore):
+
+    def append(self, *records):
+        raise OSError("results store is read-only")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setenv("BENCH_BACKEND", "cpu")
+    previous = results.get_store()
+    yield results.set_store(results.ResultsStore(str(tmp_path / "results.jsonl")))
+    results.set_store(previous)
+
+
+def tune_shapes(tmp_path, shapes, layout="NN"):
+    cache = tune.TuningCache(str(tmp_path / "hgemm.json"))
+    return cache, tune.tune_shapes(shapes, layout, cache, groups=GROUPS if layout == "NN" else None,
+                                   warmup=1, iters=2, verbose=False)
+
+
+def test_tune_cache(tmp_path, store):
+    cache, tuned = tune_shapes(tmp_path, [(64, 128, 32)])
+    key = tune.get_shape_key(64, 128, 32)
+    config = tune.TuningCache(cache.path).get(tune.get_device_key(), key)
+    assert config == tuned[key] and config.tflops > 0
+    records = store.load()
+    assert len(records) == len(tune.get_candidates(128, "NN", GROUPS))
+    assert all(r["shape"] == "64x128x32" and r["tflops"] > 0 and r["gbps"] > 0
+               for r in records)
+    # exact hit, then nearest, no tuning at call time
+    import torch
+    dispatcher = tune.HgemmDispatcher(cache=tune.TuningCache(cache.path))
+    assert dispatcher.select(64, 128, 32) == config
+    assert dispatcher.select(64, 256, 32) == config
+    a, b = torch.randn(64, 32).half(), torch.randn(32, 128).half()
+    out = dispatcher(a, b, torch.zeros(64, 128).half())
+    assert bench.check_close(out, a @ b, *bench.sum_tolerance(32, a.dtype)).ok
+
+
+def test_tune_record_errors(tmp_path, store):
+    # a broken results store is reported, the tuning cache is still written
+    results.set_store(BrokenStore(str(tmp_path / "results.jsonl")))
+    with pytest.warns(UserWarning, match="not recorded"):
+        cache, tuned = tune_shapes(tmp_path, [(64, 64, 64)])
+    key = tune.get_shape_key(64, 64, 64)
+    assert tune.TuningCache(cache.path).get(tune.get_device_key(), key) == tuned[key]
+
+
+def test_tune_tn(tmp_path, store):
+    # staged TN candidates have binding(stages=.., swizzle=..) tags, the
+    # layout comes with the config, not from the tag. N != K: b is [N, K].
+    M, N, K = 64, 128, 32
+    cache, tuned = tune_shapes(tmp_path, [(M, N, K)], "TN")
+    config = tuned[tune.get_shape_key(M, N, K, layout="TN")]
+    assert config.layout == "TN" and config.variant().tn
+    records = store.load()
+    assert records and all(r["layout"] == "TN" and r["shape"] == f"{M}x{N}x{K}"
+                           for r in records)
+    for r in records:
+        assert r["tflops"] == pytest.approx(2 * M * N * K * 1e-9 / r["median_ms"])
+    # the config read back from the cache is still TN
+    import torch
+    dispatcher = tune.HgemmDispatcher(cache=tune.TuningCache(cache.path))
+    assert dispatcher.select(M, N, K, "TN") == config
+    a, b = torch.randn(M, K).half(), torch.randn(K, N).half()
+    out = dispatcher(a, b.t().contiguous(), torch.zeros(M, N).half(), tn=True)
+    assert bench.check_close(out, a @ b, *bench.sum_tolerance(K, a.dtype)).ok
@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.build import file_lock
+import variants
+from variants import HgemmVariant
+
+# Autotuner of the HGEMM (kernel, stages, dsmem, swizzle stride) selection,
+# with a persistent tuning cache, and a hgemm(a, b, out) dispatcher that
+# launches the tuned variant of a shape without any sweep at call time:
+# exact (M, N, K) hit first, then the nearest tuned shape, then a default.
+#
+#   python3 tune.py --MNK 4096 8192 --M 4096 --N 1024 --K 512 [--tn]
+#   python3 tune.py --show
+#
+#   from tune import hgemm
+#   hgemm(a, b, c)          # a: [M, K], b: [K, N], c: [M, N], f16
+#   hgemm(a, b_t, c, tn=True)  # b_t: [N, K]
+#
+# The cache (BENCH_TUNE_CACHE, default ~/.cache/cuda-learn-notes/tune/hgemm.json)
+# is keyed by device name + capability + hgemm sources hash, then by
+# dtype, layout and MNK. A cache of an other TUNE_CACHE_VERSION is ignored.
+
+TUNE_CACHE_VERSION = 1
+DEFAULT_TUNE_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "cuda-learn-notes", "tune", "hgemm.json")
+STAGES = (2, 3, 4)
+SWIZZLE_FACTORS = (0.5, 0.25, 0.125) # swizzle stride = N * factor, >= 256
+# groups searched by default, the CUDA Cores kernels are never the best
+DEFAULT_GROUPS = {"NN": ["wmma_all", "mma_all", "cublas"], "TN": ["mma_tn"]}
+# used when nothing is tuned for this device yet
+DEFAULT_CONFIGS = {
+    "NN": ("hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem", 2, None),
+    "TN": ("hgemm_mma_m16n8k16_mma2x4_warp4x4_stages_dsmem_tn", 2, None),
+}
+
+
+def get_tune_cache_path() -> str:
+    return os.environ.get("BENCH_TUNE_CACHE", DEFAULT_TUNE_CACHE)
+
+
+@dataclass(frozen=True)
+class TuneConfig:
+    binding: str
+    stages: int = -1 # > 1: multi stages kernel
+    swizzle_factor: Optional[float] = None # swizzle stride / N, None: no swizzle
+    tflops: float = 0.0 # when tuned, 0.0 for the defaults
+    tag: str = "" # for display only
+    layout: str = "NN" # TN: b is [N, K]
+
+    def swizzle_stride(self, N: int) -> int:
+        # rescaled to N, so that a config of a nearest shape stays valid
+        if self.swizzle_factor is None:
+            return 1
+        stride = int(N * self.swizzle_factor)
+        return stride if stride >= 256 else 1
+
+    def variant(self) -> HgemmVariant:
+        return HgemmVariant(self.tag or self.binding, self.binding, self.stages,
+                            self.swizzle_factor is not None, layout=self.layout)
+
+
+def get_device_key() -> str:
+    capability = bench.get_device_capability()
+    return (f"{bench.get_device_name()}|sm{capability[0]}{capability[1]}|"
+            f"{variants.get_lib_version()}")
+
+
+def get_shape_key(M: int, N: int, K: int, dtype: str = "float16", layout: str = "NN") -> str:
+    return f"{dtype}|{layout}|{M}x{N}x{K}"
+
+
+def parse_shape_key(key: str) -> Tuple[str, str, Tuple[int, ...]]:
+    dtype, layout, mnk = key.split("|")
+    return dtype, layout, tuple(int(s) for s in mnk.split("x"))
+
+
+class TuningCache:
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or get_tune_cache_path()
+        self.entries: Dict[str, Dict[str, dict]] = {} # device key -> shape key -> config
+        self.load()
+
+    def _lock(self):
+        return file_lock(os.path.join(os.path.dirname(os.path.abspath(self.path)), ".tune.lock"))
+
+    def _read(self) -> Dict[str, Dict[str, dict]]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        if data.get("version") != TUNE_CACHE_VERSION:
+            print(f"ignore tuning cache {self.path} of version {data.get('version')}, "
+                  f"current version: {TUNE_CACHE_VERSION}")
+            return {}
+        return data.get("entries", {})
+
+    def load(self):
+        self.entries = self._read()
+
+    def save(self):
+        # merged with the file, tuners of other shapes/devices may have written it
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock():
+            entries = self._read()
+            for device_key, configs in self.entries.items():
+                entries.setdefault(device_key, {}).update(configs)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"version": TUNE_CACHE_VERSION, "entries": entries}, f, indent=2)
+            os.replace(tmp, self.path)
+            self.entries = entries
+
+    def put(self, device_key: str, shape_key: str, config: TuneConfig):
+        self.entries.setdefault(device_key, {})[shape_key] = asdict(config)
+
+    def get(self, device_key: str, shape_key: str) -> Optional[TuneConfig]:
+        config = self.entries.get(device_key, {}).get(shape_key)
+        return TuneConfig(**config) if config is not None else None
+
+    def nearest(self, device_key: str, shape_key: str) -> Optional[TuneConfig]:
+        # same dtype and layout, closest MNK in log2 space
+        dtype, layout, mnk = parse_shape_key(shape_key)
+        best, best_dist = None, math.inf
+        for key, config in self.entries.get(device_key, {}).items():
+            key_dtype, key_layout, key_mnk = parse_shape_key(key)
+            if (key_dtype, key_layout) != (dtype, layout):
+                continue
+            dist = sum((math.log2(x) - math.log2(y)) ** 2 for x, y in zip(mnk, key_mnk))
+            if dist < best_dist:
+                best, best_dist = config, dist
+        return TuneConfig(**best) if best is not None else None
+
+
+# ------------------------------- tuner ------------------------------------------
+def get_swizzle_factors(N: int) -> List[Optional[float]]:
+    # no swizzle, then the factors giving a stride >= 256
+    factors: List[Optional[float]] = [None]
+    strides = set()
+    for factor in SWIZZLE_FACTORS:
+        stride = int(N * factor)
+        if stride >= 256 and stride not in strides:
+            factors.append(factor)
+            strides.add(stride)
+    return factors
+
+
+def get_candidates(N: int, layout: str = "NN",
+                   groups: Optional[List[str]] = None) -> List[TuneConfig]:
+    # every registered kernel of the groups, with stages x swizzle for the
+    # multi stages ones
+    enabled = variants.get_variants(groups or DEFAULT_GROUPS[layout])
+    candidates, seen = [], set()
+    for v in enabled:
+        if v.layout != layout or v.binding in seen:
+            continue
+        seen.add(v.binding)
+        if v.stages <= 1:
+            candidates.append(TuneConfig(v.binding, tag=v.tag, layout=layout))
+            continue
+        for stages in STAGES:
+            for factor in get_swizzle_factors(N):
+                tag = f"{v.binding}(stages={stages}, swizzle={factor})"
+                candidates.append(TuneConfig(v.binding, stages, factor, tag=tag, layout=layout))
+    return candidates
+
+
+def tune(M: int, N: int, K: int, layout: str = "NN", lib=None,
+         groups: Optional[List[str]] = None, warmup: int = 2, iters: int = 10,
+         verbose: bool = True) -> TuneConfig:
+    # benchmark all the candidates on random f16 inputs, the fastest one
+    # that passes the check wins. candidates that fail to launch are skipped.
+    import torch
+    lib = lib or variants.load_hgemm_lib()
+    device = bench.get_device()
+    a = torch.randn((M, K), dtype=torch.half).to(device)
+    b = torch.randn((K, N), dtype=torch.half).to(device)
+    c = torch.zeros((M, N), dtype=torch.half).to(device)
+    ref = torch.matmul(a, b)
+    b = b.t().contiguous() if layout == "TN" else b
+    best: Optional[TuneConfig] = None
+    record_errors = 0
+    for config in get_candidates(N, layout, groups):
+        variant = config.variant()
+        try:
+            result, tflops, swizzle_stride = variants.bench_variant(
+                lib, variant, a, b, c, ref=ref, warmup=warmup, iters=iters,
+                swizzle_stride=config.swizzle_stride(N))
+        except RuntimeError as e: # e.g not enough smem for these stages
+            if verbose: print(f"{config.tag:>80}: skipped, {e}")
+            continue
+        # the tuning does not depend on the record, a broken results store
+        # must not lose the tuning cache, but it is reported, not hidden
+        try:
+            variants.record_variant(variant, result, a, b, tflops, swizzle_stride)
+        except Exception as e:
+            record_errors += 1
+            print(f"{config.tag:>80}: not recorded, {type(e).__name__}: {e}")
+        valid = result.valid
+        if verbose:
+            info = "" if valid else f", {result.check.summary()}"
+            print(f"{config.tag:>80}: time:{result.median:.6f}ms, TFLOPS: {tflops:<6.2f}{info}")
+        if valid and (best is None or tflops > best.tflops):
+            best = TuneConfig(config.binding, config.stages, config.swizzle_factor,
+                              round(tflops, 3), config.tag, config.layout)
+    if record_errors:
+        warnings.warn(f"{record_errors} HGEMM tuning results of M={M}, N={N}, K={K}, "
+                      f"{layout} not recorded in the results store")
+    if best is None:
+        raise RuntimeError(f"no valid HGEMM variant for M={M}, N={N}, K={K}, {layout}")
+    return best
+
+
+def tune_shapes(shapes: List[Tuple[int, int, int]], layout: str = "NN",
+                cache: Optional[TuningCache] = None, force: bool = False,
+                **kwargs) -> Dict[str, TuneConfig]:
+    # tunes the shapes not in the cache yet (all of them if force), and
+    # saves the cache after each shape, so that an interrupted run keeps them.
+    cache = cache or TuningCache()
+    device_key = get_device_key()
+    kwargs.setdefault("lib", variants.load_hgemm_lib())
+    tuned = {}
+    for (M, N, K) in shapes:
+        shape_key = get_shape_key(M, N, K, "float16", layout)
+        config = None if force else cache.get(device_key, shape_key)
+        if config is None:
+            print("-" * 130)
+            print(" " * 40 + f"M={M}, N={N}, K={K}, {layout}, tuning ...")
+            config = tune(M, N, K, layout, **kwargs)
+            cache.put(device_key, shape_key, config)
+            cache.save()
+        print(f"{shape_key:>32}: {config.tag}, TFLOPS: {config.tflops:<6.2f}")
+        tuned[shape_key] = config
+    return tuned
+
+
+# ------------------------------- dispatcher -------------------------------------
+class HgemmDispatcher:
+
+    def __init__(self, lib=None, cache: Optional[TuningCache] = None):
+        self.lib = lib
+        self.cache = cache
+        self.configs: Dict[str, TuneConfig] = {} # shape key -> selected config
+        self.device_key: Optional[str] = None
+
+    def select(self, M: int, N: int, K: int, layout: str = "NN") -> TuneConfig:
+        # exact hit > nearest tuned shape > default, memoized per shape
+        shape_key = get_shape_key(M, N, K, "float16", layout)
+        config = self.configs.get(shape_key)
+        if config is None:
+            if self.cache is None:
+                self.cache = TuningCache()
+            if self.device_key is None:
+                self.device_key = get_device_key()
+            config = (self.cache.get(self.device_key, shape_key)
+                      or self.cache.nearest(self.device_key, shape_key))
+            if config is None:
+                binding, stages, factor = DEFAULT_CONFIGS[layout]
+                config = TuneConfig(binding, stages, factor, tag=f"{binding}(default)",
+                                    layout=layout)
+            self.configs[shape_key] = config
+        return config
+
+    def __call__(self, a, b, out, tn: bool = False):
+        if self.lib is None:
+            self.lib = variants.load_hgemm_lib()
+        M, K = a.shape
+        N = b.size(0) if tn else b.size(1)
+        config = self.select(M, N, K, "TN" if tn else "NN")
+        config.variant().launch(self.lib, a, b, out, config.swizzle_stride(N))
+        return out
+
+
+_DISPATCHER = HgemmDispatcher()
+
+
+def hgemm(a, b, out, tn: bool = False):
+    # out = a @ b, a: [M, K], b: [K, N] ([N, K] if tn), out: [M, N], f16
+    return _DISPATCHER(a, b, out, tn)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="hgemm autotuner")
+    parser.add_argument("--M", type=int, default=None, help="Matrix M size")
+    parser.add_argument("--N", type=int, default=None, help="Matrix N size")
+    parser.add_argument("--K", type=int, default=None, help="Matrix K size")
+    parser.add_argument("--MNK", type=int, nargs="+", default=[], help="Matrix M=N=K sizes")
+    parser.add_argument("--tn", action="store_true", help="Tune the TN layout, b: [N, K]")
+    parser.add_argument("--groups", type=str, default=None, help="hgemm.py groups, sperated by comma")
+    parser.add_argument("--warmup", "--w", type=int, default=2, help="Warmup iters")
+    parser.add_argument("--iters", "--i", type=int, default=10, help="Benchmark iters")
+    parser.add_argument("--force", action="store_true", help="Retune the cached shapes")
+    parser.add_argument("--show", action="store_true", help="Show the tuning cache")
+    parser.add_argument("--cache", type=str, default=None, help="Cache path, default BENCH_TUNE_CACHE")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    cache = TuningCache(args.cache)
+    if args.show:
+        for device_key, configs in cache.entries.items():
+            print(f"{device_key}:")
+            for shape_key, config in configs.items():
+                print(f"{shape_key:>32}: {config['tag']}, TFLOPS: {config['tflops']:<6.2f}")
+        return
+    shapes = [(MNK, MNK, MNK) for MNK in args.MNK]
+    if args.M and args.N and args.K:
+        shapes.append((args.M, args.N, args.K))
+    if not shapes:
+        raise SystemExit("nothing to tune, use --MNK and/or --M --N --K")
+    import torch
+    torch.set_grad_enabled(False)
+    start = time.time()
+    tune_shapes(shapes, "TN" if args.tn else "NN", cache, force=args.force,
+                groups=args.groups.split(",") if args.groups else None,
+                warmup=args.warmup, iters=args.iters)
+    print(f"tuning done, {len(shapes)} shapes, {time.time() - start:.1f}s, saved in {cache.path}")
+
+
+if __name__ == "__main__":
+    main()
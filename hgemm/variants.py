@@ -0,0 +1,214 @@
+import os
+import sys
+from dataclasses import dataclass
+from typing import List, Optional
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import LazyLib, lazy_load
+
+# The HGEMM lib and its (kernel, stages, dsmem, swizzle, layout) variant
+# space, shared by hgemm.py, sweep.py and tune.py so that they all build,
+# name and launch the variants the same way.
+
+HGEMM_DIR = os.path.dirname(os.path.abspath(__file__))
+HGEMM_SOURCES = ['hgemm.cu', 'hgemm_async.cu', 'hgemm_wmma.cu',
+                 'hgemm_wmma_stage.cu', 'hgemm_cublas.cu',
+                 'hgemm_mma.cu', 'hgemm_mma_stage.cu',
+                 'hgemm_mma_stage_tn.cu']
+
+
+def load_hgemm_lib(verbose: bool = False) -> LazyLib:
+    # Load the CUDA kernel as a python module
+    return lazy_load(name='hgemm_lib',
+                     sources=[os.path.join(HGEMM_DIR, s) for s in HGEMM_SOURCES],
+                     extra_cuda_cflags=[
+                         "-O3",
+                         "-U__CUDA_NO_HALF_OPERATORS__",
+                         "-U__CUDA_NO_HALF_CONVERSIONS__",
+                         "-U__CUDA_NO_HALF2_OPERATORS__",
+                         "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
+                         "--expt-relaxed-constexpr",
+                         "--expt-extended-lambda",
+                         "--use_fast_math",
+                         # diag 177: variable was declared but never referenced
+                         "-diag-suppress 177",
+                         # registers, smem, cmem, stack, gmem usage
+                         # registers: 寄存器，访问速度最快。Ada Lovelace架构每个SM的寄存器文件大小
+                         # 为256KB，这相当于65536个32位寄存器，65536/256=256。一个SM可以同时执行多
+                         # 个block，对一个Kernel，同时存在于一个SM中的Block和Warp数量取决于SM中可用
+                         # 且所需的寄存器和共享内存数量。每个Thread需要的寄存器越多，那么SM中的Warp就
+                         # 越少。即减少Thread所需寄存器数量，即可增加SM中的Warp数。每个Block需要的共
+                         # 享内存越多，那么SM中可以被同时处理的Block就会变少。即减少每个Block所需的共
+                         # 享内存，即可同时处理更多Block。SM内的资源没办法处理一个完整Block，Kernel
+                         # 将无法启动。
+                         # cmem: 常量内存，被缓存，访问速度快。
+                         # stack frame: 由于寄存器的数量有限，当需要使用的变量数量超过可用寄存器数量时，
+                         # 编译器会将某些变量从寄存器“溢出”到栈上，这个过程称为spill。访问栈上的数据比
+                         # 访问寄存器慢得多。
+                         # spill stores: 指的是在执行过程中，数据因为寄存器不足而被存储到了栈上。
+                         # spill loads: 则是指将之前溢出到栈上的数据重新加载回寄存器。
+                         "-Xptxas -v",
+                         # "-maxrregcount=128 -Xptxas -dlcm=cg" if args.reduce_reg else ""
+                     ],
+                     extra_cflags=['-std=c++17'],
+                     verbose=verbose)
+
+
+def get_lib_version() -> str:
+    # hash of the HGEMM sources, changes whenever a kernel changes
+    import hashlib
+    sha = hashlib.sha256()
+    for source in HGEMM_SOURCES:
+        with open(os.path.join(HGEMM_DIR, source), "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:12]
+
+
+def make_block_swizzle_stride(N: int, K: int, swizzle_factor: Optional[float] = None):
+    # make swizzle stride as N/8,N/4,N/2 and multiples of 256
+    if swizzle_factor is None:
+        swizzle_factor = 0.5 if N <= 4096 else 0.25
+        if all((N >= 14848, K > 8192, N % 8 == 0)):
+            swizzle_factor = 0.125
+
+    swizzle_stride = int(N * swizzle_factor)
+    swizzle_stride = swizzle_stride if swizzle_stride >= 256 else 1
+
+    return swizzle_stride
+
+
+@dataclass(frozen=True)
+class HgemmVariant:
+    tag: str # as printed by hgemm.py, e.g "(mma2x4+warp4x4+stage2+dsmem+swizzle)"
+    binding: str # lib binding name
+    stages: int = -1 # > 1: multi stages kernel, takes (stages, swizzle, swizzle_stride)
+    swizzle: bool = False
+    group: str = "mma" # hgemm.py flag that enables it: cuda, wmma, mma, mma_tn, cublas ...
+    layout: str = "NN" # TN: b is [N, K], i.e b.transpose(1, 0) of the NN layout
+
+    @property
+    def tn(self) -> bool:
+        return self.layout == "TN"
+
+    def launch(self, lib, a, b, c, swizzle_stride: int = 1):
+        # swizzle_stride 1 means no thread block swizzle
+        perf_func = getattr(lib, self.binding)
+        if self.stages > 1:
+            return perf_func(a, b, c, self.stages, swizzle_stride > 1, swizzle_stride)
+        return perf_func(a, b, c)
+
+
+def _stages(binding: str, name: str, group: str, stages: List[int],
+            swizzle: bool = False, dsmem: bool = False, extra: str = "",
+            layout: str = "NN") -> List[HgemmVariant]:
+    # e.g _stages(.., "mma2x4+warp4x4", .., [3, 2], swizzle=True, dsmem=True)
+    #  -> (mma2x4+warp4x4+stage3+dsmem+swizzle), (mma2x4+warp4x4+stage2+dsmem+swizzle)
+    # the TN tags are prefixed with tn as in hgemm.py
+    prefix = "tn" if layout == "TN" else ""
+    flags = ("+dsmem" if dsmem else "") + ("+swizzle" if swizzle else "") + extra
+    return [HgemmVariant(f"{prefix}({name}+stage{s}{flags})", binding, s, swizzle, group, layout)
+            for s in stages]
+
+
+_WMMA = "hgemm_wmma_m16n16k16_"
+_MMA = "hgemm_mma_m16n8k16_"
+
+# run in this order by hgemm.py, the groups are its --mma, --wmma-all ... flags
+HGEMM_VARIANTS: List[HgemmVariant] = [
+    # CUDA Cores FP16
+    HgemmVariant("(naive)", "hgemm_naive_f16", group="cuda_all"),
+    HgemmVariant("(f16x8pack+t8x8+bcf)", "hgemm_t_8x8_sliced_k_f16x8_pack_bcf", group="cuda_all"),
+    HgemmVariant("(f16x8pack+t8x8+dbuf)", "hgemm_t_8x8_sliced_k_f16x8_pack_bcf_dbuf", group="cuda"),
+    HgemmVariant("(f16x8pack+t8x8+k16+dbuf)", "hgemm_t_8x8_sliced_k16_f16x8_pack_dbuf", group="cuda"),
+    # wmma api, stages, dsmem, swizzle
+    HgemmVariant("(wmma4x2)", _WMMA + "mma4x2", group="wmma"),
+    HgemmVariant("(wmma4x2+warp2x4)", _WMMA + "mma4x2_warp2x4", group="wmma"),
+    *_stages(_WMMA + "mma4x2_warp2x4_stages", "wmma4x2+warp2x4", "wmma", [3, 2]),
+    *_stages(_WMMA + "mma4x2_warp2x4_stages_dsmem", "wmma4x2+warp2x4", "wmma", [3, 2], dsmem=True),
+    *_stages(_WMMA + "mma4x2_warp2x4_stages", "wmma4x2+warp2x4", "wmma", [3, 2], swizzle=True),
+    *_stages(_WMMA + "mma4x2_warp2x4_stages_dsmem", "wmma4x2+warp2x4", "wmma", [3, 2],
+             swizzle=True, dsmem=True),
+    *_stages(_WMMA + "mma4x4_warp4x4_stages_dsmem", "wmma4x4+warp4x4", "wmma_all", [3, 2], dsmem=True),
+    *_stages(_WMMA + "mma4x2_warp4x4_stages_dsmem", "wmma4x2+warp4x4", "wmma_all", [3, 2], dsmem=True),
+    *_stages(_WMMA + "mma4x4_warp4x4_stages_dsmem", "wmma4x4+warp4x4", "wmma_all", [3, 2],
+             swizzle=True, dsmem=True),
+    *_stages(_WMMA + "mma4x2_warp4x4_stages_dsmem", "wmma4x2+warp4x4", "wmma_all", [3, 2],
+             swizzle=True, dsmem=True),
+    # mma ptx, stages, dsmem, swizzle, reg reuse (rr), x4
+    HgemmVariant("(mma2x4+warp4x4)", _MMA + "mma2x4_warp4x4", group="mma_all"),
+    *_stages(_MMA + "mma2x4_warp4x4_stages", "mma2x4+warp4x4", "mma_all", [3, 2]),
+    *_stages(_MMA + "mma2x4_warp4x4_stages_dsmem", "mma2x4+warp4x4", "mma", [3, 2], dsmem=True),
+    *_stages(_MMA + "mma2x4_warp4x4x2_stages_dsmem", "mma2x4+warp4x4x2", "mma", [4, 3, 2], dsmem=True),
+    *_stages(_MMA + "mma2x4_warp4x4x2_stages_dsmem_rr", "mma2x4+warp4x4x2", "mma_all", [4, 3, 2],
+             dsmem=True, extra="+rr"),
+    *_stages(_MMA + "mma2x4_warp4x4x2_stages_dsmem_x4", "mma2x4+warp4x4x2", "mma_all", [4, 3, 2],
+             dsmem=True, extra="+x4"),
+    *_stages(_MMA + "mma2x4_warp4x4_stages", "mma2x4+warp4x4", "mma", [3, 2], swizzle=True),
+    *_stages(_MMA + "mma2x4_warp4x4_stages_dsmem", "mma2x4+warp4x4", "mma", [3, 2],
+             swizzle=True, dsmem=True),
+    *_stages(_MMA + "mma2x4_warp4x4x2_stages_dsmem", "mma2x4+warp4x4x2", "mma", [4, 3, 2],
+             swizzle=True, dsmem=True),
+    *_stages(_MMA + "mma2x4_warp4x4x2_stages_dsmem_rr", "mma2x4+warp4x4x2", "mma_all", [4, 3, 2],
+             swizzle=True, dsmem=True, extra="+rr"),
+    *_stages(_MMA + "mma2x4_warp4x4x2_stages_dsmem_x4", "mma2x4+warp4x4x2", "mma_all", [4, 3, 2],
+             swizzle=True, dsmem=True, extra="+x4"),
+    HgemmVariant("(cublas)", "hgemm_cublas_tensor_op_nn", group="cublas"),
+    # mma ptx, TN layout, b is [N, K]
+    *_stages(_MMA + "mma2x4_warp4x4_stages_dsmem_tn", "mma2x4+warp4x4", "mma_tn", [3, 2],
+             dsmem=True, layout="TN"),
+    *_stages(_MMA + "mma2x4_warp4x4_stages_dsmem_tn", "mma2x4+warp4x4", "mma_tn", [3, 2],
+             swizzle=True, dsmem=True, layout="TN"),
+    HgemmVariant("tn(cublas)", "hgemm_cublas_tensor_op_tn", group="cublas_tn", layout="TN"),
+]
+
+# hgemm.py flags -> groups, the *_all flags include the default groups
+GROUPS = {
+    "cuda": ["cuda"], "cuda_all": ["cuda", "cuda_all"],
+    "wmma": ["wmma"], "wmma_all": ["wmma", "wmma_all"],
+    "mma": ["mma"], "mma_all": ["mma", "mma_all"],
+    "mma_tn": ["mma_tn", "cublas_tn"], "cublas": ["cublas"],
+}
+
+
+def get_variants(groups: List[str], tags: Optional[List[str]] = None) -> List[HgemmVariant]:
+    # variants of the given hgemm.py groups, or with the given tags
+    if tags:
+        return [v for v in HGEMM_VARIANTS if v.tag in tags]
+    enabled = {g for group in groups for g in GROUPS[group]}
+    return [v for v in HGEMM_VARIANTS if v.group in enabled]
+
+
+def bench_variant(lib, variant: HgemmVariant, a, b, c, ref=None,
+                  warmup: int = 2, iters: int = 10,
+                  swizzle_factor: Optional[float] = None,
+                  swizzle_stride: Optional[int] = None):
+    # time one variant, a: [M, K], b: [K, N] ([N, K] for TN), c: [M, N], and
+    # check c against ref. swizzle_stride: explicit stride, else from the
+    # swizzle factor heuristic. returns (BenchResult, TFLOPS, swizzle_stride).
+    M, K = a.shape
+    N = b.size(0) if variant.tn else b.size(1)
+    if swizzle_stride is None:
+        swizzle_stride = make_block_swizzle_stride(N, K, swizzle_factor) if variant.swizzle else 1
+    c.fill_(0)
+    result = bench.do_bench(lambda: variant.launch(lib, a, b, c, swizzle_stride),
+                            variant.tag, warmup=warmup, iters=iters)
+    if ref is not None:
+        # all the HGEMM kernels accumulate in f16, see bench.sum_tolerance
+        result.check = bench.check_close(c, ref, *bench.sum_tolerance(K, a.dtype))
+    tflops = (2 * M * N * K) * 1e-9 / result.median
+    return result, tflops, swizzle_stride
+
+
+def record_variant(variant: HgemmVariant, result, a, b, tflops: float,
+                   swizzle_stride: int = 1, **extra):
+    # the hgemm.py record of a variant, the roofline info has a tflops field too
+    M, K = a.shape
+    N = b.size(0) if variant.tn else b.size(1)
+    fields = bench.get_roofline_info(bench.gemm_cost(a, b), result.median,
+                                     bench.get_device_name(), str(a.dtype)[6:])
+    fields.update(tflops=tflops, layout=variant.layout, **extra)
+    return bench.record_result(
+        result, kernel=variant.binding, shape=(M, N, K), dtype=a.dtype,
+        stages=variant.stages if variant.stages > 1 else None,
+        swizzle_stride=swizzle_stride if swizzle_stride > 1 else None,
+        **fields)
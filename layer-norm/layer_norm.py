@@ -1,30 +1,34 @@
 import torch
-import time 
-from torch.utils.cpp_extension import load
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import lazy_load
 from typing import Optional
 
 torch.set_grad_enabled(False)
 
 # Load the CUDA kernel as a python module
-lib = load(name='layer_norm_lib', 
-           sources=['layer_norm.cu'], 
-           extra_cuda_cflags=[
-               "-O3",
-                "-U__CUDA_NO_HALF_OPERATORS__",
-                "-U__CUDA_NO_HALF_CONVERSIONS__",
-                "-U__CUDA_NO_HALF2_OPERATORS__",
-                "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
-                "--expt-relaxed-constexpr",
-                "--expt-extended-lambda",
-                "--use_fast_math"
-            ], 
-           extra_cflags=['-std=c++17'])
+lib = lazy_load(name='layer_norm_lib', 
+                sources=['layer_norm.cu'], 
+                extra_cuda_cflags=[
+                    "-O3",
+                     "-U__CUDA_NO_HALF_OPERATORS__",
+                     "-U__CUDA_NO_HALF_CONVERSIONS__",
+                     "-U__CUDA_NO_HALF2_OPERATORS__",
+                     "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
+                     "--expt-relaxed-constexpr",
+                     "--expt-extended-lambda",
+                     "--use_fast_math"
+                 ], 
+                extra_cflags=['-std=c++17'])
+device = bench.get_device()
 
 
 # un-fused naive layer norm
 def naive_layer_norm(x: torch.Tensor, g: float, b: float):
     s_mean = torch.mean(x, dim=1, keepdim=True) # m
-    s_variance = 1 / torch.std(x, dim=1, keepdim=True) # 1/std(x)
+    s_variance = 1 / torch.std(x, dim=1, keepdim=True, unbiased=False) # 1/std(x)
     y = ((x - s_mean) * s_variance) * g + b
     return y
 
@@ -35,41 +39,18 @@ def run_benchmark(perf_func: callable, x: torch.Tensor,
                   show_all: bool = False):
     g = 1.0
     b = 0.0
-    if out is not None: 
-        out.fill_(0)      
-    if out is not None:
-        for i in range(warmup):
-            perf_func(x, out, g, b)
-    else:
-        for i in range(warmup):
-            _ = perf_func(x, g, b) 
-    torch.cuda.synchronize()
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            perf_func(x, out, g, b)
-    else:
-        for i in range(iters):
-            out = perf_func(x, g, b) 
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000 # ms
-    mean_time = total_time / iters
-    out_info = f"out_{tag}"
-    out_val = out.flatten().detach().cpu().numpy().tolist()[:3]
-    out_val = [round(v, 8) for v in out_val]
-    out_val = [f"{v:<12}" for v in out_val]
-    print(f"{out_info:>17}: {out_val}, time:{mean_time:.8f}ms")
-    if show_all: print(out)
-    return out, mean_time
+    return bench.run_benchmark(perf_func, (x,), tag, out, args=(g, b),
+                               warmup=warmup, iters=iters,
+                               show_all=show_all, width=17,
+                               ref=lambda: naive_layer_norm(x.float(), g, b),
+                               cost="layer_norm")
 
 print("-" * 85)
 N, K = 4096, 512
 print(" " * 40 + f"N={N}, K={K}")
 print("-" * 85)
-x = torch.randn((N, K)).cuda().float().contiguous()
-out = torch.zeros_like(x).cuda().float().contiguous()
+x = torch.randn((N, K)).to(device).float().contiguous()
+out = torch.zeros_like(x).to(device).float().contiguous()
 run_benchmark(lib.layer_norm_f32,   x, "f32",   out)
 run_benchmark(lib.layer_norm_f32x4, x, "f32x4", out)
 run_benchmark(naive_layer_norm,     x, "f32_th")
@@ -90,8 +71,8 @@ print("-" * 85)
 N, K = 4096, 1024
 print(" " * 40 + f"N={N}, K={K}")
 print("-" * 85)
-x = torch.randn((N, K)).cuda().float().contiguous()
-out = torch.zeros_like(x).cuda().float().contiguous()
+x = torch.randn((N, K)).to(device).float().contiguous()
+out = torch.zeros_like(x).to(device).float().contiguous()
 run_benchmark(lib.layer_norm_f32,   x, "f32",   out)
 run_benchmark(lib.layer_norm_f32x4, x, "f32x4", out)
 run_benchmark(naive_layer_norm,     x, "f32_th")
@@ -112,8 +93,8 @@ print("-" * 85)
 N, K = 4096, 2048
 print(" " * 40 + f"N={N}, K={K}")
 print("-" * 85)
-x = torch.randn((N, K)).cuda().float().contiguous()
-out = torch.zeros_like(x).cuda().float().contiguous()
+x = torch.randn((N, K)).to(device).float().contiguous()
+out = torch.zeros_like(x).to(device).float().contiguous()
 run_benchmark(lib.layer_norm_f32x4, x, "f32x4", out)
 run_benchmark(naive_layer_norm,     x, "f32_th")
 
@@ -131,8 +112,8 @@ print("-" * 85)
 N, K = 4096, 4096
 print(" " * 40 + f"N={N}, K={K}")
 print("-" * 85)
-x = torch.randn((N, K)).cuda().float().contiguous()
-out = torch.zeros_like(x).cuda().float().contiguous()
+x = torch.randn((N, K)).to(device).float().contiguous()
+out = torch.zeros_like(x).to(device).float().contiguous()
 run_benchmark(lib.layer_norm_f32x4, x, "f32x4", out)
 run_benchmark(naive_layer_norm,     x, "f32_th")
 
@@ -149,8 +130,8 @@ print("-" * 85)
 N, K = 4096, 8192
 print(" " * 40 + f"N={N}, K={K}")
 print("-" * 85)
-x_f16 = torch.randn((N, K)).cuda().half().contiguous()
-out_f16 = torch.zeros_like(x_f16).cuda().half().contiguous()
+x_f16 = torch.randn((N, K)).to(device).half().contiguous()
+out_f16 = torch.zeros_like(x_f16).to(device).half().contiguous()
 run_benchmark(lib.layer_norm_f16x8_f16,      x_f16, "f16x8f16",     out_f16)
 run_benchmark(lib.layer_norm_f16x8_pack_f16, x_f16, "f16x8packf16", out_f16)
 run_benchmark(lib.layer_norm_f16x8_pack_f32, x_f16, "f16x8packf32", out_f16)
@@ -161,10 +142,176 @@ print("-" * 85)
 N, K = 8192, 8192
 print(" " * 40 + f"N={N}, K={K}")
 print("-" * 85)
-x_f16 = torch.randn((N, K)).cuda().half().contiguous()
-out_f16 = torch.zeros_like(x_f16).cuda().half().contiguous()
+x_f16 = torch.randn((N, K)).to(device).half().contiguous()
+out_f16 = torch.zeros_like(x_f16).to(device).half().contiguous()
 run_benchmark(lib.layer_norm_f16x8_f16,      x_f16, "f16x8f16",     out_f16)
 run_benchmark(lib.layer_norm_f16x8_pack_f16, x_f16, "f16x8packf16", out_f16)
 run_benchmark(lib.layer_norm_f16x8_pack_f32, x_f16, "f16x8packf32", out_f16)
 run_benchmark(naive_layer_norm,              x_f16, "f16_th")
 print("-" * 85)
+
+# fused residual add + layer norm of a transformer block: residual += x;
+# y = layer_norm(residual) * weight + bias, y in half or int8/fp8 with a per
+# token scale for the next GEMM. The residual is updated in place, so every
+# variant is checked once (both outputs) before the timed runs.
+EPS = 1e-5
+QUANT_MAX = {torch.int8: 127.0, torch.float8_e4m3fn: 448.0}
+
+
+# un-fused: add, norm (and quant) kernels, residual in place
+def naive_fused_add_layer_norm(x: torch.Tensor, residual: torch.Tensor,
+                               weight: torch.Tensor, bias: torch.Tensor, eps: float = EPS):
+    residual.add_(x)
+    r = residual.float()
+    s_mean = torch.mean(r, dim=1, keepdim=True)
+    s_variance = torch.rsqrt(torch.var(r, dim=1, keepdim=True, unbiased=False) + eps)
+    y = (r - s_mean) * s_variance * weight.float() + bias.float()
+    return y.half()
+
+
+def quant_per_token(y: torch.Tensor, dtype: torch.dtype):
+    # y_q = y / scale, scale = max|y| / QUANT_MAX per row
+    qmax = QUANT_MAX[dtype]
+    absmax = y.float().abs().amax(dim=1, keepdim=True)
+    v = y.float() * torch.where(absmax > 0, qmax / absmax, torch.zeros_like(absmax))
+    q = v.round().clamp(-128, 127) if dtype == torch.int8 else v.clamp(-qmax, qmax)
+    return q.to(dtype), (absmax / qmax).squeeze(1)
+
+
+def check_fused_add_layer_norm():
+    for K in [512, 5120, 14336]:
+        x = torch.randn((64, K)).to(device).half()
+        residual = torch.randn((64, K)).to(device).half()
+        weight = torch.randn(K).to(device).half()
+        bias = torch.randn(K).to(device).half()
+        ref_residual = residual.clone()
+        ref_y = naive_fused_add_layer_norm(x, ref_residual, weight, bias).float()
+        for dtype in [torch.half, torch.int8, torch.float8_e4m3fn]:
+            r = residual.clone()
+            y = torch.zeros((64, K), device=device, dtype=dtype)
+            if dtype == torch.half:
+                lib.fused_add_layer_norm_f16x8_f32(x, r, weight, bias, y, EPS)
+                checks = [bench.check_close(y, ref_y)]
+            else:
+                scale = torch.zeros(64, device=device)
+                func = (lib.fused_add_layer_norm_f16x8_f32_int8 if dtype == torch.int8
+                        else lib.fused_add_layer_norm_f16x8_f32_fp8)
+                func(x, r, weight, bias, y, scale, EPS)
+                ref_q, ref_scale = quant_per_token(ref_y, dtype)
+                # int8: off by one where y / scale is ~.5 from an integer
+                checks = [bench.check_close(y, ref_q, atol=1.0 if dtype == torch.int8 else None),
+                          bench.check_close(scale, ref_scale, atol=0.0, rtol=1e-3)]
+            checks.append(bench.check_close(r, ref_residual, atol=0.0, rtol=0.0))
+            summary = ", ".join(c.summary() for c in checks)
+            print(f"{'fused add layer norm':>20} K={K:<6} {str(dtype)[6:]:>14}: {summary}")
+
+
+def run_fused_benchmark(perf_func: callable, x: torch.Tensor, residual: torch.Tensor,
+                        weight: torch.Tensor, bias: torch.Tensor, tag: str,
+                        out: Optional[torch.Tensor] = None,
+                        scale: Optional[torch.Tensor] = None,
+                        warmup: int = 10, iters: int = 200):
+    args = (EPS,) if scale is None else (scale, EPS)
+    return bench.run_benchmark(perf_func, (x, residual, weight, bias), tag, out, args=args,
+                               warmup=warmup, iters=iters, width=17,
+                               cost="fused_add_layer_norm")
+
+
+print("-" * 85)
+check_fused_add_layer_norm()
+for K in [4096, 5120, 8192]:
+    N = 4096
+    print("-" * 85)
+    print(" " * 30 + f"fused add + layer norm N={N}, K={K}")
+    x = torch.randn((N, K)).to(device).half().contiguous()
+    residual = torch.randn((N, K)).to(device).half().contiguous()
+    weight = torch.randn(K).to(device).half().contiguous()
+    bias = torch.randn(K).to(device).half().contiguous()
+    y = torch.zeros_like(x)
+    y_i8 = torch.zeros((N, K), device=device, dtype=torch.int8)
+    y_fp8 = torch.zeros((N, K), device=device, dtype=torch.float8_e4m3fn)
+    scale = torch.zeros(N, device=device)
+    run_fused_benchmark(lib.fused_add_layer_norm_f16x8_f32,      x, residual, weight, bias, "f16x8f32",      y)
+    run_fused_benchmark(lib.fused_add_layer_norm_f16x8_f32_int8, x, residual, weight, bias, "f16x8f32(i8)",  y_i8, scale)
+    run_fused_benchmark(lib.fused_add_layer_norm_f16x8_f32_fp8,  x, residual, weight, bias, "f16x8f32(fp8)", y_fp8, scale)
+    run_fused_benchmark(naive_fused_add_layer_norm,              x, residual, weight, bias, "f16_th")
+print("-" * 85)
+
+# any K: layer_norm_*_auto pick a strategy by K, 1 warp per row (small K), 1
+# block per row, or the row split over several blocks (large K), see
+# select_norm_strategy in layer_norm.cu. Same bytes moved for every K (N*K
+# fixed), so GB/s should be flat over K: no cliff at the strategy switches.
+# The thresholds are read from the #defines of layer_norm.cu, not copied.
+NORM_DEFINES = bench.parse_defines(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "layer_norm.cu"))
+NORM_WARP_MAX_K = NORM_DEFINES["NORM_WARP_MAX_K"]
+NORM_BLOCK_MAX_K = NORM_DEFINES["NORM_BLOCK_MAX_K"]
+STRATEGIES = {"warp": 0, "block": 1, "split": 2}
+
+
+def select_norm_strategy(K: int) -> str:
+    # same as select_norm_strategy in layer_norm.cu
+    if K <= NORM_WARP_MAX_K: return "warp"
+    if K <= NORM_BLOCK_MAX_K: return "block"
+    return "split"
+
+
+# un-fused naive layer norm, epsilon as the *_auto kernels
+def naive_layer_norm_eps(x: torch.Tensor, g: float, b: float):
+    v = x.float()
+    x_hat = v - torch.mean(v, dim=1, keepdim=True)
+    s_variance = torch.rsqrt(torch.mean(x_hat**2, dim=1, keepdim=True) + EPS)
+    return (x_hat * s_variance * g + b).to(x.dtype)
+
+
+def check_layer_norm_auto():
+    # every strategy at any K, K % 8 != 0 takes the unpacked path. An offset
+    # mean: the split partials are merged without sum(x^2) - K*mean^2.
+    for K in [64, 1000, 4096, 5121, 20000]:
+        x = (torch.randn((8, K)) + 10.0).to(device)
+        for name, strategy in STRATEGIES.items():
+            checks = []
+            for func, x_ in [(lib.layer_norm_f32_auto, x), (lib.layer_norm_f16_f32_auto, x.half())]:
+                y = torch.zeros_like(x_)
+                func(x_, y, 1.0, 0.5, strategy)
+                checks.append(bench.check_close(y, naive_layer_norm_eps(x_, 1.0, 0.5)).summary())
+            print(f"{'layer norm auto':>20} K={K:<6} {name:>6}: f32 {checks[0]}, f16 {checks[1]}")
+
+
+def run_sweep_benchmark(perf_func: callable, x: torch.Tensor, tag: str,
+                        out: Optional[torch.Tensor] = None, strategy: Optional[int] = None,
+                        warmup: int = 10, iters: int = 100):
+    g, b = 1.0, 0.0
+    args = (g, b) if strategy is None else (g, b, strategy)
+    return bench.run_benchmark(perf_func, (x,), tag, out, args=args,
+                               warmup=warmup, iters=iters, width=17,
+                               ref=lambda: naive_layer_norm_eps(x, g, b),
+                               cost="layer_norm",
+                               meta={"sweep": "any_k", "K": x.shape[1]})
+
+
+print("-" * 85)
+check_layer_norm_auto()
+Ks = sorted(set([2**i for i in range(6, 17)] + [5120, 6656, 14336]))
+gbps = {}
+for K in Ks:
+    N = max(1, 2**24 // K)
+    print("-" * 85)
+    print(" " * 30 + f"any K N={N}, K={K}, auto: {select_norm_strategy(K)}")
+    x = torch.randn((N, K)).to(device).float().contiguous()
+    out = torch.zeros_like(x)
+    x_f16, out_f16 = x.half(), out.half()
+    _, r = run_sweep_benchmark(lib.layer_norm_f32_auto,     x,     "f32(auto)", out, -1)
+    gbps[(K, "f32")] = r.roofline["gbps"]
+    _, r = run_sweep_benchmark(lib.layer_norm_f16_f32_auto, x_f16, "f16f32(auto)", out_f16, -1)
+    gbps[(K, "f16")] = r.roofline["gbps"]
+    for name, strategy in STRATEGIES.items():
+        if name != select_norm_strategy(K):
+            run_sweep_benchmark(lib.layer_norm_f16_f32_auto, x_f16, f"f16f32({name})", out_f16, strategy)
+    run_sweep_benchmark(naive_layer_norm_eps, x_f16, "f16_th")
+print("-" * 85)
+print(" " * 30 + "any K, auto: GB/s over K")
+for K in Ks:
+    print(f"{'K=' + str(K):>17}: f32 {gbps[(K, 'f32')]:8.1f}GB/s, f16 {gbps[(K, 'f16')]:8.1f}GB/s"
+          f" ({select_norm_strategy(K)})")
+print("-" * 85)
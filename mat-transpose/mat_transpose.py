@@ -1,13 +1,16 @@
 import torch
-import time
-from torch.utils.cpp_extension import load
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import lazy_load
 from typing import Optional
 from functools import partial
 
 torch.set_grad_enabled(False)
 
 # Load the CUDA kernel as a python module
-lib = load(
+lib = lazy_load(
     name="mat_transpose_lib",
     sources=["mat_transpose.cu"],
     extra_cuda_cflags=[
@@ -22,6 +25,7 @@ lib = load(
     ],
     extra_cflags=["-std=c++17"],
 )
+device = bench.get_device()
 
 
 def run_benchmark(
@@ -33,37 +37,18 @@ def run_benchmark(
     iters: int = 1000,
     show_all: bool = False,
 ):
-    if out is not None:
-        out.fill_(0)
-    # warmup
-    if out is not None:
-        for i in range(warmup):
-            perf_func(x, out)
-    else:
-        for i in range(warmup):
-            _ = perf_func(x)
-    torch.cuda.synchronize()
+    def format_func(out: torch.Tensor) -> str:
+        real_t = f"{out.T.equal(x)}"
+        out_val = out[:2, :2].flatten().detach().cpu().numpy().tolist()[:3]
+        out_val = [round(v, 8) for v in out_val]
+        return f"{out_val}, validate {real_t:<5}"
 
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            perf_func(x, out)
-    else:
-        for i in range(iters):
-            out = perf_func(x)
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000  # ms
-    mean_time = total_time / iters
-    out_info = f"out_{tag}"
-    real_t = f"{out.T.equal(x)}"
-    out_val = out[:2, :2].flatten().detach().cpu().numpy().tolist()[:3]
-    out_val = [round(v, 8) for v in out_val]
-    print(f"{out_info:>35}: {out_val}, validate {real_t:<5}, time:{mean_time:.8f}ms")
-    if show_all:
-        print(out)
-    return out, mean_time
+    return bench.run_benchmark(
+        perf_func, (x,), tag, out, warmup=warmup, iters=iters,
+        show_all=show_all, width=35, format_func=format_func,
+        ref=None if tag == "original" else (lambda: x.t()),
+        cost="mat_transpose",
+    )
 
 
 Ms = [1024, 2048, 4096]
@@ -74,8 +59,8 @@ copy_x = lambda x: x
 for M, N in MNs:
     print("-" * 130)
     print(" " * 55 + f"M={M}, N={N}")
-    x = torch.randn((M, N)).cuda().float().contiguous()
-    y = torch.randn((N, M)).cuda().float().contiguous()
+    x = torch.randn((M, N)).to(device).float().contiguous()
+    y = torch.randn((N, M)).to(device).float().contiguous()
     run_benchmark(partial(copy_x), x, "original")
     run_benchmark(lib.mat_transpose_f32_col2row, x, "f32_col2row", y)
     run_benchmark(lib.mat_transpose_f32_row2col, x, "f32_row2col", y)
@@ -1,13 +1,16 @@
 import torch
-import time
-from torch.utils.cpp_extension import load
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import lazy_load
 from typing import Optional
 from functools import partial
 from torchvision.ops import nms
 torch.set_grad_enabled(False)
 
 # Load the CUDA kernel as a python module
-lib = load(
+lib = lazy_load(
     name="nms_lib",
     sources=["nms.cu"],
     extra_cuda_cflags=[
@@ -22,6 +25,7 @@ lib = load(
     ],
     extra_cflags=["-std=c++17"],
 )
+device = bench.get_device()
 
 
 def generate_random_data(Nboxes):
@@ -44,29 +48,20 @@ def run_benchmark(
     warmup: int = 10,
     iters: int = 100,
     show_all: bool = False,
+    ref: Optional[torch.Tensor] = None,
 ):
-    # warmup
-    for i in range(warmup):
-        out = perf_func(scores, boxes, thresholds)
-    torch.cuda.synchronize()
+    def format_func(out: torch.Tensor) -> str:
+        out_val = sorted(out.flatten().detach().cpu().numpy().tolist())
+        len_val = len(out_val)
+        out_val = out_val[-min(3, len_val) :]
+        out_val = [f"{v:<5}" for v in out_val]
+        return f"{out_val}, len of keep: {len_val}"
 
-    start = time.time()
-    # iters
-    for i in range(iters):
-        out = perf_func(scores, boxes, thresholds)
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000  # ms
-    mean_time = total_time / iters
-    out_info = f"{tag}"
-    out_val = sorted(out.flatten().detach().cpu().numpy().tolist())
-    len_val = len(out_val)
-    out_val = out_val[-min(3, len_val) :]
-    out_val = [f"{v:<5}" for v in out_val]
-    print(f"{out_info:>14}: {out_val}, len of keep: {len_val}, time:{mean_time:.8f}ms")
-    if show_all:
-        print(out)
-    return out, mean_time
+    return bench.run_benchmark(
+        perf_func, (scores, boxes, thresholds), tag, warmup=warmup,
+        iters=iters, show_all=show_all, width=18, format_func=format_func,
+        ref=ref,
+    )
 
 
 Nboxes = [1024, 2048, 4096, 8192]
@@ -77,8 +72,14 @@ for nboxes in Nboxes:
     print("-" * 85)
     print(" " * 40 + f"nboxes={nboxes}")
     boxes, scores = generate_random_data(nboxes)
-    boxes = boxes.cuda().float().contiguous()
-    scores = scores.cuda().float().contiguous()
-    run_benchmark(lib.nms, boxes, scores, thresholds, "nms")
+    boxes = boxes.to(device).float().contiguous()
+    scores = scores.to(device).float().contiguous()
+    # lib.nms returns the kept positions in the score sorted order,
+    # torchvision the kept indices of the original boxes.
+    order = scores.sort(stable=True, dim=0, descending=True)[1]
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(nboxes, device=order.device)
+    keep = rank[nms(boxes, scores, thresholds)].sort()[0].int()
+    run_benchmark(lib.nms, boxes, scores, thresholds, "nms", ref=keep)
     run_benchmark(nms, boxes, scores, thresholds, "nms_th")
     print("-" * 85)
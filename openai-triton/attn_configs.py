@@ -0,0 +1,54 @@
+# Autotune config space shared by the prefill-shaped attention kernels
+# (prefix_prefill.py, flash_attn_v2_fwd.py): BLOCK_M/BLOCK_N/num_warps/
+# num_stages, pruned by a shared memory budget. The kernels must take Q and
+# BLOCK_DMODEL_PADDED args.
+
+import os
+
+import triton
+
+# shared memory budget of the Q/K/V tiles when pruning the autotune configs,
+# ~ the 99KB opt-in limit of sm86/sm89, sm80/sm90 have more
+FWD_SMEM_LIMIT = 96 * 1024
+
+
+def is_interpreter() -> bool:
+    return os.environ.get("TRITON_INTERPRET", "0") == "1"
+
+
+def get_fwd_configs():
+    # (BLOCK_M, BLOCK_N, num_warps, num_stages), BLOCK_M % BLOCK_N == 0 for
+    # the causal loop. (128, 128, 8, 1) was the only config before autotuning
+    configs = []
+    for block_m, block_n, num_warps, num_stages in (
+        (128, 128, 8, 1),
+        (128, 64, 4, 1),
+        (128, 64, 8, 2),
+        (128, 32, 4, 2),
+        (64, 64, 4, 1),
+        (64, 64, 4, 2),
+        (64, 32, 4, 2),
+        (32, 32, 4, 1),
+    ):
+        configs.append(
+            triton.Config({"BLOCK_M": block_m, "BLOCK_N": block_n},
+                          num_warps=num_warps,
+                          num_stages=num_stages))
+    return configs
+
+
+def prune_fwd_configs(configs, named_args, **kwargs):
+    # drop the configs whose Q/K/V tiles do not fit in shared memory, so
+    # fp32 and large head sizes get smaller blocks. the interpreter can't
+    # benchmark, it runs the first config left.
+    elem_size = named_args["Q"].element_size()
+    head_size = kwargs["BLOCK_DMODEL_PADDED"]
+
+    def smem(config):
+        block_m, block_n = config.kwargs["BLOCK_M"], config.kwargs["BLOCK_N"]
+        return ((block_m + 2 * block_n) * head_size * elem_size *
+                max(config.num_stages, 1))
+
+    pruned = [c for c in configs if smem(c) <= FWD_SMEM_LIMIT]
+    pruned = pruned or [min(configs, key=smem)]
+    return pruned[:1] if is_interpreter() else pruned
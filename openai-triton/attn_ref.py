@@ -0,0 +1,227 @@
+# Randomized differential testing of the Triton attention kernels: random
+# ragged batches in the paged KV cache layout (shuffled block tables, GQA,
+# non power of 2 head sizes, sliding windows, ALiBi) and a chunked f32 CPU
+# reference with an online softmax, whose memory does not grow with the
+# context length. The cases are drawn from a seeded RNG per tier, see
+# conftest.py: smoke (default, a few small cases) and nightly.
+
+import random
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import torch
+
+from kv_cache import PagedKVCache
+
+TIERS = {
+    # num cases, max seqs per batch, max context / new tokens of a seq
+    "smoke": {"num_cases": 6, "max_seqs": 3, "max_ctx_len": 96, "max_query_len": 48},
+    "nightly": {"num_cases": 16, "max_seqs": 4, "max_ctx_len": 384, "max_query_len": 160},
+}
+HEAD_SIZES = (32, 40, 64, 80, 96, 128)
+GQA_RATIOS = (1, 2, 4)
+
+
+@dataclass
+class AttnCase:
+    seed: int
+    ctx_lens: List[int]
+    query_lens: List[int]
+    num_kv_heads: int
+    num_queries_per_kv: int
+    head_size: int
+    block_size: int
+    sliding_window: Optional[int] = None
+    alibi: bool = False
+
+    @property
+    def num_heads(self) -> int:
+        return self.num_kv_heads * self.num_queries_per_kv
+
+    def __str__(self) -> str:
+        return (f"seed{self.seed}-b{len(self.ctx_lens)}-h{self.num_heads}/{self.num_kv_heads}"
+                f"-d{self.head_size}-w{self.sliding_window or 0}" + ("-alibi" if self.alibi else ""))
+
+
+def random_case(seed: int, tier: str = "smoke") -> AttnCase:
+    limits = TIERS[tier]
+    rng = random.Random(seed)
+    num_seqs = rng.randint(1, limits["max_seqs"])
+
+    def length(max_len, min_len):
+        # edge lengths often, uniform otherwise
+        return rng.choice([min_len, min_len + 1, max_len, rng.randint(min_len, max_len)])
+
+    return AttnCase(
+        seed=seed,
+        ctx_lens=[length(limits["max_ctx_len"], 0) for _ in range(num_seqs)],
+        query_lens=[length(limits["max_query_len"], 1) for _ in range(num_seqs)],
+        num_kv_heads=rng.choice([1, 2]),
+        num_queries_per_kv=rng.choice(GQA_RATIOS),
+        head_size=rng.choice(HEAD_SIZES),
+        block_size=rng.choice([8, 16, 32]),
+        sliding_window=rng.choice(
+            [None, 1, rng.randint(2, limits["max_ctx_len"] + limits["max_query_len"])]),
+        alibi=rng.random() < 0.5,
+    )
+
+
+def get_cases(tier: str = "smoke", base_seed: int = 0) -> List[AttnCase]:
+    return [random_case(base_seed + i, tier) for i in range(TIERS[tier]["num_cases"])]
+
+
+def get_alibi_slopes(num_heads: int) -> torch.Tensor:
+    # geometric slopes of the ALiBi paper, extended for non power of 2 heads
+    n = 2**(num_heads.bit_length() - 1)
+    slopes = [2**(-8 * (i + 1) / n) for i in range(n)]
+    if n < num_heads:
+        extra = [2**(-4 * (i + 1) / n) for i in range(2 * n)]
+        slopes += extra[0::2][:num_heads - n]
+    return torch.tensor(slopes, dtype=torch.float32)
+
+
+@dataclass
+class AttnBatch:
+    cache: PagedKVCache # the context of every sequence
+    q: torch.Tensor # [num_tokens, num_heads, head_size], new tokens packed
+    k: torch.Tensor # [num_tokens, num_kv_heads, head_size]
+    v: torch.Tensor
+    ctx_lens: List[int]
+    query_lens: List[int]
+    metadata: Tuple = field(default=()) # b_loc, b_start_loc, b_seq_len, b_ctx_len, max_input_len
+
+
+def make_batch(case: AttnCase, dtype: torch.dtype, device: str) -> AttnBatch:
+    gen = torch.Generator().manual_seed(case.seed)
+    num_blocks = sum(c // case.block_size + 1 for c in case.ctx_lens) + 1
+    cache = PagedKVCache(num_blocks, case.num_kv_heads, case.head_size,
+                         case.block_size, dtype, device)
+    # block tables out of order
+    random.Random(case.seed).shuffle(cache.allocator.free_list)
+
+    def randn(n, h):
+        return torch.randn(n, h, case.head_size, generator=gen).to(dtype=dtype, device=device)
+
+    for seq_id, ctx_len in enumerate(case.ctx_lens):
+        cache.append(seq_id, randn(ctx_len, case.num_kv_heads), randn(ctx_len, case.num_kv_heads))
+    num_tokens = sum(case.query_lens)
+
+    def i32(values):
+        return torch.tensor(values, dtype=torch.int32, device=device)
+
+    metadata = (cache.get_block_tables(range(len(case.ctx_lens))),
+                i32([sum(case.query_lens[:i]) for i in range(len(case.query_lens))]),
+                i32([c + n for c, n in zip(case.ctx_lens, case.query_lens)]),
+                i32(case.ctx_lens), max(case.query_lens))
+    return AttnBatch(cache, randn(num_tokens, case.num_heads),
+                     randn(num_tokens, case.num_kv_heads),
+                     randn(num_tokens, case.num_kv_heads), list(case.ctx_lens),
+                     list(case.query_lens), metadata)
+
+
+def split_batch(batch: AttnBatch) -> List[AttnBatch]:
+    # every sequence alone, its context copied into a new cache (other blocks)
+    batches = []
+    start = 0
+    for seq_id, (ctx_len, query_len) in enumerate(zip(batch.ctx_lens, batch.query_lens)):
+        src = batch.cache
+        cache = PagedKVCache(src.get_num_blocks(ctx_len) + 1, src.num_kv_heads,
+                             src.head_size, src.block_size, src.dtype, src.device)
+        cache.append(0, *src.gather(seq_id))
+        device = batch.q.device
+        metadata = (cache.get_block_tables([0]),
+                    torch.zeros(1, dtype=torch.int32, device=device),
+                    torch.tensor([ctx_len + query_len], dtype=torch.int32, device=device),
+                    torch.tensor([ctx_len], dtype=torch.int32, device=device), query_len)
+        end = start + query_len
+        batches.append(AttnBatch(cache, batch.q[start:end], batch.k[start:end],
+                                 batch.v[start:end], [ctx_len], [query_len], metadata))
+        start = end
+    return batches
+
+
+def ref_rope(x: torch.Tensor, pos: torch.Tensor, theta: float = 10000.0,
+             style: str = "gptj") -> torch.Tensor:
+    # x: [num_tokens, num_heads, head_size] rotated at pos: [num_tokens],
+    # naive_rope of rope/rope.py (gptj, interleaved pairs) for any positions,
+    # neox: the halves are the pairs
+    dim = x.shape[-1]
+    freqs = 1.0 / (theta**(torch.arange(0, dim, 2)[:(dim // 2)].float() / dim))
+    freqs_cis = torch.polar(torch.ones(len(pos), dim // 2),
+                            torch.outer(pos.float().cpu(), freqs))[:, None, :]
+    xf = x.float().cpu()
+    if style == "gptj":
+        x_ = torch.view_as_complex(xf.reshape(*x.shape[:-1], -1, 2))
+        out = torch.view_as_real(x_ * freqs_cis).flatten(-2)
+    else:
+        x_ = torch.complex(xf[..., :dim // 2], xf[..., dim // 2:])
+        out = torch.view_as_real(x_ * freqs_cis).transpose(-1, -2).flatten(-2)
+    return out.to(device=x.device, dtype=x.dtype)
+
+
+def get_new_positions(batch: AttnBatch) -> torch.Tensor:
+    # positions of the new tokens in their sequences, after the context
+    return torch.cat([torch.arange(c, c + n) for c, n in zip(batch.ctx_lens, batch.query_lens)])
+
+
+def ref_chunked_attn(batch: AttnBatch,
+                     causal: bool = True,
+                     sliding_window: Optional[int] = None,
+                     alibi_slopes: Optional[torch.Tensor] = None,
+                     soft_cap: Optional[float] = None,
+                     chunk_size: int = 128) -> Tuple[torch.Tensor, torch.Tensor]:
+    # f32 attention of the new tokens of every sequence over its context and
+    # new tokens, chunk_size keys at a time: o [num_tokens, num_heads,
+    # head_size] and lse [num_tokens, num_heads]. sliding_window: keys at
+    # most sliding_window - 1 positions away (before, or both sides when not
+    # causal), alibi: + slope * (key pos - query pos) per head, - slope *
+    # |distance| when not causal, soft_cap: soft_cap * tanh(scores / soft_cap)
+    # before the alibi bias.
+    q, k, v = batch.q, batch.k, batch.v
+    group = q.shape[1] // k.shape[1]
+    scale = q.shape[-1]**-0.5
+    outs, lses = [], []
+    start = 0
+    for seq_id, (ctx_len, query_len) in enumerate(zip(batch.ctx_lens, batch.query_lens)):
+        end = start + query_len
+        ck, cv = batch.cache.gather(seq_id)
+        keys = torch.cat([ck, k[start:end]]).float().cpu()
+        values = torch.cat([cv, v[start:end]]).float().cpu()
+        qs = q[start:end].float().cpu().transpose(0, 1) * scale # [H, n, d]
+        q_pos = torch.arange(ctx_len, ctx_len + query_len)[:, None]
+        m = torch.full((q.shape[1], query_len), float("-inf"))
+        l = torch.zeros(q.shape[1], query_len)
+        acc = torch.zeros(q.shape[1], query_len, q.shape[-1])
+        for c0 in range(0, ctx_len + query_len, chunk_size):
+            c1 = min(c0 + chunk_size, ctx_len + query_len)
+            kc = keys[c0:c1].repeat_interleave(group, 1).transpose(0, 1) # [H, c, d]
+            vc = values[c0:c1].repeat_interleave(group, 1).transpose(0, 1)
+            s = qs @ kc.transpose(1, 2) # [H, n, c]
+            if soft_cap:
+                s = soft_cap * torch.tanh(s / soft_cap)
+            k_pos = torch.arange(c0, c1)[None, :]
+            mask = torch.ones(query_len, c1 - c0, dtype=torch.bool)
+            if causal:
+                mask &= k_pos <= q_pos
+            if sliding_window:
+                dist = q_pos - k_pos if causal else (q_pos - k_pos).abs()
+                mask &= dist < sliding_window
+            if alibi_slopes is not None:
+                dist = k_pos - q_pos if causal else -(k_pos - q_pos).abs()
+                s = s + alibi_slopes.float().cpu()[:, None, None] * dist
+            s = s.masked_fill(~mask, float("-inf"))
+            m_new = torch.maximum(m, s.amax(-1))
+            m_safe = m_new.masked_fill(m_new == float("-inf"), 0.0)
+            p = (s - m_safe[..., None]).exp()
+            alpha = (m - m_safe).exp()
+            l = alpha * l + p.sum(-1)
+            acc = alpha[..., None] * acc + p @ vc
+            m = m_new
+        outs.append((acc / l[..., None]).transpose(0, 1))
+        lses.append((m + l.log()).transpose(0, 1))
+        start = end
+    return torch.cat(outs).to(q.device), torch.cat(lses).to(q.device)
+
+
+def get_atol(dtype: torch.dtype) -> float:
+    return 1e-2 if dtype in (torch.float16, torch.bfloat16) else 1e-4
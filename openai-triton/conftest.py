@@ -0,0 +1,24 @@
+import os
+
+import torch
+
+# the kernels are jitted at import, without a GPU run them on CPU with the
+# Triton interpreter. TRITON_INTERPRET=1 forces it with a GPU too.
+if not torch.cuda.is_available():
+    os.environ.setdefault("TRITON_INTERPRET", "1")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--tier", choices=["smoke", "nightly"],
+                     default=os.environ.get("TRITON_TEST_TIER", "smoke"),
+                     help="randomized attention cases: a few small ones (smoke) "
+                     "or many and larger ones (nightly)")
+    parser.addoption("--seed", type=int, default=0, help="base seed of the random cases")
+
+
+def pytest_generate_tests(metafunc):
+    # a test with a "case" arg runs on the random cases of the tier, see attn_ref.py
+    if "case" in metafunc.fixturenames:
+        from attn_ref import get_cases
+        cases = get_cases(metafunc.config.getoption("tier"), metafunc.config.getoption("seed"))
+        metafunc.parametrize("case", cases, ids=str)
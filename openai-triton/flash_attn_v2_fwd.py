@@ -1,10 +1,18 @@
 # The kernels in this file are adapted from LightLLM's context_attention_fwd:
 # https://github.com/ModelTC/lightllm/blob/main/lightllm/models/llama/triton_kernel/context_flashattention_nopad.py
 
+# Flash attention v2 style: the softmax normalization is deferred to the
+# epilogue (one division per row instead of rescaling p every block), with
+# the same paged KV cache inputs as prefix_prefill.py, causal or not, an
+# optional sliding window and an optional log-sum-exp output, to merge the
+# result with the attention over other keys (e.g split-K, cascade).
+
 import torch
 import triton
 import triton.language as tl
 
+from attn_configs import get_fwd_configs, prune_fwd_configs
+
 
 if triton.__version__ >= "2.1.0":
 
@@ -23,6 +31,7 @@ if triton.__version__ >= "2.1.0":
         block_size,
         x,
         Out,
+        Lse,
         stride_b_loc_b,
         stride_b_loc_s,
         stride_qbs,
@@ -46,10 +55,16 @@ if triton.__version__ >= "2.1.0":
         stride_v_cache_h,
         stride_v_cache_d,
         stride_v_cache_bl,
+        stride_lse_bs,
+        stride_lse_h,
         num_queries_per_kv: int,
         BLOCK_M: tl.constexpr,
-        BLOCK_DMODEL: tl.constexpr,
+        BLOCK_DMODEL: tl.constexpr,  # head size
+        BLOCK_DMODEL_PADDED: tl.constexpr,  # head size padded to a power of 2
         BLOCK_N: tl.constexpr,
+        IS_CAUSAL: tl.constexpr,
+        SLIDING_WINDOW: tl.constexpr,
+        RETURN_LSE: tl.constexpr,
     ):
         cur_batch = tl.program_id(0)
         cur_head = tl.program_id(1)
@@ -60,28 +75,37 @@ if triton.__version__ >= "2.1.0":
         cur_batch_ctx_len = tl.load(B_Ctxlen + cur_batch)
         cur_batch_seq_len = tl.load(B_Seqlen + cur_batch)
         cur_batch_in_all_start_index = tl.load(B_Start_Loc + cur_batch)
+        cur_batch_query_len = cur_batch_seq_len - cur_batch_ctx_len
 
         block_start_loc = BLOCK_M * start_m
 
         # initialize offsets
         offs_n = tl.arange(0, BLOCK_N)
-        offs_d = tl.arange(0, BLOCK_DMODEL)
+        offs_d = tl.arange(0, BLOCK_DMODEL_PADDED)
         offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
         off_q = (
             (cur_batch_in_all_start_index + offs_m[:, None]) * stride_qbs +
             cur_head * stride_qh + offs_d[None, :] * stride_qd)
+        dim_mask = offs_d < BLOCK_DMODEL
 
-        q = tl.load(
-            Q + off_q,
-            mask=offs_m[:, None] < cur_batch_seq_len - cur_batch_ctx_len,
-            other=0.0)
+        q = tl.load(Q + off_q,
+                    mask=dim_mask[None, :] &
+                    (offs_m[:, None] < cur_batch_query_len),
+                    other=0.0)
 
-        # # initialize pointer to m and l
+        # initialize pointer to m and l
         m_i = tl.zeros([BLOCK_M], dtype=tl.float32) - float("inf")
         l_i = tl.zeros([BLOCK_M], dtype=tl.float32)
-        acc = tl.zeros([BLOCK_M, BLOCK_DMODEL], dtype=tl.float32)
+        acc = tl.zeros([BLOCK_M, BLOCK_DMODEL_PADDED], dtype=tl.float32)
 
-        for start_n in range(0, cur_batch_ctx_len, BLOCK_N):
+        # compute query against context (no causal mask here), a sliding
+        # window skips the blocks before it
+        ctx_start = 0
+        if SLIDING_WINDOW > 0:
+            ctx_start = (tl.maximum(
+                cur_batch_ctx_len + block_start_loc - SLIDING_WINDOW + 1, 0) //
+                         BLOCK_N) * BLOCK_N
+        for start_n in range(ctx_start, cur_batch_ctx_len, BLOCK_N):
             start_n = tl.multiple_of(start_n, BLOCK_N)
             # -- compute qk ----
             bn = tl.load(B_Loc + cur_batch * stride_b_loc_b +
@@ -100,39 +124,40 @@ if triton.__version__ >= "2.1.0":
                 offs_d[None, :] * stride_v_cache_d +
                 (start_n + offs_n[:, None]) % block_size * stride_v_cache_bl)
             k = tl.load(K_cache + off_k,
-                        mask=(start_n + offs_n[None, :]) < cur_batch_ctx_len,
+                        mask=dim_mask[:, None] &
+                        ((start_n + offs_n[None, :]) < cur_batch_ctx_len),
                         other=0.0)
 
             qk = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
             qk += tl.dot(q, k)
-            qk = tl.where((start_n + offs_n[None, :]) < cur_batch_ctx_len, qk,
-                          float("-inf"))
             qk *= sm_scale
+            mask = (start_n + offs_n[None, :]) < cur_batch_ctx_len
+            if SLIDING_WINDOW > 0:
+                # positions in the sequence: query ctx_len + m, key start_n + n
+                mask = mask & ((cur_batch_ctx_len + offs_m[:, None]) -
+                               (start_n + offs_n[None, :]) < SLIDING_WINDOW)
+            qk = tl.where(mask, qk, float("-inf"))
 
             # -- compute m_ij, p, l_ij
             m_ij = tl.max(qk, 1)
             m_i_new = tl.maximum(m_i, m_ij)
-            p = tl.math.exp(qk - m_i_new[:, None])
+            # a row with all its keys masked so far (sliding window) keeps
+            # m = -inf, exp(-inf - -inf) would be NaN
+            m_i_safe = tl.where(m_i_new == float("-inf"), 0.0, m_i_new)
+            p = tl.exp(qk - m_i_safe[:, None])
             l_ij = tl.sum(p, 1)
             # -- update m_i and l_i
-
-            alpha = tl.math.exp(m_i - m_i_new)
-            l_i_new = alpha * l_i + l_ij
-            # -- update output accumulator --
-            # scale p
-            # scale acc
-            acc_scale = alpha
-            # acc_scale = l_i / l_i_new * alpha
-            acc = acc * acc_scale[:, None]
-            # update acc
+            alpha = tl.exp(m_i - m_i_safe)
+            l_i = alpha * l_i + l_ij
+            # -- update output accumulator, normalized in the epilogue --
+            acc = acc * alpha[:, None]
             v = tl.load(V_cache + off_v,
-                        mask=(start_n + offs_n[:, None]) < cur_batch_ctx_len,
+                        mask=dim_mask[None, :] &
+                        ((start_n + offs_n[:, None]) < cur_batch_ctx_len),
                         other=0.0)
 
             p = p.to(v.dtype)
             acc += tl.dot(p, v)
-            # update m_i and l_i
-            l_i = l_i_new
             m_i = m_i_new
 
         off_k = (offs_n[None, :] * stride_kbs + cur_kv_head * stride_kh +
@@ -142,53 +167,66 @@ if triton.__version__ >= "2.1.0":
         k_ptrs = K + off_k
         v_ptrs = V + off_v
 
-        block_mask = tl.where(
-            block_start_loc < cur_batch_seq_len - cur_batch_ctx_len, 1, 0)
+        # block_mask is 0 when we're already past the current query length
+        block_mask = tl.where(block_start_loc < cur_batch_query_len, 1, 0)
+        start_new = 0
+        if SLIDING_WINDOW > 0:
+            start_new = (tl.maximum(block_start_loc - SLIDING_WINDOW + 1, 0) //
+                         BLOCK_N) * BLOCK_N
+        if IS_CAUSAL:
+            end_new = block_mask * (start_m + 1) * BLOCK_M
+        else:
+            end_new = block_mask * cur_batch_query_len
 
-        for start_n in range(0, block_mask * (start_m + 1) * BLOCK_M, BLOCK_N):
+        # compute query against itself
+        for start_n in range(start_new, end_new, BLOCK_N):
             start_n = tl.multiple_of(start_n, BLOCK_N)
             # -- compute qk ----
             k = tl.load(k_ptrs +
                         (cur_batch_in_all_start_index + start_n) * stride_kbs,
-                        mask=(start_n + offs_n[None, :]) <
-                        cur_batch_seq_len - cur_batch_ctx_len,
+                        mask=dim_mask[:, None] &
+                        ((start_n + offs_n[None, :]) < cur_batch_query_len),
                         other=0.0)
 
             qk = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
             qk += tl.dot(q, k)
             qk *= sm_scale
-            qk = tl.where(offs_m[:, None] >= (start_n + offs_n[None, :]), qk,
-                          float("-inf"))
+            mask = (start_n + offs_n[None, :]) < cur_batch_query_len
+            if IS_CAUSAL:
+                mask = mask & (offs_m[:, None] >= (start_n + offs_n[None, :]))
+            if SLIDING_WINDOW > 0:
+                # on both sides when not causal
+                dist = offs_m[:, None] - (start_n + offs_n[None, :])
+                if not IS_CAUSAL:
+                    dist = tl.abs(dist)
+                mask = mask & (dist < SLIDING_WINDOW)
+            qk = tl.where(mask, qk, float("-inf"))
 
             # -- compute m_ij, p, l_ij
             m_ij = tl.max(qk, 1)
             m_i_new = tl.maximum(m_i, m_ij)
-            p = tl.math.exp(qk - m_i_new[:, None])
+            m_i_safe = tl.where(m_i_new == float("-inf"), 0.0, m_i_new)
+            p = tl.exp(qk - m_i_safe[:, None])
             l_ij = tl.sum(p, 1)
             # -- update m_i and l_i
-
-            alpha = tl.math.exp(m_i - m_i_new)
-            l_i_new = alpha * l_i + l_ij
+            alpha = tl.exp(m_i - m_i_safe)
+            l_i = alpha * l_i + l_ij
             # -- update output accumulator --
-            # scale p
-            # scale acc
-            acc_scale = alpha
-            # acc_scale = l_i / l_i_new * alpha
-            acc = acc * acc_scale[:, None]
-            # update acc
+            acc = acc * alpha[:, None]
             v = tl.load(v_ptrs +
                         (cur_batch_in_all_start_index + start_n) * stride_vbs,
-                        mask=(start_n + offs_n[:, None]) <
-                        cur_batch_seq_len - cur_batch_ctx_len,
+                        mask=dim_mask[None, :] &
+                        ((start_n + offs_n[:, None]) < cur_batch_query_len),
                         other=0.0)
 
             p = p.to(v.dtype)
             acc += tl.dot(p, v)
-            # update m_i and l_i
-            l_i = l_i_new
             m_i = m_i_new
 
-        # acc /= l_i[:, None]
+        # epilogue: normalize once, the rows past the query length have no
+        # keys, l_i = 0, and are not stored
+        l_i_safe = tl.where(l_i == 0.0, 1.0, l_i)
+        acc = acc / l_i_safe[:, None]
         # initialize pointers to output
         off_o = (
             (cur_batch_in_all_start_index + offs_m[:, None]) * stride_obs +
@@ -196,5 +234,115 @@ if triton.__version__ >= "2.1.0":
         out_ptrs = Out + off_o
         tl.store(out_ptrs,
                  acc,
-                 mask=offs_m[:, None] < cur_batch_seq_len - cur_batch_ctx_len)
+                 mask=dim_mask[None, :] &
+                 (offs_m[:, None] < cur_batch_query_len))
+        if RETURN_LSE:
+            # natural log, of the scaled scores
+            off_lse = ((cur_batch_in_all_start_index + offs_m) * stride_lse_bs +
+                       cur_head * stride_lse_h)
+            tl.store(Lse + off_lse,
+                     m_i + tl.log(l_i_safe),
+                     mask=offs_m < cur_batch_query_len)
         return
+
+    # keyed on the head size and the GQA ratio, the autotuner also keys on
+    # the dtypes of the tensor args (q, k/v cache, ...)
+    _fwd_kernel_flash_attn_v2_autotune = triton.autotune(
+        configs=get_fwd_configs(),
+        key=["BLOCK_DMODEL", "num_queries_per_kv"],
+        prune_configs_by={"early_config_prune": prune_fwd_configs},
+    )(_fwd_kernel_flash_attn_v2)
+
+    @torch.inference_mode()
+    def flash_attn_v2_fwd(q,
+                          k,
+                          v,
+                          o,
+                          k_cache,
+                          v_cache,
+                          b_loc,
+                          b_start_loc,
+                          b_seq_len,
+                          b_ctx_len,
+                          max_input_len,
+                          causal=True,
+                          sliding_window=None,
+                          return_lse=False):
+        # inputs as context_attention_fwd (prefix_prefill.py). causal: the new
+        # tokens attend to the previous new tokens only, all of them
+        # otherwise. sliding_window: keys at most sliding_window - 1
+        # positions before the query (and after, when not causal). returns
+        # the log-sum-exp lse: [num_tokens, num_heads] f32 if return_lse.
+
+        # shape constraints
+        Lq, Lk, Lv = q.shape[-1], k.shape[-1], v.shape[-1]
+        assert Lq == Lk and Lk == Lv
+        # round up Lk to a power of 2 - this is required for Triton block size
+        Lk_padded = triton.next_power_of_2(Lk)
+
+        sm_scale = 1.0 / (Lq**0.5)
+        batch, head = b_seq_len.shape[0], q.shape[1]
+        num_queries_per_kv = q.shape[1] // k.shape[1]
+
+        def grid(META):
+            # batch, head, query blocks
+            return (batch, head, triton.cdiv(max_input_len, META["BLOCK_M"]))
+
+        # 0 means "disable"
+        if sliding_window is None or sliding_window <= 0:
+            sliding_window = 0
+        if return_lse:
+            lse = torch.empty(q.shape[0], head, dtype=torch.float32, device=q.device)
+        else:
+            lse = torch.empty(1, 1, dtype=torch.float32, device=q.device)
+
+        _fwd_kernel_flash_attn_v2_autotune[grid](
+            q,
+            k,
+            v,
+            k_cache,
+            v_cache,
+            b_loc,
+            sm_scale,
+            b_start_loc,
+            b_seq_len,
+            b_ctx_len,
+            v_cache.shape[3],
+            k_cache.shape[4],
+            o,
+            lse,
+            b_loc.stride(0),
+            b_loc.stride(1),
+            q.stride(0),
+            q.stride(1),
+            q.stride(2),
+            k.stride(0),
+            k.stride(1),
+            k.stride(2),
+            v.stride(0),
+            v.stride(1),
+            v.stride(2),
+            o.stride(0),
+            o.stride(1),
+            o.stride(2),
+            k_cache.stride(0),
+            k_cache.stride(1),
+            k_cache.stride(2),
+            k_cache.stride(3),
+            k_cache.stride(
+                4),  #[num_blocks, num_kv_heads, head_size/x, block_size, x]
+            v_cache.stride(0),
+            v_cache.stride(1),
+            v_cache.stride(2),
+            v_cache.stride(
+                3),  #[num_blocks, num_kv_heads, head_size, block_size]
+            lse.stride(0),
+            lse.stride(1),
+            num_queries_per_kv=num_queries_per_kv,
+            BLOCK_DMODEL=Lk,
+            BLOCK_DMODEL_PADDED=Lk_padded,
+            IS_CAUSAL=causal,
+            SLIDING_WINDOW=sliding_window,
+            RETURN_LSE=return_lse,
+        )
+        return lse if return_lse else None
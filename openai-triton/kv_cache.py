@@ -0,0 +1,210 @@
+# Paged KV cache in the layouts read by the prefix_prefill kernels:
+#   k_cache: [num_blocks, num_kv_heads, head_size/x, block_size, x]
+#   v_cache: [num_blocks, num_kv_heads, head_size, block_size]
+# x is the number of elements in 16 bytes, so that a thread loads the K of
+# one token with 128 bits loads. Every sequence has a block table, the list
+# of the blocks that hold its tokens, in order. Blocks are reference counted:
+# forked sequences (e.g n samples of one prompt) share the blocks of their
+# common prefix, and a shared block is copied before it is written to
+# (copy-on-write), so only the partially filled last block is ever copied.
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+def get_x(dtype: torch.dtype) -> int:
+    # elements per 16 bytes, 8 for fp16/bf16, 4 for fp32
+    return 16 // torch.empty((), dtype=dtype).element_size()
+
+
+class BlockAllocator:
+    # free list and reference counts of the blocks of a PagedKVCache
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        # popped from the end, block 0 first
+        self.free_list: List[int] = list(range(num_blocks - 1, -1, -1))
+        self.ref_counts: List[int] = [0] * num_blocks
+
+    @property
+    def num_free(self) -> int:
+        return len(self.free_list)
+
+    def allocate(self) -> int:
+        if not self.free_list:
+            raise RuntimeError("out of KV cache blocks")
+        block = self.free_list.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def incref(self, block: int) -> int:
+        if self.ref_counts[block] == 0:
+            raise ValueError(f"block {block} is free")
+        self.ref_counts[block] += 1
+        return self.ref_counts[block]
+
+    def free(self, block: int) -> int:
+        # drop a reference, the block is free again with the last one
+        if self.ref_counts[block] == 0:
+            raise ValueError(f"block {block} is already free")
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_list.append(block)
+        return self.ref_counts[block]
+
+    def get_ref_count(self, block: int) -> int:
+        return self.ref_counts[block]
+
+
+class PagedKVCache:
+
+    def __init__(self,
+                 num_blocks: int,
+                 num_kv_heads: int,
+                 head_size: int,
+                 block_size: int = 16,
+                 dtype: torch.dtype = torch.float16,
+                 device: str = "cuda"):
+        self.x = get_x(dtype)
+        if head_size % self.x != 0:
+            raise ValueError(f"head size {head_size} is not a multiple of x={self.x}")
+        self.num_blocks = num_blocks
+        self.num_kv_heads = num_kv_heads
+        self.head_size = head_size
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = device
+        self.k_cache = torch.zeros(num_blocks, num_kv_heads, head_size // self.x,
+                                   block_size, self.x, dtype=dtype, device=device)
+        self.v_cache = torch.zeros(num_blocks, num_kv_heads, head_size, block_size,
+                                   dtype=dtype, device=device)
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lens: Dict[int, int] = {}
+        # evictor(num_blocks) frees up to num_blocks blocks held by a cache
+        # (e.g the prefix cache) when an allocation runs out of free blocks
+        self.evictor: Optional[Callable[[int], int]] = None
+
+    @property
+    def num_free_blocks(self) -> int:
+        return self.allocator.num_free
+
+    def get_seq_len(self, seq_id: int) -> int:
+        return self.seq_lens.get(seq_id, 0)
+
+    def get_block_table(self, seq_id: int) -> List[int]:
+        return self.block_tables.get(seq_id, [])
+
+    def get_num_blocks(self, num_tokens: int) -> int:
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def _needs_copy(self, seq_id: int) -> bool:
+        # the next token goes into a partially filled block shared with others
+        table = self.get_block_table(seq_id)
+        return (self.get_seq_len(seq_id) % self.block_size != 0 and
+                self.allocator.get_ref_count(table[-1]) > 1)
+
+    def get_num_required_blocks(self, seq_id: int, num_tokens: int) -> int:
+        # new blocks to append num_tokens to seq_id, copy-on-write included
+        num_new = (self.get_num_blocks(self.get_seq_len(seq_id) + num_tokens) -
+                   len(self.get_block_table(seq_id)))
+        return num_new + int(num_tokens > 0 and self._needs_copy(seq_id))
+
+    def can_append(self, seq_id: int, num_tokens: int) -> bool:
+        return self.get_num_required_blocks(seq_id, num_tokens) <= self.num_free_blocks
+
+    def copy_block(self, src: int, dst: int):
+        self.k_cache[dst].copy_(self.k_cache[src])
+        self.v_cache[dst].copy_(self.v_cache[src])
+
+    def allocate(self, seq_id: int, num_tokens: int):
+        # grow the block table of seq_id to hold num_tokens more tokens, and
+        # copy its last block first if it is shared and not full
+        required = self.get_num_required_blocks(seq_id, num_tokens)
+        if required > self.num_free_blocks and self.evictor is not None:
+            self.evictor(required - self.num_free_blocks)
+        if required > self.num_free_blocks:
+            raise RuntimeError(f"out of KV cache blocks: {required} needed, "
+                               f"{self.num_free_blocks} free")
+        table = self.block_tables.setdefault(seq_id, [])
+        self.seq_lens.setdefault(seq_id, 0)
+        if num_tokens > 0 and self._needs_copy(seq_id):
+            block = self.allocator.allocate()
+            self.copy_block(table[-1], block)
+            self.allocator.free(table[-1])
+            table[-1] = block
+        for _ in range(self.get_num_blocks(self.seq_lens[seq_id] + num_tokens) - len(table)):
+            table.append(self.allocator.allocate())
+
+    def fork(self, parent_id: int, child_id: int):
+        # child_id shares all the blocks of parent_id, e.g beam search or n
+        # samples of a prompt, the writes after the fork copy on write
+        if child_id in self.block_tables:
+            raise ValueError(f"seq {child_id} already exists")
+        table = list(self.get_block_table(parent_id))
+        for block in table:
+            self.allocator.incref(block)
+        self.block_tables[child_id] = table
+        self.seq_lens[child_id] = self.get_seq_len(parent_id)
+
+    def attach_blocks(self, seq_id: int, blocks: Sequence[int], num_tokens: int):
+        # a new sequence starting with num_tokens tokens already in blocks,
+        # e.g a cached prompt prefix, shared with their other users
+        if seq_id in self.block_tables:
+            raise ValueError(f"seq {seq_id} already exists")
+        if self.get_num_blocks(num_tokens) != len(blocks):
+            raise ValueError(f"{len(blocks)} blocks for {num_tokens} tokens")
+        for block in blocks:
+            self.allocator.incref(block)
+        self.block_tables[seq_id] = list(blocks)
+        self.seq_lens[seq_id] = num_tokens
+
+    def get_slots(self, seq_id: int, start: int,
+                  end: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        # block ids and offsets in the block of the tokens [start, end)
+        table = torch.tensor(self.get_block_table(seq_id), dtype=torch.long)
+        pos = torch.arange(start, end)
+        blocks = table[pos // self.block_size].to(self.device)
+        return blocks, (pos % self.block_size).to(self.device)
+
+    def write(self, blocks: torch.Tensor, offsets: torch.Tensor, k: torch.Tensor,
+              v: torch.Tensor):
+        # k, v: [num_tokens, num_kv_heads, head_size] into the given slots
+        num_tokens = k.shape[0]
+        self.k_cache[blocks, :, :, offsets, :] = k.view(
+            num_tokens, self.num_kv_heads, self.head_size // self.x,
+            self.x).to(self.dtype)
+        self.v_cache[blocks, :, :, offsets] = v.to(self.dtype)
+
+    def append(self, seq_id: int, k: torch.Tensor, v: torch.Tensor):
+        # append the k, v: [num_tokens, num_kv_heads, head_size] of new tokens
+        num_tokens = k.shape[0]
+        self.allocate(seq_id, num_tokens)
+        seq_len = self.seq_lens[seq_id]
+        self.write(*self.get_slots(seq_id, seq_len, seq_len + num_tokens), k, v)
+        self.seq_lens[seq_id] = seq_len + num_tokens
+
+    def gather(self, seq_id: int, start: int = 0,
+               end: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        # k, v: [num_tokens, num_kv_heads, head_size] of the tokens [start, end)
+        end = self.get_seq_len(seq_id) if end is None else end
+        blocks, offsets = self.get_slots(seq_id, start, end)
+        k = self.k_cache[blocks, :, :, offsets, :].reshape(
+            end - start, self.num_kv_heads, self.head_size)
+        return k, self.v_cache[blocks, :, :, offsets]
+
+    def free(self, seq_id: int):
+        # the blocks shared with other sequences stay
+        for block in reversed(self.block_tables.pop(seq_id, [])):
+            self.allocator.free(block)
+        self.seq_lens.pop(seq_id, None)
+
+    def get_block_tables(self, seq_ids: Sequence[int]) -> torch.Tensor:
+        # b_loc: [batch, max_num_blocks] int32, padded with block 0
+        tables = [self.get_block_table(seq_id) for seq_id in seq_ids]
+        b_loc = torch.zeros(len(tables), max([len(t) for t in tables] + [1]),
+                            dtype=torch.int32)
+        for i, table in enumerate(tables):
+            b_loc[i, :len(table)] = torch.tensor(table, dtype=torch.int32)
+        return b_loc.to(self.device)
@@ -0,0 +1,411 @@
+# Split-K (flash-decoding) attention of one new token per sequence over the
+# paged KV cache of prefix_prefill.py. The prefill grid (batch, head,
+# cdiv(max_input_len, BLOCK)) launches batch * heads programs for one query
+# token, far too few to fill the GPU with long contexts at small batch. Here
+# the context is split along the sequence into partitions, one program per
+# (batch, head, partition) computes the partial softmax(qK^T)V and its
+# log-sum-exp, and a second kernel merges the partitions of a sequence:
+#   o = sum_s exp(lse_s - lse) * o_s,  lse = log(sum_s exp(lse_s))
+#
+#   decode = PagedDecode(kv_cache)
+#   o = decode(q, k, v, seq_ids) # q: [batch, num_heads, head_size]
+#
+# Runs on CPU with the Triton interpreter: TRITON_INTERPRET=1.
+
+import os
+import sys
+import argparse
+from typing import Optional, Sequence
+
+import torch
+import triton
+import triton.language as tl
+
+from kv_cache import PagedKVCache
+
+# tokens per inner iteration, and the smallest partition, a multiple of it
+DECODE_BLOCK_N = 64
+MIN_PARTITION_SIZE = 256
+# programs per SM to aim for when splitting
+DECODE_WAVES = 4
+
+
+@triton.jit
+def _fwd_kernel_decode_split(
+    Q,
+    K_cache,
+    V_cache,
+    B_Loc,
+    B_Seqlen,
+    sm_scale,
+    block_size,
+    x,
+    Mid_O,
+    Mid_Lse,
+    stride_b_loc_b,
+    stride_b_loc_s,
+    stride_qb,
+    stride_qh,
+    stride_qd,
+    stride_k_cache_bs,
+    stride_k_cache_h,
+    stride_k_cache_d,
+    stride_k_cache_bl,
+    stride_k_cache_x,
+    stride_v_cache_bs,
+    stride_v_cache_h,
+    stride_v_cache_d,
+    stride_v_cache_bl,
+    stride_mid_ob,
+    stride_mid_oh,
+    stride_mid_os,
+    stride_mid_od,
+    stride_mid_lse_b,
+    stride_mid_lse_h,
+    stride_mid_lse_s,
+    num_queries_per_kv: int,
+    PARTITION_SIZE: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,  # head size
+    BLOCK_DMODEL_PADDED: tl.constexpr,  # head size padded to a power of 2
+    SLIDING_WINDOW: tl.constexpr,
+):
+    cur_batch = tl.program_id(0)
+    cur_head = tl.program_id(1)
+    split = tl.program_id(2)
+
+    cur_kv_head = cur_head // num_queries_per_kv
+    cur_batch_seq_len = tl.load(B_Seqlen + cur_batch)
+    # the query is the last token, it attends [ctx_start, seq_len)
+    ctx_start = 0
+    if SLIDING_WINDOW > 0:
+        ctx_start = tl.maximum(cur_batch_seq_len - SLIDING_WINDOW, 0)
+    part_start = ctx_start + split * PARTITION_SIZE
+    part_end = tl.minimum(part_start + PARTITION_SIZE, cur_batch_seq_len)
+    # the partitions past the end of a shorter sequence of the batch
+    if part_start >= part_end:
+        return
+
+    offs_n = tl.arange(0, BLOCK_N)  # [N]
+    offs_d = tl.arange(0, BLOCK_DMODEL_PADDED)  # [D]
+    dim_mask = offs_d < BLOCK_DMODEL  # [D]
+
+    q = tl.load(Q + cur_batch * stride_qb + cur_head * stride_qh +
+                offs_d * stride_qd,
+                mask=dim_mask,
+                other=0.0).to(tl.float32)  # [D]
+
+    m_i = -float("inf")
+    l_i = 0.0
+    acc = tl.zeros([BLOCK_DMODEL_PADDED], dtype=tl.float32)  # [D]
+
+    for start_n in range(part_start, part_end, BLOCK_N):
+        offs = start_n + offs_n  # [N] positions in the sequence
+        mask_n = offs < part_end
+        bn = tl.load(B_Loc + cur_batch * stride_b_loc_b +
+                     (offs // block_size) * stride_b_loc_s,
+                     mask=mask_n,
+                     other=0)  # [N]
+        # [N,D]
+        off_k = (bn[:, None] * stride_k_cache_bs +
+                 cur_kv_head * stride_k_cache_h +
+                 (offs_d[None, :] // x) * stride_k_cache_d +
+                 (offs[:, None] % block_size) * stride_k_cache_bl +
+                 (offs_d[None, :] % x) * stride_k_cache_x)
+        # [N,D]
+        off_v = (bn[:, None] * stride_v_cache_bs +
+                 cur_kv_head * stride_v_cache_h +
+                 offs_d[None, :] * stride_v_cache_d +
+                 (offs[:, None] % block_size) * stride_v_cache_bl)
+        k = tl.load(K_cache + off_k,
+                    mask=mask_n[:, None] & dim_mask[None, :],
+                    other=0.0).to(tl.float32)
+        qk = tl.sum(q[None, :] * k, 1) * sm_scale  # [N]
+        qk = tl.where(mask_n, qk, float("-inf"))
+
+        m_i_new = tl.maximum(m_i, tl.max(qk, 0))
+        alpha = tl.exp(m_i - m_i_new)
+        p = tl.exp(qk - m_i_new)  # [N]
+        v = tl.load(V_cache + off_v,
+                    mask=mask_n[:, None] & dim_mask[None, :],
+                    other=0.0).to(tl.float32)
+        acc = acc * alpha + tl.sum(p[:, None] * v, 0)
+        l_i = l_i * alpha + tl.sum(p, 0)
+        m_i = m_i_new
+
+    off_mid = cur_batch * stride_mid_ob + cur_head * stride_mid_oh + split * stride_mid_os
+    tl.store(Mid_O + off_mid + offs_d * stride_mid_od, acc / l_i, mask=dim_mask)
+    tl.store(Mid_Lse + cur_batch * stride_mid_lse_b + cur_head * stride_mid_lse_h +
+             split * stride_mid_lse_s, m_i + tl.log(l_i))
+
+
+@triton.jit
+def _fwd_kernel_decode_reduce(
+    Mid_O,
+    Mid_Lse,
+    B_Seqlen,
+    Out,
+    stride_mid_ob,
+    stride_mid_oh,
+    stride_mid_os,
+    stride_mid_od,
+    stride_mid_lse_b,
+    stride_mid_lse_h,
+    stride_mid_lse_s,
+    stride_ob,
+    stride_oh,
+    stride_od,
+    PARTITION_SIZE: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    BLOCK_DMODEL_PADDED: tl.constexpr,
+    SLIDING_WINDOW: tl.constexpr,
+):
+    cur_batch = tl.program_id(0)
+    cur_head = tl.program_id(1)
+
+    cur_batch_seq_len = tl.load(B_Seqlen + cur_batch)
+    ctx_start = 0
+    if SLIDING_WINDOW > 0:
+        ctx_start = tl.maximum(cur_batch_seq_len - SLIDING_WINDOW, 0)
+    num_splits = tl.cdiv(cur_batch_seq_len - ctx_start, PARTITION_SIZE)
+
+    offs_d = tl.arange(0, BLOCK_DMODEL_PADDED)
+    dim_mask = offs_d < BLOCK_DMODEL
+    off_mid = cur_batch * stride_mid_ob + cur_head * stride_mid_oh
+    off_mid_lse = cur_batch * stride_mid_lse_b + cur_head * stride_mid_lse_h
+
+    m_i = -float("inf")
+    l_i = 0.0
+    acc = tl.zeros([BLOCK_DMODEL_PADDED], dtype=tl.float32)
+    for split in range(0, num_splits):
+        lse = tl.load(Mid_Lse + off_mid_lse + split * stride_mid_lse_s)
+        o = tl.load(Mid_O + off_mid + split * stride_mid_os + offs_d * stride_mid_od,
+                    mask=dim_mask,
+                    other=0.0)
+        m_i_new = tl.maximum(m_i, lse)
+        alpha = tl.exp(m_i - m_i_new)
+        beta = tl.exp(lse - m_i_new)
+        acc = acc * alpha + o * beta
+        l_i = l_i * alpha + beta
+        m_i = m_i_new
+
+    tl.store(Out + cur_batch * stride_ob + cur_head * stride_oh + offs_d * stride_od,
+             acc / l_i,
+             mask=dim_mask)
+
+
+def get_num_sms(device) -> int:
+    if torch.device(device).type == "cuda":
+        return torch.cuda.get_device_properties(device).multi_processor_count
+    return 1
+
+
+def get_partition_size(batch: int, num_heads: int, max_seq_len: int,
+                       num_sms: int) -> int:
+    # split until there are ~DECODE_WAVES programs per SM, in partitions of
+    # at least MIN_PARTITION_SIZE tokens (a power of 2, >= DECODE_BLOCK_N)
+    num_splits = triton.cdiv(DECODE_WAVES * num_sms, batch * num_heads)
+    partition_size = triton.next_power_of_2(triton.cdiv(max_seq_len, num_splits))
+    return max(partition_size, MIN_PARTITION_SIZE)
+
+
+@torch.inference_mode()
+def paged_decode_fwd(q,
+                     o,
+                     k_cache,
+                     v_cache,
+                     b_loc,
+                     b_seq_len,
+                     max_seq_len,
+                     sliding_window=None,
+                     partition_size=None):
+    # q, o: [batch, num_heads, head_size], the last token of every sequence,
+    # b_seq_len: [batch] tokens in the cache, the new one included, b_loc:
+    # [batch, max_num_blocks] block tables. partition_size: tokens per
+    # program, default from get_partition_size.
+    batch, num_heads, head_size = q.shape
+    num_queries_per_kv = num_heads // k_cache.shape[1]
+    head_size_padded = triton.next_power_of_2(head_size)
+    sm_scale = 1.0 / (head_size**0.5)
+    # 0 means "disable"
+    if sliding_window is None or sliding_window <= 0:
+        sliding_window = 0
+    max_ctx_len = min(max_seq_len, sliding_window) if sliding_window else max_seq_len
+    if partition_size is None:
+        partition_size = get_partition_size(batch, num_heads, max_ctx_len,
+                                            get_num_sms(q.device))
+    if partition_size % DECODE_BLOCK_N != 0:
+        raise ValueError(f"partition size {partition_size} is not a multiple of {DECODE_BLOCK_N}")
+    num_splits = triton.cdiv(max_ctx_len, partition_size)
+
+    mid_o = torch.empty(batch, num_heads, num_splits, head_size,
+                        dtype=torch.float32, device=q.device)
+    mid_lse = torch.empty(batch, num_heads, num_splits, dtype=torch.float32,
+                          device=q.device)
+    _fwd_kernel_decode_split[(batch, num_heads, num_splits)](
+        q,
+        k_cache,
+        v_cache,
+        b_loc,
+        b_seq_len,
+        sm_scale,
+        v_cache.shape[3],
+        k_cache.shape[4],
+        mid_o,
+        mid_lse,
+        b_loc.stride(0),
+        b_loc.stride(1),
+        q.stride(0),
+        q.stride(1),
+        q.stride(2),
+        k_cache.stride(0),
+        k_cache.stride(1),
+        k_cache.stride(2),
+        k_cache.stride(3),
+        k_cache.stride(4),  #[num_blocks, num_kv_heads, head_size/x, block_size, x]
+        v_cache.stride(0),
+        v_cache.stride(1),
+        v_cache.stride(2),
+        v_cache.stride(3),  #[num_blocks, num_kv_heads, head_size, block_size]
+        mid_o.stride(0),
+        mid_o.stride(1),
+        mid_o.stride(2),
+        mid_o.stride(3),
+        mid_lse.stride(0),
+        mid_lse.stride(1),
+        mid_lse.stride(2),
+        num_queries_per_kv=num_queries_per_kv,
+        PARTITION_SIZE=partition_size,
+        BLOCK_N=DECODE_BLOCK_N,
+        BLOCK_DMODEL=head_size,
+        BLOCK_DMODEL_PADDED=head_size_padded,
+        SLIDING_WINDOW=sliding_window,
+        num_warps=4,
+        num_stages=2,
+    )
+    _fwd_kernel_decode_reduce[(batch, num_heads)](
+        mid_o,
+        mid_lse,
+        b_seq_len,
+        o,
+        mid_o.stride(0),
+        mid_o.stride(1),
+        mid_o.stride(2),
+        mid_o.stride(3),
+        mid_lse.stride(0),
+        mid_lse.stride(1),
+        mid_lse.stride(2),
+        o.stride(0),
+        o.stride(1),
+        o.stride(2),
+        PARTITION_SIZE=partition_size,
+        BLOCK_DMODEL=head_size,
+        BLOCK_DMODEL_PADDED=head_size_padded,
+        SLIDING_WINDOW=sliding_window,
+        num_warps=4,
+    )
+    return o
+
+
+class PagedDecode:
+
+    def __init__(self,
+                 kv_cache: PagedKVCache,
+                 sliding_window: Optional[int] = None,
+                 partition_size: Optional[int] = None):
+        self.kv_cache = kv_cache
+        self.sliding_window = sliding_window
+        self.partition_size = partition_size
+
+    def forward(self,
+                q: torch.Tensor,
+                k: torch.Tensor,
+                v: torch.Tensor,
+                seq_ids: Sequence[int],
+                o: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # q: [batch, num_heads, head_size], k, v: [batch, num_kv_heads,
+        # head_size], one new token of each of seq_ids. appends k, v to the
+        # KV cache, returns o: [batch, num_heads, head_size].
+        if q.shape[0] != len(seq_ids) or k.shape[0] != q.shape[0]:
+            raise ValueError(f"{q.shape[0]} tokens for {len(seq_ids)} seqs")
+        for i, seq_id in enumerate(seq_ids):
+            self.kv_cache.append(seq_id, k[i:i + 1], v[i:i + 1])
+        seq_lens = [self.kv_cache.get_seq_len(seq_id) for seq_id in seq_ids]
+        b_seq_len = torch.tensor(seq_lens, dtype=torch.int32, device=self.kv_cache.device)
+        o = torch.empty_like(q) if o is None else o
+        paged_decode_fwd(q, o, self.kv_cache.k_cache, self.kv_cache.v_cache,
+                         self.kv_cache.get_block_tables(seq_ids), b_seq_len,
+                         max(seq_lens), sliding_window=self.sliding_window,
+                         partition_size=self.partition_size)
+        return o
+
+    __call__ = forward
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="paged split-K decode")
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[1, 300, 1000])
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-kv-heads", type=int, default=2)
+    parser.add_argument("--head-size", type=int, default=128)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--partition-size", type=int, default=None)
+    parser.add_argument("--sliding-window", type=int, default=None)
+    parser.add_argument("--dtype", type=str, default="float16")
+    parser.add_argument("--bench", action="store_true", help="Time split-K vs prefill kernel, GPU only")
+    return parser.parse_args()
+
+
+def main():
+    # checks PagedDecode against ref_paged_prefill (one query token), on CPU
+    # with TRITON_INTERPRET=1 when there is no GPU. --bench compares it with
+    # context_attention_fwd, e.g --seq-lens 32768 --num-heads 32 --num-kv-heads 8
+    from paged_prefill import PagedPrefill, ref_paged_prefill
+    args = get_args()
+    print(args)
+    torch.manual_seed(0)
+    interpret = os.environ.get("TRITON_INTERPRET", "0") == "1"
+    device = "cpu" if interpret or not torch.cuda.is_available() else "cuda"
+    if device == "cpu" and not interpret:
+        raise SystemExit("no GPU, run with TRITON_INTERPRET=1")
+    dtype = getattr(torch, args.dtype)
+    num_blocks = sum(n // args.block_size + 2 for n in args.seq_lens)
+    cache = PagedKVCache(num_blocks, args.num_kv_heads, args.head_size,
+                         args.block_size, dtype, device)
+    decode = PagedDecode(cache, args.sliding_window, args.partition_size)
+    seq_ids = list(range(len(args.seq_lens)))
+    batch = len(seq_ids)
+
+    def randn(n, h):
+        return torch.randn(n, h, args.head_size, dtype=dtype, device=device)
+
+    for seq_id, seq_len in zip(seq_ids, args.seq_lens):
+        # the context, the last token is appended by decode
+        cache.append(seq_id, randn(seq_len - 1, args.num_kv_heads),
+                     randn(seq_len - 1, args.num_kv_heads))
+    q, k, v = randn(batch, args.num_heads), randn(batch, args.num_kv_heads), randn(batch, args.num_kv_heads)
+    o = decode(q, k, v, seq_ids)
+    ref = ref_paged_prefill(q, cache, seq_ids, [1] * batch, args.sliding_window)
+    diff = (o.float() - ref.float()).abs().max().item()
+    print(f"paged decode on {device}, seq lens: {args.seq_lens}, max diff: {diff:.6f}")
+    if args.bench and device == "cuda":
+        b_loc = cache.get_block_tables(seq_ids)
+        b_seq_len = torch.tensor(args.seq_lens, dtype=torch.int32, device=device)
+        ms = triton.testing.do_bench(lambda: paged_decode_fwd(
+            q, o, cache.k_cache, cache.v_cache, b_loc, b_seq_len, max(args.seq_lens),
+            args.sliding_window, args.partition_size))
+        # the same attention with the prefill grid, context = seq_len - 1
+        prefill = PagedPrefill(cache, args.sliding_window)
+        metadata = prefill.get_metadata(seq_ids, [1] * batch)
+        from prefix_prefill import context_attention_fwd
+        ms_prefill = triton.testing.do_bench(lambda: context_attention_fwd(
+            q, k, v, o, cache.k_cache, cache.v_cache, metadata.b_loc,
+            metadata.b_start_loc, metadata.b_seq_len, metadata.b_ctx_len, 1,
+            args.sliding_window))
+        print(f"split-K decode: {ms * 1e3:.2f}us, prefill kernel: {ms_prefill * 1e3:.2f}us, "
+              f"speedup: {ms_prefill / ms:.2f}x")
+    return 0 if diff < 2e-2 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
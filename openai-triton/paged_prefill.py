@@ -0,0 +1,232 @@
+# Paged-attention prefill of a batch of variable-length requests: the new
+# tokens of every request attend to its context in the paged KV cache and,
+# causally, to themselves, with context_attention_fwd (prefix_prefill.py).
+# PagedPrefill appends the new K/V to the cache and builds the kernel
+# metadata (b_loc, b_start_loc, b_seq_len, b_ctx_len), cached per batch
+# layout, so that repeated steps with the same layout (e.g benchmarks, or
+# fixed size chunked prefill) do not rebuild and copy it to the device.
+# rope_style ("gptj"/"neox"): q and k are given unrotated, the kernel
+# rotates them at their positions and stores the rotated k into the cache,
+# which then only holds rotated keys for the next steps.
+#
+#   cache = PagedKVCache(num_blocks, num_kv_heads, head_size, device="cuda")
+#   prefill = PagedPrefill(cache)
+#   o = prefill(q, k, v, seq_ids=[0, 1], query_lens=[17, 5])
+#
+# Runs on CPU with the Triton interpreter: TRITON_INTERPRET=1, device="cpu".
+
+import os
+import sys
+import argparse
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+from kv_cache import PagedKVCache
+from prefix_prefill import context_attention_fwd
+
+
+@dataclass(frozen=True)
+class PrefillMetadata:
+    b_loc: torch.Tensor # [batch, max_num_blocks] int32 block tables
+    b_start_loc: torch.Tensor # [batch] int32 start of the new tokens in q
+    b_seq_len: torch.Tensor # [batch] int32 context + new tokens
+    b_ctx_len: torch.Tensor # [batch] int32 context tokens
+    max_input_len: int # max new tokens of a request
+    num_tokens: int # total new tokens
+
+
+@dataclass
+class PrefillRequest:
+    seq_id: int
+    q: torch.Tensor # [query_len, num_heads, head_size]
+    k: torch.Tensor # [query_len, num_kv_heads, head_size]
+    v: torch.Tensor # [query_len, num_kv_heads, head_size]
+
+
+def pack_requests(
+    requests: Sequence[PrefillRequest]
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, List[int], List[int]]:
+    # q, k, v packed (no padding), seq_ids, query_lens
+    q = torch.cat([r.q for r in requests])
+    k = torch.cat([r.k for r in requests])
+    v = torch.cat([r.v for r in requests])
+    return q, k, v, [r.seq_id for r in requests], [r.q.shape[0] for r in requests]
+
+
+class PagedPrefill:
+
+    def __init__(self,
+                 kv_cache: PagedKVCache,
+                 sliding_window: Optional[int] = None,
+                 max_layouts: int = 64,
+                 rope_style: Optional[str] = None,
+                 rope_theta: float = 10000.0):
+        self.kv_cache = kv_cache
+        self.sliding_window = sliding_window
+        self.rope_style = rope_style
+        self.rope_theta = rope_theta
+        self.max_layouts = max_layouts
+        # batch layout -> metadata, LRU
+        self._metadata: "OrderedDict[tuple, PrefillMetadata]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_layout(self, seq_ids: Sequence[int], query_lens: Sequence[int]) -> tuple:
+        # everything the metadata depends on: context, new tokens and blocks
+        # of every request, not the seq ids
+        layout = []
+        for seq_id, query_len in zip(seq_ids, query_lens):
+            ctx_len = self.kv_cache.get_seq_len(seq_id) - query_len
+            if ctx_len < 0:
+                raise ValueError(f"seq {seq_id}: {query_len} new tokens not in the KV cache")
+            layout.append((ctx_len, query_len, tuple(self.kv_cache.get_block_table(seq_id))))
+        return tuple(layout)
+
+    def get_metadata(self, seq_ids: Sequence[int],
+                     query_lens: Sequence[int]) -> PrefillMetadata:
+        # the new tokens must already be in the KV cache, see forward
+        layout = self.get_layout(seq_ids, query_lens)
+        metadata = self._metadata.get(layout)
+        if metadata is not None:
+            self._metadata.move_to_end(layout)
+            self.hits += 1
+            return metadata
+        self.misses += 1
+        device = self.kv_cache.device
+        ctx_lens = [ctx_len for ctx_len, _, _ in layout]
+        start_locs = [0]
+        for query_len in query_lens[:-1]:
+            start_locs.append(start_locs[-1] + query_len)
+        metadata = PrefillMetadata(
+            b_loc=self.kv_cache.get_block_tables(seq_ids),
+            b_start_loc=torch.tensor(start_locs, dtype=torch.int32, device=device),
+            b_seq_len=torch.tensor([c + n for c, n in zip(ctx_lens, query_lens)],
+                                   dtype=torch.int32, device=device),
+            b_ctx_len=torch.tensor(ctx_lens, dtype=torch.int32, device=device),
+            max_input_len=max(query_lens),
+            num_tokens=sum(query_lens),
+        )
+        self._metadata[layout] = metadata
+        if len(self._metadata) > self.max_layouts:
+            self._metadata.popitem(last=False)
+        return metadata
+
+    def forward(self,
+                q: torch.Tensor,
+                k: torch.Tensor,
+                v: torch.Tensor,
+                seq_ids: Sequence[int],
+                query_lens: Sequence[int],
+                o: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # q: [num_tokens, num_heads, head_size], k, v: [num_tokens,
+        # num_kv_heads, head_size], the new tokens of seq_ids packed, in order.
+        # appends k, v to the KV cache, returns o: [num_tokens, num_heads,
+        # head_size]. the context of a sequence is what it has in the cache.
+        if len(seq_ids) != len(query_lens) or not seq_ids:
+            raise ValueError("seq_ids and query_lens must be non empty and match")
+        if q.shape[0] != sum(query_lens) or k.shape[0] != q.shape[0]:
+            raise ValueError(f"{q.shape[0]} tokens, {sum(query_lens)} expected")
+        start = 0
+        for seq_id, query_len in zip(seq_ids, query_lens):
+            self.kv_cache.append(seq_id, k[start:start + query_len],
+                                 v[start:start + query_len])
+            start += query_len
+        metadata = self.get_metadata(seq_ids, query_lens)
+        o = torch.empty_like(q) if o is None else o
+        context_attention_fwd(q, k, v, o, self.kv_cache.k_cache,
+                              self.kv_cache.v_cache, metadata.b_loc,
+                              metadata.b_start_loc, metadata.b_seq_len,
+                              metadata.b_ctx_len, metadata.max_input_len,
+                              sliding_window=self.sliding_window,
+                              rope_style=self.rope_style, rope_theta=self.rope_theta,
+                              store_rope_k=self.rope_style is not None)
+        return o
+
+    __call__ = forward
+
+    def forward_requests(self, requests: Sequence[PrefillRequest]) -> List[torch.Tensor]:
+        q, k, v, seq_ids, query_lens = pack_requests(requests)
+        return list(self.forward(q, k, v, seq_ids, query_lens).split(query_lens))
+
+
+# ------------------------------- reference --------------------------------------
+def ref_paged_prefill(q: torch.Tensor,
+                      kv_cache: PagedKVCache,
+                      seq_ids: Sequence[int],
+                      query_lens: Sequence[int],
+                      sliding_window: Optional[int] = None) -> torch.Tensor:
+    # f32 attention of the new tokens over the whole sequences, read back from
+    # the cache after forward, i.e context + new tokens, causal.
+    outs = []
+    start = 0
+    num_queries_per_kv = q.shape[1] // kv_cache.num_kv_heads
+    for seq_id, query_len in zip(seq_ids, query_lens):
+        k, v = kv_cache.gather(seq_id)
+        seq_len = k.shape[0]
+        qi = q[start:start + query_len].float().transpose(0, 1) # [H, n, d]
+        k = k.float().repeat_interleave(num_queries_per_kv, 1).transpose(0, 1)
+        v = v.float().repeat_interleave(num_queries_per_kv, 1).transpose(0, 1)
+        scores = qi @ k.transpose(1, 2) / (q.shape[-1]**0.5) # [H, n, seq_len]
+        q_pos = torch.arange(seq_len - query_len, seq_len, device=q.device)[:, None]
+        k_pos = torch.arange(seq_len, device=q.device)[None, :]
+        mask = k_pos <= q_pos
+        if sliding_window:
+            mask &= q_pos - k_pos < sliding_window
+        scores = scores.masked_fill(~mask, float("-inf"))
+        outs.append((scores.softmax(-1) @ v).transpose(0, 1))
+        start += query_len
+    return torch.cat(outs).to(q.dtype)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="paged prefill")
+    parser.add_argument("--ctx-lens", type=int, nargs="+", default=[0, 17, 100])
+    parser.add_argument("--query-lens", type=int, nargs="+", default=[33, 5, 64])
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-kv-heads", type=int, default=2)
+    parser.add_argument("--head-size", type=int, default=64)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--sliding-window", type=int, default=None)
+    parser.add_argument("--dtype", type=str, default="float16")
+    return parser.parse_args()
+
+
+def main():
+    # checks PagedPrefill against ref_paged_prefill, on CPU with
+    # TRITON_INTERPRET=1 when there is no GPU
+    args = get_args()
+    print(args)
+    torch.manual_seed(0)
+    interpret = os.environ.get("TRITON_INTERPRET", "0") == "1"
+    device = "cpu" if interpret or not torch.cuda.is_available() else "cuda"
+    if device == "cpu" and not interpret:
+        raise SystemExit("no GPU, run with TRITON_INTERPRET=1")
+    dtype = getattr(torch, args.dtype)
+    num_blocks = sum((c + n) // args.block_size + 1
+                     for c, n in zip(args.ctx_lens, args.query_lens))
+    cache = PagedKVCache(num_blocks, args.num_kv_heads, args.head_size,
+                         args.block_size, dtype, device)
+    prefill = PagedPrefill(cache, sliding_window=args.sliding_window)
+    seq_ids = list(range(len(args.ctx_lens)))
+
+    def randn(n, h):
+        return torch.randn(n, h, args.head_size, dtype=dtype, device=device)
+
+    for seq_id, ctx_len in zip(seq_ids, args.ctx_lens):
+        cache.append(seq_id, randn(ctx_len, args.num_kv_heads), randn(ctx_len, args.num_kv_heads))
+    num_tokens = sum(args.query_lens)
+    q = randn(num_tokens, args.num_heads)
+    k, v = randn(num_tokens, args.num_kv_heads), randn(num_tokens, args.num_kv_heads)
+    o = prefill(q, k, v, seq_ids, args.query_lens)
+    ref = ref_paged_prefill(q, cache, seq_ids, args.query_lens, args.sliding_window)
+    diff = (o.float() - ref.float()).abs().max().item()
+    print(f"paged prefill on {device}, {len(seq_ids)} seqs, {num_tokens} new tokens, "
+          f"max diff: {diff:.6f}")
+    return 0 if diff < 2e-2 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+# Prefix sharing for the prefix-prefill path: a radix tree over the token
+# ids of the prompts, one edge per full KV cache block (block_size tokens),
+# every node holds a reference on its block. On admission the longest cached
+# prefix of the prompt is attached to the sequence, it becomes its context
+# (b_ctx_len of context_attention_fwd) and only the suffix goes through
+# prefill. Unreferenced blocks (only held by the tree) are evicted LRU, leaves
+# first, when the KV cache runs out of free blocks.
+#
+#   prefix_cache = PrefixCache(kv_cache)
+#   ctx_len = prefix_cache.admit(seq_id, token_ids)
+#   # q, k, v of token_ids[ctx_len:] only
+#   prefill(q, k, v, [seq_id], [len(token_ids) - ctx_len])
+#   prefix_cache.insert(seq_id, token_ids) # share its blocks with the next ones
+#   ...
+#   prefix_cache.release(seq_id, token_ids) # finished, blocks stay cached
+
+import heapq
+import itertools
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from kv_cache import PagedKVCache
+
+
+class RadixNode:
+    __slots__ = ("key", "block", "parent", "children", "last_access")
+
+    def __init__(self,
+                 key: Tuple[int, ...] = (),
+                 block: int = -1,
+                 parent: Optional["RadixNode"] = None):
+        self.key = key # the block_size token ids of the block
+        self.block = block
+        self.parent = parent
+        self.children: Dict[Tuple[int, ...], "RadixNode"] = {}
+        self.last_access = 0
+
+
+class PrefixCache:
+
+    def __init__(self, kv_cache: PagedKVCache):
+        self.kv_cache = kv_cache
+        self.block_size = kv_cache.block_size
+        self.root = RadixNode()
+        self.num_nodes = 0
+        self._clock = itertools.count(1)
+        kv_cache.evictor = self.evict
+        # hit rate statistics, in prompt tokens
+        self.num_queries = 0
+        self.query_tokens = 0
+        self.hit_tokens = 0
+        self.evicted_blocks = 0
+
+    def _chunks(self, token_ids: Sequence[int], num_tokens: int):
+        # the full blocks of token_ids[:num_tokens]
+        for start in range(0, num_tokens - self.block_size + 1, self.block_size):
+            yield tuple(token_ids[start:start + self.block_size])
+
+    def match(self, token_ids: Sequence[int]) -> List[RadixNode]:
+        # nodes of the longest cached prefix of token_ids, whole blocks
+        nodes = []
+        node = self.root
+        for key in self._chunks(token_ids, len(token_ids)):
+            node = node.children.get(key)
+            if node is None:
+                break
+            nodes.append(node)
+        return nodes
+
+    def _touch(self, nodes: Sequence[RadixNode]):
+        clock = next(self._clock)
+        for node in nodes:
+            node.last_access = clock
+
+    def admit(self, seq_id: int, token_ids: Sequence[int]) -> int:
+        # attach the longest cached prefix of the prompt to the new seq_id,
+        # returns its length, the context length of the prefill. the last
+        # token is always prefilled, its logits are needed.
+        nodes = self.match(token_ids[:len(token_ids) - 1])
+        ctx_len = len(nodes) * self.block_size
+        self.kv_cache.attach_blocks(seq_id, [n.block for n in nodes], ctx_len)
+        self._touch(nodes)
+        self.num_queries += 1
+        self.query_tokens += len(token_ids)
+        self.hit_tokens += ctx_len
+        return ctx_len
+
+    def insert(self, seq_id: int, token_ids: Sequence[int]) -> int:
+        # cache the full blocks of seq_id, whose tokens are token_ids (at
+        # least the ones in the KV cache), returns the number of new blocks.
+        # a prefix already cached under other blocks (prefilled twice
+        # concurrently) keeps them.
+        table = self.kv_cache.get_block_table(seq_id)
+        num_tokens = min(len(token_ids), self.kv_cache.get_seq_len(seq_id))
+        node, nodes, num_new = self.root, [], 0
+        for i, key in enumerate(self._chunks(token_ids, num_tokens)):
+            child = node.children.get(key)
+            if child is None:
+                child = RadixNode(key, table[i], node)
+                node.children[key] = child
+                self.kv_cache.allocator.incref(table[i])
+                self.num_nodes += 1
+                num_new += 1
+            node = child
+            nodes.append(node)
+        self._touch(nodes)
+        return num_new
+
+    def release(self, seq_id: int, token_ids: Optional[Sequence[int]] = None):
+        # seq_id is done: cache its blocks (if token_ids) and free it
+        if token_ids is not None:
+            self.insert(seq_id, token_ids)
+        self.kv_cache.free(seq_id)
+
+    def _is_evictable(self, node: RadixNode) -> bool:
+        # a leaf whose block is only held by the tree
+        return (not node.children and node is not self.root and
+                self.kv_cache.allocator.get_ref_count(node.block) == 1)
+
+    def evict(self, num_blocks: int) -> int:
+        # free up to num_blocks blocks, least recently used leaves first, a
+        # parent becomes a candidate once its children are gone
+        heap = [(n.last_access, id(n), n) for n in self._nodes() if self._is_evictable(n)]
+        heapq.heapify(heap)
+        num_evicted = 0
+        while heap and num_evicted < num_blocks:
+            _, _, node = heapq.heappop(heap)
+            parent = node.parent
+            del parent.children[node.key]
+            self.kv_cache.allocator.free(node.block)
+            self.num_nodes -= 1
+            num_evicted += 1
+            if self._is_evictable(parent):
+                heapq.heappush(heap, (parent.last_access, id(parent), parent))
+        self.evicted_blocks += num_evicted
+        return num_evicted
+
+    def _nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
+
+    @property
+    def hit_rate(self) -> float:
+        # prompt tokens not prefilled thanks to the cache
+        return self.hit_tokens / self.query_tokens if self.query_tokens else 0.0
+
+    def get_stats(self) -> Dict[str, float]:
+        return {"queries": self.num_queries, "query_tokens": self.query_tokens,
+                "hit_tokens": self.hit_tokens, "hit_rate": self.hit_rate,
+                "cached_blocks": self.num_nodes, "evicted_blocks": self.evicted_blocks}
+
+    def reset_stats(self):
+        self.num_queries = self.query_tokens = self.hit_tokens = self.evicted_blocks = 0
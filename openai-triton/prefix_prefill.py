@@ -1,13 +1,106 @@
 # The kernels in this file are adapted from LightLLM's context_attention_fwd:
 # https://github.com/ModelTC/lightllm/blob/main/lightllm/models/llama/triton_kernel/context_flashattention_nopad.py
 
+# One kernel family for the prefix prefill: the features are constexpr, so
+# every combination compiles to its own specialized kernel, with nothing of
+# the disabled ones left in it:
+#   IS_CAUSAL      new tokens attend to the previous new tokens only
+#   SLIDING_WINDOW keys at most SLIDING_WINDOW - 1 positions away, 0: off
+#   USE_ALIBI      + slope * (key pos - query pos), -slope * |distance| when
+#                  not causal, one slope per head
+#   SOFT_CAP       scores = SOFT_CAP * tanh(scores / SOFT_CAP), 0: off
+#   ROPE_STYLE     rotary embedding of the q and the new k tiles as they are
+#                  loaded, at their positions in the sequence (after the
+#                  context), 1: GPT-J (interleaved pairs), 2: NeoX (split
+#                  halves), 0: off. The context keys of the KV cache are
+#                  already rotated, as they are stored after RoPE.
+#   STORE_ROPE_K   the rotated new k tiles are also stored into their slots
+#                  of the KV cache (b_loc covers the new tokens, appended
+#                  unrotated before the launch), so that no separate RoPE
+#                  pass over k is needed before the next step reads them as
+#                  context. Only one program writes a tile: the first query
+#                  head of the kv head, whose query block holds those tokens.
+# prefix_prefill_alibi.py is a wrapper of it.
+
 import torch
 import triton
 import triton.language as tl
 
+from attn_configs import get_fwd_configs, prune_fwd_configs
+
+# rope_style of context_attention_fwd -> ROPE_STYLE
+ROPE_STYLES = {None: 0, "gptj": 1, "neox": 2}
 
 if triton.__version__ >= "2.1.0":
 
+    @triton.jit
+    def _score_mod(qk, q_pos, k_pos, k_valid, alibi_slope,
+                   IS_CAUSAL: tl.constexpr, SLIDING_WINDOW: tl.constexpr,
+                   USE_ALIBI: tl.constexpr, SOFT_CAP: tl.constexpr):
+        # qk: [M,N] scaled scores, q_pos: [M], k_pos: [N] positions in the
+        # sequence, k_valid: [N] keys in range
+        if SOFT_CAP > 0:
+            # tanh(x) = 2 * sigmoid(2x) - 1
+            qk = SOFT_CAP * (2 * tl.sigmoid(2 * qk / SOFT_CAP) - 1)
+        dist = q_pos[:, None] - k_pos[None, :]  # [M,N]
+        if USE_ALIBI:
+            if IS_CAUSAL:
+                qk -= alibi_slope * dist
+            else:
+                qk -= alibi_slope * tl.abs(dist)
+        mask = k_valid[None, :]
+        if IS_CAUSAL:
+            mask = mask & (dist >= 0)
+        if SLIDING_WINDOW > 0:
+            if IS_CAUSAL:
+                mask = mask & (dist < SLIDING_WINDOW)
+            else:
+                mask = mask & (tl.abs(dist) < SLIDING_WINDOW)
+        return tl.where(mask, qk, float("-inf"))
+
+    @triton.jit
+    def _rope_pair(d, BLOCK_DMODEL: tl.constexpr, ROPE_STYLE: tl.constexpr):
+        # the dim rotated together with d
+        if ROPE_STYLE == 1:
+            return d ^ 1
+        else:
+            half = BLOCK_DMODEL // 2
+            return tl.where(d < half, d + half, d - half)
+
+    @triton.jit
+    def _rope(x, x_pair, pos, d, rope_theta, BLOCK_DMODEL: tl.constexpr,
+              ROPE_STYLE: tl.constexpr):
+        # x, x_pair: the tile and its pair dims (_rope_pair), pos and d
+        # broadcast to its shape. the first dim of a pair gets
+        # x * cos - pair * sin, the second x * cos + pair * sin
+        if ROPE_STYLE == 1:
+            i = d // 2
+            sign = tl.where(d % 2 == 0, -1.0, 1.0)
+        else:
+            i = d % (BLOCK_DMODEL // 2)
+            sign = tl.where(d < BLOCK_DMODEL // 2, -1.0, 1.0)
+        # theta ** (-2i / dim)
+        inv_freq = tl.exp2(-(2.0 * i / BLOCK_DMODEL) * tl.log2(rope_theta))
+        angle = pos.to(tl.float32) * inv_freq
+        x_rot = (x.to(tl.float32) * tl.cos(angle) +
+                 sign * x_pair.to(tl.float32) * tl.sin(angle))
+        return x_rot.to(x.dtype)
+
+    @triton.jit
+    def _online_softmax_update(acc, m_i, l_i, qk, v):
+        # flash attention v2: acc is normalized once in the epilogue. a row
+        # with all its keys masked so far keeps m = -inf, exp(-inf - -inf)
+        # would be NaN
+        m_ij = tl.max(qk, 1)  # [M]
+        m_i_new = tl.maximum(m_i, m_ij)  # [M]
+        m_i_safe = tl.where(m_i_new == float("-inf"), 0.0, m_i_new)
+        p = tl.exp(qk - m_i_safe[:, None])  # [M,N]
+        alpha = tl.exp(m_i - m_i_safe)  # [M]
+        l_i = alpha * l_i + tl.sum(p, 1)
+        acc = acc * alpha[:, None]
+        acc += tl.dot(p.to(v.dtype), v)
+        return acc, m_i_new, l_i
+
     @triton.jit
     def _fwd_kernel(
         Q,
@@ -20,6 +113,8 @@ if triton.__version__ >= "2.1.0":
         B_Start_Loc,
         B_Seqlen,
         B_Ctxlen,
+        Alibi_slopes,
+        rope_theta,
         block_size,
         x,
         Out,
@@ -51,7 +146,12 @@ if triton.__version__ >= "2.1.0":
         BLOCK_DMODEL: tl.constexpr,  # head size
         BLOCK_DMODEL_PADDED: tl.constexpr,  # head size padded to a power of 2
         BLOCK_N: tl.constexpr,
+        IS_CAUSAL: tl.constexpr,
         SLIDING_WINDOW: tl.constexpr,
+        USE_ALIBI: tl.constexpr,
+        SOFT_CAP: tl.constexpr,
+        ROPE_STYLE: tl.constexpr,
+        STORE_ROPE_K: tl.constexpr,
     ):
         cur_batch = tl.program_id(0)
         cur_head = tl.program_id(1)
@@ -75,19 +175,27 @@ if triton.__version__ >= "2.1.0":
         offs_d = tl.arange(0, BLOCK_DMODEL_PADDED)
         # [M]; starts at current position in query
         offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        # [M]; positions of the queries in the sequence
+        q_pos = cur_batch_ctx_len + offs_m
         # [M,D]
         off_q = (
             (cur_batch_in_all_start_index + offs_m[:, None]) * stride_qbs +
             cur_head * stride_qh + offs_d[None, :] * stride_qd)
 
-        dim_mask = tl.where(
-            tl.arange(0, BLOCK_DMODEL_PADDED) < BLOCK_DMODEL, 1,
-            0).to(tl.int1)  # [D]
+        dim_mask = offs_d < BLOCK_DMODEL  # [D]
 
         q = tl.load(Q + off_q,
                     mask=dim_mask[None, :] &
                     (offs_m[:, None] < cur_batch_query_len),
                     other=0.0)  # [M,D]
+        if ROPE_STYLE > 0:
+            offs_d_pair = _rope_pair(offs_d, BLOCK_DMODEL, ROPE_STYLE)  # [D]
+            q_pair = tl.load(
+                Q + off_q + (offs_d_pair - offs_d)[None, :] * stride_qd,
+                mask=dim_mask[None, :] & (offs_m[:, None] < cur_batch_query_len),
+                other=0.0)  # [M,D]
+            q = _rope(q, q_pair, q_pos[:, None], offs_d[None, :], rope_theta,
+                      BLOCK_DMODEL, ROPE_STYLE)
 
         # initialize pointer to m and l
         m_i = tl.zeros([BLOCK_M], dtype=tl.float32) - float("inf")  # [M]
@@ -95,81 +203,50 @@ if triton.__version__ >= "2.1.0":
         acc = tl.zeros([BLOCK_M, BLOCK_DMODEL_PADDED],
                        dtype=tl.float32)  # [M,D]
 
-        # compute query against context (no causal mask here)
-        for start_n in range(0, cur_batch_ctx_len, BLOCK_N):
+        alibi_slope = 0.0
+        if USE_ALIBI:
+            alibi_slope = tl.load(Alibi_slopes + cur_head)
+
+        # compute query against context, a sliding window skips the blocks
+        # before it
+        ctx_start = 0
+        if SLIDING_WINDOW > 0:
+            ctx_start = (tl.maximum(
+                cur_batch_ctx_len + block_start_loc - SLIDING_WINDOW + 1, 0) //
+                         BLOCK_N) * BLOCK_N
+        for start_n in range(ctx_start, cur_batch_ctx_len, BLOCK_N):
             start_n = tl.multiple_of(start_n, BLOCK_N)
+            k_pos = start_n + offs_n  # [N]
+            k_valid = k_pos < cur_batch_ctx_len  # [N]
             # -- compute qk ----
             bn = tl.load(B_Loc + cur_batch * stride_b_loc_b +
-                         ((start_n + offs_n) // block_size) * stride_b_loc_s,
-                         mask=(start_n + offs_n) < cur_batch_ctx_len,
+                         (k_pos // block_size) * stride_b_loc_s,
+                         mask=k_valid,
                          other=0)  # [N]
             # [D,N]
             off_k = (bn[None, :] * stride_k_cache_bs +
                      cur_kv_head * stride_k_cache_h +
                      (offs_d[:, None] // x) * stride_k_cache_d +
-                     ((start_n + offs_n[None, :]) % block_size) *
-                     stride_k_cache_bl +
+                     (k_pos[None, :] % block_size) * stride_k_cache_bl +
                      (offs_d[:, None] % x) * stride_k_cache_x)
             # [N,D]
-            off_v = (
-                bn[:, None] * stride_v_cache_bs +
-                cur_kv_head * stride_v_cache_h +
-                offs_d[None, :] * stride_v_cache_d +
-                (start_n + offs_n[:, None]) % block_size * stride_v_cache_bl)
+            off_v = (bn[:, None] * stride_v_cache_bs +
+                     cur_kv_head * stride_v_cache_h +
+                     offs_d[None, :] * stride_v_cache_d +
+                     (k_pos[:, None] % block_size) * stride_v_cache_bl)
             k = tl.load(K_cache + off_k,
-                        mask=dim_mask[:, None] &
-                        ((start_n + offs_n[None, :]) < cur_batch_ctx_len),
+                        mask=dim_mask[:, None] & k_valid[None, :],
                         other=0.0)  # [D,N]
 
             qk = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)  # [M,N]
             qk += tl.dot(q, k)
-            qk = tl.where((start_n + offs_n[None, :]) < cur_batch_ctx_len, qk,
-                          float("-inf"))
             qk *= sm_scale
-            if SLIDING_WINDOW > 0:
-                # (cur_batch_ctx_len + offs_m[:, None]) are the positions of
-                # Q entries in sequence
-                # (start_n + offs_n[None, :]) are the positions of
-                # KV entries in sequence
-                # So the condition makes sure each entry in Q only attends
-                # to KV entries not more than SLIDING_WINDOW away.
-                #
-                # We can't use -inf here, because the
-                # sliding window may lead to the entire row being masked.
-                # This then makes m_ij contain -inf, which causes NaNs in
-                # exp().
-                qk = tl.where((cur_batch_ctx_len + offs_m[:, None]) -
-                              (start_n + offs_n[None, :]) < SLIDING_WINDOW, qk,
-                              -10000)
-
-            # -- compute m_ij, p, l_ij
-            m_ij = tl.max(qk, 1)  # [M]
-            p = tl.exp(qk - m_ij[:, None])  # [M,N]
-            l_ij = tl.sum(p, 1)  # [M]
-            # -- update m_i and l_i
-            m_i_new = tl.maximum(m_i, m_ij)  # [M]
-            alpha = tl.exp(m_i - m_i_new)  # [M]
-            beta = tl.exp(m_ij - m_i_new)  # [M]
-            l_i_new = alpha * l_i + beta * l_ij  # [M]
-
-            # -- update output accumulator --
-            # scale p
-            p_scale = beta / l_i_new
-            p = p * p_scale[:, None]
-            # scale acc
-            acc_scale = l_i / l_i_new * alpha
-            acc = acc * acc_scale[:, None]
-            # update acc
+            qk = _score_mod(qk, q_pos, k_pos, k_valid, alibi_slope, IS_CAUSAL,
+                            SLIDING_WINDOW, USE_ALIBI, SOFT_CAP)
             v = tl.load(V_cache + off_v,
-                        mask=dim_mask[None, :] &
-                        ((start_n + offs_n[:, None]) < cur_batch_ctx_len),
+                        mask=dim_mask[None, :] & k_valid[:, None],
                         other=0.0)  # [N,D]
-
-            p = p.to(v.dtype)
-            acc += tl.dot(p, v)
-            # # update m_i and l_i
-            l_i = l_i_new
-            m_i = m_i_new
+            acc, m_i, l_i = _online_softmax_update(acc, m_i, l_i, qk, v)
 
         off_k = (offs_n[None, :] * stride_kbs + cur_kv_head * stride_kh +
                  offs_d[:, None] * stride_kd)
@@ -180,56 +257,68 @@ if triton.__version__ >= "2.1.0":
 
         # block_mask is 0 when we're already past the current query length
         block_mask = tl.where(block_start_loc < cur_batch_query_len, 1, 0)
+        start_new = 0
+        if SLIDING_WINDOW > 0:
+            start_new = (tl.maximum(block_start_loc - SLIDING_WINDOW + 1, 0) //
+                         BLOCK_N) * BLOCK_N
+        if IS_CAUSAL:
+            end_new = block_mask * (start_m + 1) * BLOCK_M
+        else:
+            end_new = block_mask * cur_batch_query_len
 
-        # compute query against itself (with causal mask)
-        for start_n in range(0, block_mask * (start_m + 1) * BLOCK_M, BLOCK_N):
+        # compute query against itself
+        for start_n in range(start_new, end_new, BLOCK_N):
             start_n = tl.multiple_of(start_n, BLOCK_N)
+            k_valid = (start_n + offs_n) < cur_batch_query_len  # [N]
             # -- compute qk ----
             k = tl.load(k_ptrs +
                         (cur_batch_in_all_start_index + start_n) * stride_kbs,
-                        mask=dim_mask[:, None] &
-                        ((start_n + offs_n[None, :]) < cur_batch_query_len),
-                        other=0.0)
+                        mask=dim_mask[:, None] & k_valid[None, :],
+                        other=0.0)  # [D,N]
+            if ROPE_STYLE > 0:
+                k_pair = tl.load(
+                    k_ptrs + (cur_batch_in_all_start_index + start_n) * stride_kbs +
+                    (offs_d_pair - offs_d)[:, None] * stride_kd,
+                    mask=dim_mask[:, None] & k_valid[None, :],
+                    other=0.0)  # [D,N]
+                k = _rope(k, k_pair, (cur_batch_ctx_len + start_n + offs_n)[None, :],
+                          offs_d[:, None], rope_theta, BLOCK_DMODEL, ROPE_STYLE)
+                if STORE_ROPE_K:
+                    # new tokens are never read from the cache by this
+                    # launch, the other programs load k from K
+                    new_pos = cur_batch_ctx_len + start_n + offs_n  # [N]
+                    is_owner = ((cur_head % num_queries_per_kv == 0) &
+                                (start_n >= block_start_loc) &
+                                (start_n < block_start_loc + BLOCK_M))
+                    store_mask = k_valid & is_owner  # [N]
+                    bn = tl.load(B_Loc + cur_batch * stride_b_loc_b +
+                                 (new_pos // block_size) * stride_b_loc_s,
+                                 mask=store_mask,
+                                 other=0)  # [N]
+                    off_k_cache = (bn[None, :] * stride_k_cache_bs +
+                                   cur_kv_head * stride_k_cache_h +
+                                   (offs_d[:, None] // x) * stride_k_cache_d +
+                                   (new_pos[None, :] % block_size) * stride_k_cache_bl +
+                                   (offs_d[:, None] % x) * stride_k_cache_x)  # [D,N]
+                    tl.store(K_cache + off_k_cache,
+                             k.to(K_cache.dtype.element_ty),
+                             mask=dim_mask[:, None] & store_mask[None, :])
 
             qk = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
             qk += tl.dot(q, k)
             qk *= sm_scale
-            # apply causal mask
-            qk = tl.where(offs_m[:, None] >= (start_n + offs_n[None, :]), qk,
-                          float("-inf"))
-            if SLIDING_WINDOW > 0:
-                qk = tl.where(
-                    offs_m[:, None] -
-                    (start_n + offs_n[None, :]) < SLIDING_WINDOW, qk, -10000)
-
-            # -- compute m_ij, p, l_ij
-            m_ij = tl.max(qk, 1)
-            p = tl.exp(qk - m_ij[:, None])
-            l_ij = tl.sum(p, 1)
-            # -- update m_i and l_i
-            m_i_new = tl.maximum(m_i, m_ij)
-            alpha = tl.exp(m_i - m_i_new)
-            beta = tl.exp(m_ij - m_i_new)
-            l_i_new = alpha * l_i + beta * l_ij
-            # -- update output accumulator --
-            # scale p
-            p_scale = beta / l_i_new
-            p = p * p_scale[:, None]
-            # scale acc
-            acc_scale = l_i / l_i_new * alpha
-            acc = acc * acc_scale[:, None]
-            # update acc
+            qk = _score_mod(qk, q_pos, cur_batch_ctx_len + start_n + offs_n,
+                            k_valid, alibi_slope, IS_CAUSAL, SLIDING_WINDOW,
+                            USE_ALIBI, SOFT_CAP)
             v = tl.load(v_ptrs +
                         (cur_batch_in_all_start_index + start_n) * stride_vbs,
-                        mask=dim_mask[None, :] &
-                        ((start_n + offs_n[:, None]) < cur_batch_query_len),
+                        mask=dim_mask[None, :] & k_valid[:, None],
                         other=0.0)
+            acc, m_i, l_i = _online_softmax_update(acc, m_i, l_i, qk, v)
 
-            p = p.to(v.dtype)
-            acc += tl.dot(p, v)
-            # update m_i and l_i
-            l_i = l_i_new
-            m_i = m_i_new
+        # epilogue: normalize once, the rows past the query length have no
+        # keys, l_i = 0, and are not stored
+        acc = acc / tl.where(l_i == 0.0, 1.0, l_i)[:, None]
         # initialize pointers to output
         off_o = (
             (cur_batch_in_all_start_index + offs_m[:, None]) * stride_obs +
@@ -241,6 +330,15 @@ if triton.__version__ >= "2.1.0":
                  (offs_m[:, None] < cur_batch_query_len))
         return
 
+    # keyed on the head size and the GQA ratio, the autotuner also keys on
+    # the dtypes of the tensor args (q, k/v cache, ...), and every feature
+    # combination is a kernel of its own
+    _fwd_kernel_autotune = triton.autotune(
+        configs=get_fwd_configs(),
+        key=["BLOCK_DMODEL", "num_queries_per_kv"],
+        prune_configs_by={"early_config_prune": prune_fwd_configs},
+    )(_fwd_kernel)
+
     @torch.inference_mode()
     def context_attention_fwd(q,
                               k,
@@ -253,14 +351,23 @@ if triton.__version__ >= "2.1.0":
                               b_seq_len,
                               b_ctx_len,
                               max_input_len,
-                              sliding_window=None):
-
-        BLOCK = 128 # sm80+ 128 else 64
-
-        # need to reduce num. blocks when using fp32
-        # due to increased use of GPU shared memory
-        if q.dtype is torch.float32:
-            BLOCK = BLOCK // 2
+                              sliding_window=None,
+                              alibi_slopes=None,
+                              causal=True,
+                              soft_cap=None,
+                              rope_style=None,
+                              rope_theta=10000.0,
+                              store_rope_k=False):
+        # q, k, v, o: [num_tokens, num_heads(num_kv_heads), head_size], the new
+        # tokens of all the sequences packed, b_start_loc: [batch] start of the
+        # sequences in them, b_seq_len/b_ctx_len: [batch] context + new tokens
+        # and context lengths, b_loc: [batch, max_num_blocks] block tables of
+        # the context in the paged k_cache/v_cache. alibi_slopes: [num_heads]
+        # f32. rope_style: "gptj" or "neox", q and k are rotated in the
+        # kernel, k_cache holds rotated keys. store_rope_k: the rotated new
+        # keys are also written into their k_cache slots, b_loc must cover
+        # the new tokens (as after PagedKVCache.append). BLOCK_M/BLOCK_N/
+        # num_warps/num_stages are autotuned, see attn_configs.py.
 
         # shape constraints
         Lq, Lk, Lv = q.shape[-1], k.shape[-1], v.shape[-1]
@@ -272,14 +379,26 @@ if triton.__version__ >= "2.1.0":
         batch, head = b_seq_len.shape[0], q.shape[1]
         num_queries_per_kv = q.shape[1] // k.shape[1]
 
-        grid = (batch, head, triton.cdiv(max_input_len, BLOCK))  # batch, head,
+        def grid(META):
+            # batch, head, query blocks
+            return (batch, head, triton.cdiv(max_input_len, META["BLOCK_M"]))
 
         # 0 means "disable"
         if sliding_window is None or sliding_window <= 0:
             sliding_window = 0
+        if soft_cap is None or soft_cap <= 0:
+            soft_cap = 0.0
+        use_alibi = alibi_slopes is not None
+        if not use_alibi:
+            alibi_slopes = torch.empty(1, dtype=torch.float32, device=q.device)
+        elif alibi_slopes.shape != (head,):
+            raise ValueError(f"alibi_slopes: {tuple(alibi_slopes.shape)}, ({head},) expected")
+        if rope_style not in ROPE_STYLES:
+            raise ValueError(f"rope_style: {rope_style}, one of {list(ROPE_STYLES)} expected")
+        if store_rope_k and rope_style is None:
+            raise ValueError("store_rope_k needs a rope_style")
 
-        num_warps = 8 if Lk <= 64 else 8
-        _fwd_kernel[grid](
+        _fwd_kernel_autotune[grid](
             q,
             k,
             v,
@@ -290,6 +409,8 @@ if triton.__version__ >= "2.1.0":
             b_start_loc,
             b_seq_len,
             b_ctx_len,
+            alibi_slopes,
+            float(rope_theta),
             v_cache.shape[3],
             k_cache.shape[4],
             o,
@@ -319,12 +440,13 @@ if triton.__version__ >= "2.1.0":
             v_cache.stride(
                 3),  #[num_blocks, num_kv_heads, head_size, block_size]
             num_queries_per_kv=num_queries_per_kv,
-            BLOCK_M=BLOCK,
             BLOCK_DMODEL=Lk,
             BLOCK_DMODEL_PADDED=Lk_padded,
-            BLOCK_N=BLOCK,
+            IS_CAUSAL=causal,
             SLIDING_WINDOW=sliding_window,
-            num_warps=num_warps,
-            num_stages=1,
+            USE_ALIBI=use_alibi,
+            SOFT_CAP=float(soft_cap),
+            ROPE_STYLE=ROPE_STYLES[rope_style],
+            STORE_ROPE_K=store_rope_k,
         )
         return
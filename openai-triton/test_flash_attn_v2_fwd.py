@@ -0,0 +1,85 @@
+import os
+
+import pytest
+import torch
+
+from attn_ref import AttnCase, get_atol, make_batch, ref_chunked_attn, split_batch
+from flash_attn_v2_fwd import flash_attn_v2_fwd
+
+DEVICE = "cpu" if os.environ.get("TRITON_INTERPRET", "0") == "1" else "cuda"
+DTYPES = [torch.float16, torch.float32]
+
+
+def run(batch, causal=True, sliding_window=None, return_lse=True):
+    o = torch.empty_like(batch.q)
+    lse = flash_attn_v2_fwd(batch.q, batch.k, batch.v, o, batch.cache.k_cache,
+                            batch.cache.v_cache, *batch.metadata, causal=causal,
+                            sliding_window=sliding_window, return_lse=return_lse)
+    return o, lse
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("causal", [True, False])
+def test_random(case, dtype, causal):
+    # ragged context/new lengths, GQA, head sizes, windows (no ALiBi here)
+    batch = make_batch(case, dtype, DEVICE)
+    o, lse = run(batch, causal, case.sliding_window)
+    ref, ref_lse = ref_chunked_attn(batch, causal, case.sliding_window)
+    atol = get_atol(dtype)
+    torch.testing.assert_close(o.float(), ref, atol=atol, rtol=0)
+    torch.testing.assert_close(lse, ref_lse, atol=atol, rtol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_batch_invariance(case, dtype):
+    batch = make_batch(case, dtype, DEVICE)
+    o, lse = run(batch, sliding_window=case.sliding_window)
+    alone = [run(b, sliding_window=case.sliding_window) for b in split_batch(batch)]
+    torch.testing.assert_close(torch.cat([a[0] for a in alone]), o, atol=get_atol(dtype), rtol=0)
+    torch.testing.assert_close(torch.cat([a[1] for a in alone]), lse, atol=get_atol(dtype), rtol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("num_heads,num_kv_heads", [(4, 4), (8, 2)])
+@pytest.mark.parametrize("causal", [True, False])
+@pytest.mark.parametrize("sliding_window", [None, 19])
+def test_fixed(dtype, num_heads, num_kv_heads, causal, sliding_window):
+    case = AttnCase(0, [0, 37, 130], [50, 1, 70], num_kv_heads,
+                    num_heads // num_kv_heads, 64, 16)
+    batch = make_batch(case, dtype, DEVICE)
+    o, lse = run(batch, causal, sliding_window)
+    ref, ref_lse = ref_chunked_attn(batch, causal, sliding_window)
+    atol = get_atol(dtype)
+    torch.testing.assert_close(o.float(), ref, atol=atol, rtol=0)
+    torch.testing.assert_close(lse, ref_lse, atol=atol, rtol=0)
+
+
+@pytest.mark.parametrize("head_size", [40, 80, 128])
+def test_head_sizes(head_size):
+    # non power of 2 head sizes are padded, no lse by default
+    case = AttnCase(1, [20, 3], [9, 33], 1, 2, head_size, 16)
+    batch = make_batch(case, torch.float32, DEVICE)
+    o, lse = run(batch, return_lse=False)
+    assert lse is None
+    ref, _ = ref_chunked_attn(batch)
+    torch.testing.assert_close(o, ref, atol=1e-4, rtol=0)
+
+
+def test_lse_merge():
+    # the kernel over the new tokens only (context length 0), merged by lse
+    # with the attention over the context == attention over both
+    case = AttnCase(2, [48], [16], 2, 1, 32, 16)
+    batch = make_batch(case, torch.float32, DEVICE)
+    ref, _ = ref_chunked_attn(batch)
+    b_loc, b_start_loc, b_seq_len, b_ctx_len, max_input_len = batch.metadata
+    batch.metadata = (b_loc, b_start_loc, b_seq_len - b_ctx_len, b_ctx_len * 0, max_input_len)
+    o_new, lse_new = run(batch)
+    # context keys are all before the new tokens, no mask
+    k, v = batch.cache.gather(0)
+    scores = torch.einsum("qhd,khd->qhk", batch.q, k) / 32**0.5
+    lse_ctx = scores.logsumexp(-1)
+    o_ctx = torch.einsum("qhk,khd->qhd", scores.softmax(-1), v)
+    lse = torch.logaddexp(lse_ctx, lse_new)
+    merged = (o_ctx * (lse_ctx - lse).exp()[..., None] +
+              o_new * (lse_new - lse).exp()[..., None])
+    torch.testing.assert_close(merged, ref, atol=1e-4, rtol=0)
@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from kv_cache import BlockAllocator, PagedKVCache
+
+
+def make_cache(num_blocks=8, block_size=4, num_kv_heads=2, head_size=16):
+    return PagedKVCache(num_blocks, num_kv_heads, head_size, block_size,
+                        dtype=torch.float32, device="cpu")
+
+
+def randn(cache, n):
+    return torch.randn(n, cache.num_kv_heads, cache.head_size)
+
+
+def test_block_allocator():
+    allocator = BlockAllocator(3)
+    blocks = [allocator.allocate() for _ in range(3)]
+    assert blocks == [0, 1, 2] and allocator.num_free == 0
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+    assert allocator.incref(1) == 2
+    assert allocator.free(1) == 1 and allocator.num_free == 0
+    assert allocator.free(1) == 0 and allocator.num_free == 1
+    with pytest.raises(ValueError):
+        allocator.free(1)
+    assert allocator.allocate() == 1
+
+
+def test_append_layout():
+    # token t of a sequence is at k_cache[b, h, d // x, t % block_size, d % x]
+    torch.manual_seed(0)
+    cache = make_cache()
+    k, v = randn(cache, 6), randn(cache, 6)
+    cache.append(0, k[:3], v[:3])
+    cache.append(0, k[3:], v[3:])
+    table = cache.get_block_table(0)
+    assert len(table) == 2 and cache.get_seq_len(0) == 6
+    for t in range(6):
+        block, offset = table[t // 4], t % 4
+        assert torch.equal(cache.k_cache[block, :, :, offset, :].reshape(2, 16), k[t])
+        assert torch.equal(cache.v_cache[block, :, :, offset], v[t])
+    gk, gv = cache.gather(0)
+    assert torch.equal(gk, k) and torch.equal(gv, v)
+
+
+def test_block_tables():
+    cache = make_cache()
+    cache.append(0, randn(cache, 9), randn(cache, 9))
+    cache.append(1, randn(cache, 2), randn(cache, 2))
+    b_loc = cache.get_block_tables([1, 0])
+    assert b_loc.dtype == torch.int32
+    assert b_loc.tolist() == [[3, 0, 0], [0, 1, 2]]
+
+
+def test_fork_copy_on_write():
+    torch.manual_seed(0)
+    cache = make_cache()
+    k, v = randn(cache, 6), randn(cache, 6)
+    cache.append(0, k, v)
+    cache.fork(0, 1)
+    assert cache.get_block_table(1) == cache.get_block_table(0)
+    assert cache.num_free_blocks == 6
+    # the full block stays shared, the partial last block is copied
+    assert cache.get_num_required_blocks(1, 1) == 1
+    k1, v1 = randn(cache, 1), randn(cache, 1)
+    cache.append(1, k1, v1)
+    t0, t1 = cache.get_block_table(0), cache.get_block_table(1)
+    assert t0[0] == t1[0] and t0[1] != t1[1]
+    assert cache.allocator.get_ref_count(t0[0]) == 2
+    assert cache.allocator.get_ref_count(t0[1]) == 1
+    gk, _ = cache.gather(1)
+    assert torch.equal(gk, torch.cat([k, k1]))
+    assert torch.equal(cache.gather(0)[0], k)
+    # the parent now owns its last block, no copy
+    cache.append(0, k1, v1)
+    assert cache.get_block_table(0) == t0
+    cache.free(0)
+    assert cache.allocator.get_ref_count(t0[0]) == 1
+    cache.free(1)
+    assert cache.num_free_blocks == 8
+
+
+def test_out_of_blocks():
+    cache = make_cache(num_blocks=2)
+    assert not cache.can_append(0, 9)
+    with pytest.raises(RuntimeError):
+        cache.append(0, randn(cache, 9), randn(cache, 9))
+    # nothing allocated by the failed append
+    assert cache.num_free_blocks == 2
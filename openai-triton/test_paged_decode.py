@@ -0,0 +1,46 @@
+import os
+
+import pytest
+import torch
+
+from kv_cache import PagedKVCache
+from paged_decode import (DECODE_BLOCK_N, MIN_PARTITION_SIZE, PagedDecode,
+                          get_partition_size)
+from paged_prefill import ref_paged_prefill
+
+DEVICE = "cpu" if os.environ.get("TRITON_INTERPRET", "0") == "1" else "cuda"
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.float32])
+@pytest.mark.parametrize("num_heads,num_kv_heads", [(2, 2), (4, 1)])
+@pytest.mark.parametrize("head_size", [64, 96])
+@pytest.mark.parametrize("sliding_window", [None, 90])
+@pytest.mark.parametrize("partition_size", [64, None])
+def test_paged_decode(dtype, num_heads, num_kv_heads, head_size, sliding_window,
+                      partition_size):
+    torch.manual_seed(0)
+    seq_lens = [1, 64, 129, 300] # context + the new token
+    cache = PagedKVCache(64, num_kv_heads, head_size, 16, dtype, DEVICE)
+    for seq_id, seq_len in enumerate(seq_lens):
+        cache.append(seq_id,
+                     torch.randn(seq_len - 1, num_kv_heads, head_size, dtype=dtype, device=DEVICE),
+                     torch.randn(seq_len - 1, num_kv_heads, head_size, dtype=dtype, device=DEVICE))
+    decode = PagedDecode(cache, sliding_window, partition_size)
+    batch, seq_ids = len(seq_lens), list(range(len(seq_lens)))
+    q = torch.randn(batch, num_heads, head_size, dtype=dtype, device=DEVICE)
+    k = torch.randn(batch, num_kv_heads, head_size, dtype=dtype, device=DEVICE)
+    v = torch.randn(batch, num_kv_heads, head_size, dtype=dtype, device=DEVICE)
+    o = decode(q, k, v, seq_ids)
+    assert [cache.get_seq_len(s) for s in seq_ids] == seq_lens
+    ref = ref_paged_prefill(q, cache, seq_ids, [1] * batch, sliding_window)
+    atol = 1e-2 if dtype == torch.float16 else 1e-4
+    torch.testing.assert_close(o, ref, atol=atol, rtol=0)
+
+
+def test_partition_size():
+    # long context, small batch: split until the SMs are busy
+    partition_size = get_partition_size(1, 32, 32768, num_sms=132)
+    assert partition_size % DECODE_BLOCK_N == 0
+    assert 32 * (32768 // partition_size) >= 132
+    # enough programs without splitting: one minimal partition
+    assert get_partition_size(64, 32, 128, num_sms=132) == MIN_PARTITION_SIZE
@@ -0,0 +1,141 @@
+import os
+
+import pytest
+import torch
+
+from attn_ref import ref_rope
+from kv_cache import PagedKVCache
+from paged_prefill import PagedPrefill, PrefillRequest, ref_paged_prefill
+
+DEVICE = "cpu" if os.environ.get("TRITON_INTERPRET", "0") == "1" else "cuda"
+
+
+def make_prefill(ctx_lens, num_kv_heads, head_size, dtype, block_size=16,
+                 sliding_window=None):
+    num_blocks = sum(c // block_size + 8 for c in ctx_lens)
+    cache = PagedKVCache(num_blocks, num_kv_heads, head_size, block_size,
+                         dtype, DEVICE)
+    for seq_id, ctx_len in enumerate(ctx_lens):
+        cache.append(seq_id,
+                     torch.randn(ctx_len, num_kv_heads, head_size, dtype=dtype, device=DEVICE),
+                     torch.randn(ctx_len, num_kv_heads, head_size, dtype=dtype, device=DEVICE))
+    return PagedPrefill(cache, sliding_window=sliding_window)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.float32])
+@pytest.mark.parametrize("num_heads,num_kv_heads", [(4, 4), (8, 2)])
+@pytest.mark.parametrize("sliding_window", [None, 24])
+def test_paged_prefill(dtype, num_heads, num_kv_heads, sliding_window):
+    torch.manual_seed(0)
+    head_size = 64
+    ctx_lens, query_lens = [0, 21, 70], [40, 3, 17]
+    prefill = make_prefill(ctx_lens, num_kv_heads, head_size, dtype,
+                           sliding_window=sliding_window)
+    num_tokens = sum(query_lens)
+    q = torch.randn(num_tokens, num_heads, head_size, dtype=dtype, device=DEVICE)
+    k = torch.randn(num_tokens, num_kv_heads, head_size, dtype=dtype, device=DEVICE)
+    v = torch.randn(num_tokens, num_kv_heads, head_size, dtype=dtype, device=DEVICE)
+    seq_ids = [0, 1, 2]
+    o = prefill(q, k, v, seq_ids, query_lens)
+    ref = ref_paged_prefill(q, prefill.kv_cache, seq_ids, query_lens, sliding_window)
+    atol = 1e-2 if dtype == torch.float16 else 1e-4
+    torch.testing.assert_close(o, ref, atol=atol, rtol=0)
+    assert [prefill.kv_cache.get_seq_len(s) for s in seq_ids] == [
+        c + n for c, n in zip(ctx_lens, query_lens)]
+
+
+def test_metadata_cache():
+    torch.manual_seed(0)
+    prefill = make_prefill([5, 9], 2, 32, torch.float32)
+    cache = prefill.kv_cache
+    first = prefill.get_metadata([0, 1], [2, 3])
+    assert prefill.get_metadata([0, 1], [2, 3]) is first
+    assert (prefill.hits, prefill.misses) == (1, 1)
+    assert first.b_ctx_len.tolist() == [3, 6]
+    assert first.b_seq_len.tolist() == [5, 9]
+    assert first.b_start_loc.tolist() == [0, 2]
+    # same lengths and blocks under other seq ids: same layout
+    cache.block_tables[7], cache.seq_lens[7] = cache.block_tables.pop(0), cache.seq_lens.pop(0)
+    assert prefill.get_metadata([7, 1], [2, 3]) is first
+    # new tokens change it
+    cache.append(1, torch.randn(4, 2, 32), torch.randn(4, 2, 32))
+    assert prefill.get_metadata([7, 1], [2, 3]) is not first
+
+
+def test_forward_requests():
+    torch.manual_seed(0)
+    dtype = torch.float32
+    prefill = make_prefill([12], 2, 32, dtype)
+    requests = [PrefillRequest(seq_id, *(torch.randn(n, h, 32, dtype=dtype, device=DEVICE)
+                                         for h in (4, 2, 2)))
+                for seq_id, n in ((0, 7), (1, 19))]
+    outs = prefill.forward_requests(requests)
+    assert [o.shape[0] for o in outs] == [7, 19]
+    q = torch.cat([r.q for r in requests])
+    ref = ref_paged_prefill(q, prefill.kv_cache, [0, 1], [7, 19])
+    torch.testing.assert_close(torch.cat(outs), ref, atol=1e-4, rtol=0)
+
+
+
+def test_forked_prefix():
+    # two sequences share the blocks of a 21 tokens prompt, then diverge
+    torch.manual_seed(0)
+    dtype = torch.float32
+    prefill = make_prefill([21], 2, 32, dtype)
+    prefill.kv_cache.fork(0, 1)
+    query_lens = [6, 13]
+    q = torch.randn(19, 4, 32, dtype=dtype, device=DEVICE)
+    k = torch.randn(19, 2, 32, dtype=dtype, device=DEVICE)
+    v = torch.randn(19, 2, 32, dtype=dtype, device=DEVICE)
+    o = prefill(q, k, v, [0, 1], query_lens)
+    t0, t1 = (prefill.kv_cache.get_block_table(s) for s in (0, 1))
+    assert t0[0] == t1[0] and t0[1] != t1[1]
+    ref = ref_paged_prefill(q, prefill.kv_cache, [0, 1], query_lens)
+    torch.testing.assert_close(o, ref, atol=1e-4, rtol=0)
+
+
+def ref_causal_attn(q, k, v):
+    # f32 attention of the last q.shape[0] positions over all the keys
+    group = q.shape[1] // k.shape[1]
+    qs = q.float().transpose(0, 1)
+    ks = k.float().repeat_interleave(group, 1).transpose(0, 1)
+    vs = v.float().repeat_interleave(group, 1).transpose(0, 1)
+    scores = qs @ ks.transpose(1, 2) / (q.shape[-1]**0.5)
+    q_pos = torch.arange(k.shape[0] - q.shape[0], k.shape[0], device=q.device)[:, None]
+    k_pos = torch.arange(k.shape[0], device=q.device)[None, :]
+    scores = scores.masked_fill(k_pos > q_pos, float("-inf"))
+    return (scores.softmax(-1) @ vs).transpose(0, 1)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.float32])
+@pytest.mark.parametrize("rope_style", ["gptj", "neox"])
+def test_rope_chunked_prefill(dtype, rope_style):
+    # unrotated q, k in two chunked prefill steps: the first step stores its
+    # rotated keys into the cache, the second reads them as context. vs
+    # naive rope of the whole sequences, then attention.
+    torch.manual_seed(0)
+    num_heads, num_kv_heads, head_size, theta = 8, 2, 64, 500.0
+    cache = PagedKVCache(16, num_kv_heads, head_size, 16, dtype, DEVICE)
+    prefill = PagedPrefill(cache, rope_style=rope_style, rope_theta=theta)
+    seq_ids, steps = [0, 1], [[37, 9], [5, 20]]
+    seqs = {s: ([], [], []) for s in seq_ids}
+    atol = 1e-2 if dtype == torch.float16 else 1e-4
+    for query_lens in steps:
+        num_tokens = sum(query_lens)
+        q, k, v = (torch.randn(num_tokens, h, head_size, dtype=dtype, device=DEVICE)
+                   for h in (num_heads, num_kv_heads, num_kv_heads))
+        o = prefill(q, k, v, seq_ids, query_lens)
+        start = 0
+        for seq_id, query_len in zip(seq_ids, query_lens):
+            end = start + query_len
+            for seq, t in zip(seqs[seq_id], (q, k, v)):
+                seq.append(t[start:end])
+            sq, sk, sv = (torch.cat(seq) for seq in seqs[seq_id])
+            pos = torch.arange(sk.shape[0])
+            rk = ref_rope(sk, pos, theta, rope_style)
+            ref = ref_causal_attn(ref_rope(sq, pos, theta, rope_style)[-query_len:], rk, sv)
+            torch.testing.assert_close(o[start:end].float(), ref, atol=atol, rtol=0)
+            # the cache holds the rotated keys of the whole sequence
+            cached_k, _ = cache.gather(seq_id)
+            torch.testing.assert_close(cached_k.float(), rk.float(), atol=atol, rtol=0)
+            start = end
@@ -0,0 +1,74 @@
+import os
+
+import torch
+
+from kv_cache import PagedKVCache
+from paged_prefill import PagedPrefill
+from prefix_cache import PrefixCache
+
+DEVICE = "cpu" if os.environ.get("TRITON_INTERPRET", "0") == "1" else "cuda"
+
+
+def make_cache(num_blocks=16, block_size=4, device="cpu"):
+    kv_cache = PagedKVCache(num_blocks, 2, 16, block_size, torch.float32, device)
+    return kv_cache, PrefixCache(kv_cache)
+
+
+def append(kv_cache, seq_id, n):
+    kv_cache.append(seq_id, torch.randn(n, 2, 16), torch.randn(n, 2, 16))
+
+
+def test_admit_insert():
+    kv_cache, cache = make_cache()
+    prompt = list(range(10))
+    assert cache.admit(0, prompt) == 0
+    append(kv_cache, 0, 10)
+    assert cache.insert(0, prompt) == 2 # 2 full blocks, not the partial one
+    # same first 9 tokens: 2 blocks hit; a full match still prefills a token
+    assert cache.admit(1, prompt[:9] + [99]) == 8
+    assert cache.admit(2, prompt[:8]) == 4
+    assert cache.admit(3, [7] + prompt) == 0
+    assert kv_cache.get_block_table(1) == kv_cache.get_block_table(0)[:2]
+    stats = cache.get_stats()
+    assert stats["queries"] == 4 and stats["hit_tokens"] == 12
+    assert abs(cache.hit_rate - 12 / 39) < 1e-6
+
+
+def test_lru_eviction():
+    kv_cache, cache = make_cache(num_blocks=6)
+    for seq_id, first in enumerate((0, 100)):
+        prompt = list(range(first, first + 8))
+        cache.admit(seq_id, prompt)
+        append(kv_cache, seq_id, 8)
+        cache.release(seq_id, prompt)
+    assert kv_cache.num_free_blocks == 2 and cache.num_nodes == 4
+    # reuse the first prompt, the second one is now the LRU
+    assert cache.admit(2, list(range(8)) + [1]) == 8
+    append(kv_cache, 2, 1)
+    # 3 blocks needed, 1 free: evicts the 2 blocks of the second prompt,
+    # leaf first; the blocks of seq 2 are referenced and stay
+    append(kv_cache, 3, 12)
+    assert cache.evicted_blocks == 2
+    assert len(cache.match(list(range(100, 108)))) == 0
+    assert len(cache.match(list(range(8)))) == 2
+
+
+def test_prefill_with_cached_prefix():
+    # the suffix prefill over a cached prefix == prefill of the whole prompt
+    torch.manual_seed(0)
+    block_size, num_heads, num_kv_heads, head_size = 16, 4, 2, 32
+    kv_cache = PagedKVCache(16, num_kv_heads, head_size, block_size, torch.float32, DEVICE)
+    cache, prefill = PrefixCache(kv_cache), PagedPrefill(kv_cache)
+    prompt = list(range(45))
+    # per token q/k/v, as a model would compute them from the token ids
+    q = torch.randn(len(prompt), num_heads, head_size, device=DEVICE)
+    k = torch.randn(len(prompt), num_kv_heads, head_size, device=DEVICE)
+    v = torch.randn(len(prompt), num_kv_heads, head_size, device=DEVICE)
+    assert cache.admit(0, prompt) == 0
+    full = prefill(q, k, v, [0], [len(prompt)])
+    cache.release(0, prompt)
+    ctx_len = cache.admit(1, prompt)
+    assert ctx_len == 32
+    suffix = prefill(q[ctx_len:], k[ctx_len:], v[ctx_len:], [1], [len(prompt) - ctx_len])
+    assert prefill.get_metadata([1], [len(prompt) - ctx_len]).b_ctx_len.tolist() == [32]
+    torch.testing.assert_close(suffix, full[ctx_len:], atol=1e-4, rtol=0)
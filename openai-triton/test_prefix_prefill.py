@@ -0,0 +1,92 @@
+import os
+from dataclasses import replace
+
+import pytest
+import torch
+
+from attn_ref import (AttnCase, get_alibi_slopes, get_atol, get_new_positions, make_batch,
+                      ref_chunked_attn, ref_rope, split_batch)
+from prefix_prefill import context_attention_fwd
+
+DEVICE = "cpu" if os.environ.get("TRITON_INTERPRET", "0") == "1" else "cuda"
+DTYPES = [torch.float16, torch.float32]
+
+
+def run(batch, sliding_window=None, alibi_slopes=None, **kwargs):
+    o = torch.empty_like(batch.q)
+    if alibi_slopes is not None:
+        alibi_slopes = alibi_slopes.to(batch.q.device)
+    context_attention_fwd(batch.q, batch.k, batch.v, o, batch.cache.k_cache,
+                          batch.cache.v_cache, *batch.metadata,
+                          sliding_window=sliding_window,
+                          alibi_slopes=alibi_slopes, **kwargs)
+    return o
+
+
+def get_slopes(case):
+    return get_alibi_slopes(case.num_heads) if case.alibi else None
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_random(case, dtype):
+    # ragged context/new lengths, GQA, head sizes, windows and ALiBi together
+    batch = make_batch(case, dtype, DEVICE)
+    o = run(batch, case.sliding_window, get_slopes(case))
+    ref, _ = ref_chunked_attn(batch, sliding_window=case.sliding_window,
+                              alibi_slopes=get_slopes(case))
+    torch.testing.assert_close(o.float(), ref, atol=get_atol(dtype), rtol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_batch_invariance(case, dtype):
+    # a sequence gives the same output alone or in a batch
+    batch = make_batch(case, dtype, DEVICE)
+    o = run(batch, case.sliding_window, get_slopes(case))
+    alone = torch.cat([run(b, case.sliding_window, get_slopes(case))
+                       for b in split_batch(batch)])
+    torch.testing.assert_close(alone, o, atol=get_atol(dtype), rtol=0)
+
+
+def test_non_causal(case):
+    # new tokens attend to all the new tokens, windows on both sides
+    batch = make_batch(case, torch.float32, DEVICE)
+    o = run(batch, case.sliding_window, get_slopes(case), causal=False)
+    ref, _ = ref_chunked_attn(batch, causal=False, sliding_window=case.sliding_window,
+                              alibi_slopes=get_slopes(case))
+    torch.testing.assert_close(o, ref, atol=1e-4, rtol=0)
+
+
+@pytest.mark.parametrize("soft_cap", [1.0, 30.0])
+def test_soft_cap(soft_cap):
+    case = AttnCase(3, [40, 17], [9, 30], 2, 2, 64, 16, sliding_window=33, alibi=True)
+    batch = make_batch(case, torch.float32, DEVICE)
+    batch.q.mul_(4) # scores well above the cap
+    o = run(batch, case.sliding_window, get_slopes(case), soft_cap=soft_cap)
+    ref, _ = ref_chunked_attn(batch, sliding_window=case.sliding_window,
+                              alibi_slopes=get_slopes(case), soft_cap=soft_cap)
+    torch.testing.assert_close(o, ref, atol=1e-4, rtol=0)
+
+
+@pytest.mark.parametrize("head_size", [40, 72, 96])
+def test_padded_head_size(head_size):
+    # BLOCK_DMODEL_PADDED > BLOCK_DMODEL
+    case = AttnCase(7, [33, 0, 70], [5, 40, 17], 2, 2, head_size, 16)
+    batch = make_batch(case, torch.float32, DEVICE)
+    ref, _ = ref_chunked_attn(batch)
+    torch.testing.assert_close(run(batch), ref, atol=1e-4, rtol=0)
+
+
+@pytest.mark.parametrize("rope_style", ["gptj", "neox"])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_rope(case, rope_style, dtype):
+    # fused RoPE of q and the new k == naive rope then attention, the
+    # context keys in the cache are already rotated
+    batch = make_batch(case, dtype, DEVICE)
+    pos = get_new_positions(batch)
+    o = run(batch, case.sliding_window, get_slopes(case), rope_style=rope_style,
+            rope_theta=500.0)
+    rotated = replace(batch, q=ref_rope(batch.q, pos, 500.0, rope_style),
+                      k=ref_rope(batch.k, pos, 500.0, rope_style))
+    ref, _ = ref_chunked_attn(rotated, sliding_window=case.sliding_window,
+                              alibi_slopes=get_slopes(case))
+    torch.testing.assert_close(o.float(), ref, atol=get_atol(dtype), rtol=0)
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+import torch
+
+from attn_ref import (AttnCase, get_alibi_slopes, get_atol, make_batch,
+                      ref_chunked_attn, split_batch)
+from prefix_prefill_alibi import context_attention_fwd_alibi
+
+DEVICE = "cpu" if os.environ.get("TRITON_INTERPRET", "0") == "1" else "cuda"
+DTYPES = [torch.float16, torch.float32]
+
+
+def run(batch, alibi_slopes):
+    o = torch.empty_like(batch.q)
+    context_attention_fwd_alibi(batch.q, batch.k, batch.v, o, batch.cache.k_cache,
+                                batch.cache.v_cache, *batch.metadata,
+                                alibi_slopes=alibi_slopes.to(batch.q.device))
+    return o
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_random(case, dtype):
+    # ragged context/new lengths, GQA, head sizes (no sliding window here)
+    batch = make_batch(case, dtype, DEVICE)
+    slopes = get_alibi_slopes(case.num_heads)
+    o = run(batch, slopes)
+    ref, _ = ref_chunked_attn(batch, alibi_slopes=slopes)
+    torch.testing.assert_close(o.float(), ref, atol=get_atol(dtype), rtol=0)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_batch_invariance(case, dtype):
+    batch = make_batch(case, dtype, DEVICE)
+    slopes = get_alibi_slopes(case.num_heads)
+    o = run(batch, slopes)
+    alone = torch.cat([run(b, slopes) for b in split_batch(batch)])
+    torch.testing.assert_close(alone, o, atol=get_atol(dtype), rtol=0)
+
+
+def test_zero_slopes():
+    # no bias: plain causal attention
+    case = AttnCase(3, [40, 0], [9, 30], 2, 2, 64, 16)
+    batch = make_batch(case, torch.float32, DEVICE)
+    ref, _ = ref_chunked_attn(batch)
+    torch.testing.assert_close(run(batch, torch.zeros(case.num_heads)), ref, atol=1e-4, rtol=0)
+
+
+@pytest.mark.parametrize("num_heads", [1, 3, 8, 12])
+def test_alibi_slopes(num_heads):
+    slopes = get_alibi_slopes(num_heads)
+    assert slopes.shape == (num_heads,) and (slopes > 0).all()
+    if num_heads == 8:
+        assert torch.allclose(slopes, torch.tensor([2**-(i + 1) for i in range(8)]))
@@ -16,6 +16,7 @@
 #define HALF2(value) (reinterpret_cast<half2*>(&(value))[0])
 #define BFLOAT2(value) (reinterpret_cast<__nv_bfloat162*>(&(value))[0])
 #define LDST128BITS(value) (reinterpret_cast<float4*>(&(value))[0])
+#define LDST64BITS(value) (reinterpret_cast<float2*>(&(value))[0])
 
 // -------------------------------------- FP32 -------------------------------------- 
 // Warp Reduce Sum
@@ -371,6 +372,285 @@ __global__ void rms_norm_f16x8_pack_f32_kernel(half* x, half* y, float g, int N,
 }
 
 
+// ------------------------------ Fused Add + RMS Norm ------------------------------
+// Warp/Block Reduce Max, for the per token absmax of the quantized outputs
+template<const int kWarpSize = WARP_SIZE>
+__device__ __forceinline__ float warp_reduce_max_f32(float val) {
+  #pragma unroll
+  for (int mask = kWarpSize >> 1; mask >= 1; mask >>= 1) {
+    val = fmaxf(val, __shfl_xor_sync(0xffffffff, val, mask));
+  }
+  return val;
+}
+
+template<const int NUM_THREADS=256>
+__device__ __forceinline__ float block_reduce_max_f32(float val) {
+  constexpr int NUM_WARPS = (NUM_THREADS + WARP_SIZE - 1) / WARP_SIZE;
+  int warp = threadIdx.x / WARP_SIZE;
+  int lane = threadIdx.x % WARP_SIZE;
+  static __shared__ float shared[NUM_WARPS];
+
+  val = warp_reduce_max_f32<WARP_SIZE>(val);
+  if (lane == 0) shared[warp] = val;
+  __syncthreads();
+  val = (lane < NUM_WARPS) ? shared[lane] : 0.0f; // max of |y|, >= 0
+  val = warp_reduce_max_f32<NUM_WARPS>(val);
+  return val;
+}
+
+// output types of the fused kernels: half y, or int8/fp8(e4m3) y with a per
+// token scale, y_q = y / scale, scale = max|y| / kMax.
+template<typename T> struct QuantOut {
+  static constexpr bool kQuant = false;
+  static constexpr float kMax = 1.0f;
+  __device__ __forceinline__ static T cast(float v) { return __float2half(v); }
+};
+
+template<> struct QuantOut<int8_t> {
+  static constexpr bool kQuant = true;
+  static constexpr float kMax = 127.0f;
+  __device__ __forceinline__ static int8_t cast(float v) {
+    return static_cast<int8_t>(fminf(fmaxf(rintf(v), -128.0f), 127.0f));
+  }
+};
+
+template<> struct QuantOut<__nv_fp8_e4m3> {
+  static constexpr bool kQuant = true;
+  static constexpr float kMax = 448.0f;
+  __device__ __forceinline__ static __nv_fp8_e4m3 cast(float v) {
+    return __nv_fp8_e4m3(fminf(fmaxf(v, -kMax), kMax));
+  }
+};
+
+// store 8 outputs, 128 bits (half) or 64 bits (int8/fp8) in 1 memory issue
+template<typename T>
+__device__ __forceinline__ void store_pack8(T* dst, T* pack) {
+  if (sizeof(T) == 2) { LDST128BITS(dst[0]) = LDST128BITS(pack[0]); }
+  else { LDST64BITS(dst[0]) = LDST64BITS(pack[0]); }
+}
+
+// Transformer block: residual += x; y = rms_norm(residual) * weight, in 1
+// kernel instead of add + norm (+ quant), saves a write and a read of the
+// residual and of y per layer. x, residual: NxK half, weight: K half, f32
+// math, residual updated in place (rounded to half, the norm is taken of the
+// rounded sum, as the next layer reads it). 1/rms = rsqrtf(sum(r^2)/K + eps).
+// grid(N), block(NUM_THREADS), the threads stride over the row 8 halfs (128
+// bits) at a time, any K % 8 == 0. The row is read back from L2 by the same
+// thread that wrote it. T: half y, or int8/fp8 y and scale: N f32 per token.
+template<const int NUM_THREADS=256, typename T=half>
+__global__ void fused_add_rms_norm_f16x8_f32_kernel(
+  half* x, half* residual, half* weight, T* y, float* scale, float eps, int K) {
+  int tid = threadIdx.x;
+  int row = blockIdx.x; // 0..N-1
+  half* x_row = x + (size_t) row * K;
+  half* r_row = residual + (size_t) row * K;
+  T* y_row = y + (size_t) row * K;
+
+  __shared__ float s_variance; // shared within block
+  __shared__ float s_inv_scale; // kMax / max|y|
+  // 1. residual += x, sum of squares
+  float variance = 0.0f;
+  for (int k = tid * 8; k < K; k += NUM_THREADS * 8) {
+    half pack_x[8], pack_r[8];
+    LDST128BITS(pack_x[0]) = LDST128BITS(x_row[k]);
+    LDST128BITS(pack_r[0]) = LDST128BITS(r_row[k]);
+    #pragma unroll
+    for (int i = 0; i < 8; ++i) {
+      pack_r[i] = __float2half(__half2float(pack_r[i]) + __half2float(pack_x[i]));
+      float v = __half2float(pack_r[i]);
+      variance += v * v;
+    }
+    LDST128BITS(r_row[k]) = LDST128BITS(pack_r[0]);
+  }
+  variance = block_reduce_sum_f32<NUM_THREADS>(variance);
+  if (tid == 0) s_variance = rsqrtf(variance / (float) K + eps);
+  // wait for s_variance in shared memory to be ready for all threads
+  __syncthreads();
+
+  // 2. quantized y only: per token absmax -> scale
+  if (QuantOut<T>::kQuant) {
+    float absmax = 0.0f;
+    for (int k = tid * 8; k < K; k += NUM_THREADS * 8) {
+      half pack_r[8], pack_w[8];
+      LDST128BITS(pack_r[0]) = LDST128BITS(r_row[k]);
+      LDST128BITS(pack_w[0]) = LDST128BITS(weight[k]);
+      #pragma unroll
+      for (int i = 0; i < 8; ++i) {
+        float v = __half2float(pack_r[i]) * s_variance * __half2float(pack_w[i]);
+        absmax = fmaxf(absmax, fabsf(v));
+      }
+    }
+    absmax = block_reduce_max_f32<NUM_THREADS>(absmax);
+    if (tid == 0) {
+      scale[row] = absmax / QuantOut<T>::kMax;
+      s_inv_scale = (absmax > 0.0f) ? QuantOut<T>::kMax / absmax : 0.0f;
+    }
+    __syncthreads();
+  }
+
+  // 3. y = r / rms(r) * weight (/ scale)
+  for (int k = tid * 8; k < K; k += NUM_THREADS * 8) {
+    half pack_r[8], pack_w[8];
+    alignas(16) T pack_y[8];
+    LDST128BITS(pack_r[0]) = LDST128BITS(r_row[k]);
+    LDST128BITS(pack_w[0]) = LDST128BITS(weight[k]);
+    #pragma unroll
+    for (int i = 0; i < 8; ++i) {
+      float v = __half2float(pack_r[i]) * s_variance * __half2float(pack_w[i]);
+      pack_y[i] = QuantOut<T>::cast(QuantOut<T>::kQuant ? v * s_inv_scale : v);
+    }
+    store_pack8<T>(y_row + k, pack_y);
+  }
+}
+
+// --------------------------- Any K: warp / block / split ---------------------------
+// The kernels above use 1 block per row with K/n_elements threads, so K is
+// limited to a few template values (<= 1024 threads). The *_auto ones take
+// any K and pick a strategy by K (select_norm_strategy):
+//   WARP  (K <= NORM_WARP_MAX_K): 1 warp per row, NORM_ROWS_PER_BLOCK rows
+//         per block, warp shuffles only (no smem, no __syncthreads).
+//   BLOCK (K <= NORM_BLOCK_MAX_K): 1 block per row, 256..1024 threads that
+//         stride over the row, block reduce.
+//   SPLIT (larger K): the row split into NORM_SPLIT_CHUNK chunks, grid
+//         (chunks, N). A first kernel writes the partial reduction of every
+//         chunk, a second one reduces the partials of its row (a few floats)
+//         and normalizes its chunk: no atomics, deterministic.
+// x/y are read/written kPack elements (128 bits) at a time when K % kPack
+// == 0 and the pointers are aligned, 1 element otherwise. f32 math.
+// rms_norm.py reads NORM_WARP_MAX_K/NORM_BLOCK_MAX_K (bench.parse_defines)
+// and mirrors select_norm_strategy for its labels: keep them plain
+// integers and change select_norm_strategy in both.
+#define NORM_WARP_MAX_K 1024
+#define NORM_BLOCK_MAX_K 16384
+#define NORM_SPLIT_CHUNK 8192
+#define NORM_SPLIT_THREADS 256
+#define NORM_ROWS_PER_BLOCK 4
+
+enum NormStrategy { NORM_AUTO = -1, NORM_WARP = 0, NORM_BLOCK = 1, NORM_SPLIT = 2 };
+
+int select_norm_strategy(int K) {
+  if (K <= NORM_WARP_MAX_K) return NORM_WARP;
+  if (K <= NORM_BLOCK_MAX_K) return NORM_BLOCK;
+  return NORM_SPLIT;
+}
+
+template<typename T, const int kPack>
+struct alignas(sizeof(T) * kPack) PackT { T v[kPack]; };
+
+__device__ __forceinline__ float to_f32(float v) { return v; }
+__device__ __forceinline__ float to_f32(half v) { return __half2float(v); }
+
+template<typename T> __device__ __forceinline__ T from_f32(float v);
+template<> __device__ __forceinline__ float from_f32<float>(float v) { return v; }
+template<> __device__ __forceinline__ half from_f32<half>(float v) { return __float2half(v); }
+
+template<typename T, const int kPack>
+__device__ __forceinline__ PackT<T, kPack> load_pack(const T* src) {
+  return *reinterpret_cast<const PackT<T, kPack>*>(src);
+}
+
+template<typename T, const int kPack>
+__device__ __forceinline__ void store_pack(T* dst, const PackT<T, kPack>& pack) {
+  *reinterpret_cast<PackT<T, kPack>*>(dst) = pack;
+}
+
+// sum of x^2 over row[begin, end), thread tid of num_threads
+template<typename T, const int kPack>
+__device__ __forceinline__ float row_sum_sq(const T* row, int begin, int end,
+                                            int tid, int num_threads) {
+  float sum = 0.0f;
+  for (int k = begin + tid * kPack; k < end; k += num_threads * kPack) {
+    PackT<T, kPack> pack = load_pack<T, kPack>(row + k);
+    #pragma unroll
+    for (int i = 0; i < kPack; ++i) {
+      float v = to_f32(pack.v[i]);
+      sum += v * v;
+    }
+  }
+  return sum;
+}
+
+// y = x * scale over row[begin, end), scale = g / rms(x)
+template<typename T, const int kPack>
+__device__ __forceinline__ void row_rms_norm(const T* x_row, T* y_row, int begin, int end,
+                                             int tid, int num_threads, float scale) {
+  for (int k = begin + tid * kPack; k < end; k += num_threads * kPack) {
+    PackT<T, kPack> pack = load_pack<T, kPack>(x_row + k);
+    #pragma unroll
+    for (int i = 0; i < kPack; ++i) {
+      pack.v[i] = from_f32<T>(to_f32(pack.v[i]) * scale);
+    }
+    store_pack<T, kPack>(y_row + k, pack);
+  }
+}
+
+// WARP: grid(N/NORM_ROWS_PER_BLOCK), block(NORM_ROWS_PER_BLOCK * WARP_SIZE)
+template<typename T, const int kPack>
+__global__ void rms_norm_warp_kernel(T* x, T* y, float g, int N, int K) {
+  int row = blockIdx.x * NORM_ROWS_PER_BLOCK + threadIdx.x / WARP_SIZE;
+  int lane = threadIdx.x % WARP_SIZE;
+  const float epsilon = 1e-5f;
+  if (row >= N) return; // the whole warp
+  T* x_row = x + (size_t) row * K;
+  // xor shuffles: every lane gets the sum
+  float variance = warp_reduce_sum_f32<WARP_SIZE>(
+    row_sum_sq<T, kPack>(x_row, 0, K, lane, WARP_SIZE));
+  float scale = rsqrtf(variance / (float) K + epsilon) * g;
+  row_rms_norm<T, kPack>(x_row, y + (size_t) row * K, 0, K, lane, WARP_SIZE, scale);
+}
+
+// BLOCK: grid(N), block(NUM_THREADS)
+template<typename T, const int kPack, const int NUM_THREADS>
+__global__ void rms_norm_block_kernel(T* x, T* y, float g, int N, int K) {
+  int tid = threadIdx.x;
+  int row = blockIdx.x;
+  const float epsilon = 1e-5f;
+  T* x_row = x + (size_t) row * K;
+
+  __shared__ float s_scale; // shared within block
+  float variance = block_reduce_sum_f32<NUM_THREADS>(
+    row_sum_sq<T, kPack>(x_row, 0, K, tid, NUM_THREADS));
+  if (tid == 0) s_scale = rsqrtf(variance / (float) K + epsilon) * g;
+  // wait for s_scale in shared memory to be ready for all threads
+  __syncthreads();
+  row_rms_norm<T, kPack>(x_row, y + (size_t) row * K, 0, K, tid, NUM_THREADS, s_scale);
+}
+
+// SPLIT: grid(num_chunks, N), block(NORM_SPLIT_THREADS), partial: N x num_chunks
+template<typename T, const int kPack>
+__global__ void rms_norm_split_partial_kernel(T* x, float* partial, int N, int K) {
+  int tid = threadIdx.x;
+  int chunk = blockIdx.x;
+  int row = blockIdx.y;
+  int begin = chunk * NORM_SPLIT_CHUNK;
+  int end = min(begin + NORM_SPLIT_CHUNK, K);
+  float variance = block_reduce_sum_f32<NORM_SPLIT_THREADS>(
+    row_sum_sq<T, kPack>(x + (size_t) row * K, begin, end, tid, NORM_SPLIT_THREADS));
+  if (tid == 0) partial[row * gridDim.x + chunk] = variance;
+}
+
+template<typename T, const int kPack>
+__global__ void rms_norm_split_apply_kernel(T* x, T* y, float* partial, float g,
+                                            int N, int K) {
+  int tid = threadIdx.x;
+  int chunk = blockIdx.x;
+  int row = blockIdx.y;
+  int begin = chunk * NORM_SPLIT_CHUNK;
+  int end = min(begin + NORM_SPLIT_CHUNK, K);
+  const float epsilon = 1e-5f;
+
+  __shared__ float s_scale; // shared within block
+  if (tid == 0) {
+    // same order in every chunk's block: the same scale for the whole row
+    float variance = 0.0f;
+    for (int c = 0; c < gridDim.x; ++c) variance += partial[row * gridDim.x + c];
+    s_scale = rsqrtf(variance / (float) K + epsilon) * g;
+  }
+  __syncthreads();
+  row_rms_norm<T, kPack>(x + (size_t) row * K, y + (size_t) row * K, begin, end,
+                         tid, NORM_SPLIT_THREADS, s_scale);
+}
+
 // --------------------- PyTorch bindings for custom kernel -----------------------
 #define STRINGFY(str) #str
 #define TORCH_BINDING_COMMON_EXTENSION(func) \
@@ -806,6 +1086,139 @@ void rms_norm_f16x8_pack_f32(torch::Tensor x, torch::Tensor y, float g) {
   DISPATCH_RMS_NORM_F16x8_PACK_F32_KERNEL(N, K)
 }
 
+// fused add + rms norm: x, residual: NxK half, weight: K half, K % 8 == 0,
+// y: NxK half/int8/fp8(e4m3), scale: N f32 (quantized y only).
+#define LANUCH_FUSED_ADD_RMS_NORM_KERNEL(NUM_THREADS, T)               \
+fused_add_rms_norm_f16x8_f32_kernel<(NUM_THREADS), T><<<N, (NUM_THREADS)>>>( \
+  reinterpret_cast<half*>(x.data_ptr()),                                \
+  reinterpret_cast<half*>(residual.data_ptr()),                         \
+  reinterpret_cast<half*>(weight.data_ptr()),                           \
+  reinterpret_cast<T*>(y.data_ptr()), scale_ptr, eps, K);
+
+template<typename T>
+void launch_fused_add_rms_norm(torch::Tensor x, torch::Tensor residual, torch::Tensor weight,
+                               torch::Tensor y, float* scale_ptr, float eps) {
+  CHECK_TORCH_TENSOR_DTYPE(x,        torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(residual, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(weight,   torch::kHalf)
+  CHECK_TORCH_TENSOR_SHAPE(x, residual)
+  CHECK_TORCH_TENSOR_SHAPE(x, y)
+  const int N = x.size(0);
+  const int K = x.size(1);
+  if (K % 8 != 0 || weight.numel() != K) {
+    throw std::runtime_error("K must be a multiple of 8, weight: K");
+  }
+  // 1 thread per 8 halfs, up to 1024 threads, then each thread loops
+  const int num_packs = K / 8;
+  if (num_packs <= 64) {
+    LANUCH_FUSED_ADD_RMS_NORM_KERNEL(64, T)
+  } else if (num_packs <= 128) {
+    LANUCH_FUSED_ADD_RMS_NORM_KERNEL(128, T)
+  } else if (num_packs <= 256) {
+    LANUCH_FUSED_ADD_RMS_NORM_KERNEL(256, T)
+  } else if (num_packs <= 512) {
+    LANUCH_FUSED_ADD_RMS_NORM_KERNEL(512, T)
+  } else {
+    LANUCH_FUSED_ADD_RMS_NORM_KERNEL(1024, T)
+  }
+}
+
+void fused_add_rms_norm_f16x8_f32(torch::Tensor x, torch::Tensor residual,
+                                  torch::Tensor weight, torch::Tensor y, float eps) {
+  CHECK_TORCH_TENSOR_DTYPE(y, torch::kHalf)
+  launch_fused_add_rms_norm<half>(x, residual, weight, y, nullptr, eps);
+}
+
+void fused_add_rms_norm_f16x8_f32_int8(torch::Tensor x, torch::Tensor residual,
+                                       torch::Tensor weight, torch::Tensor y,
+                                       torch::Tensor scale, float eps) {
+  CHECK_TORCH_TENSOR_DTYPE(y,     torch::kInt8)
+  CHECK_TORCH_TENSOR_DTYPE(scale, torch::kFloat32)
+  if (scale.numel() != x.size(0)) throw std::runtime_error("scale: N");
+  launch_fused_add_rms_norm<int8_t>(x, residual, weight, y, scale.data_ptr<float>(), eps);
+}
+
+void fused_add_rms_norm_f16x8_f32_fp8(torch::Tensor x, torch::Tensor residual,
+                                      torch::Tensor weight, torch::Tensor y,
+                                      torch::Tensor scale, float eps) {
+  CHECK_TORCH_TENSOR_DTYPE(y,     torch::kFloat8_e4m3fn)
+  CHECK_TORCH_TENSOR_DTYPE(scale, torch::kFloat32)
+  if (scale.numel() != x.size(0)) throw std::runtime_error("scale: N");
+  launch_fused_add_rms_norm<__nv_fp8_e4m3>(x, residual, weight, y, scale.data_ptr<float>(), eps);
+}
+
+// any K: x, y: NxK, strategy: NORM_AUTO (by K) or a NormStrategy.
+#define LANUCH_RMS_NORM_BLOCK_KERNEL(NUM_THREADS)                    \
+rms_norm_block_kernel<T, kPack, (NUM_THREADS)><<<N, (NUM_THREADS)>>>( \
+  x_ptr, y_ptr, g, N, K);
+
+template<typename T, const int kPack>
+void launch_rms_norm_auto(torch::Tensor x, torch::Tensor y, float g, int strategy) {
+  const int N = x.size(0);
+  const int K = x.size(1);
+  T* x_ptr = reinterpret_cast<T*>(x.data_ptr());
+  T* y_ptr = reinterpret_cast<T*>(y.data_ptr());
+  if (strategy == NORM_WARP) {
+    dim3 block(NORM_ROWS_PER_BLOCK * WARP_SIZE);
+    dim3 grid((N + NORM_ROWS_PER_BLOCK - 1) / NORM_ROWS_PER_BLOCK);
+    rms_norm_warp_kernel<T, kPack><<<grid, block>>>(x_ptr, y_ptr, g, N, K);
+  } else if (strategy == NORM_BLOCK) {
+    // a few packs per thread
+    const int num_packs = K / kPack;
+    if (num_packs <= 512) {
+      LANUCH_RMS_NORM_BLOCK_KERNEL(256)
+    } else if (num_packs <= 2048) {
+      LANUCH_RMS_NORM_BLOCK_KERNEL(512)
+    } else {
+      LANUCH_RMS_NORM_BLOCK_KERNEL(1024)
+    }
+  } else {
+    const int num_chunks = (K + NORM_SPLIT_CHUNK - 1) / NORM_SPLIT_CHUNK;
+    torch::Tensor partial = torch::empty({N, num_chunks, 1},
+                                         x.options().dtype(torch::kFloat32));
+    dim3 block(NORM_SPLIT_THREADS);
+    dim3 grid(num_chunks, N);
+    rms_norm_split_partial_kernel<T, kPack><<<grid, block>>>(
+      x_ptr, partial.data_ptr<float>(), N, K);
+    rms_norm_split_apply_kernel<T, kPack><<<grid, block>>>(
+      x_ptr, y_ptr, partial.data_ptr<float>(), g, N, K);
+  }
+}
+
+template<typename T, const int kPack>
+void dispatch_rms_norm_auto(torch::Tensor x, torch::Tensor y, float g, int strategy) {
+  CHECK_TORCH_TENSOR_SHAPE(x, y)
+  if (x.dim() != 2 || !x.is_contiguous() || !y.is_contiguous()) {
+    throw std::runtime_error("x, y must be contiguous NxK");
+  }
+  const int K = x.size(1);
+  if (strategy == NORM_AUTO) strategy = select_norm_strategy(K);
+  if (strategy < NORM_WARP || strategy > NORM_SPLIT) {
+    throw std::runtime_error("strategy: -1 (auto), 0 (warp), 1 (block), 2 (split)");
+  }
+  if (x.size(0) == 0 || K == 0) return;
+  // 128 bits loads/stores when K and the pointers allow it
+  const bool aligned = (reinterpret_cast<uintptr_t>(x.data_ptr()) % 16 == 0 &&
+                        reinterpret_cast<uintptr_t>(y.data_ptr()) % 16 == 0);
+  if (K % kPack == 0 && aligned) {
+    launch_rms_norm_auto<T, kPack>(x, y, g, strategy);
+  } else {
+    launch_rms_norm_auto<T, 1>(x, y, g, strategy);
+  }
+}
+
+void rms_norm_f32_auto(torch::Tensor x, torch::Tensor y, float g, int strategy) {
+  CHECK_TORCH_TENSOR_DTYPE(x, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(y, torch::kFloat32)
+  dispatch_rms_norm_auto<float, 4>(x, y, g, strategy);
+}
+
+void rms_norm_f16_f32_auto(torch::Tensor x, torch::Tensor y, float g, int strategy) {
+  CHECK_TORCH_TENSOR_DTYPE(x, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(y, torch::kHalf)
+  dispatch_rms_norm_auto<half, 8>(x, y, g, strategy);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   TORCH_BINDING_COMMON_EXTENSION(rms_norm_f32)
   TORCH_BINDING_COMMON_EXTENSION(rms_norm_f32x4)
@@ -816,4 +1229,9 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   TORCH_BINDING_COMMON_EXTENSION(rms_norm_f16x8_f32)
   TORCH_BINDING_COMMON_EXTENSION(rms_norm_f16x8_pack_f32)
   TORCH_BINDING_COMMON_EXTENSION(rms_norm_f16_f32)
+  TORCH_BINDING_COMMON_EXTENSION(fused_add_rms_norm_f16x8_f32)
+  TORCH_BINDING_COMMON_EXTENSION(fused_add_rms_norm_f16x8_f32_int8)
+  TORCH_BINDING_COMMON_EXTENSION(fused_add_rms_norm_f16x8_f32_fp8)
+  TORCH_BINDING_COMMON_EXTENSION(rms_norm_f32_auto)
+  TORCH_BINDING_COMMON_EXTENSION(rms_norm_f16_f32_auto)
 }
@@ -12,6 +12,7 @@
 
 #define INT4(value) (reinterpret_cast<int4*>(&(value))[0])
 #define FLOAT4(value) (reinterpret_cast<float4*>(&(value))[0])
+#define FLOAT2(value) (reinterpret_cast<float2*>(&(value))[0])
 #define HALF2(value) (reinterpret_cast<half2*>(&(value))[0])
 #define BFLOAT2(value) (reinterpret_cast<__nv_bfloat162*>(&(value))[0])
 #define BLOCK_SIZE 256
@@ -66,6 +67,83 @@ __global__ void rope_f32x4_pack_kernel(float* x, float* out, int seq_len, int N)
   FLOAT4(out[idx * 4]) = out_v;
 }
 
+// table version: cos/sin are [max_pos, N] tables of a RotaryCache (see
+// rope_cache.py), N = hidden_size/2, so no powf/sinf/cosf per element.
+// x: [B, seq_len, 2N], token s of sequence b is at position offsets[b] + s,
+// e.g decode: seq_len 1 and offsets = the context lengths.
+__global__ void rope_cached_f32_kernel(float* x, float* out, float* cos_table,
+                                       float* sin_table, int* offsets,
+                                       int seq_len, int N, int total) {
+  int idx = blockIdx.x * blockDim.x + threadIdx.x; // pair (x[2i], x[2i+1])
+  if (idx >= total) return;
+  int token = idx / N;
+  int pair_idx = idx % N;
+  int pos = offsets[token / seq_len] + token % seq_len;
+  float cos_v = cos_table[pos * N + pair_idx];
+  float sin_v = sin_table[pos * N + pair_idx];
+  float x1 = x[idx * 2];
+  float x2 = x[idx * 2 + 1];
+  out[idx * 2] = x1 * cos_v - x2 * sin_v;
+  out[idx * 2 + 1] = x1 * sin_v + x2 * cos_v;
+}
+
+// 2 pairs per thread, float4 x and float2 cos/sin loads, N must be even.
+__global__ void rope_cached_f32x4_pack_kernel(float* x, float* out, float* cos_table,
+                                              float* sin_table, int* offsets,
+                                              int seq_len, int N, int total) {
+  int idx = blockIdx.x * blockDim.x + threadIdx.x; // pairs 2*idx, 2*idx+1
+  if (idx * 2 >= total) return;
+  int token = (idx * 2) / N;
+  int pair_idx = (idx * 2) % N;
+  int pos = offsets[token / seq_len] + token % seq_len;
+  float2 cos_v = FLOAT2(cos_table[pos * N + pair_idx]);
+  float2 sin_v = FLOAT2(sin_table[pos * N + pair_idx]);
+  float4 x_v = FLOAT4(x[idx * 4]);
+  float4 out_v;
+  out_v.x = x_v.x * cos_v.x - x_v.y * sin_v.x;
+  out_v.y = x_v.x * sin_v.x + x_v.y * cos_v.x;
+  out_v.z = x_v.z * cos_v.y - x_v.w * sin_v.y;
+  out_v.w = x_v.z * sin_v.y + x_v.w * cos_v.y;
+  FLOAT4(out[idx * 4]) = out_v;
+}
+
+// batched, multi-head version: q: [num_tokens, num_heads, head_dim], k:
+// [num_tokens, num_kv_heads, head_dim] (e.g views of a packed qkv), token t
+// at position positions[t], so packed varlen batches and decode steps at
+// any position work. q and k are rotated in place by the same launch, one
+// block per token, the threads stride over the (head, pair) of q then k.
+// The first rot_dim = 2N dims of a head are rotated (partial rotary), by
+// the cos/sin tables of a RotaryCache: [max_pos, N].
+// GPT-J: pairs (x[2i], x[2i+1]), NeoX: pairs (x[i], x[i+N]).
+template<typename T, bool kNeox>
+__global__ void rope_qk_cached_kernel(T* q, T* k, int* positions, float* cos_table,
+                                      float* sin_table, int num_heads, int num_kv_heads,
+                                      int q_token_stride, int q_head_stride,
+                                      int k_token_stride, int k_head_stride, int N) {
+  int token = blockIdx.x;
+  int pos = positions[token];
+  float* cos_row = cos_table + pos * N;
+  float* sin_row = sin_table + pos * N;
+  int num_q_pairs = num_heads * N;
+  int num_pairs = (num_heads + num_kv_heads) * N;
+  for (int idx = threadIdx.x; idx < num_pairs; idx += blockDim.x) {
+    bool is_q = idx < num_q_pairs;
+    int head_pair = is_q ? idx : idx - num_q_pairs;
+    int head = head_pair / N;
+    int pair_idx = head_pair % N;
+    T* x = is_q ? q + token * q_token_stride + head * q_head_stride
+                : k + token * k_token_stride + head * k_head_stride;
+    int i1 = kNeox ? pair_idx : pair_idx * 2;
+    int i2 = kNeox ? pair_idx + N : pair_idx * 2 + 1;
+    float cos_v = cos_row[pair_idx];
+    float sin_v = sin_row[pair_idx];
+    float x1 = static_cast<float>(x[i1]);
+    float x2 = static_cast<float>(x[i2]);
+    x[i1] = static_cast<T>(x1 * cos_v - x2 * sin_v);
+    x[i2] = static_cast<T>(x1 * sin_v + x2 * cos_v);
+  }
+}
+
 // --------------------- PyTorch bindings for custom kernel -----------------------
 #define STRINGFY(str) #str
 #define TORCH_BINDING_COMMON_EXTENSION(func) \
@@ -113,8 +191,104 @@ void rope_f32x4_pack(torch::Tensor x, torch::Tensor out) {
     x.data_ptr<float>(), out.data_ptr<float>(), seq_len, N);
 }
 
+// x, out: [seq_len, hidden_size] or [B, seq_len, hidden_size], cos/sin:
+// [max_pos, hidden_size/2], offsets: [B] int32. positions past the tables
+// are not checked (device side), grow the RotaryCache first.
+#define CHECK_ROPE_CACHED_INPUTS(x, cos, sin, offsets, out, n_pack)         \
+  CHECK_TORCH_TENSOR_DTYPE(x,       torch::kFloat32)                        \
+  CHECK_TORCH_TENSOR_DTYPE(cos,     torch::kFloat32)                        \
+  CHECK_TORCH_TENSOR_DTYPE(sin,     torch::kFloat32)                        \
+  CHECK_TORCH_TENSOR_DTYPE(offsets, torch::kInt32)                          \
+  CHECK_TORCH_TENSOR_DTYPE(out,     torch::kFloat32)                        \
+  const int seq_len = x.size(-2);                                           \
+  const int hidden_size = x.size(-1);                                       \
+  const int B = x.numel() / (seq_len * hidden_size);                        \
+  const int N = hidden_size / 2;                                            \
+  if (hidden_size % (n_pack) != 0 || cos.size(1) != N ||                    \
+      sin.size(1) != N || offsets.numel() != B) {                           \
+    throw std::runtime_error("Tensor size mismatch!");                      \
+  }
+
+void rope_cached_f32(torch::Tensor x, torch::Tensor cos, torch::Tensor sin,
+                     torch::Tensor offsets, torch::Tensor out) {
+  CHECK_ROPE_CACHED_INPUTS(x, cos, sin, offsets, out, 2)
+  int total = B * seq_len * N;
+  dim3 grid((total + BLOCK_SIZE - 1) / BLOCK_SIZE);
+  dim3 block(BLOCK_SIZE);
+  rope_cached_f32_kernel<<<grid, block>>>(
+    x.data_ptr<float>(), out.data_ptr<float>(), cos.data_ptr<float>(),
+    sin.data_ptr<float>(), offsets.data_ptr<int>(), seq_len, N, total);
+}
+
+void rope_cached_f32x4_pack(torch::Tensor x, torch::Tensor cos, torch::Tensor sin,
+                            torch::Tensor offsets, torch::Tensor out) {
+  CHECK_ROPE_CACHED_INPUTS(x, cos, sin, offsets, out, 4)
+  int total = B * seq_len * N;
+  dim3 grid((total / 2 + BLOCK_SIZE - 1) / BLOCK_SIZE);
+  dim3 block(BLOCK_SIZE);
+  rope_cached_f32x4_pack_kernel<<<grid, block>>>(
+    x.data_ptr<float>(), out.data_ptr<float>(), cos.data_ptr<float>(),
+    sin.data_ptr<float>(), offsets.data_ptr<int>(), seq_len, N, total);
+}
+
+// q: [num_tokens, num_heads, head_dim], k: [num_tokens, num_kv_heads,
+// head_dim], the last dim contiguous, rotated in place. positions:
+// [num_tokens] int32, cos/sin: [max_pos, rot_dim/2] f32, rot_dim <= head_dim.
+template<typename T>
+void launch_rope_qk_cached(torch::Tensor q, torch::Tensor k, torch::Tensor positions,
+                           torch::Tensor cos, torch::Tensor sin, bool is_neox) {
+  CHECK_TORCH_TENSOR_DTYPE(positions, torch::kInt32)
+  CHECK_TORCH_TENSOR_DTYPE(cos,       torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(sin,       torch::kFloat32)
+  if (q.dim() != 3 || k.dim() != 3) {
+    throw std::runtime_error("q, k must be [num_tokens, num_heads, head_dim]");
+  }
+  const int num_tokens = q.size(0);
+  const int num_heads = q.size(1);
+  const int num_kv_heads = k.size(1);
+  const int head_dim = q.size(2);
+  const int N = cos.size(1);
+  if (k.size(0) != num_tokens ||
+      k.size(2) != head_dim || positions.numel() != num_tokens ||
+      sin.size(1) != N || 2 * N > head_dim || q.stride(2) != 1 || k.stride(2) != 1) {
+    throw std::runtime_error("Tensor size mismatch!");
+  }
+  if (num_tokens == 0) return;
+  dim3 grid(num_tokens);
+  dim3 block(std::min((num_heads + num_kv_heads) * N, 512));
+  if (is_neox) {
+    rope_qk_cached_kernel<T, true><<<grid, block>>>(
+      reinterpret_cast<T*>(q.data_ptr()), reinterpret_cast<T*>(k.data_ptr()),
+      positions.data_ptr<int>(), cos.data_ptr<float>(), sin.data_ptr<float>(),
+      num_heads, num_kv_heads, q.stride(0), q.stride(1), k.stride(0), k.stride(1), N);
+  } else {
+    rope_qk_cached_kernel<T, false><<<grid, block>>>(
+      reinterpret_cast<T*>(q.data_ptr()), reinterpret_cast<T*>(k.data_ptr()),
+      positions.data_ptr<int>(), cos.data_ptr<float>(), sin.data_ptr<float>(),
+      num_heads, num_kv_heads, q.stride(0), q.stride(1), k.stride(0), k.stride(1), N);
+  }
+}
+
+void rope_qk_cached_f32(torch::Tensor q, torch::Tensor k, torch::Tensor positions,
+                        torch::Tensor cos, torch::Tensor sin, bool is_neox) {
+  CHECK_TORCH_TENSOR_DTYPE(q, torch::kFloat32)
+  CHECK_TORCH_TENSOR_DTYPE(k, torch::kFloat32)
+  launch_rope_qk_cached<float>(q, k, positions, cos, sin, is_neox);
+}
+
+void rope_qk_cached_f16(torch::Tensor q, torch::Tensor k, torch::Tensor positions,
+                        torch::Tensor cos, torch::Tensor sin, bool is_neox) {
+  CHECK_TORCH_TENSOR_DTYPE(q, torch::kHalf)
+  CHECK_TORCH_TENSOR_DTYPE(k, torch::kHalf)
+  launch_rope_qk_cached<half>(q, k, positions, cos, sin, is_neox);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   TORCH_BINDING_COMMON_EXTENSION(rope_f32)
   TORCH_BINDING_COMMON_EXTENSION(rope_f32_v2)
   TORCH_BINDING_COMMON_EXTENSION(rope_f32x4_pack)
+  TORCH_BINDING_COMMON_EXTENSION(rope_cached_f32)
+  TORCH_BINDING_COMMON_EXTENSION(rope_cached_f32x4_pack)
+  TORCH_BINDING_COMMON_EXTENSION(rope_qk_cached_f32)
+  TORCH_BINDING_COMMON_EXTENSION(rope_qk_cached_f16)
 }
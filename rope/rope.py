@@ -1,7 +1,11 @@
 import torch
-import time
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
 import math
-from torch.utils.cpp_extension import load
+from bench.registry import lazy_load
+from rope_cache import RopeScaling, RotaryCache, apply_rope_qk, get_inv_freq, get_rotary_cache
 from functools import partial
 from typing import Optional
 from typing import Tuple
@@ -10,7 +14,7 @@ import torch.nn.functional as F
 torch.set_grad_enabled(False)
 
 # Load the CUDA kernel as a python module
-lib = load(
+lib = lazy_load(
     name="rope",
     sources=["rope.cu"],
     extra_cuda_cflags=[
@@ -25,6 +29,7 @@ lib = load(
     ],
     extra_cflags=["-std=c++17"],
 )
+device = bench.get_device()
 
 
 def run_benchmark(
@@ -32,45 +37,26 @@ def run_benchmark(
     a: torch.Tensor,
     tag: str,
     out: Optional[torch.Tensor] = None,
+    args: tuple = (),
+    ref: Optional[torch.Tensor] = None,
+    cost: str = "rope",
     warmup: int = 2,
     iters: int = 20,
     show_all: bool = False,
 ):
-    if out is not None:
-        out.fill_(0)
-    if out is not None:
-        for i in range(warmup):
-            perf_func(a, out)
-    else:
-        for i in range(warmup):
-            _ = perf_func(a)
-
-    torch.cuda.synchronize()
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            perf_func(a, out)
-    else:
-        for i in range(iters):
-            out = perf_func(a)
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000  # ms
-    mean_time = total_time / iters
-    out_info = f"out_{tag}"
-    out_val = out.flatten().detach().cpu().numpy().tolist()[:3]
-    out_val = [round(v, 8) for v in out_val]
-    out_val = [f"{v:<12}" for v in out_val]
-    print(f"{out_info:>20}: {out_val}, time:{mean_time:.6f}ms")
-    if show_all:
-        print(out)
-    return out.clone(), mean_time
+    # args: the rope_cached_* tables and offsets, ref: naive_rope(a) by default
+    out, result = bench.run_benchmark(
+        perf_func, (a, *args), tag, out, warmup=warmup, iters=iters,
+        show_all=show_all, width=20, ref=(lambda: naive_rope(a)) if ref is None else ref,
+        cost=cost,
+    )
+    return out.clone(), result
 
 
 def naive_rope(
     x: torch.Tensor,
     theta: float = 10000.0,
+    positions: Optional[torch.Tensor] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     dim = x.shape[-1]
     seq_len = x.shape[-2]
@@ -82,14 +68,97 @@ def naive_rope(
     # pack neibored element into a complex
     # x_: [batch_size, seq_len, dim//2, 1]. eg: tensor([(1.6116-0.5772j), ...]
     freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
-    t = torch.arange(seq_len , device=freqs.device)
-    freqs = torch.outer(t, freqs).float().cuda()
+    # positions: [seq_len] or [batch_size, seq_len], 0..seq_len-1 by default
+    t = torch.arange(seq_len , device=freqs.device) if positions is None else positions.float().cpu()
+    freqs = (t[..., None] * freqs).float().to(x.device)
     freqs_cis = torch.polar(torch.ones_like(freqs), freqs) 
     # get rotate angle
-    xq_out = torch.view_as_real(x_ * freqs_cis).flatten(1)
+    xq_out = torch.view_as_real(x_ * freqs_cis).flatten(-2)
     # do rotate
     return xq_out.type_as(x)
 
+
+def check_rotary_cache():
+    # the tables of every scaling against naive_rope, and lazy growth
+    x = torch.randn(2, 300, 128)
+    offsets = torch.tensor([0, 5000], dtype=torch.int32)
+    pos = offsets.long()[:, None] + torch.arange(300)
+    factor = 4.0
+    cases = [
+        ("none", RopeScaling(), naive_rope(x, positions=pos)),
+        ("linear", RopeScaling("linear", factor), naive_rope(x, positions=pos / factor)),
+        ("ntk", RopeScaling("ntk", factor),
+         naive_rope(x, 10000.0 * factor ** (128 / 126), positions=pos)),
+        # no interpolation with factor 1
+        ("yarn", RopeScaling("yarn", 1.0), naive_rope(x, positions=pos)),
+    ]
+    for name, scaling, ref in cases:
+        cache = RotaryCache(128, max_seq_len=256, scaling=scaling)
+        cos, _ = cache.get(256)
+        out = cache.apply(x, offsets)
+        ok = (torch.allclose(out, ref, atol=1e-3) and cache.max_seq_len == 8192
+              and torch.equal(cache.cos[:256], cos))
+        print(f"rotary cache {name:>6}: {'ok' if ok else 'WRONG'}")
+    # yarn keeps the highest frequencies, interpolates the lowest ones
+    inv_freq, mscale = get_inv_freq(128, scaling=RopeScaling("yarn", factor))
+    base, _ = get_inv_freq(128)
+    ok = (inv_freq[0] == base[0] and torch.isclose(inv_freq[-1], base[-1] / factor)
+          and mscale > 1.0)
+    print(f"rotary cache yarn 4x: {'ok' if ok else 'WRONG'}")
+
+
+def naive_rope_qk(q: torch.Tensor, k: torch.Tensor, positions: torch.Tensor,
+                  is_neox: bool = False, theta: float = 10000.0):
+    # [num_tokens, num_heads, head_dim] at positions: [num_tokens], out of
+    # place. NeoX is GPT-J with the pairs (x[i], x[i+dim/2]) interleaved first
+    def rotate(x):
+        dim = x.shape[-1]
+        if is_neox:
+            x = x.reshape(*x.shape[:-1], 2, dim // 2).transpose(-1, -2).flatten(-2)
+        out = naive_rope(x, theta, positions=positions.long()[:, None])
+        if is_neox:
+            out = out.reshape(*x.shape[:-1], dim // 2, 2).transpose(-1, -2).flatten(-2)
+        return out
+    return rotate(q), rotate(k)
+
+
+def rope_qk(rope_qk_func: callable, q: torch.Tensor, k: torch.Tensor,
+            positions: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor,
+            is_neox: bool):
+    # in place, returns q for the printout
+    rope_qk_func(q, k, positions, cos, sin, is_neox)
+    return q
+
+
+def check_rope_qk():
+    # one in-place call of every variant against naive_rope_qk: packed varlen
+    # batch (positions restart per sequence), GQA, and a strided q/k view of
+    # a packed qkv
+    lens = [5, 1, 17]
+    positions = torch.cat([torch.arange(n) + off for n, off in zip(lens, [0, 4000, 37])])
+    positions = positions.to(torch.int32).to(device)
+    cache = get_rotary_cache(128, device=device)
+    cos, sin = cache.get(int(positions.max()) + 1)
+    for dtype, func in [(torch.float32, lib.rope_qk_cached_f32),
+                        (torch.float16, lib.rope_qk_cached_f16),
+                        (torch.float32, apply_rope_qk)]:
+        for is_neox in [False, True]:
+            qkv = torch.randn(sum(lens), 8 + 2 + 2, 128).to(device).to(dtype)
+            q, k = qkv[:, :8], qkv[:, 8:10]
+            ref_q, ref_k = naive_rope_qk(q, k, positions, is_neox)
+            v = qkv[:, 10:].clone()
+            func(q, k, positions, cos, sin, is_neox)
+            atol = 1e-2 if dtype == torch.float16 else 1e-4
+            ok = (torch.allclose(q.float(), ref_q.float(), atol=atol)
+                  and torch.allclose(k.float(), ref_k.float(), atol=atol)
+                  and torch.equal(qkv[:, 10:], v))
+            name = f"{bench.get_func_name(func)}({'neox' if is_neox else 'gptj'})"
+            print(f"{name:>32}: {'ok' if ok else 'WRONG'}")
+
+
+check_rotary_cache()
+check_rope_qk()
+
 print("-" * 100)
 M = [4096, 8192]
 N = [512, 1024]
@@ -97,9 +166,63 @@ MN = [[m, n] for m in M for n in N]
 for M,N in MN:
     print(" " * 40 + f"M={M}, N={N}")
     print("-" * 100)
-    x = torch.randn((M, N)).cuda().float().contiguous()
-    out = torch.zeros_like(x).cuda().float().contiguous()
-    run_benchmark(lib.rope_f32,          x, "f32",          out)
-    run_benchmark(lib.rope_f32x4_pack,   x, "f32x4_pack",   out)
-    run_benchmark(naive_rope,            x, "f32_th")
-    print("-" * 100)     
+    x = torch.randn((M, N)).to(device).float().contiguous()
+    out = torch.zeros_like(x).to(device).float().contiguous()
+    # built once, shared by every call with the same (dim, theta, ...)
+    cache = get_rotary_cache(N, max_seq_len=M, device=device)
+    tables = (*cache.get(M), torch.zeros(1, dtype=torch.int32, device=device))
+    run_benchmark(lib.rope_f32,               x, "f32",               out)
+    run_benchmark(lib.rope_f32x4_pack,        x, "f32x4_pack",        out)
+    run_benchmark(lib.rope_cached_f32,        x, "f32(cached)",       out, tables)
+    run_benchmark(lib.rope_cached_f32x4_pack, x, "f32x4_pack(cached)", out, tables)
+    run_benchmark(naive_rope,                 x, "f32_th")
+    run_benchmark(cache.apply,                x, "f32_th(cached)",    cost="rope_cached")
+    print("-" * 100)
+
+# decode: one new token per sequence at position offsets[b] (its context
+# length), the tables grow as longer contexts arrive
+B = [64, 256]
+N = [128, 1024]
+for B, N in [[b, n] for b in B for n in N]:
+    print(" " * 40 + f"decode B={B}, N={N}")
+    print("-" * 100)
+    x = torch.randn((B, 1, N)).to(device).float().contiguous()
+    out = torch.zeros_like(x).to(device).float().contiguous()
+    offsets = torch.randint(0, 32768, (B,), dtype=torch.int32).to(device)
+    cache = get_rotary_cache(N, device=device)
+    tables = (*cache.get(int(offsets.max()) + 1), offsets)
+    ref = naive_rope(x, positions=offsets.long()[:, None])
+    run_benchmark(lib.rope_cached_f32,        x, "f32(cached)",        out, tables, ref)
+    run_benchmark(lib.rope_cached_f32x4_pack, x, "f32x4_pack(cached)", out, tables, ref)
+    run_benchmark(partial(naive_rope, positions=offsets.long()[:, None]), x, "f32_th",
+                  ref=ref)
+    run_benchmark(cache.apply,                x, "f32_th(cached)",     args=(offsets,),
+                  ref=ref, cost="rope_cached")
+    print(f"{'':>20}  table: {cache.max_seq_len} positions, built {cache.num_builds}x")
+    print("-" * 100)
+
+# batched q/k, in place: num_tokens of a packed varlen prefill batch or
+# decode step, positions per token
+T = [512, 4096]
+HD = [(32, 8, 128), (64, 8, 128)] # num_heads, num_kv_heads, head_dim
+for T, (H, KVH, D) in [[t, hd] for t in T for hd in HD]:
+    print(" " * 30 + f"q/k T={T}, H={H}, KVH={KVH}, D={D}")
+    print("-" * 100)
+    positions = torch.randint(0, 8192, (T,), dtype=torch.int32).to(device)
+    cache = get_rotary_cache(D, device=device)
+    cos, sin = cache.get(8192)
+    for dtype, func in [(torch.float32, lib.rope_qk_cached_f32),
+                        (torch.float16, lib.rope_qk_cached_f16)]:
+        q = torch.randn(T, H, D).to(device).to(dtype)
+        k = torch.randn(T, KVH, D).to(device).to(dtype)
+        for is_neox in [False, True]:
+            tag = f"{str(dtype)[6:]}({'neox' if is_neox else 'gptj'})"
+            bench.run_benchmark(partial(rope_qk, func), (q, k, positions, cos, sin),
+                                tag, args=(is_neox,), warmup=2, iters=20, width=20,
+                                cost="rope_qk_cached",
+                                meta={"kernel": bench.get_func_name(func)})
+    q, k = q.float(), k.float()
+    bench.run_benchmark(partial(rope_qk, apply_rope_qk), (q, k, positions, cos, sin),
+                        "float32_th(gptj)", args=(False,), warmup=2, iters=20, width=20,
+                        cost="rope_qk_cached", meta={"kernel": "apply_rope_qk"})
+    print("-" * 100)
@@ -0,0 +1,159 @@
+# RoPE cos/sin tables: cos[pos, i] and sin[pos, i] of the angle
+# pos * inv_freq[i], i < dim/2, computed once per (dim, theta, dtype,
+# device, scaling) and shared by every call, so the kernels index them by
+# absolute position instead of calling powf/sinf/cosf (rope_f32) or
+# rebuilding freqs/outer/polar (naive_rope) every time. Tables grow lazily
+# (to the next power of 2) when a longer position is asked for; rows already
+# computed do not change.
+#
+# Context extension (scaling.type):
+#   linear: positions divided by factor (position interpolation)
+#   ntk:    NTK-aware, theta * factor^(dim/(dim-2)), high frequencies kept
+#   yarn:   NTK-by-parts, frequencies interpolated by factor below the
+#           beta_slow rotations over original_max_position, kept above
+#           beta_fast, ramp in between; cos/sin scaled by 0.1*ln(factor)+1
+
+import math
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import torch
+
+SCALING_TYPES = ("none", "linear", "ntk", "yarn")
+
+
+@dataclass(frozen=True)
+class RopeScaling:
+    type: str = "none"
+    factor: float = 1.0
+    original_max_position: int = 2048 # yarn
+    beta_fast: float = 32.0
+    beta_slow: float = 1.0
+
+    def __post_init__(self):
+        if self.type not in SCALING_TYPES:
+            raise ValueError(f"scaling type must be one of {SCALING_TYPES}, got {self.type}")
+
+
+def _yarn_correction_dim(num_rotations: float, dim: int, theta: float,
+                         max_position: int) -> float:
+    # dim index whose wavelength fits num_rotations times in max_position
+    return (dim * math.log(max_position / (num_rotations * 2 * math.pi))) / (2 * math.log(theta))
+
+
+def get_inv_freq(dim: int, theta: float = 10000.0,
+                 scaling: Optional[RopeScaling] = None) -> Tuple[torch.Tensor, float]:
+    # inv_freq: [dim/2] f32, and the magnitude scale of cos/sin
+    scaling = scaling or RopeScaling()
+    if scaling.type == "ntk":
+        theta = theta * scaling.factor**(dim / (dim - 2))
+    inv_freq = 1.0 / (theta**(torch.arange(0, dim, 2)[:(dim // 2)].float() / dim))
+    if scaling.type == "linear":
+        return inv_freq / scaling.factor, 1.0
+    if scaling.type != "yarn":
+        return inv_freq, 1.0
+    low = math.floor(_yarn_correction_dim(scaling.beta_fast, dim, theta,
+                                          scaling.original_max_position))
+    high = math.ceil(_yarn_correction_dim(scaling.beta_slow, dim, theta,
+                                         scaling.original_max_position))
+    low, high = max(low, 0), min(high, dim - 1)
+    # 0 below low (extrapolation), 1 above high (interpolation)
+    ramp = ((torch.arange(dim // 2).float() - low) / max(high - low, 1e-3)).clamp(0, 1)
+    inv_freq = inv_freq * (1 - ramp) + inv_freq / scaling.factor * ramp
+    mscale = 0.1 * math.log(scaling.factor) + 1.0 if scaling.factor > 1 else 1.0
+    return inv_freq, mscale
+
+
+class RotaryCache:
+    # cos/sin: [max_seq_len, dim/2], contiguous, on device
+
+    def __init__(self, dim: int, theta: float = 10000.0, max_seq_len: int = 2048,
+                 dtype: torch.dtype = torch.float32, device: Optional[torch.device] = None,
+                 scaling: Optional[RopeScaling] = None):
+        if dim % 2:
+            raise ValueError(f"dim must be even, got {dim}")
+        self.dim = dim
+        self.theta = theta
+        self.dtype = dtype
+        self.device = device
+        self.scaling = scaling or RopeScaling()
+        self.inv_freq, self.mscale = get_inv_freq(dim, theta, self.scaling)
+        self.cos = torch.empty(0, dim // 2, dtype=dtype, device=device)
+        self.sin = torch.empty(0, dim // 2, dtype=dtype, device=device)
+        self.num_builds = 0
+        self._grow(max_seq_len)
+
+    @property
+    def max_seq_len(self) -> int:
+        return self.cos.shape[0]
+
+    def _grow(self, max_seq_len: int):
+        # rows [0, max_seq_len), the angles computed in f32 as the inline
+        # kernels and naive_rope do
+        angle = torch.outer(torch.arange(max_seq_len).float(), self.inv_freq)
+        self.cos = (angle.cos() * self.mscale).to(dtype=self.dtype, device=self.device)
+        self.sin = (angle.sin() * self.mscale).to(dtype=self.dtype, device=self.device)
+        self.num_builds += 1
+
+    def get(self, max_seq_len: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the tables for positions < max_seq_len (or more)
+        if max_seq_len > self.max_seq_len:
+            self._grow(1 << (max_seq_len - 1).bit_length())
+        return self.cos, self.sin
+
+    def apply(self, x: torch.Tensor, offsets: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # torch path of the rope_cached_* kernels. x: [B, seq_len, dim] or
+        # [seq_len, dim], interleaved pairs (x[2i], x[2i+1]); token s of
+        # sequence b is at position offsets[b] + s (0 by default).
+        seq_len = x.shape[-2]
+        xb = x.reshape(-1, seq_len, self.dim)
+        if offsets is None:
+            offsets = torch.zeros(xb.shape[0], dtype=torch.int32, device=x.device)
+        pos = offsets.long()[:, None] + torch.arange(seq_len, device=x.device)
+        cos, sin = self.get(int(pos.max()) + 1)
+        cos, sin = cos[pos].float(), sin[pos].float()
+        x1, x2 = xb[..., 0::2].float(), xb[..., 1::2].float()
+        out = torch.stack([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1)
+        return out.reshape(x.shape).to(x.dtype)
+
+    def rotate_qk(self, q: torch.Tensor, k: torch.Tensor, positions: torch.Tensor,
+                  is_neox: bool = False):
+        # in place, see apply_rope_qk
+        cos, sin = self.get(int(positions.max()) + 1 if positions.numel() else 0)
+        apply_rope_qk(q, k, positions, cos, sin, is_neox)
+
+
+def apply_rope_qk(q: torch.Tensor, k: torch.Tensor, positions: torch.Tensor,
+                  cos: torch.Tensor, sin: torch.Tensor, is_neox: bool = False):
+    # torch path of the rope_qk_cached_* kernels, in place. q: [num_tokens,
+    # num_heads, head_dim], k: [num_tokens, num_kv_heads, head_dim], token t
+    # at positions[t], the first rot_dim = 2 * cos.size(1) dims of a head
+    # rotated. GPT-J: pairs (x[2i], x[2i+1]), NeoX: (x[i], x[i+rot_dim/2]).
+    half = cos.size(1)
+    cos = cos[positions.long()][:, None, :].float()
+    sin = sin[positions.long()][:, None, :].float()
+    for x in (q, k):
+        if is_neox:
+            x1, x2 = x[..., :half], x[..., half:2 * half]
+        else:
+            x1, x2 = x[..., 0:2 * half:2], x[..., 1:2 * half:2]
+        r1 = x1.float() * cos - x2.float() * sin
+        r2 = x1.float() * sin + x2.float() * cos
+        x1.copy_(r1)
+        x2.copy_(r2)
+
+_ROTARY_CACHES: Dict[Tuple, RotaryCache] = {}
+
+
+def get_rotary_cache(dim: int, theta: float = 10000.0, max_seq_len: int = 2048,
+                     dtype: torch.dtype = torch.float32, device: Optional[torch.device] = None,
+                     scaling: Optional[RopeScaling] = None) -> RotaryCache:
+    # one RotaryCache per (dim, theta, dtype, device, scaling), grown to at
+    # least max_seq_len
+    scaling = scaling or RopeScaling()
+    key = (dim, float(theta), dtype, str(torch.device(device or "cpu")), scaling)
+    cache = _ROTARY_CACHES.get(key)
+    if cache is None:
+        cache = _ROTARY_CACHES[key] = RotaryCache(dim, theta, max_seq_len, dtype, device, scaling)
+    cache.get(max_seq_len)
+    return cache
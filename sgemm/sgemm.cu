@@ -713,6 +713,9 @@ void sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages(torch::Tensor a, torch::Tensor b,
 void sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages_dsmem(torch::Tensor a, torch::Tensor b, torch::Tensor c, 
                                                      int stages, bool swizzle, int swizzle_stride);
 
+// bench/registry.py builds each .cu alone with generated bindings and
+// -DSKIP_TORCH_BINDINGS, see bench/README.md
+#ifndef SKIP_TORCH_BINDINGS
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   // CUDA Cores 
   TORCH_BINDING_COMMON_EXTENSION(sgemm_naive_f32)
@@ -735,3 +738,5 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   TORCH_BINDING_COMMON_EXTENSION(sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages)
   TORCH_BINDING_COMMON_EXTENSION(sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages_dsmem)
 }
+#endif
+
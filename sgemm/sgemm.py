@@ -1,28 +1,44 @@
 import torch
-import time 
-from torch.utils.cpp_extension import load
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench
+from bench.registry import lazy_load
 from functools import partial
 from typing import Optional
 
 torch.set_grad_enabled(False)
 
 # Load the CUDA kernel as a python module
-lib = load(name='sgemm_lib', 
-           sources=['sgemm.cu', 'sgemm_async.cu', 
-                    'sgemm_wmma_tf32_stage.cu', 'sgemm_cublas.cu'], 
-           extra_cuda_cflags=[
-               "-O3",
-                "-U__CUDA_NO_HALF_OPERATORS__",
-                "-U__CUDA_NO_HALF_CONVERSIONS__",
-                "-U__CUDA_NO_HALF2_OPERATORS__",
-                "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
-                "--expt-relaxed-constexpr",
-                "--expt-extended-lambda",
-                "--use_fast_math"
-            ], 
-           extra_cflags=['-std=c++17'])
+lib = lazy_load(name='sgemm_lib', 
+                sources=['sgemm.cu', 'sgemm_async.cu', 
+                         'sgemm_wmma_tf32_stage.cu', 'sgemm_cublas.cu'], 
+                extra_cuda_cflags=[
+                    "-O3",
+                     "-U__CUDA_NO_HALF_OPERATORS__",
+                     "-U__CUDA_NO_HALF_CONVERSIONS__",
+                     "-U__CUDA_NO_HALF2_OPERATORS__",
+                     "-U__CUDA_NO_BFLOAT16_CONVERSIONS__",
+                     "--expt-relaxed-constexpr",
+                     "--expt-extended-lambda",
+                     "--use_fast_math"
+                 ], 
+                extra_cflags=['-std=c++17'])
+device = bench.get_device()
 
 MAX_TFLOPS = -1
+REF_CACHE = {}
+
+
+def get_reference(a: torch.Tensor, b: torch.Tensor):
+    # cuBLAS f32 (torch.matmul, tf32 off by default) result of the current
+    # MNK, computed once and shared by all the variants.
+    key = (a.size(0), a.size(1), b.size(1))
+    if key not in REF_CACHE:
+        REF_CACHE.clear()
+        REF_CACHE[key] = torch.matmul(a, b)
+    return REF_CACHE[key]
+
 
 def run_benchmark(perf_func: callable, 
                   a: torch.Tensor, b: torch.Tensor,
@@ -56,31 +72,20 @@ def run_benchmark(perf_func: callable,
     if out is not None: 
         out.fill_(0)      
     if out is not None:
-        for i in range(warmup):
-            if stages > 1:
-                perf_func(a, b, out, stages, swizzle, swizzle_stride)
-            else:
-                perf_func(a, b, out)
-    else:
-        for i in range(warmup):
-            _ = perf_func(a, b) 
-    
-    torch.cuda.synchronize()
-    start = time.time()
-    # iters
-    if out is not None:
-        for i in range(iters):
-            if stages > 1:
-                perf_func(a, b, out, stages, swizzle, swizzle_stride)
-            else:
-                perf_func(a, b, out)
+        if stages > 1:
+            perf = lambda: perf_func(a, b, out, stages, swizzle, swizzle_stride)
+        else:
+            perf = lambda: perf_func(a, b, out)
     else:
-        for i in range(iters):
-            out = perf_func(a, b) 
-    torch.cuda.synchronize()
-    end = time.time()
-    total_time = (end - start) * 1000 # ms
-    mean_time = total_time / iters
+        perf = lambda: perf_func(a, b)
+    result = bench.do_bench(perf, tag, warmup=warmup, iters=iters)
+    if out is None:
+        out = perf()
+    # tf32 keeps 10 mantissa bits, as f16 does
+    acc_dtype = torch.half if "tf32" in tag else torch.float
+    result.check = bench.check_close(out, get_reference(a, b),
+                                     *bench.sum_tolerance(K, acc_dtype))
+    mean_time = result.median
     out_info = f"out_{tag}"
     out_val = out.flatten()[:2].detach().cpu().numpy().tolist()[:3]
     out_val = [round(v, 8) for v in out_val]
@@ -88,9 +93,10 @@ def run_benchmark(perf_func: callable,
     TFLOPS = (2 * M * N * K) * 1e-9 / (mean_time)
     mean_time = str(f"{mean_time:<12}")[:8]
     swizzle_stride = 'NOOP' if swizzle_stride == 1 else swizzle_stride
+    wrong_info = "" if result.valid else f", {result.check.summary()}"
 
-    # caculate TFLOPS improved.
-    if TFLOPS > MAX_TFLOPS:
+    # caculate TFLOPS improved, wrong variants are never the best one.
+    if result.valid and TFLOPS > MAX_TFLOPS:
         if MAX_TFLOPS > 0:
             improve = ((TFLOPS - MAX_TFLOPS) / MAX_TFLOPS) * 100
             improve = round(improve, 2)
@@ -101,9 +107,16 @@ def run_benchmark(perf_func: callable,
               f"swizzle: {swizzle_stride:<4}, TFLOPS: {TFLOPS:<6.2f}(+{improve:.2f}%)")
     else:
         print(f"{out_info:>35}: {out_val}, time:{mean_time}ms, "
-              f"swizzle: {swizzle_stride:<4}, TFLOPS: {TFLOPS:<6.2f}")
+              f"swizzle: {swizzle_stride:<4}, TFLOPS: {TFLOPS:<6.2f}{wrong_info}")
     if show_all: print(out)
-    return out, mean_time
+    # get_roofline_info gives the tflops (2*M*N*K at the median, as TFLOPS)
+    bench.record_result(result, kernel=bench.get_func_name(perf_func),
+                        shape=(M, N, K), dtype=a.dtype,
+                        stages=stages if stages > 1 else None,
+                        swizzle_stride=swizzle_stride if swizzle else None,
+                        **bench.get_roofline_info(bench.gemm_cost(a, b), result.median,
+                                                  bench.get_device_name(), str(a.dtype)[6:]))
+    return out, result
 
 
 Ms = [4096, 8192, 16384]
@@ -111,10 +124,10 @@ Ns = [4096, 8192, 16384]
 Ks = [2048, 4096, 8192]
 MAX_M, MAX_N, MAX_K = 16384, 16384, 8192
 # pre allocate for fast profiling.
-A = torch.randn((MAX_M, MAX_K), dtype=torch.float).cuda()
-B = torch.randn((MAX_K, MAX_N), dtype=torch.float).cuda()
-C = torch.randn((MAX_M, MAX_N), dtype=torch.float).cuda()
-torch.cuda.synchronize()
+A = torch.randn((MAX_M, MAX_K), dtype=torch.float).to(device)
+B = torch.randn((MAX_K, MAX_N), dtype=torch.float).to(device)
+C = torch.randn((MAX_M, MAX_N), dtype=torch.float).to(device)
+bench.synchronize()
 
 MNKs = [(M, N, K) for M in Ms for N in Ns for K in Ks]
 for (M, N, K) in MNKs:
@@ -124,7 +137,7 @@ for (M, N, K) in MNKs:
     a = A[:M, :K].contiguous()
     b = B[:K, :N].contiguous()
     c = C[:M, :N].contiguous()
-    torch.cuda.synchronize()
+    bench.synchronize()
 
     # CUDA Cores FP32
     # run_benchmark(lib.sgemm_naive_f32, a, b, "f32(naive)", c)
@@ -149,5 +162,5 @@ for (M, N, K) in MNKs:
     run_benchmark(lib.sgemm_wmma_m16n16k8_mma4x2_warp2x4_stages_dsmem, a, b, "tf32(...+stage2+dsmem+swizzle)", c, stages=2, swizzle=True)
     
     run_benchmark(lib.sgemm_cublas_tf32, a, b, "tf32(cublas+tf32)", c)
-    torch.cuda.synchronize()
+    bench.synchronize()
     print("-" * 130)